@@ -23,58 +23,83 @@ import anuga.utilities.log as log
 from math import sqrt
 
 def _quantities2csv(quantities, point_quantities, centroids, point_i):
-    points_list = []
-    
+    """Compute the csv columns of one gauge for all its timesteps.
+
+    point_quantities is the list of arrays [stage, elevation, xmomentum,
+    ymomentum] at the gauge.
+
+    Return list of columns, one for each quantity.
+    """
+
+    stage, elevation, xmomentum, ymomentum = \
+        [num.asarray(q, num.float) for q in point_quantities]
+
+    columns = []
     for quantity in quantities:
         #core quantities that are exported from the interpolator     
         if quantity == 'stage':
-            points_list.append(point_quantities[0])
+            columns.append(stage)
             
         if quantity == 'elevation':
-            points_list.append(point_quantities[1])
+            columns.append(elevation)
             
         if quantity == 'xmomentum':
-            points_list.append(point_quantities[2])
+            columns.append(xmomentum)
             
         if quantity == 'ymomentum':
-            points_list.append(point_quantities[3])
+            columns.append(ymomentum)
 
         #derived quantities that are calculated from the core ones
         if quantity == 'depth':
-            points_list.append(point_quantities[0] 
-                               - point_quantities[1])
+            columns.append(stage - elevation)
 
         if quantity == 'momentum':
-            momentum = sqrt(point_quantities[2]**2 
-                            + point_quantities[3]**2)
-            points_list.append(momentum)
+            columns.append(num.sqrt(xmomentum**2 + ymomentum**2))
             
         if quantity == 'speed':
-            #if depth is less than 0.001 then speed = 0.0
-            if point_quantities[0] - point_quantities[1] < 0.001:
-                vel = 0.0
-            else:
-                if point_quantities[2] < 1.0e6:
-                    momentum = sqrt(point_quantities[2]**2
-                                    + point_quantities[3]**2)
-                    vel = momentum / (point_quantities[0] 
-                                      - point_quantities[1])
-                else:
-                    momentum = 0
-                    vel = 0
-                
-            points_list.append(vel)
+            #if depth is less than 0.001 or momentum is huge then speed = 0.0
+            depth = stage - elevation
+            wet = (depth >= 0.001) & (xmomentum < 1.0e6)
+
+            vel = num.zeros(len(depth), num.float)
+            vel[wet] = num.sqrt(xmomentum[wet]**2 + ymomentum[wet]**2) \
+                       / depth[wet]
+            columns.append(vel)
             
         if quantity == 'bearing':
-            points_list.append(calc_bearing(point_quantities[2],
-                                            point_quantities[3]))
+            columns.append(_calc_bearings(xmomentum, ymomentum))
+
         if quantity == 'xcentroid':
-            points_list.append(centroids[point_i][0])
+            columns.append(num.repeat(centroids[point_i][0], len(stage)))
 
         if quantity == 'ycentroid':
-            points_list.append(centroids[point_i][1])
+            columns.append(num.repeat(centroids[point_i][1], len(stage)))
+
+    return columns
+
+
+def _calc_bearings(uh, vh):
+    """Vectorised version of calc_bearing
+
+    Return bearings from North in degrees, NAN where uh and vh are both 0.
+    """
+
+    from anuga.utilities.numerical_tools import NAN
+
+    bearings = num.zeros(len(uh), num.float)
+    bearings[:] = NAN
+
+    moving = (uh != 0) | (vh != 0)
+    u = uh[moving]
+    v = vh[moving]
 
-    return points_list
+    # Angle from [0, -1] to [u, v] measured counter clockwise
+    theta = num.arccos(num.clip(-v/num.sqrt(u**2 + v**2), -1.0, 1.0))
+    theta = num.where(u < 0, 2*num.pi - theta, theta)
+
+    bearings[moving] = num.degrees(theta)
+
+    return bearings
     
     
 def sww2csv_gauges(sww_file,
@@ -135,7 +160,9 @@ def sww2csv_gauges(sww_file,
     from anuga.utilities.numerical_tools import ensure_numeric, mean, NAN
     import string
     from anuga.utilities.file_utils import get_all_swwfiles
-    from anuga.abstract_2d_finite_volumes.util import file_function    
+    from anuga.file.sww import get_timeseries_at_points_from_file
+    from anuga.file.swt import get_current_swt_filename, \
+                               get_timeseries_at_points_from_swt
 
     assert isinstance(gauge_file,str) or isinstance(gauge_file, unicode), 'Gauge filename must be a string or unicode'
     assert isinstance(out_name,str) or isinstance(out_name, unicode), 'Output filename prefix must be a string'
@@ -217,40 +244,63 @@ def sww2csv_gauges(sww_file,
     is_opened = [False]*len(points_array)
     for sww_file in sww_files:
         sww_file = join(dir_name, sww_file+'.sww')
-        callable_sww = file_function(sww_file,
-                                     quantities=core_quantities,
-                                     interpolation_points=points_array,
-                                     verbose=verbose,
-                                     use_cache=use_cache,
-                                     output_centroids = output_centroids)
+
+        if get_current_swt_filename(sww_file) is not None:
+            # Read only the gauge time series from the sidecar
+            if verbose: log.critical('Using time series sidecar of %s'
+                                     % sww_file)
+            time, starttime, values, centroids = \
+                get_timeseries_at_points_from_swt(sww_file,
+                                                  core_quantities,
+                                                  points_array,
+                                                  output_centroids=output_centroids,
+                                                  use_cache=use_cache,
+                                                  verbose=verbose)
+        else:
+            # Interpolate blocks of frames with one interpolation matrix
+            time, starttime, values, centroids = \
+                get_timeseries_at_points_from_file(sww_file,
+                                                   core_quantities,
+                                                   points_array,
+                                                   output_centroids=output_centroids,
+                                                   use_cache=use_cache,
+                                                   verbose=verbose)
 
         if quake_offset_time is None:
-            quake_offset_time = callable_sww.starttime
+            quake_offset_time = starttime
 
-        for point_i, point in enumerate(points_array):
-            for time in callable_sww.get_time():
-                # add domain starttime to relative time.
-                quake_time = time + quake_offset_time
-                point_quantities = callable_sww(time, point_i) # __call__ is overridden
-
-
-                if point_quantities[0] != NAN:
-                    if is_opened[point_i] == False:
-                        points_writer = writer(file(dir_name + sep + gauge_file
-                                                    + point_name[point_i] + '.csv', "wb"))
-                        points_writer.writerow(heading)
-                        is_opened[point_i] = True
-                    else:
-                        points_writer = writer(file(dir_name + sep + gauge_file
-                                                    + point_name[point_i] + '.csv', "ab"))
+        # add domain starttime to relative time.
+        quake_time = num.asarray(time, num.float) + quake_offset_time
 
+        for point_i, point in enumerate(points_array):
+            point_quantities = [values[name][point_i, :]
+                                for name in core_quantities]
+
+            on_mesh = point_quantities[0] != NAN
+            if not num.alltrue(on_mesh) and verbose:
+                msg = 'gauge' + point_name[point_i] + 'falls off the mesh in file ' + sww_file + '.'
+                log.warning(msg)
+
+            if not num.sometrue(on_mesh):
+                continue
+
+            point_quantities = [q[on_mesh] for q in point_quantities]
+            columns = [quake_time[on_mesh], quake_time[on_mesh]/3600.] + \
+                      _quantities2csv(quantities, point_quantities,
+                                      centroids, point_i)
+
+            filename = dir_name + sep + gauge_file + point_name[point_i] + '.csv'
+            if is_opened[point_i] == False:
+                fid = file(filename, "wb")
+                points_writer = writer(fid)
+                points_writer.writerow(heading)
+                is_opened[point_i] = True
+            else:
+                fid = file(filename, "ab")
+                points_writer = writer(fid)
 
-                    points_list = [quake_time, quake_time/3600.] +  _quantities2csv(quantities, point_quantities, callable_sww.centroids, point_i)
-                    points_writer.writerow(points_list)
-                else:
-                    if verbose:
-                        msg = 'gauge' + point_name[point_i] + 'falls off the mesh in file ' + sww_file + '.'
-                        log.warning(msg)
+            points_writer.writerows(num.transpose(num.array(columns)).tolist())
+            fid.close()
 
 def sww2timeseries(swwfiles,
                    gauge_filename,
@@ -57,6 +57,14 @@ class General_mesh:
 
     """
 
+    # Structures derived from nodes and triangles which are stored in the
+    # mesh cache (see mesh_cache.py)
+    mesh_cache_names = ['xy_extent', 'normals', 'areas', 'edgelengths',
+                        'centroid_coordinates', 'radii',
+                        'vertex_coordinates', 'edge_midpoint_coordinates',
+                        'node_index', 'number_of_triangles_per_node',
+                        'vertex_value_indices']
+
     # FIXME: It would be a good idea to use geospatial data as an alternative
     #        input
     def __init__(self,
@@ -64,7 +72,8 @@ class General_mesh:
                  triangles,
                  geo_reference=None,
                  use_inscribed_circle=False,
-                 verbose=False):
+                 verbose=False,
+                 mesh_cache_dir=None):
         """Build triangular 2d mesh from nodes and triangle information
 
         Input:
@@ -79,7 +88,9 @@ class General_mesh:
           georeference (optional): If specified coordinates are
           assumed to be relative to this origin.
 
-
+          mesh_cache_dir (optional): Directory where the structures
+          derived from the mesh are stored, so that they are loaded
+          rather than computed the next time the same mesh is built.
         """
 
         if verbose: log.critical('General_mesh: Building basic mesh structure')
@@ -118,6 +129,13 @@ class General_mesh:
         msg = 'Vertex indices reference non-existing coordinate sets'
         assert num.max(self.triangles) < self.nodes.shape[0], msg
 
+        # Use structures stored by a previous build of the same mesh
+        self.loaded_from_mesh_cache = False
+        if mesh_cache_dir is not None:
+            self.load_from_mesh_cache(mesh_cache_dir, verbose)
+            if self.loaded_from_mesh_cache:
+                return
+
         # FIXME: Maybe move to statistics?
         # Or use with get_extent
         xy_extent = [min(self.nodes[:,0]), min(self.nodes[:,1]),
@@ -373,6 +391,10 @@ class General_mesh:
         self.build_inverted_triangle_structure()
         
         if verbose: log.timingInfo("aoi, '%s'" % self.get_area())
+
+        # Subclasses store their structures once they are complete
+        if mesh_cache_dir is not None and self.__class__ is General_mesh:
+            self.save_to_mesh_cache(verbose)
         
 
     def __len__(self):
@@ -382,6 +404,65 @@ class General_mesh:
         return ('Mesh: %d vertices, %d triangles'
                 % (self.nodes.shape[0], len(self)))
 
+    def get_mesh_hash(self):
+        """Return hash of the input determining the mesh structures.
+        """
+
+        from mesh_cache import get_mesh_hash
+
+        return get_mesh_hash(self.__class__.__name__, self.nodes,
+                             self.triangles, self.use_inscribed_circle)
+
+    def get_mesh_cache_structures(self):
+        """Return dictionary of arrays to be stored in the mesh cache.
+        """
+
+        structures = {}
+        for name in self.mesh_cache_names:
+            structures[name] = getattr(self, name)
+
+        return structures
+
+    def set_mesh_cache_structures(self, structures):
+        """Set mesh structures from dictionary of arrays loaded from the
+        mesh cache.
+        """
+
+        for name in self.mesh_cache_names:
+            setattr(self, name, structures[name])
+
+    def load_from_mesh_cache(self, mesh_cache_dir, verbose=False):
+        """Load mesh structures from mesh_cache_dir if they are stored
+        there. Sets self.loaded_from_mesh_cache accordingly and
+        self.mesh_cache_filename to the file used by save_to_mesh_cache.
+        """
+
+        from mesh_cache import get_mesh_cache_filename, load_mesh_structures
+
+        self.mesh_cache_filename = \
+                 get_mesh_cache_filename(mesh_cache_dir, self.get_mesh_hash())
+        structures = load_mesh_structures(self.mesh_cache_filename, verbose)
+
+        if structures is not None:
+            try:
+                self.set_mesh_cache_structures(structures)
+            except KeyError:
+                return  # Incomplete file, rebuild and store again
+
+            self.loaded_from_mesh_cache = True
+
+    def save_to_mesh_cache(self, verbose=False):
+        """Store mesh structures in the mesh cache.
+
+        Precondition: load_from_mesh_cache has been called
+        """
+
+        from mesh_cache import save_mesh_structures
+
+        save_mesh_structures(self.mesh_cache_filename,
+                             self.get_mesh_cache_structures(),
+                             verbose)
+
     def get_normals(self):
         """Return all normal vectors.
 
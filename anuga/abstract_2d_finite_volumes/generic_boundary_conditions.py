@@ -33,6 +33,52 @@ class Boundary:
         raise Exception(msg)
 
 
+    def get_state(self):
+        """Return dictionary of the values (numbers or arrays) the boundary
+        changes while evolving. Used for checkpointing.
+
+        This is whether the default boundary has been invoked and the
+        state of the boundary function (self.function or self.F, e.g. the
+        time cursor of an Interpolation_function reading a time series
+        from file), stored under keys prefixed with 'function_' or 'F_'.
+        Boundaries whose values only depend on the model time (and the
+        domain) have no other state.
+        """
+
+        state = {}
+
+        if hasattr(self, 'default_boundary_invoked'):
+            state['default_boundary_invoked'] = self.default_boundary_invoked
+
+        for name in ['function', 'F']:
+            function = getattr(self, name, None)
+            if hasattr(function, 'get_state'):
+                for key, value in function.get_state().items():
+                    state[name + '_' + key] = value
+
+        return state
+
+
+    def set_state(self, state):
+        """Restore state as returned by get_state
+        """
+
+        function_states = {}
+        for key, value in state.items():
+            for name in ['function', 'F']:
+                function = getattr(self, name, None)
+                if key.startswith(name + '_') and \
+                       hasattr(function, 'set_state'):
+                    function_states.setdefault(name, {})\
+                                   [key[len(name)+1:]] = value
+                    break
+            else:
+                setattr(self, key, value)
+
+        for name, function_state in function_states.items():
+            getattr(self, name).set_state(function_state)
+
+
     def evaluate_segment(self, domain=None, segment_edges=None):
         """
         Evaluate boundary condition at edges of a domain in a list
@@ -53,7 +53,8 @@ class Generic_Domain:
                        numproc=1,
                        number_of_full_nodes=None,
                        number_of_full_triangles=None,
-                       ghost_layer_width=2):
+                       ghost_layer_width=2,
+                       mesh_cache_dir=None):
 
         """Instantiate generic computational Domain.
 
@@ -71,6 +72,9 @@ class Generic_Domain:
 
           tagged_elements:
           ...
+          mesh_cache_dir: Directory where structures derived from the mesh
+                          are stored for reuse by later runs using the
+                          same mesh (see mesh_cache.py)
         """
         
         if verbose: log.critical('Domain: Initialising')
@@ -104,7 +108,8 @@ class Generic_Domain:
                          use_inscribed_circle=use_inscribed_circle,
                          #number_of_full_nodes=number_of_full_nodes,
                          #number_of_full_triangles=number_of_full_triangles,
-                         verbose=verbose)
+                         verbose=verbose,
+                         mesh_cache_dir=mesh_cache_dir)
        
         if verbose: log.critical('Domain: Expose mesh attributes')
 
@@ -0,0 +1,89 @@
+"""Store structures derived from a mesh for reuse by later runs.
+
+Building a Mesh computes areas, normals, edge lengths, radii, the inverted
+triangle structure, the neighbour structure and the boundary and tagged
+element dictionaries. For large meshes this takes minutes and is repeated
+every time the same mesh is used, e.g. for many scenarios.
+
+If a mesh cache directory is given to General_mesh, Mesh or Domain (keyword
+mesh_cache_dir) these structures are stored there in an uncompressed .npz
+file named after a hash of the nodes, triangles, boundary tags and tagged
+elements. Building a mesh from the same input again loads the structures
+from that file instead of computing them.
+"""
+
+import os
+
+import numpy as num
+
+import anuga.utilities.log as log
+
+
+# Change when the stored structures or the way they are computed change,
+# so that files written by older versions are not used
+mesh_cache_version = 1
+
+
+def get_mesh_hash(*inputs):
+    """Return hash (hex string) of the inputs determining a mesh.
+
+    Inputs can be numeric arrays (or sequences convertible to them),
+    dictionaries of such inputs, strings, numbers or None.
+    """
+
+    import hashlib
+    from anuga.caching.caching import hash_array
+
+    hasher = hashlib.md5(str(mesh_cache_version))
+
+    def update(x):
+        if x is None:
+            hasher.update('None')
+        elif isinstance(x, dict):
+            hasher.update('dict%d' % len(x))
+            for key in sorted(x.keys()):
+                update(key)
+                update(x[key])
+        elif isinstance(x, (basestring, int, long, float, bool)):
+            hasher.update(repr(x))
+        else:
+            hasher.update('%x' % hash_array(num.asarray(x)))
+
+    for x in inputs:
+        update(x)
+
+    return hasher.hexdigest()
+
+
+def get_mesh_cache_filename(mesh_cache_dir, mesh_hash):
+    """Return name of the file holding the structures of mesh_hash.
+    """
+
+    return os.path.join(mesh_cache_dir, 'mesh_%s.npz' % mesh_hash)
+
+
+def load_mesh_structures(filename, verbose=False):
+    """Load structures stored by save_mesh_structures.
+
+    Return dictionary of arrays or None if filename does not exist or
+    can't be read.
+    """
+
+    from anuga.caching.caching import load_arrays
+
+    if verbose and os.path.exists(filename):
+        log.critical('Mesh cache: Loading %s' % filename)
+
+    return load_arrays(filename, verbose)
+
+
+def save_mesh_structures(filename, structures, verbose=False):
+    """Save dictionary of arrays structures to filename (see
+    anuga.caching.caching.save_arrays).
+    """
+
+    from anuga.caching.caching import save_arrays
+
+    if verbose: log.critical('Mesh cache: Saving %s' % filename)
+
+    save_arrays(structures, filename, verbose)
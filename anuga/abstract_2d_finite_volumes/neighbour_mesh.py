@@ -72,21 +72,32 @@ class Mesh(General_mesh):
                  tagged_elements=None,
                  geo_reference=None,
                  use_inscribed_circle=False,
-                 verbose=False):
+                 verbose=False,
+                 mesh_cache_dir=None):
         """
         Build Mesh
 
             Input x,y coordinates (sequence of 2-tuples or Mx2 numeric array of floats)
             triangles (sequence of 3-tuples or Nx3 numeric array of non-negative integers).
-        """
-
 
+            If mesh_cache_dir is given the structures derived from the mesh
+            are stored there and loaded when the same mesh is built again
+            (see mesh_cache.py).
+        """
 
+        # Input identifying the mesh in the mesh cache (see get_mesh_hash)
+        self.boundary = boundary
+        self.tagged_elements = tagged_elements
 
         General_mesh.__init__(self, coordinates, triangles,
                               geo_reference=geo_reference,
                               use_inscribed_circle=use_inscribed_circle,
-                              verbose=verbose)
+                              verbose=verbose,
+                              mesh_cache_dir=mesh_cache_dir)
+
+        if self.loaded_from_mesh_cache:
+            if verbose: log.critical('Mesh: Done')
+            return
 
         if verbose: log.critical('Mesh: Initialising')
 
@@ -190,6 +201,9 @@ class Mesh(General_mesh):
 
 
 
+        if mesh_cache_dir is not None:
+            self.save_to_mesh_cache(verbose)
+
         #FIXME check integrity?
         if verbose: log.critical('Mesh: Done')
         if verbose: log.timingInfo("finishMesh, '%s'" % log.CurrentDateTime())
@@ -199,6 +213,86 @@ class Mesh(General_mesh):
         return General_mesh.__repr__(self) + ', %d boundary segments'\
                %(len(self.boundary))
 
+    def get_mesh_hash(self):
+        """Return hash of the input determining the mesh structures.
+
+        Precondition: self.boundary and self.tagged_elements are the
+        input boundary and tagged_elements
+        """
+
+        from mesh_cache import get_mesh_hash
+
+        if self.boundary is None:
+            segments = []
+        else:
+            segments = sorted(self.boundary.keys())
+
+        return get_mesh_hash(General_mesh.get_mesh_hash(self),
+                             num.array(segments, num.int).reshape(-1, 2),
+                             repr([self.boundary[s] for s in segments]),
+                             self.tagged_elements)
+
+    def get_mesh_cache_structures(self):
+        """Return dictionary of arrays to be stored in the mesh cache.
+
+        The boundary dictionary is stored as the tags of boundary_cells and
+        boundary_edges and tagged elements as a list of tags and arrays.
+        """
+
+        structures = General_mesh.get_mesh_cache_structures(self)
+
+        for name in ['neighbours', 'neighbour_edges', 'number_of_boundaries',
+                     'surrogate_neighbours', 'boundary_cells',
+                     'boundary_edges']:
+            structures[name] = getattr(self, name)
+
+        structures['boundary_tags'] = \
+             num.array([self.boundary[id, edge] for id, edge
+                        in zip(self.boundary_cells, self.boundary_edges)],
+                       num.object).astype(str)
+
+        tags = self.tagged_elements.keys()
+        structures['element_tags'] = num.array(tags, num.object).astype(str)
+        for i, tag in enumerate(tags):
+            structures['tagged_elements_%d' % i] = self.tagged_elements[tag]
+
+        return structures
+
+    def set_mesh_cache_structures(self, structures):
+        """Set mesh structures from dictionary of arrays loaded from the
+        mesh cache.
+        """
+
+        General_mesh.set_mesh_cache_structures(self, structures)
+
+        for name in ['neighbours', 'neighbour_edges', 'number_of_boundaries',
+                     'surrogate_neighbours', 'boundary_cells',
+                     'boundary_edges']:
+            setattr(self, name, structures[name])
+
+        # Boundary dictionaries as built by build_boundary_dictionary and
+        # build_boundary_neighbours
+        cells = self.boundary_cells.tolist()
+        edges = self.boundary_edges.tolist()
+        tags = [str(tag) for tag in structures['boundary_tags']]
+
+        self.boundary = dict(zip(zip(cells, edges), tags))
+        self.boundary_length = len(self.boundary)
+        self.boundary_enumeration = dict(zip(zip(cells, edges),
+                                             range(len(cells))))
+
+        self.tag_boundary_cells = {}
+        for j, tag in enumerate(tags):
+            self.tag_boundary_cells.setdefault(tag, []).append(j)
+
+        self.tagged_elements = {}
+        for i, tag in enumerate(structures['element_tags']):
+            self.tagged_elements[str(tag)] = \
+                 structures['tagged_elements_%d' % i]
+
+        self.lone_vertices = \
+             num.where(self.number_of_triangles_per_node == 0)[0].tolist()
+
 
     def set_to_inscribed_circle(self,safety_factor = 1):
         #FIXME phase out eventually
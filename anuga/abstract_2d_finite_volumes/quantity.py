@@ -737,7 +737,7 @@ class Quantity:
           
 
         filename:
-          Name of a points file or dem file (.asc or .grd or .dem) containing data points and attributes for
+          Name of a points file or dem file (.asc or .grd or .dem or .flt) containing data points and attributes for
           use with fit_interpolate.fit.
           
         raster:
@@ -918,12 +918,12 @@ class Quantity:
                                       indices, verbose=verbose,
                                       max_read_lines=max_read_lines,
                                       use_cache=use_cache)
-            # dem file in the format of .asc, .grd or .dem 
-            elif filename_ext in ['.asc', '.grd', '.dem']:
+            # dem file in the format of .asc, .grd, .dem or .flt
+            elif filename_ext in ['.asc', '.grd', '.dem', '.flt']:
                 self.set_values_from_utm_grid_file(filename, location,
                       indices, verbose=verbose)
             else:
-                raise Exception('Extension should be .pts .dem, .csv, .txt, .asc or .grd')
+                raise Exception('Extension should be .pts .dem, .csv, .txt, .asc, .grd or .flt')
 
         elif raster is not None:
             self.set_values_from_utm_raster(raster, 
@@ -1326,20 +1326,14 @@ class Quantity:
         Xshift        0.0000000000
         Yshift        10000000.0000000000
         Parameters
+
+        Files .asc, .dem and .flt are sampled in windows covering the
+        domain (see anuga.fit_interpolate.raster_sampling), so large
+        rasters are not loaded into memory.
         """
         
-        
-        
-        from anuga.file_conversion.grd2array import grd2array
-        from anuga.file_conversion.dem2array import dem2array
-        
         filename_ext = os.path.splitext(filename)[1]
         
-        if filename_ext in ['.asc', '.grd']:
-            x,y,Z = grd2array(filename)
-        elif filename_ext == '.dem':
-            x,y,Z = dem2array(filename)
-        
         if location == 'centroids':
             points = self.domain.centroid_coordinates
         
@@ -1350,10 +1344,18 @@ class Quantity:
         
         points = ensure_absolute(points, geo_reference=self.domain.geo_reference)        
         
-        from  anuga.fit_interpolate.interpolate2d import interpolate2d 
-        
-        #print points 
-        values = interpolate2d(x, y, Z, points, mode='linear', bounds_error=False)
+        if filename_ext == '.grd':
+            from anuga.file_conversion.grd2array import grd2array
+            from anuga.fit_interpolate.interpolate2d import interpolate2d
+
+            x,y,Z = grd2array(filename)
+            values = interpolate2d(x, y, Z, points, mode='linear', bounds_error=False)
+        else:
+            # Read in windows rather than loading the whole raster
+            from anuga.fit_interpolate.raster_sampling import sample_raster
+
+            values = sample_raster(filename, points, mode='linear',
+                                   verbose=verbose)
         
         #print values
 
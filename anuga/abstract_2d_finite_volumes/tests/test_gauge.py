@@ -550,6 +550,30 @@ point2, 0.5, 2.0\n")
         os.remove(basename+".sww")
         #os.remove(basename+str(time.time())+".sww")
 
+
+    def test_calc_bearings(self):
+        """Check that the vectorised bearings used by sww2csv_gauges
+        agree with calc_bearing
+        """
+
+        from anuga.abstract_2d_finite_volumes.gauge import _calc_bearings
+        from anuga.abstract_2d_finite_volumes.util import calc_bearing
+        from anuga.utilities.numerical_tools import NAN
+
+        self.sww = None
+
+        uh = num.array([3.0, -3.0, 0.0, 0.0, 1.0, -1.0, 0.0, 2.5, -0.1])
+        vh = num.array([4.0, 4.0, 1.0, -1.0, 0.0, 0.0, 0.0, -7.0, -0.2])
+
+        bearings = _calc_bearings(uh, vh)
+
+        for i in range(len(uh)):
+            reference = calc_bearing(uh[i], vh[i])
+            if reference == NAN:
+                assert bearings[i] == NAN
+            else:
+                assert num.allclose(bearings[i], reference)
+
 #-------------------------------------------------------------
 
 if __name__ == "__main__":
@@ -507,6 +507,44 @@ class Test_General_Mesh(unittest.TestCase):
         self.assertRaises(AssertionError, General_mesh,
                               nodes, triangles, geo_reference=geo)
 
+    def test_mesh_cache(self):
+        """General_mesh structures are loaded from the mesh cache
+        """
+
+        import os, tempfile, shutil
+
+        points, vertices, boundary = rectangular(4, 3)
+        ref = General_mesh(points, vertices)
+
+        mesh_cache_dir = tempfile.mkdtemp()
+        try:
+            for loaded in [False, True]:
+                mesh = General_mesh(points, vertices,
+                                    mesh_cache_dir=mesh_cache_dir)
+                assert mesh.loaded_from_mesh_cache == loaded
+
+                for name in mesh.mesh_cache_names:
+                    assert num.all(getattr(mesh, name) == getattr(ref, name))
+
+            # Moving a node makes a different mesh
+            points[0] = [0.01, 0.0]
+            mesh = General_mesh(points, vertices,
+                                mesh_cache_dir=mesh_cache_dir)
+            assert not mesh.loaded_from_mesh_cache
+            assert not num.allclose(mesh.areas, ref.areas)
+
+            # Unreadable files are rebuilt
+            for filename in os.listdir(mesh_cache_dir):
+                open(os.path.join(mesh_cache_dir, filename), 'w').write('x')
+            mesh = General_mesh(points, vertices,
+                                mesh_cache_dir=mesh_cache_dir)
+            assert not mesh.loaded_from_mesh_cache
+            mesh = General_mesh(points, vertices,
+                                mesh_cache_dir=mesh_cache_dir)
+            assert mesh.loaded_from_mesh_cache
+        finally:
+            shutil.rmtree(mesh_cache_dir)
+
 ################################################################################
 
 if __name__ == "__main__":
@@ -1845,6 +1845,69 @@ class Test_Mesh(unittest.TestCase):
             #print ref_length, total_length
             assert num.allclose(total_length, ref_length)
 
+    def test_mesh_cache(self):
+        """Mesh structures loaded from the mesh cache equal computed ones
+        """
+
+        import os, tempfile, shutil
+
+        points, vertices, boundary = rectangular(6, 4, len1=6.0, len2=4.0)
+        boundary[(0, 0)] = 'internal'  # Tag an internal edge
+        del boundary[boundary.keys()[3]]  # Default tag
+        tagged_elements = {'first': [0, 1, 2], 'second': [5]}
+        points = num.concatenate((points, [[20.0, 20.0]]))  # Lone vertex
+
+        ref = Mesh(points, vertices, boundary,
+                   tagged_elements=dict(tagged_elements))
+
+        mesh_cache_dir = tempfile.mkdtemp()
+        try:
+            mesh = Mesh(points, vertices, boundary,
+                        tagged_elements=dict(tagged_elements),
+                        mesh_cache_dir=mesh_cache_dir)
+            assert not mesh.loaded_from_mesh_cache
+            assert len(os.listdir(mesh_cache_dir)) == 1
+
+            mesh = Mesh(points, vertices, boundary,
+                        tagged_elements=dict(tagged_elements),
+                        mesh_cache_dir=mesh_cache_dir)
+            assert mesh.loaded_from_mesh_cache
+
+            for name in mesh.mesh_cache_names + \
+                    ['neighbours', 'neighbour_edges', 'number_of_boundaries',
+                     'surrogate_neighbours', 'boundary_cells',
+                     'boundary_edges']:
+                assert num.all(getattr(mesh, name) == getattr(ref, name)), name
+
+            assert mesh.boundary == ref.boundary
+            assert mesh.boundary_length == ref.boundary_length
+            assert mesh.boundary_enumeration == ref.boundary_enumeration
+            assert mesh.tag_boundary_cells == ref.tag_boundary_cells
+            assert mesh.lone_vertices == ref.lone_vertices == [35]
+            assert sorted(mesh.tagged_elements.keys()) == ['first', 'second']
+            for tag in ref.tagged_elements:
+                assert num.all(mesh.tagged_elements[tag] ==
+                               ref.tagged_elements[tag])
+
+            # Different boundary tags make a different mesh
+            boundary[(0, 0)] = 'other'
+            mesh = Mesh(points, vertices, boundary,
+                        tagged_elements=dict(tagged_elements),
+                        mesh_cache_dir=mesh_cache_dir)
+            assert not mesh.loaded_from_mesh_cache
+            assert mesh.boundary[(0, 0)] == 'other'
+            assert len(os.listdir(mesh_cache_dir)) == 2
+
+            # Domains use the mesh cache too
+            from anuga.shallow_water.shallow_water_domain import Domain
+            for i in range(2):
+                domain = Domain(points, vertices, boundary,
+                                mesh_cache_dir=mesh_cache_dir)
+                assert domain.mesh.loaded_from_mesh_cache == (i == 1)
+            assert num.allclose(domain.areas, ref.areas)
+        finally:
+            shutil.rmtree(mesh_cache_dir)
+
 
 #-------------------------------------------------------------
 
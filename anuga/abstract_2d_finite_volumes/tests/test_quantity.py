@@ -1679,6 +1679,8 @@ class Test_Quantity(unittest.TestCase):
             os.remove(txt_file)
             os.remove(txt_file_prj)
             os.remove(txt_file_dem)
+            os.remove('test_asc.flt')
+            os.remove('test_asc.hdr')
         except:
             pass
 
@@ -31,6 +31,10 @@ Public functions:
 
 cache(my_F,args) -- Cache values returned from callable object my_F given args.
 cachestat() --      Reports statistics about cache hits and time saved.
+get_cache_stats() -- Returns hit, miss and timing counters as a dictionary.
+evict() --          Removes least recently used results beyond size and age
+                    limits.
+clear_memory_cache() -- Removes results kept in memory (see option memorysize).
 test() --       Conducts a basic test of the caching functionality.
 
 See doc strings of individual functions for detailed documentation.
@@ -42,6 +46,7 @@ See doc strings of individual functions for detailed documentation.
 # Determine platform
 #
 from os import getenv
+from collections import OrderedDict
 import types
 import time
 
@@ -55,6 +60,11 @@ import anuga.utilities.log as log
 
 import numpy as num
 
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # No file locking (e.g. under Windows)
+
 #from future
 
 cache_dir = '.python_cache'
@@ -93,9 +103,19 @@ options = {
   'verbose': True,       # Write messages to standard output
   'bin': True,           # Use binary format (more efficient)
   'compression': True,   # Use zlib compression
+  'npz': True,           # Store numpy array results as uncompressed .npz
+                         # files, which load fast and can be memory mapped
   'bytecode': True,      # Recompute if bytecode has changed
-  'expire': False        # Automatically remove files that have been accessed
+  'expire': False,       # Automatically remove files that have been accessed
                          # least recently
+  'lock': True,          # Let one process compute a missing result while
+                         # other processes calling for it wait
+  'maxsize': None,       # Maximum total size of cached files in bytes.
+                         # Least recently used results are evicted beyond it.
+  'maxage': None,        # Maximum time in seconds since a cached result was
+                         # last used. Older results are evicted.
+  'memorysize': None     # Maximum total size in bytes of results also kept
+                         # in memory for repeated calls (None: disk only)
 }
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -133,12 +153,13 @@ def cache(my_F,
           evaluate=False, 
           test=False, 
           clear=False,
-          return_filename=False):
+          return_filename=False,
+          mmap=False):
   """Supervised caching of function results. Also known as memoization.
 
   USAGE:
     result = cache(my_F, args, kwargs, dependencies, cachedir, verbose,
-                   compression, evaluate, test, return_filename)
+                   compression, evaluate, test, return_filename, mmap)
 
   ARGUMENTS:
     my_F --            Callable object (Required)
@@ -153,6 +174,8 @@ def cache(my_F,
     test --            Flag test for cached results (Default: False)
     clear --           Flag delete cached results (Default: False)    
     return_filename -- Flag return of cache filename (Default: False)    
+    mmap --            Flag return of read-only memory mapped arrays for
+                       array results (Default: False)
 
   DESCRIPTION:
     A Python function call of the form
@@ -251,6 +274,47 @@ def cache(my_F,
     returns the hashed base filename under which this function and its
     arguments would be cached
 
+  Array results:
+    Results which are numpy arrays, or tuples, lists or dictionaries (with
+    string keys) of numpy arrays, are stored as uncompressed .npz files
+    rather than pickled (unless set_option('npz', False) is used). They load
+    without unpickling or decompression and the call
+      cache(my_F,(arg1,...,argn), mmap=True)
+    returns read-only arrays memory mapped from the cached file, so only the
+    parts of the arrays actually used are read from disk.
+
+  Concurrent use:
+    Many processes (e.g. the MPI ranks of a parallel run) may share a caching
+    directory. When a result is missing, the first process to ask for it
+    takes a lock on it (a file .FN.lock in the caching directory) and
+    computes it while the other processes wait and then read the stored
+    result instead of computing it as well. Files are written to a temporary
+    file and renamed, so no process ever reads a partially written file.
+    Locking requires fcntl (i.e. unix) and can be turned off with
+    set_option('lock', False).
+
+  Size and age limits:
+    The calls
+      set_option('maxsize', <bytes>)
+      set_option('maxage', <seconds>)
+    make cache evict the least recently used results whenever a new result
+    is stored, keeping the caching directory below maxsize bytes and removing
+    results not used for more than maxage seconds. Use evict() to apply the
+    limits explicitly and get_cache_stats() to obtain hit, miss and timing
+    counters.
+
+  Memory tier:
+    The call
+      set_option('memorysize', <bytes>)
+    makes cache keep the most recently used results in memory as well, up to
+    a total of memorysize bytes, so that repeated calls within one process
+    are answered without reading the caching directory. Results are shared
+    between calls: arrays are returned read-only and other objects must not
+    be modified by the caller. Arrays returned by my_F itself are copied, so
+    the arrays the caller gets from evaluating my_F stay as they are. Memory
+    hits are not recorded in the stats files. clear_memory_cache() empties
+    the memory tier.
+
   Clearing cached results:
     The call
       cache(my_F,'clear')
@@ -294,6 +358,7 @@ def cache(my_F,
   if isinstance(args, basestring):
     if string.lower(args) == 'clear':
       clear_cache(CD,my_F,verbose=verbose)
+      clear_memory_cache()
       return
 
   # Force singleton arg into a tuple
@@ -322,10 +387,14 @@ def cache(my_F,
   if return_filename:
     return(FN)
 
+  # Results kept in memory are identified by caching directory and filename
+  memory_key = CD+FN
+
   if clear:
+    forget_result(memory_key)
     for file_type in file_types:
       file_name = CD+FN+'_'+file_type
-      for fn in [file_name, file_name + '.z']:
+      for fn in [file_name, file_name + '.z', file_name + array_extension]:
         if os.access(fn, os.F_OK):              
           if unix:
             os.remove(fn)
@@ -341,6 +410,17 @@ def cache(my_F,
 
   #-------------------------------------------------------------------        
   
+  # Check if previous computation is kept in memory
+  if options['memorysize'] and evaluate is not True:
+    found, T = recall_result(memory_key, args, kwargs, deps, my_F)
+    if found:
+      return T
+
+  if options['memorysize']:
+    # Arguments of a result kept in memory, taken before my_F can change them
+    import copy
+    memory_args = copy.deepcopy((args, kwargs))
+
   # Check if previous computation has been cached
   if evaluate is True:
     Retrieved = None  # Force evaluation of my_F regardless of caching status.
@@ -352,45 +432,83 @@ def cache(my_F,
                     deps, 
                     verbose, 
                     compression,
-                    dependencies)
+                    dependencies,
+                    mmap)
 
-  if not Retrieved:
-    if test:  # Do not attempt to evaluate function
-      T = None
-    else:  # Evaluate function and save to cache
-      if verbose is True:
-        
-        msg1(funcname, args, kwargs,reason)
+  if not Retrieved and not test:
+    # Only one process computes the result, others wait for it
+    lock = acquire_lock(CD+'.'+FN+'.lock', verbose)
+    try:
+      if evaluate is not True:
+        # Result may have been stored by another process while we waited
+        T, FN, Retrieved, reason, comptime, loadtime, compressed = \
+            CacheLookup(CD, FN, my_F, 
+                        args, kwargs, 
+                        deps, 
+                        verbose, 
+                        compression,
+                        dependencies,
+                        mmap)
+
+      if not Retrieved:  # Evaluate function and save to cache
+        if verbose is True:
+          
+          msg1(funcname, args, kwargs,reason)
 
-      # Remove expired files automatically
-      if options['expire']:
-        DeleteOldFiles(CD,verbose)
-        
-      # Save args before function is evaluated in case
-      # they are modified by function
-      save_args_to_cache(CD,FN,args,kwargs,compression)
+        # Remove expired files automatically
+        if options['expire']:
+          DeleteOldFiles(CD,verbose)
+          
+        # Save args before function is evaluated in case
+        # they are modified by function
+        save_args_to_cache(CD,FN,args,kwargs,compression)
 
-      # Execute and time function with supplied arguments
-      t0 = time.time()
+        # Execute and time function with supplied arguments
+        t0 = time.time()
 
-      T = my_F(*args, **kwargs) # Built-in 'apply' deprecated in Py3K    
-      
-      #comptime = round(time.time()-t0)
-      comptime = time.time()-t0
+        T = my_F(*args, **kwargs) # Built-in 'apply' deprecated in Py3K    
+        
+        #comptime = round(time.time()-t0)
+        comptime = time.time()-t0
+
+        if verbose is True:
+          msg2(funcname,args,kwargs,comptime,reason)
+
+        # Save results and estimated loading time to cache
+        loadtime = save_results_to_cache(T, CD, FN, my_F, deps, comptime, \
+                                         funcname, dependencies, compression)
+        if verbose is True:
+          msg3(loadtime, CD, FN, deps, compression)
+        compressed = compression
+
+        # Return the stored arrays as they would be retrieved
+        if mmap and get_result_filename(CD, FN).endswith(array_extension):
+          T = load_array_result(get_result_filename(CD, FN), mmap)
+    finally:
+      release_lock(lock)
+
+    # Keep cache within its size and age limits
+    if not Retrieved and \
+           (options['maxsize'] is not None or options['maxage'] is not None):
+      evict(CD, keep=FN, verbose=verbose)
 
-      if verbose is True:
-        msg2(funcname,args,kwargs,comptime,reason)
+  if not Retrieved:
+    if test:  # Do not attempt to evaluate function
+      T = None
+  else:
+    # Record use of cached result for least recently used eviction
+    touch_cache_entry(CD, FN)
 
-      # Save results and estimated loading time to cache
-      loadtime = save_results_to_cache(T, CD, FN, my_F, deps, comptime, \
-                                       funcname, dependencies, compression)
-      if verbose is True:
-        msg3(loadtime, CD, FN, deps, compression)
-      compressed = compression
+  if options['memorysize'] and (Retrieved or not test):
+    remember_result(memory_key, T, memory_args, deps, my_F, CD, FN,
+                    Retrieved)
+    if Retrieved:
+      T = share_result(T)
 
   if options['savestat'] and (not test or Retrieved):
   ##if options['savestat']:
     addstatsline(CD,funcname,FN,Retrieved,reason,comptime,loadtime,compressed)
+    update_index(CD, funcname, Retrieved, comptime, loadtime)
   return(T)  # Return results in all cases
 
 # -----------------------------------------------------------------------------
@@ -758,9 +876,27 @@ def test(cachedir=None, verbose=False, compression=None):
 import cPickle  # 10 to 100 times faster than pickle
 pickler = cPickle 
 
+# Import hash function for the contents of numpy arrays
+# Use blake2b if available, then xxhash and md5 as a last resort
+# (collisions are detected by comparing the arguments anyway).
+#
+try:
+  from hashlib import blake2b as array_hasher
+except ImportError:
+  try:
+    from pyblake2 import blake2b as array_hasher
+  except ImportError:
+    try:
+      from xxhash import xxh64 as array_hasher
+    except ImportError:
+      from hashlib import md5 as array_hasher
+
 # Local immutable constants
 #
 comp_level = 1              # Compression level for zlib.
+hash_block_size = 2**22     # Number of bytes of an array hashed at a time.
+hash_list_size = 1000       # Lists and tuples of at least this length are
+                            # hashed as arrays if they only contain numbers.
                             # comp_level = 1 works well.
 textwidth1 = 16             # Text width of key fields in report forms.
 #textwidth2 = 132            # Maximal width of textual representation of
@@ -770,6 +906,10 @@ textwidth3 = 16             # Initial width of separation lines. Is modified.
 textwidth4 = 50             # Text width in logtestOK()
 statsfile  = '.cache_stat'  # Basefilename for cached statistics.
                             # It will reside in the chosen cache directory.
+indexfile  = '.cache_index' # Filename of counters read by get_cache_stats.
+                            # It will reside in the chosen cache directory.
+
+array_extension = '.npz'    # Extension of array results (see 'npz' option).
 
 file_types = ['Result',     # File name extension for cached function results.
               'Args',       # File name extension for stored function args.
@@ -786,13 +926,13 @@ Reason_msg = ['OK',         # Verbose reasons for recomputation
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 def CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression, 
-                dependencies):
+                dependencies, mmap=False):
   """Determine whether cached result exists and return info.
 
   USAGE:
     (T, FN, Retrieved, reason, comptime, loadtime, compressed) = \  
     CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression, \
-                dependencies)
+                dependencies, mmap)
 
   INPUT ARGUMENTS:
     CD --            Cache Directory
@@ -804,6 +944,7 @@ def CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression,
     verbose --       Flag text output
     compression --   Flag zlib compression
     dependencies --  Given list of dependencies
+    mmap --          Flag memory mapping of array results
     
   OUTPUT ARGUMENTS:
     T --             Cached result if present otherwise None
@@ -842,6 +983,11 @@ def CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression,
   (argsfile,compressed1) = myopen(CD+FN+'_'+file_types[1],"rb",compression)
   (admfile,compressed2) =  myopen(CD+FN+'_'+file_types[2],"rb",compression)
 
+  # Array results are never compressed
+  if not datafile and os.path.exists(CD+FN+'_'+file_types[0]+array_extension):
+    datafile = open(CD+FN+'_'+file_types[0]+array_extension, 'rb')
+    compressed0 = compressed1
+
   if verbose is True and deps is not None:
     log.critical('Caching: Dependencies are %s' % deps.keys())
 
@@ -900,7 +1046,8 @@ def CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression,
      (not options['bytecode'] or compare(bytecode, coderef)):
 
     # Arguments and dependencies match. Get cached results
-    T, loadtime, compressed, reason = load_from_cache(CD, FN, compressed)
+    T, loadtime, compressed, reason = load_from_cache(CD, FN, compressed,
+                                                      mmap)
     if reason > 0:
         # Recompute using same FN     
         return(None, FN, None, reason, None, None, None)
@@ -923,7 +1070,7 @@ def CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression,
     #
     (T, FN, Retrieved, reason, comptime, loadtime, compressed) = \
         CacheLookup(CD, FN+'x', my_F, args, kwargs, deps, 
-                    verbose, compression, dependencies)
+                    verbose, compression, dependencies, mmap)
 
     # The real reason is that args or bytecodes have changed.
     # Not that the recursive seach has found an unused filename
@@ -955,13 +1102,14 @@ def CacheLookup(CD, FN, my_F, args, kwargs, deps, verbose, compression,
   #    raise Exception(msg)
 
   import anuga.utilities.sparse_matrix_ext as sparse_matrix_ext
+  from anuga.utilities.sparse import Sparse_CSR
   import anuga.utilities.quad_tree_ext as quad_tree_ext
   from anuga.geometry.aabb import AABB
 
   if isinstance(T, FitInterpolate):
     if hasattr(T,"D"):
         T.D=sparse_matrix_ext.deserialise_dok(T.D)
-    if hasattr(T,"AtA"):
+    if hasattr(T,"AtA") and not isinstance(T.AtA, Sparse_CSR):
         T.AtA=sparse_matrix_ext.deserialise_dok(T.AtA)
     if hasattr(T,"root"):
         T.build_quad_tree(verbose=verbose)
@@ -1067,6 +1215,305 @@ def DeleteOldFiles(CD,verbose=None):
 
 # -----------------------------------------------------------------------------
 
+def get_cache_entries(CD):
+  """Get cached results in caching directory
+
+  USAGE:
+    entries = get_cache_entries(CD)
+
+  DESCRIPTION:
+    Return dictionary with an entry (size, last_used, filenames) for each
+    cached result FN, where size is the total number of bytes of its files
+    and last_used the most recent time it was stored or retrieved.
+  """
+
+  entries = {}
+  for file_name in os.listdir(CD):
+    if file_name.startswith('.'):
+      continue  # Statistics
+
+    base_name = file_name
+    for extension in ['.z', array_extension]:
+      if base_name.endswith(extension):
+        base_name = base_name[:-len(extension)]
+
+    FN, file_type = base_name.rpartition('_')[::2]
+    if file_type not in file_types:
+      continue
+
+    try:
+      stats = os.stat(CD+file_name)
+    except OSError:
+      continue  # Removed meanwhile
+
+    size, last_used, file_names = entries.get(FN, (0, 0.0, []))
+    entries[FN] = (size + stats.st_size,
+                   max(last_used, stats.st_mtime, stats.st_atime),
+                   file_names + [file_name])
+
+  return entries
+
+# -----------------------------------------------------------------------------
+
+def touch_cache_entry(CD, FN):
+  """Mark cached result FN as used now
+
+  USAGE:
+    touch_cache_entry(CD, FN)
+  """
+
+  for file_type in file_types:
+    for file_name in [CD+FN+'_'+file_type, CD+FN+'_'+file_type+'.z',
+                      CD+FN+'_'+file_type+array_extension]:
+      if os.path.exists(file_name):
+        try:
+          os.utime(file_name, None)
+        except OSError:
+          pass  # E.g. a shared cache owned by someone else
+
+# -----------------------------------------------------------------------------
+
+def evict(cachedir=None, maxsize=None, maxage=None, keep=None, verbose=None):
+  """Remove cached results beyond size and age limits
+
+  USAGE:
+    evict(cachedir, maxsize, maxage)
+
+  ARGUMENTS:
+    cachedir -- Directory for cache files (Default: options['cachedir'])
+    maxsize --  Maximum total size in bytes (Default: options['maxsize'])
+    maxage --   Maximum time in seconds since a result was last used
+                (Default: options['maxage'])
+    keep --     Name of cached result which must not be removed
+    verbose --  Flag verbose output (Default: options['verbose'])
+
+  DESCRIPTION:
+    Results that have not been used for more than maxage seconds are removed
+    first. Then the least recently used results are removed until the total
+    size is at most maxsize. A limit of None means no limit.
+
+    Return number of cached results removed.
+  """
+
+  import time
+
+  if not cachedir:
+    cachedir = options['cachedir']
+
+  if maxsize is None:
+    maxsize = options['maxsize']
+
+  if maxage is None:
+    maxage = options['maxage']
+
+  if verbose is None:
+    verbose = options['verbose']
+
+  CD = checkdir(cachedir, verbose)
+
+  entries = get_cache_entries(CD)
+
+  # Least recently used first
+  I = [(last_used, FN) for FN, (size, last_used, file_names) in entries.items()]
+  I.sort()
+
+  total_size = 0
+  for size, last_used, file_names in entries.values():
+    total_size += size
+
+  now = time.time()
+  evicted = 0
+  for last_used, FN in I:
+    if FN == keep:
+      continue
+
+    expired = maxage is not None and now - last_used > maxage
+    too_big = maxsize is not None and total_size > maxsize
+    if not (expired or too_big):
+      continue
+
+    size, last_used, file_names = entries[FN]
+    for file_name in file_names:
+      try:
+        os.remove(CD+file_name)
+      except OSError:
+        pass  # Removed meanwhile
+
+    total_size -= size
+    evicted += 1
+    if verbose:
+      log.critical('MESSAGE (caching): Evicted %s (%d bytes)' % (FN, size))
+
+  if evicted > 0 and options['savestat']:
+    update_index(CD, evicted=evicted)
+
+  return evicted
+
+# -----------------------------------------------------------------------------
+# Memory tier
+
+# Results kept in memory: key -> (T, size, deps, bytecode, (args, kwargs))
+# in order of use
+memory_cache = OrderedDict()
+memory_cache_size = 0
+
+def recall_result(key, args, kwargs, deps, my_F):
+  """Get result kept in memory
+
+  USAGE:
+    found, T = recall_result(key, args, kwargs, deps, my_F)
+
+  DESCRIPTION:
+    As for results in the caching directory the arguments are compared with
+    those of the result, as different arguments may have the same hash. The
+    result is only valid if dependencies and (if option bytecode is set)
+    the bytecode of my_F are unchanged. Return (False, None) if there is no
+    valid result in memory.
+  """
+
+  if key not in memory_cache:
+    return False, None
+
+  T, size, deps0, bytecode0, args0 = memory_cache[key]
+
+  if not compare(args0[0], args) or not compare(args0[1], kwargs):
+    return False, None  # Hash collision, the cache files sort it out
+
+  if not compare(deps, deps0) or \
+         (options['bytecode'] and not compare(get_bytecode(my_F), bytecode0)):
+    forget_result(key)
+    return False, None
+
+  # Mark as most recently used
+  del memory_cache[key]
+  memory_cache[key] = (T, size, deps0, bytecode0, args0)
+
+  return True, share_result(T)
+
+# -----------------------------------------------------------------------------
+
+def remember_result(key, T, args, deps, my_F, CD, FN, Retrieved):
+  """Keep result T of my_F for arguments args = (args, kwargs) in memory
+
+  USAGE:
+    remember_result(key, T, args, deps, my_F, CD, FN, Retrieved)
+
+  DESCRIPTION:
+    Array results are kept read-only and count with their number of bytes,
+    other results with the size of their cache file. Arrays just returned
+    by my_F are copied first, as they may belong to the caller. The least
+    recently used results are dropped to keep the total within option
+    memorysize.
+  """
+
+  global memory_cache_size
+
+  from anuga.fit_interpolate.general_fit_interpolate import FitInterpolate
+
+  forget_result(key)
+
+  if isinstance(T, FitInterpolate) and not Retrieved:
+    return  # Its C structures have been serialised by save_results_to_cache
+
+  if is_array_result(T):
+    if not Retrieved:
+      T = copy_array_result(T)
+
+    if type(T) == dict:
+      arrays = T.values()
+    elif type(T) in [tuple, list]:
+      arrays = T
+    else:
+      arrays = [T]
+
+    size = 0
+    for A in arrays:
+      A.flags.writeable = False
+      size += A.nbytes
+  else:
+    file_name = get_result_filename(CD, FN)
+    if file_name is None:
+      return
+    size = os.stat(file_name).st_size
+
+  if size > options['memorysize']:
+    return
+
+  if options['bytecode']:
+    bytecode = get_bytecode(my_F)
+  else:
+    bytecode = None
+
+  memory_cache[key] = (T, size, deps, bytecode, args)
+  memory_cache_size += size
+
+  while memory_cache_size > options['memorysize']:
+    forget_result(next(iter(memory_cache)))
+
+# -----------------------------------------------------------------------------
+
+def forget_result(key):
+  """Remove result from memory
+
+  USAGE:
+    forget_result(key)
+  """
+
+  global memory_cache_size
+
+  if key in memory_cache:
+    memory_cache_size -= memory_cache.pop(key)[1]
+
+# -----------------------------------------------------------------------------
+
+def clear_memory_cache():
+  """Remove all results kept in memory
+
+  USAGE:
+    clear_memory_cache()
+  """
+
+  global memory_cache_size
+
+  memory_cache.clear()
+  memory_cache_size = 0
+
+# -----------------------------------------------------------------------------
+
+def copy_array_result(T):
+  """Return copy of array result T
+
+  USAGE:
+    T = copy_array_result(T)
+  """
+
+  if type(T) == dict:
+    return dict([(key, num.array(T[key])) for key in T])
+  elif type(T) in [tuple, list]:
+    return type(T)([num.array(A) for A in T])
+  else:
+    return num.array(T)
+
+# -----------------------------------------------------------------------------
+
+def share_result(T):
+  """Return result kept in memory for use by caller
+
+  USAGE:
+    T = share_result(T)
+
+  DESCRIPTION:
+    Arrays are shared as they are read-only. Lists and dictionaries of arrays
+    are copied so that the caller can't change the result kept in memory.
+  """
+
+  if type(T) in [list, dict]:
+    return type(T)(T)
+
+  return T
+
+# -----------------------------------------------------------------------------
+
 def save_args_to_cache(CD, FN, args, kwargs, compression):
   """Save arguments to cache
 
@@ -1076,14 +1523,13 @@ def save_args_to_cache(CD, FN, args, kwargs, compression):
 
   import time, os, sys
 
-  (argsfile, compressed) = myopen(CD+FN+'_'+file_types[1], 'wb', compression)
-  if argsfile is None:
+  try:
+    # Save args and kwargs to cache
+    save_atomically((args,kwargs), CD+FN+'_'+file_types[1], compression)
+  except (IOError, OSError):
     msg = 'ERROR (caching): Could not open argsfile for writing: %s' %FN
     raise IOError(msg)
 
-  mysave((args,kwargs),argsfile,compression)  # Save args and kwargs to cache
-  argsfile.close()
-
   # Change access rights if possible
   #
   #if unix:
@@ -1117,12 +1563,13 @@ def save_results_to_cache(T, CD, FN, my_F, deps, comptime, funcname,
   
   import anuga.utilities.quad_tree_ext as quad_tree_ext
   import anuga.utilities.sparse_matrix_ext as sparse_matrix_ext
+  from anuga.utilities.sparse import Sparse_CSR
   from anuga.geometry.aabb import AABB
 
   if isinstance(T, FitInterpolate):
     if hasattr(T,"D"):
         T.D=sparse_matrix_ext.serialise_dok(T.D)
-    if hasattr(T,"AtA"):
+    if hasattr(T,"AtA") and not isinstance(T.AtA, Sparse_CSR):
         T.AtA=sparse_matrix_ext.serialise_dok(T.AtA)
     if hasattr(T,"root"):
         T.root.root=None
@@ -1130,31 +1577,31 @@ def save_results_to_cache(T, CD, FN, my_F, deps, comptime, funcname,
 
   #---------------------------------------------------------------------------
 
-  (datafile, compressed1) = myopen(CD+FN+'_'+file_types[0],'wb',compression)
-  (admfile, compressed2) = myopen(CD+FN+'_'+file_types[2],'wb',compression)
-
-  if not datafile:
-    if verbose:
-        log.critical('ERROR: Could not open %s' % datafile.name)
-    raise IOError
-
-  if not admfile:
-    if verbose:
-        log.critical('ERROR: Could not open %s' % admfile.name)
-    raise IOError
-
   t0 = time.time()
 
-  mysave(T,datafile,compression)  # Save data to cache
-  datafile.close()
+  if options['npz'] and is_array_result(T):
+    file_name = save_atomically(T, CD+FN+'_'+file_types[0]+array_extension,
+                                False, save_array_result)
+  else:
+    file_name = save_atomically(T, CD+FN+'_'+file_types[0], compression)
   #savetime = round(time.time()-t0,2)
   savetime = time.time()-t0  
 
+  # Remove result stored in the other format, if any
+  for fn in [CD+FN+'_'+file_types[0]+array_extension,
+             CD+FN+'_'+file_types[0]+'.z',
+             CD+FN+'_'+file_types[0]]:
+    if fn != file_name and os.path.exists(fn):
+      try:
+        os.remove(fn)
+      except OSError:
+        pass  # Removed by another process
+
   bytecode = get_bytecode(my_F)  # Get bytecode from function object
   admtup = (deps, comptime, bytecode, funcname)  # Gather admin info
 
-  mysave(admtup,admfile,compression)  # Save admin info to cache
-  admfile.close()
+  # Save admin info to cache
+  save_atomically(admtup, CD+FN+'_'+file_types[2], compression)
 
   # Change access rights if possible
   #
@@ -1171,15 +1618,28 @@ def save_results_to_cache(T, CD, FN, my_F, deps, comptime, funcname,
 
 # -----------------------------------------------------------------------------
 
-def load_from_cache(CD, FN, compression):
+def load_from_cache(CD, FN, compression, mmap=False):
   """Load previously cached data from file FN
 
   USAGE:
-    load_from_cache(CD,FN,compression)
+    load_from_cache(CD,FN,compression,mmap)
   """
 
   import time
 
+  file_name = CD+FN+'_'+file_types[0]+array_extension
+  if os.path.exists(file_name):
+    t0 = time.time()
+    try:
+      T = load_array_result(file_name, mmap)
+      reason = 0
+    except:
+      T = None
+      reason = 6  # Unreadable file
+    loadtime = time.time()-t0
+
+    return T, loadtime, compression, reason
+
   (datafile, compressed) = myopen(CD+FN+'_'+file_types[0],"rb",compression)
   t0 = time.time()
   T, reason = myload(datafile,compressed)
@@ -1191,6 +1651,369 @@ def load_from_cache(CD, FN, compression):
 
 # -----------------------------------------------------------------------------
 
+def get_result_filename(CD, FN):
+  """Return name of the file holding cached result FN, None if not present
+
+  USAGE:
+    get_result_filename(CD, FN)
+  """
+
+  file_name = CD+FN+'_'+file_types[0]
+  for fn in [file_name+array_extension, file_name+'.z', file_name]:
+    if os.path.exists(fn):
+      return fn
+
+  return None
+
+# -----------------------------------------------------------------------------
+
+def is_array(A):
+  """Return True if A is a numpy array that can be stored without pickling
+  """
+
+  return type(A) in [num.ndarray, num.memmap] and not A.dtype.hasobject
+
+
+def is_array_result(T):
+  """Return True if T can be stored as an array result
+
+  USAGE:
+    is_array_result(T)
+
+  DESCRIPTION:
+    Array results are numpy arrays (not of dtype object) and tuples, lists
+    and dictionaries with string keys of such arrays.
+  """
+
+  if is_array(T):
+    return True
+
+  if type(T) in [tuple, list]:
+    for A in T:
+      if not is_array(A):
+        return False
+    return True
+
+  if type(T) == dict:
+    for key, A in T.items():
+      if not (isinstance(key, str) and is_array(A)):
+        return False
+    return True
+
+  return False
+
+# -----------------------------------------------------------------------------
+
+def save_array_result(T, file, compression=False):
+  """Save array result T to uncompressed .npz file
+
+  USAGE:
+    save_array_result(T, file)
+
+  DESCRIPTION:
+    The arrays are stored as members item_<i> (tuples and lists),
+    key_<key> (dictionaries) or array (a single array) with the
+    type of T in the member container.
+  """
+
+  if is_array(T):
+    arrays = {'array': T}
+    container = 'array'
+  elif type(T) == dict:
+    arrays = {}
+    for key, A in T.items():
+      arrays['key_' + key] = A
+    container = 'dict'
+  else:
+    arrays = {}
+    for i, A in enumerate(T):
+      arrays['item_%d' % i] = A
+    container = type(T).__name__
+
+  arrays['container'] = num.array(container)
+
+  num.savez(file, **arrays)
+
+# -----------------------------------------------------------------------------
+
+def load_array_result(file_name, mmap=False):
+  """Load array result saved by save_array_result
+
+  USAGE:
+    T = load_array_result(file_name, mmap)
+
+  DESCRIPTION:
+    If mmap is True the arrays are read-only memory maps of file_name.
+  """
+
+  if mmap:
+    arrays = memmap_npz(file_name)
+  else:
+    fid = num.load(file_name)
+    arrays = {}
+    for key in fid.files:
+      arrays[key] = fid[key]
+    fid.close()
+
+  container = str(arrays.pop('container'))
+
+  if container == 'array':
+    return arrays['array']
+
+  if container == 'dict':
+    T = {}
+    for key, A in arrays.items():
+      T[key[len('key_'):]] = A
+    return T
+
+  T = [arrays['item_%d' % i] for i in range(len(arrays))]
+  if container == 'tuple':
+    T = tuple(T)
+
+  return T
+
+# -----------------------------------------------------------------------------
+
+def memmap_npz(file_name):
+  """Memory map the arrays of uncompressed .npz file file_name
+
+  USAGE:
+    arrays = memmap_npz(file_name)
+
+  DESCRIPTION:
+    Return dictionary of read-only arrays, one for each member of the
+    zip archive, mapped directly from the .npy data inside the archive.
+  """
+
+  import struct
+  import zipfile
+  from numpy.lib import format
+
+  zf = zipfile.ZipFile(file_name)
+  infolist = zf.infolist()
+  zf.close()
+
+  arrays = {}
+  fid = open(file_name, 'rb')
+  try:
+    for info in infolist:
+      msg = 'Member %s of %s is compressed' % (info.filename, file_name)
+      assert info.compress_type == zipfile.ZIP_STORED, msg
+
+      # Skip the local file header of the member
+      fid.seek(info.header_offset)
+      header = fid.read(30)
+      name_length, extra_length = struct.unpack('<HH', header[26:30])
+      fid.seek(info.header_offset + 30 + name_length + extra_length)
+
+      # Read the .npy header
+      version = format.read_magic(fid)
+      if version == (1, 0):
+        shape, fortran_order, dtype = format.read_array_header_1_0(fid)
+      else:
+        shape, fortran_order, dtype = format.read_array_header_2_0(fid)
+
+      if fortran_order:
+        order = 'F'
+      else:
+        order = 'C'
+
+      size = 1
+      for n in shape:
+        size *= n
+
+      if size == 0:
+        A = num.zeros(shape, dtype, order)
+        A.flags.writeable = False
+      else:
+        A = num.memmap(file_name, dtype=dtype, mode='r', offset=fid.tell(),
+                       shape=shape, order=order)
+
+      arrays[info.filename[:-len('.npy')]] = A
+  finally:
+    fid.close()
+
+  return arrays
+
+# -----------------------------------------------------------------------------
+
+def save_atomically(T, FN, compression, save=None):
+  """Save T to file FN (FN.z if compressed) through a temporary file
+
+  USAGE:
+    file_name = save_atomically(T, FN, compression, save)
+
+  DESCRIPTION:
+    T is written by save(T, file, compression) (default mysave) to a
+    temporary file in the same directory, which is then renamed to FN.
+    Other processes thus either see the previous file or the complete new
+    one. Return name of the file written.
+  """
+
+  import tempfile
+
+  if save is None:
+    save = mysave
+
+  if compression:
+    FN = FN + '.z'
+
+  dir_name, base_name = os.path.split(FN)
+  fd, temp_name = tempfile.mkstemp(prefix='.'+base_name+'.', suffix='.tmp',
+                                   dir=dir_name)
+  try:
+    file = os.fdopen(fd, 'wb')
+    try:
+      save(T, file, compression)
+    finally:
+      file.close()
+
+    if unix:
+      os.chmod(temp_name, 0666)  # As new files opened by myopen
+    elif os.path.exists(FN):
+      os.remove(FN)  # Rename does not replace files under Windows
+    os.rename(temp_name, FN)
+  except:
+    if os.path.exists(temp_name):
+      os.remove(temp_name)
+    raise
+
+  return FN
+
+# -----------------------------------------------------------------------------
+
+def save_arrays(arrays, file_name, verbose=False):
+  """Save dictionary of arrays to uncompressed .npz file file_name
+
+  USAGE:
+    saved = save_arrays(arrays, file_name, verbose)
+
+  DESCRIPTION:
+    The directory of file_name is created if needed and the file is written
+    through save_atomically. Caches of derived data use this as failing to
+    store an entry must not stop the computation: errors are logged and
+    False is returned.
+  """
+
+  def save(arrays, file, compression):
+    num.savez(file, **arrays)
+
+  try:
+    dir_name = os.path.dirname(file_name)
+    if dir_name and not os.path.isdir(dir_name):
+      try:
+        os.makedirs(dir_name)
+      except OSError:
+        pass  # Created by another process meanwhile
+
+    save_atomically(arrays, file_name, False, save)
+  except (IOError, OSError), e:
+    log.critical('WARNING: Could not store %s: %s' % (file_name, e))
+    return False
+
+  return True
+
+# -----------------------------------------------------------------------------
+
+def load_arrays(file_name, verbose=False):
+  """Load dictionary of arrays saved by save_arrays
+
+  USAGE:
+    arrays = load_arrays(file_name, verbose)
+
+  DESCRIPTION:
+    Return None if file_name does not exist or can't be read.
+  """
+
+  if not os.path.exists(file_name):
+    return None
+
+  try:
+    fid = num.load(file_name)
+    try:
+      arrays = {}
+      for name in fid.files:
+        arrays[name] = fid[name]
+    finally:
+      fid.close()
+  except Exception:
+    if verbose: log.critical('Could not read %s' % file_name)
+    return None
+
+  return arrays
+
+# -----------------------------------------------------------------------------
+
+def acquire_lock(file_name, verbose=False):
+  """Wait for and take exclusive lock file_name
+
+  USAGE:
+    lock = acquire_lock(file_name, verbose)
+    ...
+    release_lock(lock)
+
+  DESCRIPTION:
+    The lock is an fcntl lock on file file_name, which is released by the
+    operating system should the process die while holding it. Return None
+    if locks can't be used (no fcntl, option 'lock' False or a caching
+    directory that isn't writable).
+  """
+
+  import errno
+
+  if fcntl is None or not options['lock']:
+    return None
+
+  while True:
+    try:
+      lock = open(file_name, 'a')
+    except IOError:
+      return None
+
+    try:
+      fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+      if e.errno not in [errno.EACCES, errno.EAGAIN]:
+        lock.close()
+        return None
+
+      if verbose:
+        log.critical('MESSAGE (caching): Waiting for other process to '
+                     'release %s' % file_name)
+      fcntl.lockf(lock, fcntl.LOCK_EX)
+
+    # The previous holder removes the lock file when releasing it, so make
+    # sure the lock is still on the current one
+    try:
+      if os.path.samestat(os.fstat(lock.fileno()), os.stat(file_name)):
+        return lock
+    except OSError:
+      pass
+
+    lock.close()
+
+# -----------------------------------------------------------------------------
+
+def release_lock(lock):
+  """Release lock taken by acquire_lock
+
+  USAGE:
+    release_lock(lock)
+  """
+
+  if lock is None:
+    return
+
+  try:
+    os.remove(lock.name)
+  except OSError:
+    pass
+
+  fcntl.lockf(lock, fcntl.LOCK_UN)
+  lock.close()
+
+# -----------------------------------------------------------------------------
+
 def myopen(FN, mode, compression=True):
   """Open file FN using given mode
 
@@ -1426,11 +2249,19 @@ def myhash(T, ids=None):
 
   # Get hash values for hashable entries
   if type(T) in [TupleType, ListType]:
-      hvals = []
-      for t in T:
-          h = myhash(t, ids)
-          hvals.append(h)
-      val = hash(tuple(hvals))
+      A = None
+      if len(T) >= hash_list_size:
+          # Long sequence of numbers, e.g. a list of points
+          A = get_numeric_array(T)
+
+      if A is not None:
+          val = hash_array(A)
+      else:
+          hvals = []
+          for t in T:
+              h = myhash(t, ids)
+              hvals.append(h)
+          val = hash(tuple(hvals))
   elif type(T) == DictType:
       # Make dictionary ordering unique  
       
@@ -1438,11 +2269,11 @@ def myhash(T, ids=None):
       I = T.items()
       I.sort()    
       val = myhash(I, ids)
+  elif isinstance(T, num.ndarray) and T.dtype.hasobject:
+      # Array of references, hash the objects
+      val = myhash(T.tolist(), ids)
   elif isinstance(T, num.ndarray):
-      T = num.array(T) # Ensure array is contiguous
-
-      # Use mean value for efficiency
-      val = hash(num.average(T.flat))
+      val = hash_array(T)
   elif type(T) == InstanceType:
       # Use the attribute values 
       val = myhash(T.__dict__, ids)
@@ -1456,6 +2287,55 @@ def myhash(T, ids=None):
 
 
 
+def hash_array(A):
+  """Compute hashed integer from the contents of numpy array A.
+
+  USAGE:
+    hash_array(A)
+
+  ARGUMENTS:
+    A -- numpy array (not of dtype object)
+
+  DESCRIPTION:
+    The raw data of A is digested hash_block_size bytes at a time together
+    with its dtype and shape, so arrays only differing in those hash to
+    different values. Contiguous arrays are digested without copying.
+  """
+
+  h = array_hasher()
+  h.update(str(A.dtype.descr))
+  h.update(str(A.shape))
+
+  step = max(1, hash_block_size/max(1, A.itemsize))
+  if A.flags.c_contiguous:
+    flat = A.reshape(-1)
+    for i in range(0, flat.size, step):
+      h.update(flat[i:i+step])
+  else:
+    # Copy one block at a time
+    flat = A.flat
+    for i in range(0, A.size, step):
+      h.update(num.ascontiguousarray(flat[i:i+step]))
+
+  return int(h.hexdigest()[:15], 16)
+
+
+def get_numeric_array(T):
+  """Return sequence T as a numeric array, None if it contains
+  anything but numbers (or nested sequences of them of equal length).
+  """
+
+  try:
+    A = num.array(T)
+  except:
+    return None
+
+  if A.dtype.kind not in 'biuf':
+    return None
+
+  return A
+
+
 def compare(A, B, ids=None):
     """Safe comparison of general objects
 
@@ -1508,7 +2388,8 @@ def compare(A, B, ids=None):
             
     elif isinstance(A, num.ndarray):
         # Use element by element comparison
-        identical = num.alltrue(A==B)
+        identical = A.shape == B.shape and A.dtype == B.dtype and \
+                    num.array_equal(A, B)
 
     elif type(A) == types.InstanceType:
         # Take care of special case where elements are instances            
@@ -1837,22 +2718,9 @@ def addstatsline(CD, funcname, FN, Retrieved, reason, comptime, loadtime,
 
   import os, time
 
-  try:
-    TimeTuple = time.localtime(time.time())
-    extension = time.strftime('%b%Y',TimeTuple)
-    SFN = CD+statsfile+'.'+extension
-    #statfile = open(SFN,'a')
-    (statfile, dummy) = myopen(SFN,'a',compression=0)
-
-    # Change access rights if possible
-    #
-    #if unix:
-    #  try:
-    #    exitcode=os.system('chmod 666 '+SFN)
-    #  except:
-    #    pass
-  except:
-    log.critical('Warning: Stat file could not be opened')
+  TimeTuple = time.localtime(time.time())
+  extension = time.strftime('%b%Y',TimeTuple)
+  SFN = CD+statsfile+'.'+extension
 
   try:
     if os.environ.has_key('USER'):
@@ -1869,10 +2737,7 @@ def addstatsline(CD, funcname, FN, Retrieved, reason, comptime, loadtime,
 
     # Get size of result file
     #    
-    if compression:
-      stats = os.stat(CD+FN+'_'+file_types[0]+'.z')
-    else:
-      stats = os.stat(CD+FN+'_'+file_types[0])
+    stats = os.stat(get_result_filename(CD, FN))
   
     if stats: 
       size = stats[6]
@@ -1891,14 +2756,145 @@ def addstatsline(CD, funcname, FN, Retrieved, reason, comptime, loadtime,
             str(round(comptime,4)) + ',' +\
             str(round(loadtime,4)) +\
             CR
-            
-    statfile.write(entry)
-    statfile.close()
+
+    # Append entry in one write so that entries of processes sharing the
+    # stats file don't get interleaved
+    try:
+      fd = os.open(SFN, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    except OSError:
+      log.critical('Warning: Stat file could not be opened')
+      return
+    try:
+      os.write(fd, entry)
+    finally:
+      os.close(fd)
   except:
     log.critical('Warning: Writing of stat file failed')
 
 # -----------------------------------------------------------------------------
 
+def read_index(CD):
+  """Read counters from the index of caching directory CD
+
+  USAGE:
+    index = read_index(CD)
+  """
+
+  import json
+
+  try:
+    fid = open(CD+indexfile)
+    try:
+      index = json.load(fid)
+    finally:
+      fid.close()
+  except (IOError, ValueError):
+    index = {}
+
+  index.setdefault('functions', {})
+  index.setdefault('evictions', 0)
+
+  return index
+
+# -----------------------------------------------------------------------------
+
+def update_index(CD, funcname=None, Retrieved=None, comptime=None,
+                 loadtime=None, evicted=0):
+  """Update counters in the index of the caching directory
+
+  USAGE:
+    update_index(CD, funcname, Retrieved, comptime, loadtime)
+    update_index(CD, evicted=n)
+
+  DESCRIPTION:
+    Count a cache hit (Retrieved) or miss of funcname. For a miss comptime
+    is the time it took to compute the result. For a hit loadtime is the
+    time it took to load the result and comptime - loadtime the time saved.
+    evicted is the number of cached results evicted.
+
+    The index is locked while being updated and replaced atomically, so
+    processes sharing the caching directory don't lose each other's counts.
+  """
+
+  import json
+
+  lock = acquire_lock(CD+indexfile+'.lock')
+  try:
+    index = read_index(CD)
+
+    if funcname is not None:
+      counters = index['functions'].setdefault(funcname,
+                                               {'hits': 0,
+                                                'misses': 0,
+                                                'comptime': 0.0,
+                                                'loadtime': 0.0,
+                                                'savedtime': 0.0})
+      if Retrieved:
+        counters['hits'] += 1
+        counters['loadtime'] += loadtime
+        counters['savedtime'] += comptime - loadtime
+      else:
+        counters['misses'] += 1
+        counters['comptime'] += comptime
+
+    index['evictions'] += evicted
+
+    save_atomically(index, CD+indexfile, False,
+                    lambda index, fid, compression: json.dump(index, fid))
+  except:
+    log.critical('Warning: Writing of cache index failed')
+  finally:
+    release_lock(lock)
+
+# -----------------------------------------------------------------------------
+
+def get_cache_stats(cachedir=None):
+  """Get caching statistics for dashboards and monitoring
+
+  USAGE:
+    stats = get_cache_stats(cachedir)
+
+  ARGUMENTS:
+    cachedir -- Directory for cache files (Default: options['cachedir'])
+
+  DESCRIPTION:
+    Return dictionary with keys
+      hits, misses --  Total number of cache hits and misses
+      comptime --      Total time in seconds spent computing results
+      loadtime --      Total time in seconds spent loading cached results
+      savedtime --     Total computation time in seconds saved by hits
+      evictions --     Number of cached results removed by evict
+      entries, size -- Current number of cached results and their total size
+                       in bytes
+      functions --     Dictionary of the hits, misses, comptime, loadtime and
+                       savedtime counters of each cached function
+  """
+
+  if not cachedir:
+    cachedir = options['cachedir']
+
+  CD = checkdir(cachedir)
+
+  index = read_index(CD)
+
+  stats = {'functions': index['functions'],
+           'evictions': index['evictions']}
+
+  for key in ['hits', 'misses', 'comptime', 'loadtime', 'savedtime']:
+    stats[key] = 0
+    for counters in index['functions'].values():
+      stats[key] += counters[key]
+
+  entries = get_cache_entries(CD)
+  stats['entries'] = len(entries)
+  stats['size'] = 0
+  for size, last_used, file_names in entries.values():
+    stats['size'] += size
+
+  return stats
+
+# -----------------------------------------------------------------------------
+
 # FIXME: should take cachedir as an optional arg
 #
 def __cachestat(sortidx=4, period=-1, showuser=None, cachedir=None):
@@ -2285,6 +3281,8 @@ def msg5(CD, FN, deps, compression):
 
   for file_type in file_types:
     file_name = FN + '_' + file_type + suffix
+    if file_type == file_types[0]:
+      file_name = os.path.basename(get_result_filename(CD, FN))
     stats = os.stat(CD+file_name)
     log.critical(string.ljust('| ' + file_type + ' file: ', textwidth1) +
                  file_name + '('+ str(stats[6]) + ' ' + bytetext + ')')
@@ -31,6 +31,46 @@ def f_numeric(A, B):
     return 3.1 * A + B + 1
   
   
+def f_arrays(A, container):
+    """Return array results in different containers
+    """
+
+    if container == 'tuple':
+        return A, 2 * A, num.array(['a', 'bc'])
+    if container == 'dict':
+        return {'A': A, 'B': num.arange(len(A)), 'empty': num.zeros((0, 3))}
+    if container == 'list':
+        return [A.reshape((2, -1)).T, A > 0]
+    if container == 'object':
+        return A, 'not an array'
+
+    return A + 1
+
+
+def f_counted(A, counter_file, delay):
+    """Slow function recording each evaluation in counter_file
+    """
+
+    import os, time
+
+    fid = open(counter_file, 'a')
+    fid.write('%d\n' % os.getpid())
+    fid.close()
+
+    time.sleep(delay)
+
+    return A * 2
+
+
+def cache_f_counted(A, counter_file, delay, cachedir):
+    """Call f_counted through the cache (run in other processes)
+    """
+
+    T = cache(f_counted, (A, counter_file, delay), cachedir=cachedir,
+              verbose=False)
+    assert num.allclose(T, A * 2)
+
+
 def f_object(A, B):
     """Operation of objects of class Dummy
     """
@@ -168,10 +208,12 @@ class Test_Caching(unittest.TestCase):
         A0 = num.arange(5) * 1.0
         B = ('x', 15)
         
-        # Create different A that hashes to the same address (having the same average)
-        A1 = num.array([2.0, 2.0, 2.0, 2.0, 2.0])        
+        # Create different arguments that hash to the same address
+        # (hash(-1) == hash(-2))
+        B0 = -1
+        B1 = -2
         
-        assert myhash(A0) == myhash(A1)
+        assert myhash((A0, B0)) == myhash((A0, B1))
             
             
         # Test caching
@@ -179,31 +221,448 @@ class Test_Caching(unittest.TestCase):
         for comp in range(comprange):
         
             # Clear
-            cache(f_numeric, (A0, A0), clear=1,
+            cache(f_numeric, (A0, B0), clear=1,
                   compression=comp, verbose=verbose)        
-            cache(f_numeric, (A1, A1), clear=1,
+            cache(f_numeric, (A0, B1), clear=1,
                   compression=comp, verbose=verbose)                          
   
   
             # Evaluate and store
-            T1 = cache(f_numeric, (A0, A0), evaluate=1,
+            T1 = cache(f_numeric, (A0, B0), evaluate=1,
                        compression=comp, verbose=verbose)
 
             
-            # Check that A1 doesn't trigger retrieval of the previous result 
+            # Check that B1 doesn't trigger retrieval of the previous result 
             # even though it hashes to the same address
-            T2 = cache(f_numeric, (A1, A1),
+            T2 = cache(f_numeric, (A0, B1),
                        compression=comp, verbose=verbose) 
            
-            T1_ref = f_numeric(A0, A0)
-            T2_ref = f_numeric(A1, A1)
-            T1_ref = f_numeric(A0, A0)
-            T2_ref = f_numeric(A1, A1)
+            T1_ref = f_numeric(A0, B0)
+            T2_ref = f_numeric(A0, B1)
 
             assert num.alltrue(T1 == T1_ref)
             assert num.alltrue(T2 == T2_ref)
 
 
+    def test_hash_of_numeric_arrays(self):
+        """Test that arrays are hashed by their contents, dtype and shape
+        """
+
+        A = num.arange(12) * 1.0
+
+        # Same average
+        assert myhash(A) != myhash(num.ones(12) * 5.5)
+
+        # Same contents, different dtype or shape
+        assert myhash(A) != myhash(num.arange(12))
+        assert myhash(A) != myhash(A.reshape(3, 4))
+
+        # Non contiguous arrays hash as their copies
+        B = num.arange(24.0).reshape(4, 6)[:, ::2]
+        assert not B.flags.c_contiguous
+        assert myhash(B) == myhash(B.copy())
+        assert myhash(B) == myhash(num.arange(0.0, 24.0, 2.0).reshape(4, 3))
+
+        # Arrays larger than a hash block
+        C = num.arange(3*hash_block_size/8 + 5) * 1.0
+        D = C.copy()
+        assert myhash(C) == myhash(D)
+        D[-1] = 0.0
+        assert myhash(C) != myhash(D)
+
+        # Arrays of objects are hashed by their elements
+        E = num.array([{'a': 1}, 'b'], dtype=object)
+        assert myhash(E) == myhash(num.array([{'a': 1}, 'b'], dtype=object))
+
+        # Long lists of numbers are hashed like arrays
+        points = [[float(i), float(i % 7)] for i in range(hash_list_size)]
+        assert myhash(points) == myhash(num.array(points))
+        assert myhash(points) == myhash(deepcopy(points))
+        assert myhash(points) != myhash(points[:-1] + [[0.0, 0.0]])
+        assert myhash(points + ['x']) == myhash(deepcopy(points) + ['x'])
+
+    def test_eviction(self):
+        """Test that least recently used results are evicted beyond the
+        size and age limits
+        """
+
+        import os, time, tempfile, shutil
+
+        cachedir = tempfile.mkdtemp()
+        CD = checkdir(cachedir)
+
+        try:
+            for i in range(4):
+                cache(f_numeric, (num.ones(1000)*i, 1.0), cachedir=cachedir,
+                      compression=False, verbose=False)
+
+            entries = get_cache_entries(CD)
+            assert len(entries) == 4
+            size = max([entry[0] for entry in entries.values()])
+
+            # Make the first result the most recently used and the others
+            # older (file times have a resolution of a second or more)
+            for FN, (s, last_used, file_names) in entries.items():
+                for file_name in file_names:
+                    os.utime(CD + file_name, (last_used - 100, last_used - 100))
+            cache(f_numeric, (num.ones(1000)*0, 1.0), cachedir=cachedir,
+                  compression=False, verbose=False)
+            FN0 = cache(f_numeric, (num.ones(1000)*0, 1.0), cachedir=cachedir,
+                        return_filename=True)
+
+            # Size limit
+            assert evict(cachedir, maxsize=2*size, verbose=False) == 2
+            entries = get_cache_entries(CD)
+            assert len(entries) == 2
+            assert FN0 in entries
+
+            # Age limit
+            assert evict(cachedir, maxage=50, verbose=False) == 1
+            assert get_cache_entries(CD).keys() == [FN0]
+
+            # Limits as options are applied when results are stored
+            set_option('maxsize', size)
+            try:
+                T = cache(f_numeric, (num.ones(1000)*7, 1.0),
+                          cachedir=cachedir, compression=False,
+                          verbose=False)
+            finally:
+                set_option('maxsize', None)
+
+            assert num.allclose(T, f_numeric(num.ones(1000)*7, 1.0))
+            assert FN0 not in get_cache_entries(CD)
+            assert len(get_cache_entries(CD)) == 1
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_cache_stats(self):
+        """Test counters of the cache index
+        """
+
+        import tempfile, shutil
+
+        cachedir = tempfile.mkdtemp()
+        savestat = options['savestat']
+        set_option('savestat', True)
+
+        try:
+            A = num.arange(10)*1.0
+            for i in range(3):
+                cache(f_numeric, (A, 1.0), cachedir=cachedir, verbose=False)
+            cache(f_numeric, (A, 2.0), cachedir=cachedir, verbose=False)
+            cache(f_generic, A, cachedir=cachedir, verbose=False)
+
+            stats = get_cache_stats(cachedir)
+            assert stats['hits'] == 2
+            assert stats['misses'] == 3
+            assert stats['entries'] == 3
+            assert stats['size'] > 0
+            assert stats['comptime'] >= 0.0
+            assert stats['loadtime'] >= 0.0
+            assert stats['evictions'] == 0
+
+            counters = stats['functions']['f_numeric']
+            assert counters['hits'] == 2
+            assert counters['misses'] == 2
+
+            evict(cachedir, maxsize=0, verbose=False)
+            stats = get_cache_stats(cachedir)
+            assert stats['evictions'] == 3
+            assert stats['entries'] == 0
+            assert stats['size'] == 0
+        finally:
+            set_option('savestat', savestat)
+            shutil.rmtree(cachedir)
+
+    def test_array_results(self):
+        """Test that array results are stored as .npz files and can be
+        returned memory mapped
+        """
+
+        import os, tempfile, shutil
+
+        cachedir = tempfile.mkdtemp()
+        CD = checkdir(cachedir)
+
+        try:
+            A = num.arange(12)*1.5
+            for container in ['array', 'tuple', 'dict', 'list', 'object']:
+                ref = f_arrays(A, container)
+
+                for mmap in [False, True, True]:
+                    T = cache(f_arrays, (A, container), cachedir=cachedir,
+                              verbose=False, mmap=mmap)
+                    FN = cache(f_arrays, (A, container), cachedir=cachedir,
+                               return_filename=True)
+                    file_name = get_result_filename(CD, FN)
+
+                    if container == 'object':
+                        assert num.all(T[0] == A) and T[1] == ref[1]
+                        assert not file_name.endswith('.npz')
+                        continue
+
+                    assert file_name.endswith('.npz')
+                    assert isinstance(T, type(ref))
+                    if container == 'array':
+                        pairs = [(T, ref)]
+                    elif container == 'dict':
+                        assert sorted(T.keys()) == sorted(ref.keys())
+                        pairs = [(T[key], ref[key]) for key in ref]
+                    else:
+                        pairs = zip(T, ref)
+
+                    for X, Y in pairs:
+                        assert X.dtype == Y.dtype
+                        assert X.shape == Y.shape
+                        assert num.all(X == Y)
+                        if mmap and X.size > 0:
+                            assert isinstance(X, num.memmap)
+                        if mmap:
+                            assert not X.flags.writeable
+                        else:
+                            assert not isinstance(X, num.memmap)
+
+            # Array results can be switched off
+            set_option('npz', False)
+            try:
+                cache(f_arrays, (A, 'tuple'), cachedir=cachedir,
+                      evaluate=True, verbose=False)
+            finally:
+                set_option('npz', True)
+            FN = cache(f_arrays, (A, 'tuple'), cachedir=cachedir,
+                       return_filename=True)
+            assert not get_result_filename(CD, FN).endswith('.npz')
+            assert not os.path.exists(CD + FN + '_Result.npz')
+            T = cache(f_arrays, (A, 'tuple'), cachedir=cachedir,
+                      verbose=False)
+            assert num.allclose(T[1], 2*A)
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_concurrent_processes(self):
+        """Test that processes asking for the same result at the same time
+        compute it only once
+        """
+
+        import os, tempfile, shutil
+        from multiprocessing import Process
+
+        cachedir = tempfile.mkdtemp()
+        CD = checkdir(cachedir)
+        counter_file = os.path.join(cachedir, '.counter')
+        savestat = options['savestat']
+        set_option('savestat', True)
+
+        try:
+            A = num.arange(100)*1.0
+            processes = []
+            for i in range(4):
+                p = Process(target=cache_f_counted,
+                            args=(A, counter_file, 0.5, cachedir))
+                p.start()
+                processes.append(p)
+
+            for p in processes:
+                p.join()
+                assert p.exitcode == 0
+
+            # One evaluation only
+            lines = open(counter_file).readlines()
+            assert len(lines) == 1
+
+            # No temporary or lock files left behind
+            for file_name in os.listdir(CD):
+                assert not file_name.endswith('.tmp')
+                assert not file_name.endswith('.lock')
+
+            # Counters of all processes made it to the index
+            stats = get_cache_stats(cachedir)
+            assert stats['misses'] == 1
+            assert stats['hits'] == 3
+            assert stats['entries'] == 1
+
+            # Without locking every process computes the result
+            os.remove(counter_file)
+            set_option('lock', False)
+            try:
+                cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                      evaluate=True, verbose=False)
+            finally:
+                set_option('lock', True)
+            assert len(open(counter_file).readlines()) == 1
+        finally:
+            set_option('savestat', savestat)
+            shutil.rmtree(cachedir)
+
+    def test_lock(self):
+        """Test that a lock can't be taken twice
+        """
+
+        import os, tempfile, shutil
+        from anuga.caching.caching import fcntl
+
+        if fcntl is None:
+            return  # No locking on this platform
+
+        cachedir = tempfile.mkdtemp()
+        lock_file = os.path.join(cachedir, '.test.lock')
+
+        try:
+            lock = acquire_lock(lock_file)
+            assert lock is not None
+            assert os.path.exists(lock_file)
+
+            # Another process can't take it
+            pid = os.fork()
+            if pid == 0:
+                fid = open(lock_file, 'a')
+                try:
+                    fcntl.lockf(fid, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError:
+                    os._exit(0)
+                os._exit(1)
+            assert os.waitpid(pid, 0)[1] == 0
+
+            release_lock(lock)
+            assert not os.path.exists(lock_file)
+
+            lock = acquire_lock(lock_file)
+            release_lock(lock)
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_save_arrays(self):
+        """Arrays are saved through a temporary file into a directory
+        created as needed, and failures are not fatal
+        """
+
+        import os, tempfile, shutil
+
+        cachedir = tempfile.mkdtemp()
+        try:
+            file_name = os.path.join(cachedir, 'sub', 'arrays.npz')
+            arrays = {'a': num.arange(5), 'b': num.ones((2, 3))}
+            assert save_arrays(arrays, file_name)
+            assert os.listdir(os.path.dirname(file_name)) == ['arrays.npz']
+
+            loaded = load_arrays(file_name)
+            assert sorted(loaded.keys()) == ['a', 'b']
+            assert num.allclose(loaded['b'], arrays['b'])
+
+            assert load_arrays(os.path.join(cachedir, 'none.npz')) is None
+            open(file_name, 'w').write('not an npz file')
+            assert load_arrays(file_name) is None
+
+            # A file where the directory should be
+            assert not save_arrays(arrays, os.path.join(file_name, 'x.npz'))
+        finally:
+            shutil.rmtree(cachedir)
+
+    def test_memory_tier_hash_collision(self):
+        """Results kept in memory for arguments with the same hash are
+        told apart by their arguments
+        """
+
+        import tempfile, shutil
+
+        cachedir = tempfile.mkdtemp()
+
+        f = lambda x: [x*10]
+        assert myhash((-1,)) == myhash((-2,))
+
+        set_option('memorysize', 10**6)
+        try:
+            for i in range(2):
+                assert cache(f, (-1,), cachedir=cachedir,
+                             verbose=False) == [-10]
+                assert cache(f, (-2,), cachedir=cachedir,
+                             verbose=False) == [-20]
+        finally:
+            set_option('memorysize', None)
+            clear_memory_cache()
+            shutil.rmtree(cachedir)
+
+    def test_memory_tier(self):
+        """Test that results kept in memory are shared read-only and
+        bounded in size
+        """
+
+        import os, tempfile, shutil, time
+
+        cachedir = tempfile.mkdtemp()
+        CD = checkdir(cachedir)
+        counter_file = os.path.join(cachedir, '.counter')
+        A = num.arange(100)*1.0
+        B = num.arange(100)*2.0
+
+        set_option('memorysize', 1000)
+        try:
+            T1 = cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                       verbose=False)
+            assert T1.flags.writeable
+
+            # Served from memory without reading the caching directory
+            FN = cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                       return_filename=True)
+            os.remove(get_result_filename(CD, FN))
+            T2 = cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                       verbose=False)
+            assert not T2.flags.writeable
+            assert num.allclose(T2, T1)
+            assert cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                         verbose=False) is T2
+            assert len(open(counter_file).readlines()) == 1
+
+            # Only one result of 800 bytes fits
+            cache(f_counted, (B, counter_file, 0.0), cachedir=cachedir,
+                  verbose=False)
+            assert len(memory_cache) == 1
+            T3 = cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                       verbose=False)
+            assert T3 is not T2
+            assert num.allclose(T3, A*2)
+            assert len(open(counter_file).readlines()) == 3
+
+            # Results are checked against their dependencies
+            dependency = os.path.join(cachedir, '.dependency')
+            open(dependency, 'w').write('a')
+            cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                  dependencies=dependency, verbose=False)
+            T4 = cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                       dependencies=dependency, verbose=False)
+            assert cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                         dependencies=dependency, verbose=False) is T4
+            open(dependency, 'w').write('bc')
+            T5 = cache(f_counted, (A, counter_file, 0.0), cachedir=cachedir,
+                       dependencies=dependency, verbose=False)
+            assert T5 is not T4
+            assert len(open(counter_file).readlines()) == 5
+
+            # Other results are kept as well
+            T = cache(f_arrays, (A, 'object'), cachedir=cachedir,
+                      verbose=False)
+            assert cache(f_arrays, (A, 'object'), cachedir=cachedir,
+                         verbose=False) is T
+
+            # Arrays returned by the function stay writeable for the caller
+            C = num.arange(10)*1.0
+            T = cache(f_arrays, (C, 'tuple'), cachedir=cachedir,
+                      verbose=False)
+            assert T[0] is C
+            assert C.flags.writeable
+            C[0] = 5.0
+            T = cache(f_arrays, (num.arange(10)*1.0, 'tuple'),
+                      cachedir=cachedir, verbose=False)
+            assert not T[0].flags.writeable
+            assert T[0][0] == 0.0
+
+            clear_memory_cache()
+            assert len(memory_cache) == 0
+        finally:
+            set_option('memorysize', None)
+            clear_memory_cache()
+            shutil.rmtree(cachedir)
+
     def test_caching_of_dictionaries(self):
         """test_caching_of_dictionaries
         
@@ -0,0 +1,212 @@
+""" Classes to read the time series sidecar (.swt) of an SWW file.
+
+SWW files store the time dependent quantities frame by frame, so extracting
+the time series at a handful of points reads every frame of the file in full.
+The .swt file holds the same quantities transposed: one row per point (or
+per triangle for the centroid quantities) containing all stored timesteps.
+A time series query then only reads the rows it needs.
+
+The .swt file is created with sww2swt (anuga.file_conversion.sww2swt) and
+lives next to its SWW file, e.g. model.sww -> model.swt.
+"""
+
+import os
+
+import numpy as num
+
+from anuga.config import netcdf_mode_r
+from anuga.file.netcdf import NetCDFFile
+from anuga.utilities.numerical_tools import ensure_numeric, NAN
+from anuga.utilities.sparse import Sparse, Sparse_CSR
+import anuga.utilities.log as log
+
+
+def get_swt_filename(sww_filename):
+    """Return name of the time series sidecar belonging to sww_filename.
+    """
+
+    return os.path.splitext(sww_filename)[0] + '.swt'
+
+
+def get_current_swt_filename(sww_filename):
+    """Return name of the sidecar of sww_filename if it can be used.
+
+    The sidecar is only used if it exists and is at least as recent as the
+    SWW file, so that an SWW file which has been rewritten or appended to
+    since the sidecar was built falls back to reading the SWW file itself.
+    Return None otherwise.
+    """
+
+    swt_filename = get_swt_filename(sww_filename)
+
+    if not os.path.exists(swt_filename):
+        return None
+
+    if os.path.getmtime(swt_filename) < os.path.getmtime(sww_filename):
+        return None
+
+    return swt_filename
+
+
+class Read_swt:
+    """Read time series from a .swt file.
+
+    Time dependent quantities are stored as variables of dimension
+    number_of_points x number_of_timesteps (or number_of_volumes x
+    number_of_timesteps for centroid quantities such as stage_c).
+    """
+
+    def __init__(self, source):
+
+        self.source = source
+
+        self.fid = NetCDFFile(source, netcdf_mode_r)
+
+        self.time = num.array(self.fid.variables['time'][:], num.float)
+        self.starttime = float(self.fid.starttime)
+
+    def get_time(self):
+        """Return vector of stored times (relative to starttime).
+        """
+
+        return self.time
+
+    def get_quantity_names(self):
+        """Return names of the time series stored in this file.
+        """
+
+        return [name for name in self.fid.variables.keys() if name != 'time']
+
+    def has_quantity(self, name):
+
+        return name in self.fid.variables
+
+    def get_timeseries(self, name, indices):
+        """Return time series of quantity name for the given row indices.
+
+        Result has shape len(indices) x number_of_timesteps.
+
+        Indices are sorted and consecutive ones are read as one contiguous
+        block, so only the rows requested are read from disk.
+        """
+
+        indices = ensure_numeric(indices, num.int)
+
+        var = self.fid.variables[name]
+        rows, inverse = num.unique(indices, return_inverse=True)
+
+        values = num.zeros((len(rows), len(self.time)), num.float)
+
+        if len(rows) == 0:
+            return values
+
+        # Find runs of consecutive rows
+        breaks = num.where(rows[1:] - rows[:-1] != 1)[0] + 1
+        starts = num.concatenate(([0], breaks))
+        ends = num.concatenate((breaks, [len(rows)]))
+
+        for k0, k1 in zip(starts, ends):
+            values[k0:k1, :] = var[rows[k0]:rows[k1-1]+1, :]
+
+        return values[inverse]
+
+    def get_interpolated_timeseries(self, name, A):
+        """Return time series of quantity name interpolated by matrix A.
+
+        A is an interpolation matrix (Sparse or Sparse_CSR) mapping values
+        at the rows of this file (e.g. sww points) to interpolation points.
+        Only the rows that A refers to are read.
+
+        Result has shape number_of_interpolation_points x number_of_timesteps.
+        """
+
+        if isinstance(A, Sparse):
+            A = Sparse_CSR(A)
+
+        columns = num.unique(A.colind)
+        values = self.get_timeseries(name, columns)
+
+        # Restrict A to the columns actually used
+        colind = num.searchsorted(columns, A.colind).astype(num.int)
+        B = Sparse_CSR(None, A.data, colind, A.row_ptr, A.M, len(columns))
+
+        return B * values
+
+    def close(self):
+
+        self.fid.close()
+
+
+def get_timeseries_at_points_from_swt(sww_filename,
+                                      quantity_names,
+                                      interpolation_points,
+                                      absolute=True,
+                                      output_centroids=False,
+                                      NODATA_value=NAN,
+                                      use_cache=False,
+                                      verbose=False):
+    """Interpolate quantities of an SWW file to points using its sidecar.
+
+    sww_filename          path to SWW file with an up to date .swt sidecar
+    quantity_names        names of quantities to interpolate. Quantities
+                          that are not time dependent are read from the SWW
+                          file and repeated for all timesteps.
+    interpolation_points  N x 2 array of points
+    absolute              True if interpolation_points are absolute UTM
+                          coordinates, False if they are relative to the
+                          georeference of the SWW file
+    output_centroids      True to use the value at the centroid of the
+                          triangle containing each point
+    use_cache             True to cache the interpolation matrix
+
+    Return (time, starttime, values, centroids)
+    where time is the vector of stored times (relative to starttime),
+          values is a dictionary of N x number_of_timesteps arrays, one for
+                 each quantity name, with NODATA_value for points outside
+                 the mesh,
+      and centroids are the centroids of the triangles containing the points
+                 (if output_centroids is True).
+
+    Only the rows of the sidecar referenced by the interpolation matrix are
+    read.
+    """
+
+    from anuga.file.sww import get_interpolation_matrix_from_file
+
+    swt_filename = get_current_swt_filename(sww_filename)
+
+    msg = 'No up to date time series sidecar found for %s' % sww_filename
+    assert swt_filename is not None, msg
+
+    fid = NetCDFFile(sww_filename, netcdf_mode_r)
+
+    if verbose: log.critical('Building interpolation matrix')
+    A, inside_indices, outside_indices, centroids = \
+        get_interpolation_matrix_from_file(fid,
+                                           interpolation_points,
+                                           absolute=absolute,
+                                           output_centroids=output_centroids,
+                                           use_cache=use_cache,
+                                           verbose=verbose)
+
+    if verbose: log.critical('Reading time series from %s' % swt_filename)
+    swt = Read_swt(swt_filename)
+    time = swt.get_time()
+    starttime = swt.starttime
+
+    values = {}
+    for name in quantity_names:
+        if swt.has_quantity(name):
+            q = swt.get_interpolated_timeseries(name, A)
+        else:
+            # Not time dependent
+            q = A * num.array(fid.variables[name][:], num.float)
+            q = num.repeat(q[:, num.newaxis], len(time), axis=1)
+
+        q[outside_indices, :] = NODATA_value
+        values[name] = q
+
+    swt.close()
+    fid.close()
+
+    return time, starttime, values, centroids
@@ -113,17 +113,19 @@ class SWW_file(Data_format):
                 if self.store_centroids: dynamic_c_quantities.append(q+'_c')
                        
         
+        self.writer = Write_sww(static_quantities,
+                                dynamic_quantities,
+                                static_c_quantities,
+                                dynamic_c_quantities)
+
         # NetCDF file definition
+        # In append mode (e.g. when restarting from a checkpoint) the
+        # header is already in place and timesteps are added to the file
         fid = NetCDFFile(self.filename, mode)
         if mode[0] == 'w':
             description = 'Output from anuga.file.sww ' \
                           'suitable for plotting'
                           
-            self.writer = Write_sww(static_quantities,
-                                    dynamic_quantities,
-                                    static_c_quantities,
-                                    dynamic_c_quantities)
-            
             self.writer.store_header(fid,
                                      domain.starttime,
                                      self.number_of_volumes,
@@ -1300,50 +1302,29 @@ def load_sww_as_domain(filename, boundary=None, t=None,
     return domain
 
 
-def get_mesh_and_quantities_from_file(filename,
-                                      quantities=None,
-                                      verbose=False):
-    """Get and rebuild mesh structure and associated quantities from sww file
+def get_mesh_from_file(filename, verbose=False):
+    """Get and rebuild mesh structure from sww file
 
     Input:
         filename - Name os sww file
-        quantities - Names of quantities to load
 
     Output:
-        mesh - instance of class Interpolate
-               (including mesh and interpolation functionality)
-        quantities - arrays with quantity values at each mesh node or
-                    each triangle vertex. (depending on whethr stored as smooth or not)
-        time - vector of stored timesteps
+        mesh - instance of class Mesh with the geo_reference of the sww file
 
-    This function is used by e.g.:
-        get_interpolated_quantities_at_polyline_midpoints
+    Vertices of sww files that are not stored smoothly are weeded so that
+    the mesh has unique vertices.
     """
 
-    # FIXME (Ole): Maybe refactor filefunction using this more fundamental code.
-
-    import types
     from anuga.abstract_2d_finite_volumes.neighbour_mesh import Mesh
 
-    if verbose: log.critical('Reading from %s' % filename)
+    if verbose: log.critical('Reading mesh from %s' % filename)
 
     fid = NetCDFFile(filename, netcdf_mode_r)    # Open existing file for read
-    time = fid.variables['time'][:]    # Time vector
-    #time += fid.starttime[0]
-    time += fid.starttime
 
     # Get the variables as numeric arrays
     x = fid.variables['x'][:]                   # x-coordinates of nodes
     y = fid.variables['y'][:]                   # y-coordinates of nodes
 
-
-    elevation = fid.variables['elevation'][:]   # Elevation
-    stage = fid.variables['stage'][:]           # Water level
-    xmomentum = fid.variables['xmomentum'][:]   # Momentum in the x-direction
-    ymomentum = fid.variables['ymomentum'][:]   # Momentum in the y-direction
-
-
-
     # Mesh (nodes (Mx2), triangles (Nx3))
     nodes = num.concatenate((x[:,num.newaxis], y[:,num.newaxis]), axis=1)
     triangles = fid.variables['volumes'][:]
@@ -1364,16 +1345,55 @@ def get_mesh_and_quantities_from_file(filename,
         nodes = nodes.tolist()
         triangles = triangles.tolist()
         nodes, triangles, boundary = weed(nodes, triangles, boundary)        
-        
-        
+
+    fid.close()
 
     try:
         mesh = Mesh(nodes, triangles, boundary, geo_reference=geo_reference)
     except AssertionError, e:
-        fid.close()
         msg = 'Domain could not be created: %s. "' % e
         raise DataDomainError, msg
-    
+
+    return mesh
+
+
+def get_mesh_and_quantities_from_file(filename,
+                                      quantities=None,
+                                      verbose=False):
+    """Get and rebuild mesh structure and associated quantities from sww file
+
+    Input:
+        filename - Name os sww file
+        quantities - Names of quantities to load
+
+    Output:
+        mesh - instance of class Interpolate
+               (including mesh and interpolation functionality)
+        quantities - arrays with quantity values at each mesh node or
+                    each triangle vertex. (depending on whethr stored as smooth or not)
+        time - vector of stored timesteps
+
+    This function is used by e.g.:
+        get_interpolated_quantities_at_polyline_midpoints
+    """
+
+    # FIXME (Ole): Maybe refactor filefunction using this more fundamental code.
+
+    import types
+
+    mesh = get_mesh_from_file(filename, verbose=verbose)
+
+    if verbose: log.critical('Reading from %s' % filename)
+
+    fid = NetCDFFile(filename, netcdf_mode_r)    # Open existing file for read
+    time = fid.variables['time'][:]    # Time vector
+    #time += fid.starttime[0]
+    time += fid.starttime
+
+    elevation = fid.variables['elevation'][:]   # Elevation
+    stage = fid.variables['stage'][:]           # Water level
+    xmomentum = fid.variables['xmomentum'][:]   # Momentum in the x-direction
+    ymomentum = fid.variables['ymomentum'][:]   # Momentum in the y-direction
     
 
     def gather(quantity):
@@ -1450,6 +1470,184 @@ def get_mesh_and_quantities_from_file(filename,
 
     return mesh, quantities, time
 
+# Default maximal number of values (timesteps x points) read from an sww
+# quantity at a time by get_timeseries_at_points_from_file
+DEFAULT_VALUES_PER_BLOCK = 10000000
+
+
+def _build_interpolation_matrix(vertex_coordinates, triangles,
+                                interpolation_points, output_centroids=False,
+                                verbose=False):
+    """Build interpolation matrix from the vertices and triangles of an
+    sww file to interpolation_points (relative to the same origin).
+
+    Return (A, inside_indices, outside_indices, centroids) as
+    returned by Interpolate._build_interpolation_matrix_A
+    """
+
+    from anuga.fit_interpolate.interpolate import Interpolate
+
+    interpol = Interpolate(vertex_coordinates, triangles, verbose=verbose)
+
+    return interpol._build_interpolation_matrix_A(interpolation_points,
+                                                  output_centroids=output_centroids,
+                                                  verbose=verbose)
+
+
+def get_interpolation_matrix_from_file(fid,
+                                       interpolation_points,
+                                       absolute=True,
+                                       output_centroids=False,
+                                       use_cache=False,
+                                       verbose=False):
+    """Build interpolation matrix from the stored vertices of an open
+    sww file to a set of points.
+
+    fid                   open NetCDF sww file
+    interpolation_points  N x 2 array of points
+    absolute              True if interpolation_points are absolute UTM
+                          coordinates, False if they are relative to the
+                          georeference of the sww file
+    output_centroids      True to weight the vertices of the triangle
+                          containing each point equally
+    use_cache             True to cache the matrix with anuga.caching,
+                          otherwise the interpolation cache is used (see
+                          fit_interpolate/interpolation_cache.py)
+
+    The columns of the matrix correspond to the points stored in the
+    file, so it can be applied directly to stored vertex values
+    (smooth or not).
+
+    Return (A, inside_indices, outside_indices, centroids) where A is a
+    Sparse_CSR matrix and the rest are as returned by
+    Interpolate._build_interpolation_matrix_A
+    """
+
+    x = num.array(fid.variables['x'][:], num.float)
+    y = num.array(fid.variables['y'][:], num.float)
+    triangles = num.array(fid.variables['volumes'][:], num.int)
+
+    interpolation_points = num.array(interpolation_points, num.float)
+    if absolute:
+        try:
+            geo_reference = Geo_reference(NetCDFObject=fid)
+        except AttributeError:
+            geo_reference = Geo_reference()
+
+        interpolation_points = \
+                 geo_reference.get_relative(interpolation_points)
+
+    vertex_coordinates = num.concatenate((x[:, num.newaxis],
+                                          y[:, num.newaxis]), axis=1)
+
+    args = (vertex_coordinates, triangles, interpolation_points,
+            output_centroids)
+    if use_cache is True:
+        from anuga.caching import cache
+        A, inside_indices, outside_indices, centroids = \
+            cache(_build_interpolation_matrix, args,
+                  {'verbose': verbose},
+                  verbose=verbose)
+    else:
+        from anuga.fit_interpolate.interpolate import get_interpolation_matrix
+        A, inside_indices, outside_indices, centroids = \
+            get_interpolation_matrix(*args, **{'verbose': verbose})
+
+    return A, inside_indices, outside_indices, centroids
+
+
+def get_timeseries_at_points_from_file(filename,
+                                       quantity_names,
+                                       interpolation_points,
+                                       absolute=True,
+                                       output_centroids=False,
+                                       NODATA_value=None,
+                                       values_per_block=DEFAULT_VALUES_PER_BLOCK,
+                                       use_cache=False,
+                                       verbose=False):
+    """Interpolate quantities of an sww file to points at all timesteps.
+
+    filename              path to sww file
+    quantity_names        names of vertex quantities to interpolate
+    interpolation_points  N x 2 array of points
+    absolute              True if interpolation_points are absolute UTM
+                          coordinates, False if they are relative to the
+                          georeference of the sww file
+    output_centroids      True to use the value at the centroid of the
+                          triangle containing each point
+    NODATA_value          value for points outside the mesh (default NAN)
+    values_per_block      maximal number of stored values read at a time.
+                          Frames are read in blocks of
+                          values_per_block/number_of_points timesteps.
+    use_cache             True to cache the interpolation matrix
+
+    The interpolation matrix is built once and applied to whole blocks of
+    frames, so the cost is dominated by reading the sww file.
+
+    Return (time, starttime, values, centroids)
+    where time is the vector of stored times (relative to starttime),
+          values is a dictionary of N x number_of_timesteps arrays, one for
+                 each quantity name,
+      and centroids are the centroids of the triangles containing the points
+                 (if output_centroids is True).
+    """
+
+    if NODATA_value is None:
+        from anuga.utilities.numerical_tools import NAN
+        NODATA_value = NAN
+
+    fid = NetCDFFile(filename, netcdf_mode_r)
+
+    missing = [name for name in ['time'] + quantity_names
+               if not fid.variables.has_key(name)]
+    if len(missing) > 0:
+        fid.close()
+        msg = 'Quantities %s could not be found in file %s' \
+              % (str(missing), filename)
+        raise Exception(msg)
+
+    time = num.array(fid.variables['time'][:], num.float)
+    starttime = float(fid.starttime)
+    number_of_timesteps = len(time)
+    number_of_points = len(fid.variables['x'])
+
+    if verbose: log.critical('Building interpolation matrix for %d points'
+                             % len(interpolation_points))
+    A, inside_indices, outside_indices, centroids = \
+        get_interpolation_matrix_from_file(fid,
+                                           interpolation_points,
+                                           absolute=absolute,
+                                           output_centroids=output_centroids,
+                                           use_cache=use_cache,
+                                           verbose=verbose)
+
+    frames_per_block = max(1, values_per_block/max(1, number_of_points))
+
+    values = {}
+    for name in quantity_names:
+        var = fid.variables[name]
+
+        if len(var.dimensions) == 1:
+            # Not time dependent
+            q = A * num.array(var[:], num.float)
+            q = num.repeat(q[:, num.newaxis], number_of_timesteps, axis=1)
+        else:
+            if verbose: log.critical('Interpolating %s (%d timesteps)'
+                                     % (name, number_of_timesteps))
+
+            q = num.zeros((A.M, number_of_timesteps), num.float)
+            for start in range(0, number_of_timesteps, frames_per_block):
+                end = min(start + frames_per_block, number_of_timesteps)
+                frames = num.array(var[start:end, :], num.float)
+                q[:, start:end] = A * num.ascontiguousarray(num.transpose(frames))
+
+        q[outside_indices, :] = NODATA_value
+        values[name] = q
+
+    fid.close()
+
+    return time, starttime, values, centroids
+
 
 def get_time_interp(time, t=None):
     """Finds the ratio and index for time interpolation.
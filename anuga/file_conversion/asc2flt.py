@@ -0,0 +1,113 @@
+# external modules
+import os
+import itertools
+import numpy as num
+
+# ANUGA modules
+from anuga.caching.caching import save_atomically
+import anuga.utilities.log as log
+
+
+def asc2flt(name_in, name_out=None, verbose=False):
+    """Convert Digital Elevation Model in ESRI ASCII format (.asc) to an
+    ESRI binary float grid (.flt with header .hdr).
+
+    Example of .asc file:
+    ncols         3121
+    nrows         1800
+    xllcorner     722000
+    yllcorner     5893000
+    cellsize      25
+    NODATA_value  -9999
+    138.3698 137.4194 136.5062 135.5558 ..........
+
+    The .flt file holds the values as 64 bit floats in the order of the
+    .asc file (rows from north to south) so that it can be memory mapped,
+    see anuga.fit_interpolate.raster_sampling. The .hdr file repeats the
+    header of the .asc file.
+
+    The .asc file is converted one row at a time, so files larger than
+    the available memory can be converted.
+
+    name_out is the name of the .flt file. It defaults to name_in with
+    extension .flt. Return name_out.
+    """
+
+    if name_in[-4:] != '.asc':
+        raise IOError('Input file %s should be of type .asc.' % name_in)
+
+    if name_out is None:
+        name_out = name_in[:-4] + '.flt'
+
+    if verbose: log.critical('Converting %s to %s' % (name_in, name_out))
+
+    datafile = open(name_in)
+    try:
+        header, first_line = read_asc_header(datafile)
+
+        ncols = int(header['ncols'])
+        nrows = int(header['nrows'])
+
+        def write_header(header, outfile, compression):
+            for key in ['ncols', 'nrows', 'xllcorner', 'xllcenter',
+                        'yllcorner', 'yllcenter', 'cellsize',
+                        'NODATA_value']:
+                if key.lower() in header:
+                    outfile.write('%-14s%s\n' % (key, header[key.lower()]))
+            outfile.write('%-14s%s\n' % ('byteorder', 'LSBFIRST'))
+            outfile.write('%-14s%s\n' % ('nbits', '64'))
+            outfile.write('%-14s%s\n' % ('pixeltype', 'FLOAT'))
+
+        def write_values(lines, outfile, compression):
+            number_of_values = 0
+            for i, line in enumerate(lines):
+                if line.strip() == '':
+                    continue
+
+                values = num.fromstring(line, dtype=num.float, sep=' ')
+                outfile.write(values.astype('<f8').tostring())
+                number_of_values += len(values)
+
+                if verbose and i % ((nrows+10)/10) == 0:
+                    log.critical('Processing row %d of %d' % (i, nrows))
+
+            if number_of_values != nrows*ncols:
+                msg = ('File %s holds %d values, but there should have '
+                       'been %d' % (name_in, number_of_values, nrows*ncols))
+                raise Exception(msg)
+
+        # Both files are written to temporary files which are then renamed,
+        # the header first, so that other processes never see a partly
+        # written .flt file or a new .flt file with an old header.
+        save_atomically(header, name_out[:-4] + '.hdr', False,
+                        save=write_header)
+        save_atomically(itertools.chain([first_line], datafile), name_out,
+                        False, save=write_values)
+    finally:
+        datafile.close()
+
+    return name_out
+
+
+def read_asc_header(datafile):
+    """Read the header of an open .asc or .hdr file.
+
+    Return dictionary of the header values (strings) with lower case
+    keys, and the first line after the header ('' if none).
+    """
+
+    header = {}
+    while True:
+        line = datafile.readline()
+        fields = line.split()
+        if len(fields) < 2 or not fields[0][0].isalpha():
+            break
+        header[fields[0].lower()] = fields[1]
+
+    for key in ['ncols', 'nrows', 'cellsize']:
+        if key not in header:
+            msg = 'Keyword %s missing in header of %s' % (key, datafile.name)
+            raise Exception(msg)
+
+    return header, line
+
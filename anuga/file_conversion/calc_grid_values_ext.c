@@ -2,6 +2,7 @@
 #include "numpy/arrayobject.h"
 #include <stdio.h>
 #include <math.h>
+#include <stdlib.h>
 //#include <malloc.h>
 
 #define DDATA(p) ((double*)(((PyArrayObject *)p)->data))
@@ -284,15 +285,17 @@ int _is_inside_triangle(double *point,
   return 0;			 			 
 }
 
-void _calc_grid_values( double *x, double *y, double *norms,
-				 int num_vert,
+// For each grid point find the triangle containing it and the
+// interpolation weights of its three vertices. Grid points outside
+// the mesh keep grid_tri = -1.
+void _calc_grid_weights( double *x, double *y, double *norms,
 				 long *volumes, 
 				 int num_tri, 
 				 double cell_size,
 				 int nrow,
 				 int ncol,
-				 double *vertex_val,
-				 double *grid_val )
+				 long *grid_tri,
+				 double *grid_sigma )
 {
 	int i, j, k;
 	int x_min, x_max, y_min, y_max, point_index;
@@ -395,9 +398,10 @@ void _calc_grid_values( double *x, double *y, double *norms,
 					sigma2 = val2 ? val1/val2 : 0;
 
 						
-					grid_val[point_index] = sigma0*vertex_val[volumes[i*3]] + \
-								sigma1*vertex_val[volumes[i*3+1]] + \
-								sigma2*vertex_val[volumes[i*3+2]];
+					grid_tri[point_index] = i;
+					grid_sigma[3*point_index]   = sigma0;
+					grid_sigma[3*point_index+1] = sigma1;
+					grid_sigma[3*point_index+2] = sigma2;
 				}
 			}
 		}
@@ -406,6 +410,50 @@ void _calc_grid_values( double *x, double *y, double *norms,
 
 }
 
+int _calc_grid_values( double *x, double *y, double *norms,
+				 int num_vert,
+				 long *volumes, 
+				 int num_tri, 
+				 double cell_size,
+				 int nrow,
+				 int ncol,
+				 double *vertex_val,
+				 double *grid_val )
+{
+	int i, tri_id;
+	long *grid_tri;
+	double *grid_sigma;
+
+	grid_tri = malloc( nrow*ncol*sizeof( long ) );
+	grid_sigma = malloc( 3*nrow*ncol*sizeof( double ) );
+
+	if ( grid_tri == NULL || grid_sigma == NULL ) {
+		free( grid_tri );
+		free( grid_sigma );
+		return 1;
+	}
+
+	for ( i = 0 ; i < nrow*ncol; i++ ) 
+		grid_tri[i] = -1;
+
+	_calc_grid_weights( x,y, norms, volumes, num_tri, \
+			    cell_size, nrow, ncol, grid_tri, grid_sigma );
+
+	for ( i = 0 ; i < nrow*ncol; i++ ) {
+		tri_id = grid_tri[i];
+		if ( tri_id >= 0 ) {
+			grid_val[i] = grid_sigma[3*i]*vertex_val[volumes[tri_id*3]] + \
+				      grid_sigma[3*i+1]*vertex_val[volumes[tri_id*3+1]] + \
+				      grid_sigma[3*i+2]*vertex_val[volumes[tri_id*3+2]];
+		}
+	}
+
+	free( grid_tri );
+	free( grid_sigma );
+
+	return 0;
+}
+
 static PyObject *calc_grid_values( PyObject *self, PyObject *args )
 {
 	int i, ok, num_tri, num_vert, ncol, nrow, num_norms, num_grid_val;
@@ -471,16 +519,73 @@ static PyObject *calc_grid_values( PyObject *self, PyObject *args )
 
 
 
-	_calc_grid_values( x,y, norms, num_vert, volumes, num_tri, \
+	if ( _calc_grid_values( x,y, norms, num_vert, volumes, num_tri, \
 				    cell_size, nrow, ncol,   	\
-				    result, grid_val );
+				    result, grid_val ) != 0 ) {
+		return PyErr_NoMemory( );
+	}
+
+
+	return Py_BuildValue("");
+}
+
+static PyObject *calc_grid_weights( PyObject *self, PyObject *args )
+{
+	int i, ok, num_tri, ncol, nrow;
+	long *volumes; 
+	long *grid_tri;
+	double cell_size;
+	double *x, *y;
+	double *norms;
+	double *grid_sigma;
+	PyObject *pyobj_x;
+	PyObject *pyobj_y;
+	PyObject *pyobj_norms;
+	PyObject *pyobj_volumes;
+	PyObject *pyobj_grid_tri;
+	PyObject *pyobj_grid_sigma;
+
+	ok = PyArg_ParseTuple( args, "iidOOOOOO",
+				&nrow,
+				&ncol,
+				&cell_size,
+				&pyobj_x,
+				&pyobj_y,
+				&pyobj_norms,
+				&pyobj_volumes, 
+				&pyobj_grid_tri,
+				&pyobj_grid_sigma );
+
+	if( !ok ){
+		fprintf( stderr, "calc_grid_weights: argument parsing error\n" );
+		exit(1);
+	}
+
+	// get data from python objects
+	x = DDATA( pyobj_x );
+	y = DDATA( pyobj_y );
+	norms      = DDATA( pyobj_norms );
+	volumes    = IDATA( pyobj_volumes );
+	grid_tri   = IDATA( pyobj_grid_tri );
+	grid_sigma = DDATA( pyobj_grid_sigma );
+
+	num_tri  = ((PyArrayObject*)pyobj_volumes)->dimensions[0];
+
+	// init triangle array
+	init_norms( x,y, norms, volumes, num_tri );
+
+	for ( i = 0 ; i < nrow*ncol; i++ ) 
+		grid_tri[i] = -1;
 
+	_calc_grid_weights( x,y, norms, volumes, num_tri, \
+			    cell_size, nrow, ncol, grid_tri, grid_sigma );
 
 	return Py_BuildValue("");
 }
 
 static PyMethodDef calc_grid_values_ext_methods[] = {
 	{"calc_grid_values", calc_grid_values, METH_VARARGS},
+	{"calc_grid_weights", calc_grid_weights, METH_VARARGS},
 	{NULL, NULL}
 };
 
@@ -28,6 +28,435 @@ quantity_formula = {'momentum':'(xmomentum**2 + ymomentum**2)**0.5',
 # Default block size for sww2dem()
 DEFAULT_BLOCK_SIZE = 10000
 
+# Maximal number of grid interpolation operators kept in memory
+MAX_CACHED_GRID_OPERATORS = 4
+
+# Grid interpolation operators from recent calls to sww2dem, keyed on
+# mesh and grid (see get_grid_operator)
+_grid_operators = {}
+_grid_operator_keys = []
+
+
+def _calc_grid_operator(x, y, volumes, nrows, ncols, cellsize):
+    """Build the operator interpolating vertex values of the mesh
+    (x, y, volumes) to a grid of nrows x ncols points with spacing cellsize
+    and lower left corner at the origin of x and y.
+
+    Return (A, inside_indices) where A is a sparse (nrows*ncols) x len(x)
+    matrix (Sparse_CSR) and inside_indices are the indices of the grid
+    points inside the mesh.
+    """
+
+    from anuga.utilities.sparse import Sparse_CSR
+    from calc_grid_values_ext import calc_grid_weights
+
+    x = num.ascontiguousarray(x, num.float)
+    y = num.ascontiguousarray(y, num.float)
+    volumes = num.ascontiguousarray(volumes, num.int)
+
+    number_of_grid_points = nrows*ncols
+
+    norms = num.zeros(6*len(volumes), num.float)
+    grid_tri = num.zeros(number_of_grid_points, num.int)
+    grid_sigma = num.zeros((number_of_grid_points, 3), num.float)
+
+    calc_grid_weights(nrows, ncols, float(cellsize), x, y, norms, volumes,
+                      grid_tri, grid_sigma)
+
+    inside = grid_tri >= 0
+
+    data = grid_sigma[inside].flatten()
+    colind = volumes[grid_tri[inside]].flatten()
+    row_ptr = num.zeros(number_of_grid_points + 1, num.int)
+    row_ptr[1:] = num.cumsum(3*inside)
+
+    A = Sparse_CSR(None, data, colind, row_ptr,
+                   int(number_of_grid_points), int(len(x)))
+
+    return A, num.where(inside)[0]
+
+
+def get_grid_operator(x, y, volumes, nrows, ncols, cellsize,
+                      use_cache=False, keep_in_memory=True, verbose=False):
+    """Get operator interpolating vertex values to a grid.
+
+    x, y       vertex coordinates relative to the lower left corner of the
+               grid
+    volumes    triangles of the mesh
+    nrows, ncols, cellsize  grid specification
+    use_cache  True to also cache the operator on disk with anuga.caching
+    keep_in_memory  False to neither look up nor store the operator in
+               the memory cache of the module
+
+    The operator depends only on the mesh and the grid, so it is kept in
+    memory keyed on both and reused for any quantity, timestep or
+    reduction. Grid values are obtained as A*vertex_values at the
+    inside_indices.
+
+    Return (A, inside_indices) as computed by _calc_grid_operator.
+    """
+
+    import hashlib
+
+    x = num.ascontiguousarray(x, num.float)
+    y = num.ascontiguousarray(y, num.float)
+    volumes = num.ascontiguousarray(volumes, num.int)
+
+    args = (x, y, volumes, nrows, ncols, cellsize)
+    if keep_in_memory is False:
+        if use_cache is True:
+            from anuga.caching import cache
+            return cache(_calc_grid_operator, args, verbose=verbose)
+        return _calc_grid_operator(*args)
+
+    hasher = hashlib.md5()
+    for array in [x, y, volumes]:
+        hasher.update(array.tostring())
+    hasher.update('%d %d %.17g' % (nrows, ncols, cellsize))
+    key = hasher.hexdigest()
+
+    if key in _grid_operators:
+        return _grid_operators[key]
+
+    if use_cache is True:
+        from anuga.caching import cache
+        operator = cache(_calc_grid_operator, args, verbose=verbose)
+    else:
+        operator = _calc_grid_operator(*args)
+
+    if len(_grid_operator_keys) >= MAX_CACHED_GRID_OPERATORS:
+        del _grid_operators[_grid_operator_keys.pop(0)]
+    _grid_operators[key] = operator
+    _grid_operator_keys.append(key)
+
+    return operator
+
+
+
+# Default tile size (number of grid rows and columns) for tiled export
+DEFAULT_TILE_SIZE = 1000
+
+
+def _write_prj_file(prjfile, zone, datum, false_easting, false_northing):
+    """Write projection file accompanying an asc file
+    """
+
+    prjid = open(prjfile, 'w')
+    prjid.write('Projection    %s\n' %'UTM')
+    prjid.write('Zone          %d\n' %zone)
+    prjid.write('Datum         %s\n' %datum)
+    prjid.write('Zunits        NO\n')
+    prjid.write('Units         METERS\n')
+    prjid.write('Spheroid      %s\n' %datum)
+    prjid.write('Xshift        %d\n' %false_easting)
+    prjid.write('Yshift        %d\n' %false_northing)
+    prjid.write('Parameters\n')
+    prjid.close()
+
+
+def _write_asc_header(ascid, ncols, nrows, xllcorner, yllcorner,
+                      cellsize, NODATA_value):
+
+    ascid.write('ncols         %d\n' %ncols)
+    ascid.write('nrows         %d\n' %nrows)
+    ascid.write('xllcorner     %f\n' %xllcorner)
+    ascid.write('yllcorner     %f\n' %yllcorner)
+    ascid.write('cellsize      %f\n' %cellsize)
+    ascid.write('NODATA_value  %d\n' %NODATA_value)
+
+
+def _get_tile_index(x, y, volumes, cellsize, tile_size,
+                    number_of_tile_rows, number_of_tile_cols):
+    """Spatial index of the triangles overlapping each tile of the grid.
+
+    Tile (r, c) holds grid rows r*tile_size to (r+1)*tile_size-1 and
+    grid columns c*tile_size to (c+1)*tile_size-1, and has index
+    r*number_of_tile_cols + c.
+
+    Return (triangle_ids, tile_ptr) where the triangles overlapping tile k
+    are triangle_ids[tile_ptr[k]:tile_ptr[k+1]], in their original order.
+    """
+
+    # Small tolerance so that grid points on triangle edges are kept
+    epsilon = 1.0e-6
+
+    triangle_x = x[volumes]
+    triangle_y = y[volumes]
+
+    tile_extent = tile_size*cellsize
+    col0 = num.floor((num.min(triangle_x, axis=1) - epsilon)/tile_extent)
+    col1 = num.floor((num.max(triangle_x, axis=1) + epsilon)/tile_extent)
+    row0 = num.floor((num.min(triangle_y, axis=1) - epsilon)/tile_extent)
+    row1 = num.floor((num.max(triangle_y, axis=1) + epsilon)/tile_extent)
+
+    col0 = num.maximum(col0, 0).astype(num.int)
+    row0 = num.maximum(row0, 0).astype(num.int)
+    col1 = num.minimum(col1, number_of_tile_cols - 1).astype(num.int)
+    row1 = num.minimum(row1, number_of_tile_rows - 1).astype(num.int)
+
+    # Number of tiles overlapped by each triangle (0 if off the grid)
+    width = num.maximum(col1 - col0 + 1, 0)
+    height = num.maximum(row1 - row0 + 1, 0)
+    counts = width*height
+
+    # One entry for each (triangle, tile) pair
+    triangle_ids = num.repeat(num.arange(len(volumes)), counts)
+    offsets = num.arange(len(triangle_ids)) - \
+              num.repeat(num.cumsum(counts) - counts, counts)
+    width = width[triangle_ids]
+    tiles = (row0[triangle_ids] + offsets/width)*number_of_tile_cols + \
+            col0[triangle_ids] + offsets%width
+
+    # Stable sort keeps triangles of each tile in their original order
+    order = num.argsort(tiles, kind='mergesort')
+    triangle_ids = triangle_ids[order]
+    tile_ptr = num.searchsorted(tiles[order],
+                    num.arange(number_of_tile_rows*number_of_tile_cols + 1))
+
+    return triangle_ids, tile_ptr
+
+
+def _calc_tile_values(args):
+    """Rasterise one tile. 
+
+    args is the tuple (x, y, volumes, vertex_values, nrows, ncols, cellsize,
+    NODATA_value, use_cache) describing the triangles overlapping the tile,
+    with x and y relative to the lower left grid point of the tile.
+
+    The grid operator of the tile is built by get_grid_operator without
+    keeping it in the memory cache of the module, as the few entries
+    there would be evicted by the other tiles. With use_cache True it is
+    cached on disk, so repeated runs on the same mesh and tiling reuse it.
+
+    Return array of nrows x ncols grid values with the southern row first.
+    """
+
+    x, y, volumes, vertex_values, nrows, ncols, cellsize, NODATA_value, \
+        use_cache = args
+
+    grid_values = num.zeros(nrows*ncols, num.float)
+    grid_values[:] = NODATA_value
+
+    if len(volumes) > 0:
+        A, inside_indices = get_grid_operator(x, y, volumes,
+                                              nrows, ncols, cellsize,
+                                              use_cache=use_cache,
+                                              keep_in_memory=False)
+        grid_values[inside_indices] = (A * vertex_values)[inside_indices]
+
+    return num.reshape(grid_values, (nrows, ncols))
+
+
+def _get_tile_args(tile_row, tile_col, triangle_ids, tile_ptr,
+                   x, y, volumes, vertex_values,
+                   nrows, ncols, cellsize, tile_size,
+                   number_of_tile_cols, NODATA_value, use_cache=False):
+    """Extract the part of the mesh needed to rasterise tile
+    (tile_row, tile_col). See _calc_tile_values
+    """
+
+    k = tile_row*number_of_tile_cols + tile_col
+    triangles = volumes[triangle_ids[tile_ptr[k]:tile_ptr[k+1]]]
+
+    # Renumber the vertices used by these triangles
+    vertices, tile_volumes = num.unique(triangles, return_inverse=True)
+    tile_volumes = num.reshape(tile_volumes, triangles.shape).astype(num.int)
+
+    tile_x = x[vertices] - tile_col*tile_size*cellsize
+    tile_y = y[vertices] - tile_row*tile_size*cellsize
+
+    tile_nrows = min(tile_size, nrows - tile_row*tile_size)
+    tile_ncols = min(tile_size, ncols - tile_col*tile_size)
+
+    return (num.ascontiguousarray(tile_x, num.float),
+            num.ascontiguousarray(tile_y, num.float),
+            num.ascontiguousarray(tile_volumes, num.int),
+            num.ascontiguousarray(vertex_values[vertices], num.float),
+            tile_nrows, tile_ncols, float(cellsize), float(NODATA_value),
+            use_cache)
+
+
+def _write_vrt_file(vrtfile, tiles, nrows, ncols,
+                    xllcorner, yllcorner, cellsize, NODATA_value):
+    """Write a GDAL virtual raster (VRT) mosaic of the asc tiles.
+
+    tiles is a list of (filename, xoff, yoff, ncols, nrows) where xoff
+    and yoff are the column and row offsets of the tile from the north
+    west corner of the mosaic.
+    """
+
+    vrtid = open(vrtfile, 'w')
+    vrtid.write('<VRTDataset rasterXSize="%d" rasterYSize="%d">\n'
+                % (ncols, nrows))
+    vrtid.write('  <GeoTransform>%.10f, %.10f, 0.0, %.10f, 0.0, %.10f'
+                '</GeoTransform>\n'
+                % (xllcorner, cellsize, yllcorner + nrows*cellsize,
+                   -cellsize))
+    vrtid.write('  <VRTRasterBand dataType="Float64" band="1">\n')
+    vrtid.write('    <NoDataValue>%f</NoDataValue>\n' % NODATA_value)
+    for filename, xoff, yoff, tile_ncols, tile_nrows in tiles:
+        vrtid.write('    <SimpleSource>\n')
+        vrtid.write('      <SourceFilename relativeToVRT="1">%s'
+                    '</SourceFilename>\n' % filename)
+        vrtid.write('      <SourceBand>1</SourceBand>\n')
+        vrtid.write('      <SrcRect xOff="0" yOff="0" xSize="%d" ySize="%d"/>\n'
+                    % (tile_ncols, tile_nrows))
+        vrtid.write('      <DstRect xOff="%d" yOff="%d" xSize="%d" ySize="%d"/>\n'
+                    % (xoff, yoff, tile_ncols, tile_nrows))
+        vrtid.write('    </SimpleSource>\n')
+    vrtid.write('  </VRTRasterBand>\n')
+    vrtid.write('</VRTDataset>\n')
+    vrtid.close()
+
+
+def _export_tiled_grid(name_out, x, y, volumes, vertex_values,
+                       nrows, ncols, cellsize, NODATA_value,
+                       xllcorner, yllcorner, zone, datum, quantity,
+                       number_of_decimal_places,
+                       false_easting, false_northing,
+                       tile_size=DEFAULT_TILE_SIZE,
+                       number_of_processes=1,
+                       use_cache=False,
+                       verbose=False):
+    """Rasterise vertex_values on the mesh (x, y, volumes) tile by tile.
+
+    The grid has nrows x ncols points with spacing cellsize, x and y being
+    relative to the lower left grid point (xllcorner, yllcorner).
+
+    Tiles are rasterised with number_of_processes processes and written as
+    soon as a row of tiles is complete, so only one row of tiles is held in
+    memory. Depending on the extension of name_out the result is written to
+
+    .asc   one ascii grid (and .prj file)
+    .ers   one ERMapper grid
+    .vrt   one ascii grid (and .prj file) per tile named
+           <basename>_<tile_row>_<tile_col>.asc and a GDAL virtual raster
+           name_out referring to them.
+    """
+
+    basename_out, out_ext = os.path.splitext(name_out)
+
+    number_of_tile_rows = (nrows + tile_size - 1)/tile_size
+    number_of_tile_cols = (ncols + tile_size - 1)/tile_size
+
+    if verbose:
+        log.critical('Rasterising %d x %d tiles of %d x %d cells'
+                     % (number_of_tile_rows, number_of_tile_cols,
+                        tile_size, tile_size))
+
+    triangle_ids, tile_ptr = _get_tile_index(x, y, volumes, cellsize,
+                                             tile_size,
+                                             number_of_tile_rows,
+                                             number_of_tile_cols)
+
+    format = '%.'+'%g' % number_of_decimal_places +'e'
+
+    if out_ext == '.asc':
+        if verbose: log.critical('Writing %s' % name_out)
+        _write_prj_file(basename_out + '.prj', zone, datum,
+                        false_easting, false_northing)
+        outid = open(name_out, 'w')
+        _write_asc_header(outid, ncols, nrows, xllcorner, yllcorner,
+                          cellsize, NODATA_value)
+    elif out_ext == '.ers':
+        import anuga.abstract_2d_finite_volumes.ermapper_grids as \
+               ermapper_grids
+
+        if verbose: log.critical('Writing %s' % name_out)
+        header = {}
+        header['datum'] = '"' + datum + '"'
+        header['projection'] = '"UTM-' + str(zone) + '"'
+        header['coordinatetype'] = 'EN'
+        header['eastings'] = str(xllcorner)
+        header['northings'] = str(yllcorner)
+        header['nullcellvalue'] = str(NODATA_value)
+        header['xdimension'] = str(cellsize)
+        header['ydimension'] = str(cellsize)
+        header['value'] = '"' + quantity + '"'
+        header['nroflines'] = str(nrows)
+        header['nrofcellsperline'] = str(ncols)
+        header = ermapper_grids.create_default_header(header)
+        ermapper_grids.write_ermapper_header(name_out, header)
+        data_format = ermapper_grids.celltype_map[header['celltype']]
+        outid = open(basename_out, 'wb')
+    else:
+        tiles = []
+
+    pool = None
+    try:
+        if number_of_processes > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(number_of_processes)
+            map_function = pool.map
+        else:
+            map_function = map
+
+        # Rows of tiles from north to south
+        for tile_row in range(number_of_tile_rows-1, -1, -1):
+            if verbose:
+                log.critical('Doing row of tiles %d of %d'
+                             % (number_of_tile_rows - tile_row,
+                                number_of_tile_rows))
+
+            tile_args = [_get_tile_args(tile_row, tile_col,
+                                        triangle_ids, tile_ptr,
+                                        x, y, volumes, vertex_values,
+                                        nrows, ncols, cellsize, tile_size,
+                                        number_of_tile_cols, NODATA_value,
+                                        use_cache)
+                         for tile_col in range(number_of_tile_cols)]
+
+            tile_values = map_function(_calc_tile_values, tile_args)
+
+            if out_ext == '.vrt':
+                for tile_col, values in enumerate(tile_values):
+                    tile_nrows, tile_ncols = values.shape
+                    tile_name = '%s_%d_%d.asc' % (basename_out, tile_row,
+                                                  tile_col)
+
+                    _write_prj_file(os.path.splitext(tile_name)[0] + '.prj',
+                                    zone, datum, false_easting, false_northing)
+                    tileid = open(tile_name, 'w')
+                    _write_asc_header(tileid, tile_ncols, tile_nrows,
+                                      xllcorner + tile_col*tile_size*cellsize,
+                                      yllcorner + tile_row*tile_size*cellsize,
+                                      cellsize, NODATA_value)
+                    num.savetxt(tileid, values[::-1, :], format, ' ')
+                    tileid.close()
+
+                    tiles.append((os.path.basename(tile_name),
+                                  tile_col*tile_size,
+                                  nrows - tile_row*tile_size - tile_nrows,
+                                  tile_ncols, tile_nrows))
+            else:
+                # Northern grid row first
+                band = num.concatenate(tile_values, axis=1)[::-1, :]
+
+                if out_ext == '.asc':
+                    num.savetxt(outid, band, format, ' ')
+                else:
+                    outid.write(band.astype(data_format).tostring())
+
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        if out_ext != '.vrt':
+            outid.close()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+
+    if out_ext == '.vrt':
+        if verbose: log.critical('Writing %s' % name_out)
+        _write_vrt_file(name_out, tiles, nrows, ncols,
+                        xllcorner, yllcorner, cellsize, NODATA_value)
+    else:
+        outid.close()
+
+
 def sww2dem(name_in, name_out,
             quantity=None, # defaults to elevation
             reduction=None,
@@ -41,7 +470,10 @@ def sww2dem(name_in, name_out,
             verbose=False,
             origin=None,
             datum='WGS84',
-            block_size=None):
+            block_size=None,
+            use_cache=False,
+            tile_size=None,
+            number_of_processes=1):
     """Read SWW file and convert to Digitial Elevation model format
     (.asc or .ers)
 
@@ -86,6 +518,18 @@ def sww2dem(name_in, name_out,
     format can be either 'asc' or 'ers'
     block_size - sets the number of slices along the non-time axis to
                  process in one block.
+    use_cache - True to cache the grid interpolation operator on disk.
+                The operator is always reused in memory by subsequent
+                calls with the same mesh and grid (see get_grid_operator).
+    tile_size - if given, rasterise the grid in tiles of tile_size x
+                tile_size cells and write them as they are completed,
+                so the whole grid is never held in memory. Only the
+                triangles overlapping a tile are used for it. With tiles,
+                name_out may also have extension .vrt, in which case each
+                tile is written to its own asc file and name_out is a GDAL
+                virtual raster mosaic of them.
+    number_of_processes - number of processes rasterising tiles
+                (only used with tile_size)
     """
 
     import sys
@@ -102,7 +546,9 @@ def sww2dem(name_in, name_out,
     if in_ext != '.sww':
         raise IOError('Input format for %s must be .sww' % name_in)
 
-    if out_ext not in ['.asc', '.ers']:
+    if tile_size is not None and out_ext == '.vrt':
+        pass
+    elif out_ext not in ['.asc', '.ers']:
         raise IOError('Format for %s must be either asc or ers.' % name_out)
 
     false_easting = 500000
@@ -239,7 +685,12 @@ def sww2dem(name_in, name_out,
         for name in var_list:
             # check if variable has time axis
             if len(fid.variables[name].shape) == 2:
-                q_dict[name] = fid.variables[name][:,start_slice:end_slice]
+                if type(reduction) is not types.BuiltinFunctionType:
+                    # Only read the requested timestep
+                    q_dict[name] = fid.variables[name][reduction,
+                                                       start_slice:end_slice]
+                else:
+                    q_dict[name] = fid.variables[name][:,start_slice:end_slice]
             else:       # no time axis
                 q_dict[name] = fid.variables[name][start_slice:end_slice]
 
@@ -247,13 +698,16 @@ def sww2dem(name_in, name_out,
         res = apply_expression_to_dictionary(quantity, q_dict)
 
         if len(res.shape) == 2:
-            new_res = num.zeros(res.shape[1], num.float)
-            for k in xrange(res.shape[1]):
-                if type(reduction) is not types.BuiltinFunctionType:
-                    new_res[k] = res[reduction,k]
-                else:
+            # Reduce over time
+            if reduction is max:
+                res = num.max(res, axis=0)
+            elif reduction is min:
+                res = num.min(res, axis=0)
+            else:
+                new_res = num.zeros(res.shape[1], num.float)
+                for k in xrange(res.shape[1]):
                     new_res[k] = reduction(res[:,k])
-            res = new_res
+                res = new_res
 
         result[start_slice:end_slice] = res
                                     
@@ -306,6 +760,19 @@ def sww2dem(name_in, name_out,
     x = x + xllcorner - newxllcorner
     y = y + yllcorner - newyllcorner
 
+    if tile_size is not None:
+        _export_tiled_grid(name_out, x, y, volumes, result,
+                           nrows, ncols, cellsize, NODATA_value,
+                           newxllcorner, newyllcorner, zone, datum, quantity,
+                           number_of_decimal_places,
+                           false_easting, false_northing,
+                           tile_size=tile_size,
+                           number_of_processes=number_of_processes,
+                           use_cache=use_cache,
+                           verbose=verbose)
+        fid.close()
+
+        return basename_out
 
     grid_values = num.zeros( (nrows*ncols, ), num.float)
     #print '---',grid_values.shape
@@ -355,14 +822,13 @@ def sww2dem(name_in, name_out,
 
         return
 
-    num_tri =  len(volumes)
-    norms = num.zeros(6*num_tri, num.float)
-
-    #print norms
-    from calc_grid_values_ext import calc_grid_values
+    A, inside_indices = get_grid_operator(x, y, volumes,
+                                          nrows, ncols, cellsize,
+                                          use_cache=use_cache,
+                                          verbose=verbose)
 
-    calc_grid_values(nrows, ncols, cellsize, NODATA_value,
-                     x,y, norms, volumes, result, grid_values)
+    grid_values[:] = NODATA_value
+    grid_values[inside_indices] = (A * result)[inside_indices]
 
 
 
@@ -418,17 +884,7 @@ def sww2dem(name_in, name_out,
         prjfile = basename_out + '.prj'
 
         if verbose: log.critical('Writing %s' % prjfile)
-        prjid = open(prjfile, 'w')
-        prjid.write('Projection    %s\n' %'UTM')
-        prjid.write('Zone          %d\n' %zone)
-        prjid.write('Datum         %s\n' %datum)
-        prjid.write('Zunits        NO\n')
-        prjid.write('Units         METERS\n')
-        prjid.write('Spheroid      %s\n' %datum)
-        prjid.write('Xshift        %d\n' %false_easting)
-        prjid.write('Yshift        %d\n' %false_northing)
-        prjid.write('Parameters\n')
-        prjid.close()
+        _write_prj_file(prjfile, zone, datum, false_easting, false_northing)
 
         if verbose: log.critical('Writing %s' % name_out)
 
@@ -483,7 +939,10 @@ def sww2dem_batch(basename_in, extra_name_out=None,
                 verbose=False,
                 origin=None,
                 datum='WGS84',
-                format='ers'):
+                format='ers',
+                use_cache=False,
+                tile_size=None,
+                number_of_processes=1):
     """Wrapper for sww2dem.
     See sww2dem to find out what most of the parameters do. Note that since this
     is a batch command, the normal filename naming conventions do not apply.
@@ -500,6 +959,9 @@ def sww2dem_batch(basename_in, extra_name_out=None,
     This function returns the names of the files produced.
 
     It will also produce as many output files as there are input sww files.
+
+    The grid interpolation operator of each sww file is computed once and
+    reused for all quantities.
     """
 
     if quantities is None:
@@ -543,7 +1005,10 @@ def sww2dem_batch(basename_in, extra_name_out=None,
                                northing_max,
                                verbose,
                                origin,
-                               datum)
+                               datum,
+                               use_cache=use_cache,
+                               tile_size=tile_size,
+                               number_of_processes=number_of_processes)
                                
             files_out.append(file_out)
     return files_out
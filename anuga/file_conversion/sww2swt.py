@@ -0,0 +1,120 @@
+"""
+    Module to build the time series sidecar (.swt) of an SWW file.
+"""
+
+import os
+import numpy as num
+
+from anuga.config import netcdf_mode_r, netcdf_mode_w
+from anuga.file.netcdf import NetCDFFile
+from anuga.file.swt import get_swt_filename
+import anuga.utilities.log as log
+
+
+# Default number of points (or triangles) transposed per block
+DEFAULT_CELLS_PER_CHUNK = 10000
+
+
+def sww2swt(name_in, name_out=None,
+            quantities=None,
+            cells_per_chunk=DEFAULT_CELLS_PER_CHUNK,
+            verbose=False):
+    """Write time series sidecar of SWW file name_in.
+
+    name_in          path to SWW file
+    name_out         name of sidecar (default: name_in with extension .swt)
+    quantities       names of time dependent quantities to transpose
+                     (default: all time dependent quantities in name_in)
+    cells_per_chunk  number of points (or triangles) read and written
+                     at a time. Memory use is proportional to
+                     cells_per_chunk x number_of_timesteps.
+    verbose          True if this function is to be verbose
+
+    The sidecar stores each time dependent quantity as a
+    number_of_points x number_of_timesteps array (number_of_volumes x
+    number_of_timesteps for centroid quantities), so the time series at a
+    point is contiguous on disk.
+
+    sww2csv_gauges, get_flow_through_cross_section and
+    get_maximum_inundation_data use the sidecar automatically when it is
+    present and up to date.
+
+    Return name of sidecar.
+    """
+
+    basename_in, in_ext = os.path.splitext(name_in)
+
+    if in_ext != '.sww':
+        raise IOError('Input format for %s must be .sww' % name_in)
+
+    if name_out is None:
+        name_out = get_swt_filename(name_in)
+
+    if os.path.splitext(name_out)[1] != '.swt':
+        raise IOError('Output format for %s must be .swt' % name_out)
+
+    msg = 'cells_per_chunk must be positive. I got %s' % cells_per_chunk
+    assert cells_per_chunk > 0, msg
+
+    if verbose: log.critical('Reading from %s' % name_in)
+    fid = NetCDFFile(name_in, netcdf_mode_r)
+
+    # Time dependent quantities have dimensions
+    # (number_of_timesteps, number_of_points or number_of_volumes)
+    available = []
+    for name in fid.variables.keys():
+        dimensions = fid.variables[name].dimensions
+        if len(dimensions) == 2 and dimensions[0] == 'number_of_timesteps':
+            available.append(name)
+
+    if quantities is None:
+        quantities = available
+
+    missing = [name for name in quantities if name not in available]
+    if len(missing) > 0:
+        fid.close()
+        msg = 'Quantities %s are not time dependent quantities of %s' \
+              % (str(missing), name_in)
+        raise Exception(msg)
+
+    time = fid.variables['time'][:]
+    number_of_timesteps = len(time)
+
+    if verbose: log.critical('Writing to %s' % name_out)
+    outfile = NetCDFFile(name_out, netcdf_mode_w)
+
+    outfile.institution = 'Geoscience Australia'
+    outfile.description = 'Time series sidecar of %s' \
+                          % os.path.basename(name_in)
+    outfile.starttime = fid.starttime
+    outfile.cells_per_chunk = cells_per_chunk
+
+    outfile.createDimension('number_of_timesteps', number_of_timesteps)
+    outfile.createVariable('time', fid.variables['time'].dtype,
+                           ('number_of_timesteps',))
+    outfile.variables['time'][:] = time
+
+    for name in quantities:
+        var = fid.variables[name]
+        cell_dimension = var.dimensions[1]
+        number_of_cells = var.shape[1]
+
+        if cell_dimension not in outfile.dimensions:
+            outfile.createDimension(cell_dimension, number_of_cells)
+
+        outfile.createVariable(name, var.dtype,
+                               (cell_dimension, 'number_of_timesteps'))
+
+        if verbose:
+            log.critical('Transposing %s (%d x %d)'
+                         % (name, number_of_timesteps, number_of_cells))
+
+        out = outfile.variables[name]
+        for start in range(0, number_of_cells, cells_per_chunk):
+            end = min(start + cells_per_chunk, number_of_cells)
+            out[start:end, :] = num.transpose(var[:, start:end])
+
+    outfile.close()
+    fid.close()
+
+    return name_out
@@ -36,6 +36,13 @@ class Capturing(list):
         self.extend(self._stringio.getvalue().splitlines())
         sys.stdout = self._stdout
 
+
+def failing_tile_values(args):
+    """Replacement of sww2dem._calc_tile_values failing for every tile
+    """
+    raise ValueError('Tile failed')
+
+
 class Test_Sww2Dem(unittest.TestCase):
     def setUp(self):
         import time
@@ -2274,6 +2281,176 @@ Doing row 4 of 5'''
         
         
 
+
+    def test_sww2dem_grid_operator(self):
+        """Test that the cached grid interpolation operator reproduces
+        calc_grid_values and is reused for the same mesh and grid
+        """
+
+        from anuga.file_conversion.sww2dem import get_grid_operator
+        from anuga.file_conversion.calc_grid_values_ext import \
+             calc_grid_values
+
+        x = num.array(self.domain.mesh.nodes[:, 0], num.float) + 0.05
+        y = num.array(self.domain.mesh.nodes[:, 1], num.float) + 0.05
+        volumes = num.array(self.domain.mesh.triangles, num.int)
+
+        nrows = 12
+        ncols = 13
+        cellsize = 0.1
+        NODATA_value = -9999.0
+
+        A, inside_indices = get_grid_operator(x, y, volumes,
+                                              nrows, ncols, cellsize)
+
+        # Same mesh and grid gives the same operator
+        B, _ = get_grid_operator(x, y, volumes, nrows, ncols, cellsize)
+        assert A is B
+
+        # Different grid gives a new one
+        C, _ = get_grid_operator(x, y, volumes, nrows, ncols, 0.2)
+        assert C is not A
+
+        for values in [x + 2*y, num.sin(x)*num.cos(y), x*0 + 1.0]:
+            reference = num.zeros(nrows*ncols, num.float)
+            norms = num.zeros(6*len(volumes), num.float)
+            calc_grid_values(nrows, ncols, cellsize, NODATA_value,
+                             x, y, norms, volumes, values, reference)
+
+            grid_values = num.zeros(nrows*ncols, num.float)
+            grid_values[:] = NODATA_value
+            grid_values[inside_indices] = (A * values)[inside_indices]
+
+            assert num.allclose(grid_values, reference)
+
+        # Grid points off the mesh are NODATA
+        assert len(inside_indices) < nrows*ncols
+        assert num.alltrue(reference[inside_indices] != NODATA_value)
+
+
+    def test_sww2dem_tiled(self):
+        """Test that tiled export gives the same grids as sww2dem
+        """
+
+        from anuga.abstract_2d_finite_volumes.mesh_factory import \
+             rectangular_cross
+        import anuga.abstract_2d_finite_volumes.ermapper_grids as \
+               ermapper_grids
+
+        points, vertices, boundary = rectangular_cross(13, 9, len1=13.0,
+                                                       len2=9.0)
+        domain = Domain(points, vertices, boundary)
+        domain.set_name('datatest_tiled')
+        domain.set_datadir('.')
+        domain.geo_reference = Geo_reference(56, 308500, 6189000)
+        domain.set_quantity('elevation', lambda x, y: -x/3.0 + num.sin(y))
+        domain.set_quantity('stage', 0.0)
+
+        sww = SWW_file(domain)
+        sww.store_connectivity()
+        sww.store_timestep()
+
+        swwfile = sww.filename
+        basename = 'datatest_tiled_depth'
+
+        def read_asc(filename):
+            fid = open(filename)
+            lines = fid.readlines()
+            fid.close()
+            header = [line.split()[1] for line in lines[:6]]
+            values = num.array([[float(v) for v in line.split()]
+                                for line in lines[6:]])
+            return header, values
+
+        sww2dem(swwfile, basename + '.asc', quantity='depth',
+                cellsize=0.4, number_of_decimal_places=9)
+        header, reference = read_asc(basename + '.asc')
+
+        sww2dem(swwfile, basename + '.ers', quantity='depth',
+                cellsize=0.4)
+        ers_reference = ermapper_grids.read_ermapper_grid(basename + '.ers')
+
+        for tile_size, processes in [(7, 1), (10, 2), (1000, 1)]:
+            sww2dem(swwfile, basename + '.asc', quantity='depth',
+                    cellsize=0.4, number_of_decimal_places=9,
+                    tile_size=tile_size, number_of_processes=processes)
+            tiled_header, values = read_asc(basename + '.asc')
+
+            assert tiled_header[:2] == header[:2]
+            assert num.allclose(float(tiled_header[2]), 308500)
+            assert num.allclose(float(tiled_header[3]), 6189000)
+            assert num.allclose(values, reference)
+
+            sww2dem(swwfile, basename + '.ers', quantity='depth',
+                    cellsize=0.4, tile_size=tile_size,
+                    number_of_processes=processes)
+            ers_values = ermapper_grids.read_ermapper_grid(basename + '.ers')
+            assert num.allclose(ers_values, ers_reference)
+
+        # Separate tiles and a virtual raster mosaic
+        nrows, ncols = reference.shape
+        tile_size = 8
+        sww2dem(swwfile, basename + '.vrt', quantity='depth',
+                cellsize=0.4, number_of_decimal_places=9,
+                tile_size=tile_size)
+
+        fid = open(basename + '.vrt')
+        vrt = fid.read()
+        fid.close()
+        assert 'rasterXSize="%d" rasterYSize="%d"' % (ncols, nrows) in vrt
+
+        tile_files = []
+        for tile_row in range((nrows + tile_size - 1)/tile_size):
+            for tile_col in range((ncols + tile_size - 1)/tile_size):
+                tile_name = '%s_%d_%d' % (basename, tile_row, tile_col)
+                assert tile_name + '.asc' in vrt
+                tile_files += [tile_name + '.asc', tile_name + '.prj']
+
+                _, values = read_asc(tile_name + '.asc')
+
+                i0 = nrows - tile_row*tile_size - values.shape[0]
+                j0 = tile_col*tile_size
+                assert num.allclose(values,
+                                    reference[i0:i0+values.shape[0],
+                                              j0:j0+values.shape[1]])
+
+        # Tile operators do not evict the operators kept in memory
+        import sys
+        sww2dem_module = sys.modules['anuga.file_conversion.sww2dem']
+        sww2dem_module._grid_operators.clear()
+        del sww2dem_module._grid_operator_keys[:]
+
+        sww2dem(swwfile, basename + '.asc', quantity='depth',
+                cellsize=0.4, number_of_decimal_places=9)
+        assert len(sww2dem_module._grid_operators) == 1
+        operator = sww2dem_module._grid_operators.values()[0]
+
+        sww2dem(swwfile, basename + '.asc', quantity='stage',
+                cellsize=0.4, number_of_decimal_places=9, tile_size=7)
+        assert sww2dem_module._grid_operators.values() == [operator]
+
+        # A failing tile stops the worker processes
+        import multiprocessing
+        calc_tile_values = sww2dem_module._calc_tile_values
+        sww2dem_module._calc_tile_values = failing_tile_values
+        try:
+            try:
+                sww2dem(swwfile, basename + '.asc', quantity='depth',
+                        cellsize=0.4, tile_size=7, number_of_processes=2)
+            except ValueError:
+                pass
+            else:
+                raise Exception('Failing tile should have raised an error')
+        finally:
+            sww2dem_module._calc_tile_values = calc_tile_values
+
+        assert multiprocessing.active_children() == []
+
+        for filename in [swwfile, basename + '.asc', basename + '.prj',
+                         basename + '.ers', basename,
+                         basename + '.vrt'] + tile_files:
+            os.remove(filename)
+
 #################################################################################
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import unittest
+import os
+import tempfile
+from csv import reader
+
+import numpy as num
+
+from anuga.shallow_water.shallow_water_domain import Domain
+from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular_cross
+from anuga.shallow_water.boundaries import Reflective_boundary
+from anuga.abstract_2d_finite_volumes.generic_boundary_conditions \
+                            import Dirichlet_boundary
+from anuga.file.netcdf import NetCDFFile
+from anuga.file.swt import Read_swt, get_swt_filename, \
+                           get_current_swt_filename
+
+# local modules
+from anuga.file_conversion.sww2swt import sww2swt
+
+
+class Test_sww2swt(unittest.TestCase):
+
+    def setUp(self):
+
+        self.filename = 'swt_test'
+        self.swwfile = self.filename + '.sww'
+        self.swtfile = self.filename + '.swt'
+
+    def tearDown(self):
+
+        for filename in [self.swwfile, self.swtfile,
+                         'swt_gauge_point1.csv', 'swt_gauge_point2.csv']:
+            try:
+                os.remove(filename)
+            except:
+                pass
+
+    def _create_sww(self, store_vertices_uniquely=False,
+                    store_centroids=True):
+        """Run up a linear bed slope and store it in an sww file
+        """
+
+        points, vertices, boundary = rectangular_cross(10, 6, len1=10.0,
+                                                       len2=6.0)
+        domain = Domain(points, vertices, boundary)
+        domain.set_name(self.filename)
+        domain.set_datadir('.')
+        if store_vertices_uniquely:
+            domain.set_store_vertices_uniquely()
+        domain.set_store_centroids(store_centroids)
+
+        domain.set_quantity('elevation', lambda x, y: -x/5.0)
+        domain.set_quantity('friction', 0.0)
+        domain.set_quantity('stage', -1.5)
+
+        Br = Reflective_boundary(domain)
+        Bd = Dirichlet_boundary([-0.5, 0, 0])
+        domain.set_boundary({'left': Br, 'right': Bd,
+                             'top': Br, 'bottom': Br})
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=3.0):
+            pass
+
+    def test_sww2swt(self):
+
+        self._create_sww()
+
+        assert get_current_swt_filename(self.swwfile) is None
+
+        name = sww2swt(self.swwfile, cells_per_chunk=7)
+        assert name == get_swt_filename(self.swwfile) == self.swtfile
+        assert get_current_swt_filename(self.swwfile) == self.swtfile
+
+        fid = NetCDFFile(self.swwfile)
+        swt = Read_swt(self.swtfile)
+
+        assert num.allclose(swt.get_time(), fid.variables['time'][:])
+        assert num.allclose(swt.starttime, fid.starttime)
+
+        # Static quantities are not transposed
+        assert not swt.has_quantity('elevation')
+
+        indices = [13, 2, 3, 4, 40, 13, 0]
+        for name in ['stage', 'xmomentum', 'ymomentum', 'stage_c']:
+            assert swt.has_quantity(name)
+
+            q = fid.variables[name][:]
+            values = swt.get_timeseries(name, indices)
+
+            assert values.shape == (len(indices), q.shape[0])
+            assert num.allclose(values, num.transpose(q[:, indices]))
+
+        swt.close()
+        fid.close()
+
+    def test_sww2swt_quantities(self):
+
+        self._create_sww()
+
+        sww2swt(self.swwfile, quantities=['stage'])
+
+        swt = Read_swt(self.swtfile)
+        assert swt.get_quantity_names() == ['stage']
+        swt.close()
+
+        try:
+            sww2swt(self.swwfile, quantities=['elevation'])
+        except Exception:
+            pass
+        else:
+            msg = 'Should have raised exception for static quantity'
+            raise Exception(msg)
+
+    def test_flow_through_cross_section_with_swt(self):
+
+        from anuga.shallow_water.sww_interrogate import \
+             get_flow_through_cross_section, \
+             get_energy_through_cross_section
+
+        self._create_sww()
+
+        cross_section = [[5.2, 0.0], [5.7, 6.0]]
+
+        time_ref, Q_ref = get_flow_through_cross_section(self.swwfile,
+                                                         cross_section)
+        _, E_ref = get_energy_through_cross_section(self.swwfile,
+                                                    cross_section)
+
+        sww2swt(self.swwfile)
+
+        time, Q = get_flow_through_cross_section(self.swwfile,
+                                                 cross_section)
+        _, E = get_energy_through_cross_section(self.swwfile,
+                                                cross_section)
+
+        assert num.allclose(time, time_ref)
+        assert num.allclose(Q, Q_ref)
+        assert num.allclose(E, E_ref)
+
+    def test_maximum_inundation_with_swt(self):
+
+        from anuga.shallow_water.sww_interrogate import \
+             get_maximum_inundation_data
+
+        polygon = [[0, 0], [6, 0], [6, 4], [0, 4]]
+
+        for store_centroids in [True, False]:
+            self._create_sww(store_centroids=store_centroids)
+
+            arguments = [{},
+                         {'time_interval': [1.0, 2.0]},
+                         {'polygon': polygon}]
+
+            if not store_centroids:
+                arguments.append({'use_centroid_values': False})
+                arguments.append({'use_centroid_values': False,
+                                  'polygon': polygon})
+
+            references = []
+            for kwargs in arguments:
+                references.append(get_maximum_inundation_data(self.swwfile,
+                                                              return_time=True,
+                                                              **kwargs))
+
+            sww2swt(self.swwfile, cells_per_chunk=5)
+
+            for kwargs, reference in zip(arguments, references):
+                runup, location, time = \
+                    get_maximum_inundation_data(self.swwfile,
+                                                return_time=True,
+                                                **kwargs)
+
+                assert num.allclose(runup, reference[0])
+                assert num.allclose(location, reference[1])
+                assert num.allclose(time, reference[2])
+
+            os.remove(self.swtfile)
+
+    def test_sww2csv_gauges_with_swt(self):
+
+        from anuga.abstract_2d_finite_volumes.gauge import sww2csv_gauges
+
+        self._create_sww(store_vertices_uniquely=True)
+
+        points_file = tempfile.mktemp('.csv')
+        fid = open(points_file, 'w')
+        fid.write('name, easting, northing, elevation \n'
+                  'point1, 8.3, 1.2, 3.0\n'
+                  'point2, 2.5, 4.1, 9.0\n')
+        fid.close()
+
+        quantities = ['stage', 'depth', 'elevation', 'xmomentum',
+                      'ymomentum', 'speed', 'bearing']
+
+        def read_gauges():
+            result = []
+            for name in ['swt_gauge_point1.csv', 'swt_gauge_point2.csv']:
+                fid = open(name)
+                rows = list(reader(fid))[1:]
+                fid.close()
+                result.append(num.array(rows, num.float))
+            return result
+
+        sww2csv_gauges(self.swwfile, points_file,
+                       out_name='swt_gauge_',
+                       quantities=quantities,
+                       use_cache=False)
+        references = read_gauges()
+
+        sww2swt(self.swwfile)
+
+        sww2csv_gauges(self.swwfile, points_file,
+                       out_name='swt_gauge_',
+                       quantities=quantities,
+                       use_cache=False)
+
+        for values, reference in zip(read_gauges(), references):
+            assert values.shape == reference.shape
+            assert num.allclose(values, reference)
+
+        os.remove(points_file)
+
+#-------------------------------------------------------------
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(Test_sww2swt, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -29,12 +29,14 @@
 from anuga.abstract_2d_finite_volumes.neighbour_mesh import Mesh
 from anuga.caching import cache
 from anuga.geospatial_data.geospatial_data import Geospatial_data, \
-     ensure_absolute
+     ensure_absolute, get_points_file_ranges, read_points_file_range
 from anuga.fit_interpolate.general_fit_interpolate import FitInterpolate
+from anuga.pmesh.mesh_quadtree import get_morton_order
 
 from anuga.utilities.sparse import Sparse_CSR
 from anuga.utilities.numerical_tools import ensure_numeric
-from anuga.utilities.cg_solve import conjugate_gradient
+from anuga.utilities.cg_solve import conjugate_gradient, \
+     block_conjugate_gradient, get_preconditioner
 from anuga.config import default_smoothing_parameter as DEFAULT_ALPHA
 import anuga.utilities.log as log
 
@@ -51,6 +53,77 @@ import sys
 import fitsmooth
 
 
+def build_matrix_pattern(triangles, number_of_nodes):
+    """Return sparsity pattern (row_ptr, colind) of a CSR matrix with an
+    entry for each pair of vertices sharing a triangle, i.e. of AtA and D.
+
+    Column indices are sorted within each row.
+    """
+
+    triangles = num.array(triangles, num.int)
+    N = number_of_nodes
+
+    rows = num.repeat(triangles, 3, axis=1).reshape(-1)
+    cols = num.tile(triangles, (1, 3)).reshape(-1)
+    keys = num.unique(rows*N + cols)
+
+    colind = num.ascontiguousarray(keys % N, dtype=num.int)
+    row_ptr = num.zeros(N+1, num.int)
+    row_ptr[1:] = num.cumsum(num.bincount(keys // N, minlength=N))
+
+    return row_ptr, colind
+
+
+# Number of ranges a points file is split into per process when fitting
+# with several processes. More ranges balance the load and give finer
+# progress reports, but each range returns a copy of AtA to be reduced.
+RANGES_PER_PROCESS = 4
+
+# Fit object used by the processes of a pool fitting ranges of a file
+_range_fit = {}
+
+
+def _init_range_fit(fit):
+    """Initialise a process fitting ranges of a points file with fit.
+
+    Pools are forked, so fit (including its quad tree) is inherited
+    rather than pickled.
+    """
+
+    if fit.num_threads is None:
+        fit.num_threads = 1
+    _range_fit['fit'] = fit
+
+
+def _fit_points_file_range(args):
+    """Build AtA and Atz of the points in a range of a points file
+    (see get_points_file_ranges) in blocks of max_read_lines points.
+
+    Return (AtA data, Atz, number of points, size of range). AtA data has
+    the pattern given by build_matrix_pattern, both are None if the range
+    holds no points.
+    """
+
+    filename, start, end, attribute_name, max_read_lines = args
+
+    fit = _range_fit['fit']
+    fit.AtA = None
+    fit.Atz = None
+    fit.point_count = 0
+
+    for geo_block in read_points_file_range(filename, start, end,
+                                            max_read_lines):
+        points = geo_block.get_data_points(absolute=True)
+        z = geo_block.get_attributes(attribute_name=attribute_name)
+
+        fit._build_matrix_AtA_Atz(points, z, attribute_name)
+
+    if fit.AtA is None:
+        return None, None, 0, end - start
+
+    return fit.AtA.data, fit.Atz, fit.point_count, end - start
+
+
 class Fit(FitInterpolate):
 
     def __init__(self,
@@ -61,7 +134,8 @@ class Fit(FitInterpolate):
                  alpha=None,
                  verbose=False,
                  cg_precon='Jacobi',
-                 use_c_cg=True):
+                 use_c_cg=True,
+                 num_threads=None):
 
         """
         Padarn Note 05/12/12: This documentation should probably
@@ -89,6 +163,24 @@ class Fit(FitInterpolate):
           Note: Don't supply a vertex coords as a geospatial object and
               a mesh origin, since geospatial has its own mesh origin.
 
+          num_threads: If None AtA and Atz are built on a single thread
+              in a sparse dictionary. Otherwise points are divided
+              between num_threads threads (0 means as many as OpenMP
+              provides) and AtA is assembled directly into a Sparse_CSR
+              matrix whose pattern is given by the mesh connectivity.
+
+          cg_precon: Preconditioner used to solve for the fit, one of
+              'None', 'Jacobi', 'ICC' or 'AMG'. See
+              anuga.utilities.cg_solve.get_preconditioner.
+
+          use_c_cg: If True (the default) the fit is solved by the c
+              conjugate gradient solver. Several attributes are then
+              solved one after another: they share B and its
+              preconditioner, but each makes its own passes over B.
+              Only with use_c_cg=False are they solved together by
+              block_conjugate_gradient, one pass over B per iteration
+              for all of them.
+
 
         Usage,
         To use this in a blocking way, call  build_fit_subset, with z info,
@@ -110,6 +202,8 @@ class Fit(FitInterpolate):
         self.AtA = None
         self.Atz = None
         self.D = None
+        self.B = None
+        self.precon = None
         self.point_count = 0
 
         # NOTE PADARN: NEEDS FIXING - currently need smoothing matrix
@@ -125,6 +219,7 @@ class Fit(FitInterpolate):
 
         self.cg_precon=cg_precon
         self.use_c_cg=use_c_cg
+        self.num_threads=num_threads
 
     def _build_coefficient_matrix_B(self,
                                   verbose=False):
@@ -134,6 +229,14 @@ class Fit(FitInterpolate):
 
         msize = self.mesh.number_of_nodes
 
+        if isinstance(self.AtA, Sparse_CSR):
+            # AtA and D share the pattern of the mesh connectivity
+            row_ptr, colind = self.AtA.row_ptr, self.AtA.colind
+            D_data = fitsmooth.dok_to_csr_data(self.D, row_ptr, colind)
+            self.B = Sparse_CSR(None, self.AtA.data + self.alpha*D_data,
+                                colind, row_ptr, msize, msize)
+            return
+
         self.B = fitsmooth.build_matrix_B(self.D, \
                                           self.AtA, self.alpha)
 
@@ -204,8 +307,9 @@ class Fit(FitInterpolate):
         m is the number of basis functions phi_k (one per vertex)
         a is the number of data attributes
 
-        This algorithm uses a quad tree data structure for fast binning of
-        data points.
+        Points are sorted along a space filling curve and each is located
+        by walking through the mesh from the triangle of the previous point,
+        the quad tree is only searched when the walk fails.
 
         If Ata is None, the matrices AtA and Atz are created.
 
@@ -234,21 +338,37 @@ class Fit(FitInterpolate):
         point_coordinates = ensure_numeric(point_coordinates, num.float)
 
         npts = len(z)
-        z = num.array(z)
-        # NOTE PADARN : This copy might be needed to
-        # make sure memory is contig - would be better to read in C..
-        z = z.copy()
+
+        # Consecutive points should be close to each other for the walk
+        # (AtA and Atz don't depend on the order of the points)
+        order = get_morton_order(point_coordinates, self.root.extents)
+        point_coordinates = num.ascontiguousarray(point_coordinates[order])
+        z = num.ascontiguousarray(num.array(z)[order])
 
         self.point_count += z.shape[0]
 
+        # New points change AtA, so B must be built again
+        self.B = None
+        self.precon = None
+
         zdim = 1
         if len(z.shape) != 1:
             zdim = z.shape[1]
 
+        if self.num_threads is not None:
+            self._build_matrix_AtA_Atz_csr(point_coordinates, z, zdim)
+            if verbose and output == 'dot':
+                print '\b.',
+                sys.stdout.flush()
+            return
+
+        vertex_coordinates, neighbours = self.root.get_walk_structures()
+
         [AtA, Atz] = fitsmooth.build_matrix_AtA_Atz_points(self.root.root, \
                self.mesh.number_of_nodes, \
                self.mesh.triangles, \
-               num.array(point_coordinates), z, zdim, npts)
+               point_coordinates, z, zdim, npts, \
+               vertex_coordinates, neighbours)
 
         if verbose and output == 'dot':
             print '\b.',
@@ -265,11 +385,120 @@ class Fit(FitInterpolate):
             fitsmooth.combine_partial_AtA_Atz(self.AtA, AtA, \
                     self.Atz, Atz, zdim, self.mesh.number_of_nodes)
 
+    def _build_matrix_AtA_Atz_csr(self, point_coordinates, z, zdim):
+        """Add the contributions of points with values z to AtA and Atz
+        using self.num_threads threads.
+
+        AtA is a Sparse_CSR matrix with the pattern of the mesh connectivity
+        and Atz an m (or m x zdim) array, both created on the first call.
+        """
+
+        m = self.mesh.number_of_nodes
+
+        if self.AtA is None and self.Atz is None:
+            row_ptr, colind = build_matrix_pattern(self.mesh.triangles, m)
+            self.AtA = Sparse_CSR(None, num.zeros(len(colind), num.float),
+                                  colind, row_ptr, m, m)
+            if zdim == 1:
+                self.Atz = num.zeros(m, num.float)
+            else:
+                self.Atz = num.zeros((m, zdim), num.float)
+
+        msg = 'AtA was built without threads, use the same num_threads '
+        msg += 'for all blocks of points'
+        assert isinstance(self.AtA, Sparse_CSR), msg
+
+        vertex_coordinates, neighbours = self.root.get_walk_structures()
+
+        fitsmooth.build_matrix_AtA_Atz_points_csr(self.root.root,
+               num.ascontiguousarray(self.mesh.triangles, dtype=num.int),
+               num.ascontiguousarray(point_coordinates, dtype=num.float),
+               z,
+               self.AtA.row_ptr, self.AtA.colind,
+               self.AtA.data, self.Atz,
+               self.num_threads,
+               vertex_coordinates, neighbours)
+
+    def _build_matrix_AtA_Atz_file(self, filename, attribute_name=None,
+                                   max_read_lines=None,
+                                   number_of_processes=2,
+                                   verbose=False):
+        """Add the contributions of the points in filename to AtA and Atz
+        using number_of_processes processes.
+
+        The file is split into ranges (byte ranges of .csv/.txt files,
+        rows of .pts and .npy files). Each process reads a range in blocks
+        of max_read_lines points and builds AtA and Atz for it, so its
+        memory use is bounded by a block and a copy of AtA and Atz
+        whatever the size of the file. The partial matrices are added up
+        as ranges complete.
+        """
+
+        import multiprocessing
+
+        ranges = get_points_file_ranges(filename,
+                                        RANGES_PER_PROCESS*number_of_processes)
+        total_size = sum([end - start for start, end in ranges])
+
+        tasks = [(filename, start, end, attribute_name, max_read_lines)
+                 for start, end in ranges]
+
+        if verbose:
+            log.critical('Fit.fit: Reading %s in %d ranges with %d processes'
+                         % (filename, len(tasks), number_of_processes))
+
+        m = self.mesh.number_of_nodes
+
+        pool = multiprocessing.Pool(number_of_processes,
+                                    _init_range_fit, (self,))
+        try:
+            done_size = 0
+            for AtA_data, Atz, point_count, size in \
+                    pool.imap_unordered(_fit_points_file_range, tasks):
+                done_size += size
+
+                if AtA_data is not None:
+                    if self.AtA is None and self.Atz is None:
+                        row_ptr, colind = build_matrix_pattern(
+                            self.mesh.triangles, m)
+                        self.AtA = Sparse_CSR(None, AtA_data, colind,
+                                              row_ptr, m, m)
+                        self.Atz = Atz
+                    else:
+                        msg = 'AtA was built without threads, use '
+                        msg += 'num_threads when fitting files with several '
+                        msg += 'processes after other points'
+                        assert isinstance(self.AtA, Sparse_CSR), msg
+
+                        self.AtA.data += AtA_data
+                        self.Atz += Atz
+
+                    self.point_count += point_count
+
+                    # New points change AtA, so B must be built again
+                    self.B = None
+                    self.precon = None
+
+                if verbose:
+                    log.critical('Fit.fit: Read %d%% of %s (%d points)'
+                                 % (100*done_size/max(total_size, 1),
+                                    filename, self.point_count))
+
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
     def fit(self, point_coordinates_or_filename=None, z=None,
             verbose=False,
             point_origin=None,
             attribute_name=None,
-            max_read_lines=1e7):
+            max_read_lines=1e7,
+            x0=None,
+            warm_start=False,
+            number_of_processes=1):
         """Fit a smooth surface to given 1d array of data points z.
 
         The smooth surface is computed at each vertex in the underlying
@@ -282,6 +511,12 @@ class Fit(FitInterpolate):
               data points or an nx2 numeric array or a Geospatial_data object
               or points file filename
           z: Single 1d vector or array of data at the point_coordinates.
+             Several attributes (e.g. elevation and friction or time
+             slices of a field) are fitted together from one n x k array.
+          x0, warm_start: see solve.
+          number_of_processes: If larger than 1 a points file is read by
+             this many processes, each building AtA and Atz for ranges
+             of the file (see _build_matrix_AtA_Atz_file).
 
         """
         if isinstance(point_coordinates_or_filename, basestring):
@@ -301,18 +536,25 @@ class Fit(FitInterpolate):
             assert point_origin is None, msg
             filename = point_coordinates_or_filename
 
-            G_data = Geospatial_data(filename,
-                                     max_read_lines=max_read_lines,
-                                     load_file_now=False,
-                                     verbose=verbose)
+            if number_of_processes > 1:
+                self._build_matrix_AtA_Atz_file(filename, attribute_name,
+                                                max_read_lines,
+                                                number_of_processes,
+                                                verbose)
+            else:
+                G_data = Geospatial_data(filename,
+                                         max_read_lines=max_read_lines,
+                                         load_file_now=False,
+                                         verbose=verbose)
 
-            for i, geo_block in enumerate(G_data):
+                for i, geo_block in enumerate(G_data):
 
-               # Build the array
-                points = geo_block.get_data_points(absolute=True)
-                z = geo_block.get_attributes(attribute_name=attribute_name)
+                   # Build the array
+                    points = geo_block.get_data_points(absolute=True)
+                    z = geo_block.get_attributes(attribute_name=attribute_name)
 
-                self._build_matrix_AtA_Atz(points, z, attribute_name, verbose)
+                    self._build_matrix_AtA_Atz(points, z, attribute_name,
+                                               verbose)
 
             point_coordinates = None
 
@@ -365,9 +607,61 @@ class Fit(FitInterpolate):
             log.critical(msg)
 
             #raise VertsWithNoTrianglesError(msg)
-        return conjugate_gradient(self.B, self.Atz, self.Atz,
-                                  imax=2 * len(self.Atz)+1000, use_c_cg=self.use_c_cg,
-                                  precon=self.cg_precon)
+
+        return self.solve(x0=x0, warm_start=warm_start)
+
+    def solve(self, x0=None, warm_start=False):
+        """Solve B x = Atz for the vertex values of all attributes, where
+        B = AtA + alpha*D.
+
+        B and its preconditioner are built once and reused by later calls
+        until more points are added.
+
+        If Atz has several columns (attributes) they are solved one after
+        another by the c solver if use_c_cg is True, otherwise together by
+        block_conjugate_gradient, sharing each pass over B. Either way
+        each column is solved to the same tolerance, relative to its
+        initial residual. With warm_start=True the columns are solved one
+        after another, each starting from the solution of the previous
+        one. This suits related columns such as consecutive time slices
+        of a field.
+
+        x0 is the initial guess (a vector or an array with a column per
+        attribute), e.g. the result of fitting a related data set on the
+        same mesh. It defaults to Atz.
+        """
+
+        if self.B is None:
+            self._build_coefficient_matrix_B()
+
+        if self.precon is None:
+            self.precon = get_preconditioner(self.B, self.cg_precon)
+
+        imax = 2 * len(self.Atz) + 1000
+
+        if x0 is None:
+            x0 = self.Atz
+        else:
+            x0 = num.array(x0, num.float).reshape(self.Atz.shape)
+
+        if len(self.Atz.shape) == 1 or (self.use_c_cg and not warm_start):
+            return conjugate_gradient(self.B, self.Atz, x0,
+                                      imax=imax, use_c_cg=self.use_c_cg,
+                                      precon=self.precon)
+
+        if not warm_start:
+            return block_conjugate_gradient(self.B, self.Atz, x0,
+                                            imax=imax, precon=self.precon)
+
+        x = num.zeros(self.Atz.shape, num.float)
+        x_previous = x0[:, 0]
+        for i in range(self.Atz.shape[1]):
+            x[:, i] = conjugate_gradient(self.B, self.Atz[:, i], x_previous,
+                                         imax=imax, use_c_cg=self.use_c_cg,
+                                         precon=self.precon)
+            x_previous = x[:, i]
+
+        return x
 
 
 #poin_coordiantes can also be a points file name
@@ -385,7 +679,9 @@ def fit_to_mesh(point_coordinates,
                 attribute_name=None,
                 use_cache=False,
                 cg_precon='Jacobi',
-                use_c_cg=True):
+                use_c_cg=True,
+                num_threads=None,
+                number_of_processes=1):
     """Wrapper around internal function _fit_to_mesh for use with caching.
     """
 
@@ -401,7 +697,9 @@ def fit_to_mesh(point_coordinates,
               'max_read_lines': max_read_lines,
               'attribute_name': attribute_name,
               'cg_precon': cg_precon,
-              'use_c_cg': use_c_cg
+              'use_c_cg': use_c_cg,
+              'num_threads': num_threads,
+              'number_of_processes': number_of_processes
               }
 
     if use_cache is True:
@@ -439,7 +737,9 @@ def _fit_to_mesh(point_coordinates,
                  max_read_lines=None,
                  attribute_name=None,
                  cg_precon='Jacobi',
-                 use_c_cg=True):
+                 use_c_cg=True,
+                 num_threads=None,
+                 number_of_processes=1):
     """
     Fit a smooth surface to a triangulation,
     given data points with attributes.
@@ -456,7 +756,7 @@ def _fit_to_mesh(point_coordinates,
           integers representing indices of all vertices in the mesh.
 
           point_coordinates: List of coordinate pairs [x, y] of data points
-          (or an nx2 numeric array). This can also be a .csv/.txt/.pts
+          (or an nx2 numeric array). This can also be a .csv/.txt/.pts/.npy
           file name.
 
           alpha: Smoothing parameter.
@@ -469,6 +769,18 @@ def _fit_to_mesh(point_coordinates,
           point_attributes: Vector or array of data at the
                             point_coordinates.
 
+          num_threads: Number of threads used to build the fitting
+                       matrices (see Fit).
+
+          use_c_cg: Solve with the c conjugate gradient solver. Several
+                       attributes are then solved one after another,
+                       reusing B and its preconditioner. With
+                       use_c_cg=False they are solved together in one
+                       block solve (see Fit).
+
+          number_of_processes: Number of processes reading a points
+                       file given as point_coordinates (see Fit.fit).
+
     """
 
     if mesh is None:
@@ -491,14 +803,16 @@ def _fit_to_mesh(point_coordinates,
                  verbose=verbose,
                  alpha=alpha,
                  cg_precon=cg_precon,
-                 use_c_cg=use_c_cg)
+                 use_c_cg=use_c_cg,
+                 num_threads=num_threads)
 
     vertex_attributes = interp.fit(point_coordinates,
                                    point_attributes,
                                    point_origin=data_origin,
                                    max_read_lines=max_read_lines,
                                    attribute_name=attribute_name,
-                                   verbose=verbose)
+                                   verbose=verbose,
+                                   number_of_processes=number_of_processes)
 
     # Add the value checking stuff that's in least squares.
     # Maybe this stuff should get pushed down into Fit.
@@ -175,15 +175,133 @@ quad_tree * _build_quad_tree(int n,
     
 }
 
+// Maximal number of triangles visited by _walk_to_point before giving up
+#define MAX_WALK_STEPS 64
+
+// Walks through the mesh from triangle k towards the triangle containing
+// (x,y), each step crossing the edge opposite the vertex with the most
+// negative barycentric coordinate, until a triangle strictly containing 
+// the point is found. vertex_coordinates holds the 6
+// coordinates of each triangle and neighbours[3*k+i] is the triangle
+// across the edge opposite vertex i of triangle k (negative on the 
+// boundary). On success the barycentric coordinates are stored in sigma
+// and the triangle is returned. Returns -1 if the walk reaches the
+// boundary or a point on an edge, meets a degenerate triangle or takes
+// too many steps.
+long _walk_to_point(long k, double x, double y,
+                    double * vertex_coordinates, long * neighbours,
+                    double * sigma)
+{
+
+    int step, i, m;
+    double x0,y0,x1,y1,x2,y2,det;
+
+    for(step=0;step<MAX_WALK_STEPS;step++){
+        x0 = vertex_coordinates[6*k];
+        y0 = vertex_coordinates[6*k+1];
+        x1 = vertex_coordinates[6*k+2];
+        y1 = vertex_coordinates[6*k+3];
+        x2 = vertex_coordinates[6*k+4];
+        y2 = vertex_coordinates[6*k+5];
+
+        det = (x1-x0)*(y2-y0) - (x2-x0)*(y1-y0);
+        if(det==0.0) return -1;
+
+        sigma[1] = ((x-x0)*(y2-y0) - (x2-x0)*(y-y0))/det;
+        sigma[2] = ((x1-x0)*(y-y0) - (x-x0)*(y1-y0))/det;
+        sigma[0] = 1.0 - sigma[1] - sigma[2];
+
+        m = 0;
+        for(i=1;i<3;i++){
+            if(sigma[i]<sigma[m]) m = i;
+        }
+
+        if(sigma[m]>1.0e-12) return k;
+
+        // Points on edges (within the tolerance of triangle_contains_point)
+        // belong to more than one triangle. Leave them to the quad tree, 
+        // so the same triangle is found whatever the order of the points.
+        if(sigma[m]>=-1.0e-12) return -1;
+
+        k = neighbours[3*k+m];
+        if(k<0) return -1;
+    }
+
+    return -1;
+}
+
+// Finds the triangle containing (x,y) and stores the barycentric 
+// coordinates of the point in sigma. If neighbours is not NULL and start 
+// is a triangle (e.g. the one containing the previous point) the mesh is
+// walked from there, otherwise or if that fails the quad tree is searched.
+// Returns the triangle or -1 if the point is outside the mesh.
+long _locate_point(quad_tree * quadtree, double x, double y, long start,
+                   double * vertex_coordinates, long * neighbours,
+                   double * sigma)
+{
+
+    long k = -1;
+    int i;
+
+    if(neighbours!=NULL && start>=0){
+        k = _walk_to_point(start,x,y,vertex_coordinates,neighbours,sigma);
+    }
+
+    if(k<0){
+        triangle * T = search(quadtree,x,y);
+        if(T!=NULL){
+            double * T_sigma = calculate_sigma(T,x,y);
+            for(i=0;i<3;i++) sigma[i] = T_sigma[i];
+            free(T_sigma);
+            k = T->index;
+        }
+    }
+
+    return k;
+}
+
+// Locates npts points, storing the triangle containing each point in ids 
+// (-1 if outside the mesh) and its barycentric coordinates in sigmas.
+// Each point is located starting from the triangle of the previous point
+// found, so points should be ordered such that consecutive points are
+// close (e.g. along a space filling curve). Returns the number of points
+// found.
+long _locate_points(long npts, double * point_coordinates,
+                    double * vertex_coordinates, long * neighbours,
+                    quad_tree * quadtree, long * ids, double * sigmas)
+{
+
+    long k, last = -1, found = 0;
+    int i;
+
+    for(k=0;k<npts;k++){
+        ids[k] = _locate_point(quadtree,
+                               point_coordinates[2*k],
+                               point_coordinates[2*k+1],
+                               last, vertex_coordinates, neighbours,
+                               sigmas+3*k);
+        if(ids[k]>=0){
+            last = ids[k];
+            found++;
+        } else {
+            for(i=0;i<3;i++) sigmas[3*k+i] = -1.0;
+        }
+    }
+
+    return found;
+}
+
 // Builds the AtA and Atz interpolation matrix
 // and residual. Uses a quad_tree for fast access to the triangles of the mesh.
 // This function takes a list of point coordinates, and associated point values
-// (for any number of attributes).
+// (for any number of attributes). If neighbours is not NULL points are 
+// located by walking the mesh (see _locate_point).
 int _build_matrix_AtA_Atz_points(int N, long * triangles,
                       double * point_coordinates, double * point_values,
                       int zdims, int npts,
                       sparse_dok * AtA,
-                      double ** Atz,quad_tree * quadtree)
+                      double ** Atz,quad_tree * quadtree,
+                      double * vertex_coordinates, long * neighbours)
               {
 
 
@@ -204,19 +322,25 @@ int _build_matrix_AtA_Atz_points(int N, long * triangles,
 
 
 
-    #pragma omp parallel for private(k,i,key,w)
-    for(k=0;k<npts;k++){
+    #pragma omp parallel private(k,i,key,w)
+    {
+    long index, last = -1;
+    double sigma[3];
 
+    #pragma omp for
+    for(k=0;k<npts;k++){
 
-        double x = point_coordinates[2*k];
-        double y = point_coordinates[2*k+1];
-        triangle * T = search(quadtree,x,y);
+        index = _locate_point(quadtree,
+                              point_coordinates[2*k],
+                              point_coordinates[2*k+1],
+                              last, vertex_coordinates, neighbours,
+                              sigma);
 
-        if(T!=NULL){
-            double * sigma = calculate_sigma(T,x,y);
+        if(index>=0){
             int js[3];
+            last = index;
             for(i=0;i<3;i++){
-                js[i]=triangles[3*(T->index)+i];
+                js[i]=triangles[3*index+i];
             }
             
             #pragma omp critical
@@ -236,11 +360,10 @@ int _build_matrix_AtA_Atz_points(int N, long * triangles,
                 }                        
             }
             }
-            free(sigma);
-            sigma=NULL;
 
        } 
     }
+    }
 
     return 0;
 }
@@ -259,6 +382,197 @@ void _combine_partial_AtA_Atz(sparse_dok * dok_AtA1,sparse_dok * dok_AtA2,
     }
 }
 
+// Finds the position of entry (i,j) in a CSR matrix with the given pattern.
+// Returns -1 if the pattern has no such entry. Rows of a mesh connectivity
+// pattern are short so a linear search is as fast as anything else.
+long _csr_position(long * row_ptr, long * colind, long i, long j){
+
+    long k;
+    for(k=row_ptr[i];k<row_ptr[i+1];k++){
+        if(colind[k]==j) return k;
+    }
+    return -1;
+}
+
+// Builds AtA and Atz from a list of points and values like 
+// _build_matrix_AtA_Atz_points, but accumulates AtA straight into the data 
+// array of a CSR matrix whose pattern (row_ptr, colind) is the connectivity
+// of the mesh, and Atz into an N x zdims array. Values are added to those 
+// already in AtA_data and Atz, so points can be processed in blocks.
+//
+// If neighbours is not NULL, each thread locates its points by walking the
+// mesh from the triangle of its previous point (see _locate_point), so 
+// points should be sorted along a space filling curve.
+//
+// Points are split across num_threads threads (OpenMP default if 0). Each 
+// thread accumulates into arrays of its own, which are summed at the end,
+// so no locking is needed. This takes (num_threads-1)*(nnz + N*zdims) 
+// doubles of extra memory, which is allocated before the threads start.
+//
+// Returns the number of points found inside the mesh, -1 if a point
+// falls in a triangle whose entries are missing from the pattern or -2 if
+// memory could not be allocated.
+long _build_matrix_AtA_Atz_points_csr(int N, long * triangles,
+                      double * point_coordinates, double * point_values,
+                      int zdims, long npts,
+                      long * row_ptr, long * colind,
+                      double * AtA_data, double * Atz,
+                      quad_tree * quadtree,
+                      double * vertex_coordinates, long * neighbours,
+                      int num_threads)
+{
+
+    long nnz = row_ptr[N];
+    long found = 0;
+    int error = 0;
+    int nthreads = 1;
+    int t;
+    double ** local_AtA;
+    double ** local_Atz;
+
+    #ifdef _OPENMP
+    if(num_threads<=0) num_threads = omp_get_max_threads();
+    #else
+    num_threads = 1;
+    #endif
+
+    // Thread 0 accumulates straight into the result arrays
+    local_AtA = calloc(num_threads, sizeof(double*));
+    local_Atz = calloc(num_threads, sizeof(double*));
+    if(local_AtA==NULL || local_Atz==NULL){
+        free(local_AtA);
+        free(local_Atz);
+        return -2;
+    }
+    local_AtA[0] = AtA_data;
+    local_Atz[0] = Atz;
+    for(t=1;t<num_threads;t++){
+        local_AtA[t] = calloc(nnz, sizeof(double));
+        local_Atz[t] = calloc((long)N*zdims, sizeof(double));
+        if(local_AtA[t]==NULL || local_Atz[t]==NULL){
+            error = 1;
+            break;
+        }
+    }
+
+    if(error==0){
+        #pragma omp parallel num_threads(num_threads) reduction(+:found) reduction(|:error)
+        {
+            long k, index, last = -1;
+            int i,w;
+            int tid = 0;
+            double sigma[3];
+            double * my_AtA;
+            double * my_Atz;
+
+            #ifdef _OPENMP
+            tid = omp_get_thread_num();
+            #pragma omp single
+            nthreads = omp_get_num_threads();
+            #endif
+
+            my_AtA = local_AtA[tid];
+            my_Atz = local_Atz[tid];
+
+            #pragma omp for schedule(dynamic, 4096)
+            for(k=0;k<npts;k++){
+                index = _locate_point(quadtree,
+                                      point_coordinates[2*k],
+                                      point_coordinates[2*k+1],
+                                      last, vertex_coordinates, neighbours,
+                                      sigma);
+
+                if(index>=0){
+                    long js[3];
+                    last = index;
+                    for(i=0;i<3;i++){
+                        js[i]=triangles[3*index+i];
+                    }
+
+                    for(i=0;i<3;i++){
+                        for(w=0;w<zdims;w++){
+                            my_Atz[js[i]*zdims+w] += sigma[i]*point_values[zdims*k+w];
+                        }
+
+                        for(w=0;w<3;w++){
+                            long pos = _csr_position(row_ptr,colind,js[i],js[w]);
+                            if(pos<0){
+                                error = 2;
+                            } else {
+                                my_AtA[pos] += sigma[i]*sigma[w];
+                            }
+                        }
+                    }
+                    found++;
+                }
+            }
+        }
+    }
+
+    if(error==0){
+        // Sum the accumulators of the other threads into the result
+        long n;
+        #pragma omp parallel for num_threads(num_threads) private(t)
+        for(n=0;n<nnz;n++){
+            for(t=1;t<nthreads;t++){
+                AtA_data[n] += local_AtA[t][n];
+            }
+        }
+        #pragma omp parallel for num_threads(num_threads) private(t)
+        for(n=0;n<(long)N*zdims;n++){
+            for(t=1;t<nthreads;t++){
+                Atz[n] += local_Atz[t][n];
+            }
+        }
+    }
+
+    for(t=1;t<num_threads;t++){
+        free(local_AtA[t]);
+        free(local_Atz[t]);
+    }
+    free(local_AtA);
+    free(local_Atz);
+
+    if(error==1) return -2;
+    if(error!=0) return -1;
+    return found;
+}
+
+// Adds mult times the entries of sparse_dok matrix src to dest, leaving
+// src unchanged.
+void _add_to_dok(sparse_dok * dest, sparse_dok * src, double mult){
+
+    edge_t * edge;
+
+    for(edge=src->edgetable; edge!=NULL; edge=edge->hh.next){
+        add_dok_entry(dest,edge->key,edge->entry*mult);
+    }
+}
+
+// Stores the entries of a sparse_dok matrix in the data array of a CSR 
+// matrix with the given pattern. Returns -1 if the pattern doesn't have
+// room for all entries, 0 otherwise.
+int _dok_to_csr_pattern(sparse_dok * dok, int N,
+                      long * row_ptr, long * colind, double * data)
+{
+
+    long k;
+    edge_t * edge;
+
+    for(k=0;k<row_ptr[N];k++){
+        data[k] = 0.0;
+    }
+
+    for(edge=dok->edgetable; edge!=NULL; edge=edge->hh.next){
+        if(edge->key.i>=N || edge->key.j>=N) return -1;
+        k = _csr_position(row_ptr,colind,edge->key.i,edge->key.j);
+        if(k<0) return -1;
+        data[k] = edge->entry;
+    }
+
+    return 0;
+}
+
 // --------------------------- Utilities -----------------------------------
 
 // Converts a double array into a PyList object for return to python.
@@ -481,14 +795,20 @@ PyObject *build_matrix_AtA_Atz_points(PyObject *self, PyObject *args) {
     int npts;
     int zdims;
     PyObject *tree;
+    PyObject *vertex_coordinates = Py_None;
+    PyObject *neighbours = Py_None;
+    double * vertex_coordinates_data = NULL;
+    long * neighbours_data = NULL;
 
     // Convert Python arguments to C
-    if (!PyArg_ParseTuple(args, "OiOOOii",&tree, &N,
+    if (!PyArg_ParseTuple(args, "OiOOOii|OO",&tree, &N,
                                             &triangles,
                                             &point_coordinates,
                                             &z,
                                             &zdims,
-                                            &npts
+                                            &npts,
+                                            &vertex_coordinates,
+                                            &neighbours
                                             )) {
       PyErr_SetString(PyExc_RuntimeError,
               "fitsmooth.c: could not parse input");
@@ -500,6 +820,15 @@ PyObject *build_matrix_AtA_Atz_points(PyObject *self, PyObject *args) {
     CHECK_C_CONTIG(point_coordinates);
     CHECK_C_CONTIG(z);
 
+    if (neighbours != Py_None) {
+      PyArrayObject *vertex_array = (PyArrayObject*) vertex_coordinates;
+      PyArrayObject *neighbour_array = (PyArrayObject*) neighbours;
+      CHECK_C_CONTIG(vertex_array);
+      CHECK_C_CONTIG(neighbour_array);
+      vertex_coordinates_data = (double*) vertex_array->data;
+      neighbours_data = (long*) neighbour_array->data;
+    }
+
     #ifdef PYVERSION273
     quad_tree * quadtree = (quad_tree*) PyCapsule_GetPointer(tree,"quad tree");
     #else
@@ -521,7 +850,9 @@ PyObject *build_matrix_AtA_Atz_points(PyObject *self, PyObject *args) {
                       npts,
                       dok_AtA,
                       Atz,
-                      quadtree);
+                      quadtree,
+                      vertex_coordinates_data,
+                      neighbours_data);
 
 
     if (err != 0) {
@@ -552,6 +883,226 @@ PyObject *build_matrix_AtA_Atz_points(PyObject *self, PyObject *args) {
 
 }
 
+// Builds AtA and Atz directly from arrays of points and values, like
+// build_matrix_AtA_Atz_points, using several threads. AtA is accumulated 
+// into AtA_data, the data array of a CSR matrix with pattern (row_ptr, 
+// colind) as returned by build_matrix_pattern in fit.py, and Atz into the 
+// N x zdims array Atz. Optional arguments vertex_coordinates (3n x 2)
+// and neighbours (n x 3) of the mesh make points be located by walking
+// the mesh (see _locate_point). Returns the number of points inside the
+// mesh.
+PyObject *build_matrix_AtA_Atz_points_csr(PyObject *self, PyObject *args) {
+
+    PyObject *tree;
+    PyObject *vertex_coordinates = Py_None;
+    PyObject *neighbours = Py_None;
+    double * vertex_coordinates_data = NULL;
+    long * neighbours_data = NULL;
+    PyArrayObject *triangles;
+    PyArrayObject *point_coordinates;
+    PyArrayObject *z;
+    PyArrayObject *row_ptr;
+    PyArrayObject *colind;
+    PyArrayObject *AtA_data;
+    PyArrayObject *Atz;
+    int num_threads;
+    int N, zdims;
+    long npts, found;
+
+    // Convert Python arguments to C
+    if (!PyArg_ParseTuple(args, "OOOOOOOOi|OO", &tree,
+                                            &triangles,
+                                            &point_coordinates,
+                                            &z,
+                                            &row_ptr,
+                                            &colind,
+                                            &AtA_data,
+                                            &Atz,
+                                            &num_threads,
+                                            &vertex_coordinates,
+                                            &neighbours
+                                            )) {
+      PyErr_SetString(PyExc_RuntimeError,
+              "fitsmooth.c: could not parse input");
+      return NULL;
+    }
+
+    CHECK_C_CONTIG(triangles);
+    CHECK_C_CONTIG(point_coordinates);
+    CHECK_C_CONTIG(z);
+    CHECK_C_CONTIG(row_ptr);
+    CHECK_C_CONTIG(colind);
+    CHECK_C_CONTIG(AtA_data);
+    CHECK_C_CONTIG(Atz);
+
+    if (neighbours != Py_None) {
+      PyArrayObject *vertex_array = (PyArrayObject*) vertex_coordinates;
+      PyArrayObject *neighbour_array = (PyArrayObject*) neighbours;
+      CHECK_C_CONTIG(vertex_array);
+      CHECK_C_CONTIG(neighbour_array);
+      vertex_coordinates_data = (double*) vertex_array->data;
+      neighbours_data = (long*) neighbour_array->data;
+    }
+
+    N = row_ptr->dimensions[0] - 1;
+    npts = point_coordinates->dimensions[0];
+    zdims = 1;
+    if (z->nd > 1) zdims = z->dimensions[1];
+
+    if (PyArray_SIZE(z) != npts*zdims || PyArray_SIZE(Atz) != (long)N*zdims
+        || PyArray_SIZE(AtA_data) != PyArray_SIZE(colind)) {
+      PyErr_SetString(PyExc_ValueError,
+              "fitsmooth.build_matrix_AtA_Atz_points_csr: inconsistent array sizes");
+      return NULL;
+    }
+
+    #ifdef PYVERSION273
+    quad_tree * quadtree = (quad_tree*) PyCapsule_GetPointer(tree,"quad tree");
+    #else
+    quad_tree * quadtree = (quad_tree*) PyCObject_AsVoidPtr(tree);
+    #endif
+
+    Py_BEGIN_ALLOW_THREADS
+    found = _build_matrix_AtA_Atz_points_csr(N, (long*) triangles->data,
+                      (double*) point_coordinates->data,
+                      (double*) z->data,
+                      zdims,
+                      npts,
+                      (long*) row_ptr->data,
+                      (long*) colind->data,
+                      (double*) AtA_data->data,
+                      (double*) Atz->data,
+                      quadtree,
+                      vertex_coordinates_data,
+                      neighbours_data,
+                      num_threads);
+    Py_END_ALLOW_THREADS
+
+    if (found == -2) {
+      PyErr_NoMemory();
+      return NULL;
+    }
+    if (found < 0) {
+      PyErr_SetString(PyExc_RuntimeError,
+              "fitsmooth.build_matrix_AtA_Atz_points_csr: pattern does not match mesh");
+      return NULL;
+    }
+
+    return PyInt_FromLong(found);
+}
+
+// Returns the entries of a sparse_dok matrix (e.g. the smoothing matrix D)
+// as the data array of a CSR matrix with pattern (row_ptr, colind). 
+PyObject *dok_to_csr_data(PyObject *self, PyObject *args) {
+
+    PyObject *dok_cap;
+    PyArrayObject *row_ptr;
+    PyArrayObject *colind;
+    PyArrayObject *data;
+    npy_intp dims[1];
+    int N;
+
+    // Convert Python arguments to C
+    if (!PyArg_ParseTuple(args, "OOO", &dok_cap, &row_ptr, &colind)) {
+      PyErr_SetString(PyExc_RuntimeError,
+              "fitsmooth.dok_to_csr_data: could not parse input");
+      return NULL;
+    }
+
+    CHECK_C_CONTIG(row_ptr);
+    CHECK_C_CONTIG(colind);
+
+    #ifdef PYVERSION273
+    sparse_dok * dok = (sparse_dok*) PyCapsule_GetPointer(dok_cap,"sparse dok");
+    #else
+    sparse_dok * dok = (sparse_dok*) PyCObject_AsVoidPtr(dok_cap);
+    #endif
+
+    N = row_ptr->dimensions[0] - 1;
+    dims[0] = colind->dimensions[0];
+    data = (PyArrayObject*) PyArray_SimpleNew(1, dims, NPY_DOUBLE);
+    if (data == NULL) return NULL;
+
+    if (_dok_to_csr_pattern(dok, N, (long*) row_ptr->data,
+                            (long*) colind->data,
+                            (double*) data->data) != 0) {
+      Py_DECREF(data);
+      PyErr_SetString(PyExc_RuntimeError,
+              "fitsmooth.dok_to_csr_data: pattern does not match matrix");
+      return NULL;
+    }
+
+    return PyArray_Return(data);
+}
+
+// Locates points (npts x 2) in the mesh stored in a quad tree. If
+// neighbours (n x 3) is not None the mesh (with vertex_coordinates 3n x 2
+// as used to build the tree) is walked from the triangle of the previous
+// point found, see _locate_points. The triangle containing each point is
+// stored in ids (-1 if outside the mesh) and its barycentric coordinates
+// in sigmas (npts x 3). Returns the number of points found.
+PyObject *locate_points(PyObject *self, PyObject *args) {
+
+    PyObject *tree;
+    PyArrayObject *point_coordinates;
+    PyObject *vertex_coordinates;
+    PyObject *neighbours;
+    PyArrayObject *ids;
+    PyArrayObject *sigmas;
+    double * vertex_coordinates_data = NULL;
+    long * neighbours_data = NULL;
+    long npts, found;
+
+    // Convert Python arguments to C
+    if (!PyArg_ParseTuple(args, "OOOOOO", &tree,
+                                          &point_coordinates,
+                                          &vertex_coordinates,
+                                          &neighbours,
+                                          &ids,
+                                          &sigmas
+                                          )) {
+      PyErr_SetString(PyExc_RuntimeError,
+              "fitsmooth.c: could not parse input");
+      return NULL;
+    }
+
+    CHECK_C_CONTIG(point_coordinates);
+    CHECK_C_CONTIG(ids);
+    CHECK_C_CONTIG(sigmas);
+
+    if (neighbours != Py_None) {
+      PyArrayObject *vertex_array = (PyArrayObject*) vertex_coordinates;
+      PyArrayObject *neighbour_array = (PyArrayObject*) neighbours;
+      CHECK_C_CONTIG(vertex_array);
+      CHECK_C_CONTIG(neighbour_array);
+      vertex_coordinates_data = (double*) vertex_array->data;
+      neighbours_data = (long*) neighbour_array->data;
+    }
+
+    npts = point_coordinates->dimensions[0];
+
+    if (PyArray_SIZE(ids) != npts || PyArray_SIZE(sigmas) != 3*npts) {
+      PyErr_SetString(PyExc_ValueError,
+              "fitsmooth.locate_points: inconsistent array sizes");
+      return NULL;
+    }
+
+    #ifdef PYVERSION273
+    quad_tree * quadtree = (quad_tree*) PyCapsule_GetPointer(tree,"quad tree");
+    #else
+    quad_tree * quadtree = (quad_tree*) PyCObject_AsVoidPtr(tree);
+    #endif
+
+    Py_BEGIN_ALLOW_THREADS
+    found = _locate_points(npts, (double*) point_coordinates->data,
+                           vertex_coordinates_data, neighbours_data,
+                           quadtree,
+                           (long*) ids->data, (double*) sigmas->data);
+    Py_END_ALLOW_THREADS
+
+    return PyInt_FromLong(found);
+}
+
 // Searches a quad tree struct for the triangle containing a given point,
 // returns the sigma values produced by this point and the triangle found,
 // and the triangle index. Found is returned as 0 if no triangle is found
@@ -811,13 +1362,18 @@ PyObject *build_matrix_B(PyObject *self, PyObject *args) {
     sparse_dok * dok_AtA = (sparse_dok*) PyCObject_AsVoidPtr(AtA_cap);
     #endif
 
-    // Add two sparse_dok matrices
-    add_sparse_dok(smoothing_mat,alpha,dok_AtA,1);
+    // Add two sparse_dok matrices into a new one. add_sparse_dok is not
+    // used as it modifies both its arguments, which would change D and AtA
+    // for later calls (e.g. after adding more points).
+    sparse_dok * dok_B = make_dok();
+    _add_to_dok(dok_B,dok_AtA,1.0);
+    _add_to_dok(dok_B,smoothing_mat,alpha);
     
     // Create sparse_csr matrix and convert result to this format
     sparse_csr * B;
     B = make_csr();
-    convert_to_csr_ptr(B,smoothing_mat);
+    convert_to_csr_ptr(B,dok_B);
+    delete_dok_matrix(dok_B);
     
     // Extract the sparse_csr data to be returned as python lists
     PyObject *data = c_double_array_to_list(B->data,
@@ -859,8 +1415,11 @@ static struct PyMethodDef MethodTable[] = {
     {"build_quad_tree",build_quad_tree, METH_VARARGS, "Print out"},
     {"build_smoothing_matrix",build_smoothing_matrix, METH_VARARGS, "Print out"},
     {"build_matrix_AtA_Atz_points",build_matrix_AtA_Atz_points, METH_VARARGS, "Print out"},
+    {"build_matrix_AtA_Atz_points_csr",build_matrix_AtA_Atz_points_csr, METH_VARARGS, "Print out"},
+    {"dok_to_csr_data",dok_to_csr_data, METH_VARARGS, "Print out"},
     {"combine_partial_AtA_Atz",combine_partial_AtA_Atz, METH_VARARGS, "Print out"},
     {"individual_tree_search",individual_tree_search, METH_VARARGS, "Print out"},
+    {"locate_points",locate_points, METH_VARARGS, "Print out"},
 	{NULL, NULL, 0, NULL}   // sentinel
 };
 
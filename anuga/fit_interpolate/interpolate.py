@@ -188,6 +188,7 @@ class Interpolate (FitInterpolate):
         self._A_can_be_reused = False  # FIXME (Ole): Probably obsolete
         self._point_coordinates = None # FIXME (Ole): Probably obsolete
         self.interpolation_matrices = {} # Store precomputed matrices
+        self._mesh_hash = None # Hash of the mesh for interpolation_cache
 
 
     # FIXME: What is a good start_blocking_len value?
@@ -338,11 +339,19 @@ class Interpolate (FitInterpolate):
                                                            verbose=verbose)
                     self.interpolation_matrices[key] = (X, point_coordinates)
         else:
-            X = self._build_interpolation_matrix_A(point_coordinates, output_centroids,
-                                                   verbose=verbose)
+            X = self._get_interpolation_matrix_A(point_coordinates,
+                                                 output_centroids,
+                                                 verbose=verbose)
 
         # Unpack result
         self._A, self.inside_poly_indices, self.outside_poly_indices, self.centroids = X
+
+        # Matrices from the interpolation cache are shared, so give
+        # this instance its own copy of the (small) index arrays
+        if isinstance(self._A, Sparse_CSR):
+            self.inside_poly_indices = num.array(self.inside_poly_indices)
+            self.outside_poly_indices = num.array(self.outside_poly_indices)
+            self.centroids = num.array(self.centroids)
         # Check that input dimensions are compatible
         msg = 'Two columns must be specified in point coordinates. ' \
               'I got shape=%s' % (str(point_coordinates.shape))
@@ -351,14 +360,14 @@ class Interpolate (FitInterpolate):
         msg = 'The number of rows in matrix A must be the same as the '
         msg += 'number of points supplied.'
         msg += ' I got %d points and %d matrix rows.' \
-               % (point_coordinates.shape[0], self._A.shape[0])
-        assert point_coordinates.shape[0] == self._A.shape[0], msg
+               % (point_coordinates.shape[0], self._A.M)
+        assert point_coordinates.shape[0] == self._A.M, msg
 
         msg = 'The number of columns in matrix A must be the same as the '
         msg += 'number of mesh vertices.'
         msg += ' I got %d vertices and %d matrix columns.' \
-               % (f.shape[0], self._A.shape[1])
-        assert self._A.shape[1] == f.shape[0], msg
+               % (f.shape[0], self._A.N)
+        assert self._A.N == f.shape[0], msg
 
         # Compute Matrix vector product and return
         return self._get_point_data_z(f, NODATA_value=NODATA_value)
@@ -389,6 +398,42 @@ class Interpolate (FitInterpolate):
         return z
 
 
+    def _get_interpolation_matrix_A(self,
+                                    point_coordinates,
+                                    output_centroids=False,
+                                    verbose=False):
+        """Return interpolation matrix as returned by
+        _build_interpolation_matrix_A, with the matrix in Sparse_CSR format.
+
+        The matrix is taken from the interpolation cache if it has been
+        built before for the same mesh and points (see
+        interpolation_cache.py), otherwise it is built and stored there.
+        """
+
+        import interpolation_cache
+
+        point_coordinates = ensure_numeric(point_coordinates, num.float)
+
+        # The mesh is hashed once, not for every block of points
+        if self._mesh_hash is None:
+            self._mesh_hash = interpolation_cache.get_mesh_hash(
+                self.mesh.nodes, self.mesh.triangles)
+
+        key = interpolation_cache.get_interpolation_hash(
+            self.mesh.nodes, self.mesh.triangles, point_coordinates,
+            output_centroids, mesh_hash=self._mesh_hash)
+
+        X = interpolation_cache.load_interpolation_matrix(key, verbose)
+        if X is None:
+            A, inside_poly_indices, outside_poly_indices, centroids = \
+                self._build_interpolation_matrix_A(point_coordinates,
+                                                   output_centroids,
+                                                   verbose=verbose)
+            X = (A, inside_poly_indices, outside_poly_indices, centroids)
+            X = interpolation_cache.save_interpolation_matrix(key, X, verbose)
+
+        return X
+
     def _build_interpolation_matrix_A(self,
                                       point_coordinates,
                                       output_centroids=False,
@@ -405,6 +450,11 @@ class Interpolate (FitInterpolate):
         This one will override any data_origin that may be specified in
         instance interpolation
 
+        Points are located all at once with MeshQuadtree.locate_points.
+
+        Return (A, inside_poly_indices, outside_poly_indices, centroids)
+        where A is a Sparse_CSR matrix.
+
         Preconditions:
             Point_coordindates and mesh vertices have the same origin.
         """
@@ -437,54 +487,47 @@ class Interpolate (FitInterpolate):
         if verbose: log.critical('Number of datapoints: %d' % n)
         if verbose: log.critical('Number of basis functions: %d' % m)
 
-        A = Sparse(n,m)
+        inside_boundary_indices = num.array(inside_boundary_indices, num.int)
+        outside_poly_indices = num.array(outside_poly_indices, num.int)
 
-        n = len(inside_boundary_indices)
-
-        centroids = []
-        inside_poly_indices = []
-        
-        # Compute matrix elements for points inside the mesh
+        # Locate all points inside the mesh boundary at once
         if verbose: log.critical('Building interpolation matrix from %d points'
-                                 % n)
+                                 % len(inside_boundary_indices))
 
-        for d, i in enumerate(inside_boundary_indices):
-            # For each data_coordinate point
-            if verbose and d%((n+10)/10)==0: log.critical('Doing %d of %d'
-                                                          %(d, n))
+        ids, sigmas = \
+             self.root.locate_points(point_coordinates[inside_boundary_indices])
 
-            x = point_coordinates[i]
-            element_found, sigma0, sigma1, sigma2, k = self.root.search_fast(x)         
-            # Update interpolation matrix A if necessary
-            if element_found is True:
+        found = ids >= 0
+        inside_poly_indices = inside_boundary_indices[found]
+        ids = ids[found]
 
-                #if verbose:
-                #    print 'Point is within mesh:', d, i
-            
-                inside_poly_indices.append(i)
-                
-                # Assign values to matrix A
-                j0 = self.mesh.triangles[k,0] # Global vertex id for sigma0
-                j1 = self.mesh.triangles[k,1] # Global vertex id for sigma1
-                j2 = self.mesh.triangles[k,2] # Global vertex id for sigma2
-                js = [j0, j1, j2]
-                
-                if output_centroids is False:
-                    # Weight each vertex according to its distance from x
-                    sigmas = {j0:sigma0, j1:sigma1, j2:sigma2}
-                    for j in js:
-                        A[i, j] = sigmas[j]
-                else:
-                    # If centroids are needed, weight all 3 vertices equally
-                    for j in js:
-                        A[i, j] = 1.0/3.0
-                    centroids.append(self.mesh.centroid_coordinates[k])                        
-            else:
-                if verbose:
-                    log.critical('Mesh has a hole - moving this point to outside list')
+        if not num.alltrue(found):
+            if verbose:
+                log.critical('Mesh has a hole - moving %d points to outside list'
+                             % num.sum(~found))
+            outside_poly_indices = \
+                num.concatenate((outside_poly_indices,
+                                 inside_boundary_indices[~found]))
+
+        if output_centroids is False:
+            # Weight each vertex according to its distance from x
+            sigmas = sigmas[found]
+            centroids = []
+        else:
+            # If centroids are needed, weight all 3 vertices equally
+            sigmas = num.ones((len(ids), 3), num.float)/3.0
+            centroids = self.mesh.centroid_coordinates[ids]
 
-                # This is a numpy arrays, so we need to do a slow transfer
-                outside_poly_indices = num.append(outside_poly_indices, [i], axis=0)
+        # Build n x m interpolation matrix, three entries per row of a point
+        # inside the mesh
+        order = num.argsort(inside_poly_indices, kind='mergesort')
+        row_ptr = num.zeros(n+1, num.int)
+        row_ptr[inside_poly_indices + 1] = 3
+        row_ptr = num.cumsum(row_ptr)
+        colind = num.array(self.mesh.triangles[ids[order]], num.int).ravel()
+        data = num.array(sigmas[order], num.float).ravel()
+
+        A = Sparse_CSR(None, data, colind, row_ptr, n, m)
 
         return A, inside_poly_indices, outside_poly_indices, centroids
 
@@ -493,6 +536,43 @@ class Interpolate (FitInterpolate):
 
 
 
+def get_interpolation_matrix(vertex_coordinates,
+                             triangles,
+                             point_coordinates,
+                             output_centroids=False,
+                             verbose=False):
+    """Return matrix interpolating values at the vertices of a mesh to
+    point_coordinates (relative to the same origin).
+
+    Return (A, inside_poly_indices, outside_poly_indices, centroids)
+    as returned by Interpolate._get_interpolation_matrix_A with A a
+    Sparse_CSR matrix.
+
+    The mesh is only built if the matrix is not found in the interpolation
+    cache (see interpolation_cache.py).
+    """
+
+    import interpolation_cache
+
+    vertex_coordinates = ensure_numeric(vertex_coordinates, num.float)
+    triangles = ensure_numeric(triangles, num.int)
+    point_coordinates = ensure_numeric(point_coordinates, num.float)
+
+    key = interpolation_cache.get_interpolation_hash(vertex_coordinates,
+                                                     triangles,
+                                                     point_coordinates,
+                                                     output_centroids)
+
+    X = interpolation_cache.load_interpolation_matrix(key, verbose)
+    if X is None:
+        I = Interpolate(vertex_coordinates, triangles, verbose=verbose)
+        X = I._get_interpolation_matrix_A(point_coordinates,
+                                          output_centroids,
+                                          verbose=verbose)
+
+    return X
+
+
 def benchmark_interpolate(vertices,
                           vertex_attributes,
                           triangles, points,
@@ -874,7 +954,8 @@ class Interpolation_function:
                 log.critical('Build interpolator')
 
 
-            # Build interpolator
+            # Build interpolation matrix (or get it from the
+            # interpolation cache)
             if triangles is not None and vertex_coordinates is not None:
                 if verbose:
                     msg = 'Building interpolation matrix from source mesh '
@@ -884,9 +965,13 @@ class Interpolation_function:
                     log.critical(msg)
 
                 # This one is no longer needed for STS files
-                interpol = Interpolate(vertex_coordinates,
-                                       triangles,
-                                       verbose=verbose)
+                A, _, outside_poly_indices, centroids = \
+                    get_interpolation_matrix(vertex_coordinates,
+                                             triangles,
+                                             self.interpolation_points,
+                                             output_centroids=output_centroids,
+                                             verbose=verbose)
+                self.centroids = centroids
 
             elif triangles is None and vertex_coordinates is not None:
                 if verbose:
@@ -922,12 +1007,8 @@ class Interpolation_function:
 
                     # Interpolate
                     if triangles is not None and vertex_coordinates is not None:
-                        result = interpol.interpolate(Q,
-                                                      point_coordinates=\
-                                                      self.interpolation_points,
-                                                      verbose=False,
-                                                      output_centroids=output_centroids)
-                        self.centroids = interpol.centroids                                                          
+                        result = A * num.array(Q, num.float)
+                        result[outside_poly_indices] = NAN
                     elif triangles is None and vertex_coordinates is not None:
                         result = interpolate_polyline(Q,
                                                       vertex_coordinates,
@@ -1062,6 +1143,19 @@ class Interpolation_function:
         """
         return self.time
 
+    def get_state(self):
+        """Return the time cursor, i.e. index of the timestep before the
+        last time evaluated. Used for checkpointing.
+        """
+
+        return {'index': self.index}
+
+    def set_state(self, state):
+        """Restore time cursor as returned by get_state
+        """
+
+        self.index = int(state['index'])
+
     def statistics(self):
         """Output statistics about interpolation_function
         """
@@ -0,0 +1,240 @@
+"""Store interpolation matrices for reuse.
+
+Building the matrix interpolating vertex values of a mesh to a set of
+points requires building the mesh and its quad tree and locating every
+point. Post processing scripts, interpolate_sww2csv, sww2timeseries and
+File_boundary repeat this for the same mesh and points, e.g. for every
+scenario run on the same mesh or every restart of a model.
+
+Matrices are identified by a hash of the mesh vertices, triangles, the
+points and whether centroid weights are used. If option cachedir is set
+they are stored in uncompressed .npz files in that directory, so that
+later runs load them instead of building them, and if option memorysize
+is set they are also kept in memory (up to memorysize bytes in total),
+e.g.
+
+    from anuga.fit_interpolate import interpolation_cache
+    interpolation_cache.set_option('cachedir', 'interpolation_cache')
+    interpolation_cache.set_option('memorysize', 100*1024*1024)
+
+An interpolation matrix is stored as the tuple
+(A, inside_poly_indices, outside_poly_indices, centroids) where A is a
+Sparse_CSR matrix and the rest are arrays. The arrays are read-only as
+they are shared by all users of the matrix.
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy as num
+
+import anuga.utilities.log as log
+
+
+# Part of every interpolation hash, increase it with any change to the
+# layout of the stored matrices
+interpolation_cache_version = 1
+
+options = {
+    'cachedir': None,             # Directory of stored matrices (None: none)
+    'memorysize': None            # Maximum total size in bytes of matrices
+                                  # kept in memory (None or 0: none)
+}
+
+# Matrices kept in memory: hash -> (X, size) in order of use
+memory_cache = OrderedDict()
+memory_cache_size = 0
+
+
+def set_option(key, value):
+    """Set interpolation cache option (see options).
+    """
+
+    if key not in options:
+        msg = 'Unknown interpolation cache option: %s' % key
+        raise KeyError(msg)
+
+    options[key] = value
+
+    if key == 'memorysize':
+        _reduce_memory(value)
+
+
+def get_mesh_hash(vertex_coordinates, triangles):
+    """Return hash (hex string) of the vertices and triangles of a mesh.
+    """
+
+    import hashlib
+    from anuga.caching.caching import hash_array
+
+    hasher = hashlib.md5()
+    for x, dtype in [(vertex_coordinates, num.float),
+                     (triangles, num.int)]:
+        hasher.update('%x' % hash_array(num.asarray(x, dtype=dtype)))
+
+    return hasher.hexdigest()
+
+
+def get_interpolation_hash(vertex_coordinates, triangles, point_coordinates,
+                           output_centroids=False, mesh_hash=None):
+    """Return hash (hex string) of the inputs determining an interpolation
+    matrix.
+
+    mesh_hash is the hash of vertex_coordinates and triangles as returned
+    by get_mesh_hash. Pass it when interpolating the same mesh to many sets
+    of points so that the mesh is only hashed once.
+    """
+
+    import hashlib
+    from anuga.caching.caching import hash_array
+
+    if mesh_hash is None:
+        mesh_hash = get_mesh_hash(vertex_coordinates, triangles)
+
+    hasher = hashlib.md5(str(interpolation_cache_version))
+    hasher.update(repr(bool(output_centroids)))
+    hasher.update(mesh_hash)
+    hasher.update('%x' % hash_array(num.asarray(point_coordinates,
+                                                dtype=num.float)))
+
+    return hasher.hexdigest()
+
+
+def get_interpolation_cache_filename(cachedir, interpolation_hash):
+    """Return name of the file holding the matrix of interpolation_hash.
+    """
+
+    return os.path.join(cachedir, 'interpolation_%s.npz' % interpolation_hash)
+
+
+def load_interpolation_matrix(interpolation_hash, verbose=False):
+    """Return interpolation matrix stored for interpolation_hash,
+    or None if there is none in memory or in option cachedir.
+    """
+
+    if interpolation_hash in memory_cache:
+        # Mark as most recently used
+        X, size = memory_cache.pop(interpolation_hash)
+        memory_cache[interpolation_hash] = (X, size)
+        return X
+
+    if options['cachedir'] is None:
+        return None
+
+    filename = get_interpolation_cache_filename(options['cachedir'],
+                                                interpolation_hash)
+    if not os.path.exists(filename):
+        return None
+
+    if verbose: log.critical('Interpolation cache: Loading %s' % filename)
+
+    from anuga.caching.caching import load_arrays
+    from anuga.utilities.sparse import Sparse_CSR
+
+    arrays = load_arrays(filename, verbose)
+    if arrays is None:
+        return None
+
+    M, N = [int(x) for x in arrays['shape']]
+    A = Sparse_CSR(None, arrays['data'], arrays['colind'], arrays['row_ptr'],
+                   M, N)
+    X = (A, arrays['inside_poly_indices'], arrays['outside_poly_indices'],
+         arrays['centroids'])
+
+    _remember(interpolation_hash, X)
+
+    return X
+
+
+def save_interpolation_matrix(interpolation_hash, X, verbose=False):
+    """Keep interpolation matrix X in memory and store it in option
+    cachedir if set.
+
+    X is (A, inside_poly_indices, outside_poly_indices, centroids) with A
+    a Sparse_CSR matrix. Return X with its arrays made read-only. The file
+    is written by anuga.caching.caching.save_arrays.
+    """
+
+    A, inside_poly_indices, outside_poly_indices, centroids = X
+
+    inside_poly_indices = num.array(inside_poly_indices, num.int)
+    outside_poly_indices = num.array(outside_poly_indices, num.int)
+    centroids = num.array(centroids, num.float).reshape(-1, 2)
+
+    X = (A, inside_poly_indices, outside_poly_indices, centroids)
+    _remember(interpolation_hash, X)
+
+    if options['cachedir'] is None:
+        return X
+
+    from anuga.caching.caching import save_arrays
+
+    filename = get_interpolation_cache_filename(options['cachedir'],
+                                                interpolation_hash)
+
+    if verbose: log.critical('Interpolation cache: Saving %s' % filename)
+
+    arrays = {'data': A.data,
+              'colind': A.colind,
+              'row_ptr': A.row_ptr,
+              'shape': num.array([A.M, A.N], num.int),
+              'inside_poly_indices': inside_poly_indices,
+              'outside_poly_indices': outside_poly_indices,
+              'centroids': centroids}
+
+    save_arrays(arrays, filename, verbose)
+
+    return X
+
+
+def clear_memory_cache():
+    """Remove all interpolation matrices kept in memory.
+    """
+
+    global memory_cache_size
+
+    memory_cache.clear()
+    memory_cache_size = 0
+
+
+def _get_arrays(X):
+    """Return list of the arrays making up interpolation matrix X.
+    """
+
+    A, inside_poly_indices, outside_poly_indices, centroids = X
+
+    return [A.data, A.colind, A.row_ptr,
+            inside_poly_indices, outside_poly_indices, centroids]
+
+
+def _remember(interpolation_hash, X):
+    """Make the arrays of X read-only and keep X in memory if it fits.
+    """
+
+    global memory_cache_size
+
+    size = 0
+    for array in _get_arrays(X):
+        array.flags.writeable = False
+        size += array.nbytes
+
+    if not options['memorysize'] or size > options['memorysize']:
+        return
+
+    if interpolation_hash in memory_cache:
+        memory_cache_size -= memory_cache.pop(interpolation_hash)[1]
+
+    memory_cache[interpolation_hash] = (X, size)
+    memory_cache_size += size
+
+    _reduce_memory(options['memorysize'])
+
+
+def _reduce_memory(memorysize):
+    """Drop least recently used matrices beyond memorysize bytes.
+    """
+
+    global memory_cache_size
+
+    while memory_cache and memory_cache_size > memorysize:
+        memory_cache_size -= memory_cache.popitem(last=False)[1][1]
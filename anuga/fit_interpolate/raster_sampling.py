@@ -0,0 +1,252 @@
+"""Sample large rasters at points without loading them into memory.
+
+Rasters in ESRI binary float grids (.flt with header .hdr) are memory
+mapped and those in NetCDF DEM files (.dem) are read through NetCDF.
+ESRI ASCII grids (.asc) are converted once to a .flt file next to them
+(see anuga.file_conversion.asc2flt), or in the caching directory should
+that directory not be writable, which is used as long as it is newer than
+the .asc file.
+
+Only the window of the raster covering the points is read, in bands of
+rows holding at most max_block_size values, so memory use is bounded by
+a band whatever the size of the raster. Within a band values are
+interpolated by interpolate2d.
+
+As in grd2array and dem2array the grid points of a raster are at
+xllcorner + j*cellsize, yllcorner + i*cellsize unless pixel_is_area is
+True, in which case values are taken to be at the centres of the cells
+of the raster as in GDAL.
+"""
+
+import os
+
+import numpy as num
+
+from anuga.fit_interpolate.interpolate2d import interpolate2d
+import anuga.utilities.log as log
+
+
+# Maximum number of raster values read at a time
+MAX_BLOCK_SIZE = 2**22
+
+
+def get_cached_flt_filename(filename):
+    """Return name of the .flt file in the cache directory used for
+    .asc file filename when its own directory is not writable.
+    """
+
+    import hashlib
+    from anuga.caching.caching import options, checkdir
+
+    path = os.path.abspath(filename)
+    base = os.path.splitext(os.path.basename(path))[0]
+    key = hashlib.md5(path).hexdigest()[:16]
+
+    return os.path.join(checkdir(options['cachedir']),
+                        '%s_%s.flt' % (base, key))
+
+
+class Raster_file:
+    """Raster in a .flt, .dem or .asc file read in windows.
+    """
+
+    def __init__(self, filename, verbose=False):
+
+        ext = os.path.splitext(filename)[1]
+        self.netcdf_file = None
+
+        if ext == '.asc':
+            filename = self._get_flt_file(filename, verbose)
+            ext = '.flt'
+
+        if ext == '.flt':
+            from anuga.file_conversion.asc2flt import read_asc_header
+
+            fid = open(filename[:-4] + '.hdr')
+            try:
+                header = read_asc_header(fid)[0]
+            finally:
+                fid.close()
+
+            self._set_header(header)
+
+            if header.get('byteorder', 'LSBFIRST').upper() == 'MSBFIRST':
+                byteorder = '>'
+            else:
+                byteorder = '<'
+            dtype = byteorder + 'f%d' % (int(header.get('nbits', 32))/8)
+
+            self.values = num.memmap(filename, dtype=dtype, mode='r',
+                                     shape=(self.nrows, self.ncols))
+        elif ext == '.dem':
+            from anuga.file.netcdf import NetCDFFile
+            from anuga.config import netcdf_mode_r
+
+            self.netcdf_file = NetCDFFile(filename, netcdf_mode_r)
+            fid = self.netcdf_file
+            self._set_header({'ncols': fid.ncols,
+                              'nrows': fid.nrows,
+                              'xllcorner': fid.xllcorner,
+                              'yllcorner': fid.yllcorner,
+                              'cellsize': fid.cellsize,
+                              'nodata_value': fid.NODATA_value})
+
+            self.values = fid.variables['elevation']
+        else:
+            msg = 'Extension should be .asc, .dem or .flt. I got %s' % ext
+            raise IOError(msg)
+
+        if verbose:
+            log.critical('Raster %s: %d rows, %d columns'
+                         % (filename, self.nrows, self.ncols))
+
+    def _set_header(self, header):
+
+        self.ncols = int(header['ncols'])
+        self.nrows = int(header['nrows'])
+        self.cellsize = float(header['cellsize'])
+
+        # Like grd2array, treat corners and centers alike
+        self.xllcorner = float(header.get('xllcorner',
+                                          header.get('xllcenter')))
+        self.yllcorner = float(header.get('yllcorner',
+                                          header.get('yllcenter')))
+
+        if header.get('nodata_value') is None:
+            self.NODATA_value = None
+        else:
+            self.NODATA_value = float(header['nodata_value'])
+
+    def _get_flt_file(self, filename, verbose):
+        """Return name of the .flt file converted from .asc filename,
+        converting it if needed.
+        """
+
+        from anuga.file_conversion.asc2flt import asc2flt
+
+        # The .flt file goes next to the .asc file, or into the cache
+        # directory should that not be writable.
+        flt_filename = filename[:-4] + '.flt'
+        cache_filename = get_cached_flt_filename(filename)
+        for name in [flt_filename, cache_filename]:
+            if (os.path.exists(name) and
+                os.path.exists(name[:-4] + '.hdr') and
+                os.path.getmtime(name) >= os.path.getmtime(filename)):
+                return name
+
+        if not os.access(os.path.dirname(os.path.abspath(filename)),
+                         os.W_OK):
+            flt_filename = cache_filename
+
+        return asc2flt(filename, flt_filename, verbose=verbose)
+
+    def read_window(self, start_row, end_row, start_col, end_col):
+        """Return values of rows start_row to end_row (counted from the
+        north) and columns start_col to end_col as an array of floats
+        with NaN for missing values.
+        """
+
+        if len(self.values.shape) == 1:
+            Z = self.values[start_row*self.ncols:end_row*self.ncols]
+            Z = num.reshape(Z, (-1, self.ncols))[:, start_col:end_col]
+        else:
+            Z = self.values[start_row:end_row, start_col:end_col]
+
+        Z = num.array(Z, num.float)
+        if self.NODATA_value is not None:
+            Z[Z == self.NODATA_value] = num.nan
+
+        return Z
+
+    def close(self):
+
+        self.values = None
+        if self.netcdf_file is not None:
+            self.netcdf_file.close()
+            self.netcdf_file = None
+
+
+def sample_raster(filename, points, mode='linear', pixel_is_area=False,
+                  max_block_size=MAX_BLOCK_SIZE, verbose=False):
+    """Return values of the raster in filename (.asc, .dem or .flt)
+    interpolated at points.
+
+    points: N x 2 array of absolute coordinates
+    mode: 'linear' (bilinear) or 'constant' (nearest grid point),
+          see interpolate2d
+    pixel_is_area: If True values are at the centres of the raster cells
+          and points within half a cell of the edge of the raster take
+          the value of the edge. Otherwise they are at the corners (see
+          module doc string).
+    max_block_size: Maximum number of raster values in memory at a time
+
+    Values of points outside the raster or next to missing values are NaN.
+    """
+
+    points = num.array(points, num.float).reshape(-1, 2)
+    px = points[:, 0].copy()
+    py = points[:, 1].copy()
+
+    raster = Raster_file(filename, verbose=verbose)
+    try:
+        ncols, nrows, cellsize = raster.ncols, raster.nrows, raster.cellsize
+
+        oldset = num.seterr(invalid='ignore')  # NaN coordinates
+
+        x0, y0 = raster.xllcorner, raster.yllcorner
+        if pixel_is_area:
+            # Move points in the outer half cells of the raster onto the
+            # centres of the edge cells
+            in_x = (px >= x0) & (px <= x0 + ncols*cellsize)
+            in_y = (py >= y0) & (py <= y0 + nrows*cellsize)
+
+            x0 += 0.5*cellsize
+            y0 += 0.5*cellsize
+            px = num.where(in_x, num.clip(px, x0, x0 + (ncols-1)*cellsize), px)
+            py = num.where(in_y, num.clip(py, y0, y0 + (nrows-1)*cellsize), py)
+
+        x = num.linspace(x0, x0 + cellsize*(ncols-1), ncols)
+        y = num.linspace(y0, y0 + cellsize*(nrows-1), nrows)
+
+        values = num.empty(len(points), num.float)
+        values[:] = num.nan
+
+        inside = (px >= x[0]) & (px <= x[-1]) & (py >= y[0]) & (py <= y[-1])
+        num.seterr(**oldset)
+
+        ids = num.nonzero(inside)[0]
+
+        # Grid cell (from the south west) of points, bands of rows
+        # are processed in turn
+        i = num.clip(((py[ids] - y0)/cellsize).astype(num.int), 0, nrows-1)
+        j = num.clip(((px[ids] - x0)/cellsize).astype(num.int), 0, ncols-1)
+
+        order = num.argsort(i, kind='mergesort')
+        ids = ids[order]
+        i = i[order]
+        j = j[order]
+
+        rows_per_block = max(1, int(max_block_size)/ncols - 2)
+        for i0 in range(0, nrows, rows_per_block):
+            lo, hi = num.searchsorted(i, [i0, i0 + rows_per_block])
+            if lo == hi:
+                continue
+
+            # Window including the neighbours of all points in the band
+            a = max(i0 - 1, 0)
+            b = min(i0 + rows_per_block, nrows - 1)
+            c = max(j[lo:hi].min() - 1, 0)
+            d = min(j[lo:hi].max() + 1, ncols - 1)
+
+            # Raster rows are stored from north to south
+            Z = raster.read_window(nrows - 1 - b, nrows - a, c, d + 1)
+            Z = num.flipud(Z).transpose()
+
+            block_ids = ids[lo:hi]
+            block_points = num.array([px[block_ids], py[block_ids]]).T
+            values[block_ids] = interpolate2d(x[c:d+1], y[a:b+1], Z,
+                                              block_points, mode=mode)
+    finally:
+        raster.close()
+
+    return values
@@ -1140,7 +1140,158 @@ class Test_Fit(unittest.TestCase):
         #clean up
         os.remove(mesh_file)
         os.remove(point_file)
-  
+
+    def test_build_matrix_pattern(self):
+        triangles = [[1,0,2], [1,2,3], [3,2,4]]
+
+        row_ptr, colind = build_matrix_pattern(triangles, 6)
+
+        assert num.allclose(row_ptr, [0, 3, 7, 12, 16, 19, 19])
+        assert num.allclose(colind, [0,1,2, 0,1,2,3, 0,1,2,3,4,
+                                     1,2,3,4, 2,3,4])
+
+    def test_threaded_AtA_Atz(self):
+        """Threaded assembly into CSR gives the same matrices and fit
+        as the single threaded dictionary of keys assembly
+        """
+
+        from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular
+
+        points, triangles, boundary = rectangular(10, 8, len1=5.0, len2=4.0)
+        mesh = Mesh(points, triangles)
+
+        num.random.seed(17)
+        data_points = num.random.uniform(0.0, 4.0, (2000, 2))
+        data_points[:,0] += 0.5
+        z = num.zeros((2000, 2))
+        z[:,0] = linear_function(data_points)
+        z[:,1] = num.sin(data_points[:,0])
+
+        fit = Fit(mesh=mesh, alpha=0.01)
+        fit._build_matrix_AtA_Atz(data_points, z)
+        ref = fit.fit()
+        B = fit.B.todense()
+
+        for num_threads in [1, 4]:
+            fit = Fit(mesh=mesh, alpha=0.01, num_threads=num_threads)
+
+            # Two blocks of points accumulate into the same matrices
+            fit._build_matrix_AtA_Atz(data_points[:1200], z[:1200])
+            fit._build_matrix_AtA_Atz(data_points[1200:], z[1200:])
+            assert isinstance(fit.AtA, Sparse_CSR)
+            assert fit.point_count == 2000
+
+            f = fit.fit()
+            assert num.allclose(fit.B.todense(), B)
+            assert num.allclose(f, ref)
+
+        # Single attribute through fit_to_mesh
+        f = fit_to_mesh(data_points, mesh=mesh, point_attributes=z[:,0],
+                        alpha=0.01, num_threads=2)
+        assert num.allclose(f, ref[:,0])
+
+    def test_fit_several_attributes(self):
+        """Fitting several attributes together, with and without warm
+        start, gives the same as fitting them one by one
+        """
+
+        from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular
+
+        points, triangles, boundary = rectangular(10, 8, len1=5.0, len2=4.0)
+        mesh = Mesh(points, triangles)
+
+        num.random.seed(13)
+        data_points = num.random.uniform(0.0, 4.0, (1000, 2))
+        times = num.arange(5)*0.1
+        z = num.zeros((1000, len(times)))
+        for i, t in enumerate(times):
+            z[:,i] = num.sin(data_points[:,0] - t) + data_points[:,1]
+
+        refs = []
+        for i in range(len(times)):
+            fit = Fit(mesh=mesh, alpha=0.01)
+            refs.append(fit.fit(data_points, z[:,i]))
+        refs = num.array(refs).transpose()
+
+        fit = Fit(mesh=mesh, alpha=0.01)
+        f = fit.fit(data_points, z)
+        assert num.allclose(f, refs)
+
+        # Together by the block solver without the c solver
+        fit_block = Fit(mesh=mesh, alpha=0.01, use_c_cg=False)
+        assert num.allclose(fit_block.fit(data_points, z), refs)
+
+        # B and the preconditioner are reused
+        B = fit.B
+        precon = fit.precon
+        f = fit.solve(warm_start=True)
+        assert fit.B is B
+        assert fit.precon is precon
+        assert num.allclose(f, refs, atol=1.0e-4)
+
+        # Initial guess from an earlier solution
+        f = fit.solve(x0=refs)
+        assert num.allclose(f, refs, atol=1.0e-4)
+
+        # Adding points builds B again
+        fit.build_fit_subset(data_points[:500], z[:500])
+        assert fit.B is None
+        f = fit.fit()
+
+        ref = Fit(mesh=mesh, alpha=0.01).fit(
+                  num.concatenate((data_points, data_points[:500])),
+                  num.concatenate((z, z[:500])))
+        assert num.allclose(f, ref)
+
+    def test_fit_file_with_several_processes(self):
+        """Fitting a points file with several processes gives the same as
+        reading it in one process, for each file format
+        """
+
+        from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular
+        from anuga.geospatial_data.geospatial_data import \
+             get_points_file_ranges, read_points_file_range
+
+        points, triangles, boundary = rectangular(10, 8, len1=5.0, len2=4.0)
+        mesh = Mesh(points, triangles)
+
+        num.random.seed(17)
+        data_points = num.random.uniform(0.0, 4.0, (1000, 2))
+        elevation = num.sin(data_points[:,0]) + data_points[:,1]
+        friction = data_points[:,0]
+        geo = Geospatial_data(data_points, {'elevation': elevation,
+                                            'friction': friction})
+
+        ref = Fit(mesh=mesh, alpha=0.01).fit(data_points, friction)
+
+        for extension in ['.csv', '.pts', '.npy']:
+            filename = tempfile.mktemp(extension)
+            geo.export_points_file(filename)
+
+            try:
+                # Ranges cover all points once
+                ranges = get_points_file_ranges(filename, 7)
+                assert len(ranges) == 7
+                blocks = [block for start, end in ranges
+                          for block in read_points_file_range(filename, start,
+                                                              end, 60)]
+                assert max([len(block) for block in blocks]) <= 60
+                read_points = num.concatenate([block.get_data_points()
+                                               for block in blocks])
+                assert num.allclose(read_points, data_points)
+
+                f = fit_to_mesh(filename, mesh=mesh, alpha=0.01,
+                                attribute_name='friction',
+                                max_read_lines=100)
+                assert num.allclose(f, ref)
+
+                f = fit_to_mesh(filename, mesh=mesh, alpha=0.01,
+                                attribute_name='friction',
+                                max_read_lines=100, number_of_processes=3)
+                assert num.allclose(f, ref)
+            finally:
+                os.remove(filename)
+
 
 #-------------------------------------------------------------
 if __name__ == "__main__":
@@ -1946,6 +1946,108 @@ class Test_Interpolate(unittest.TestCase):
         #print "answer",answer 
         assert num.allclose(z, answer)
 
+    def test_interpolation_cache(self):
+        """Interpolation matrices are reused from memory and from disk
+        """
+
+        import shutil
+        from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular
+        from anuga.fit_interpolate import interpolation_cache
+        from anuga.fit_interpolate.interpolate import get_interpolation_matrix
+
+        points, vertices, boundary = rectangular(4, 3)
+        interpolation_points = [[0.1, 0.2], [0.55, 0.35], [0.9, 0.95],
+                                [1.5, 0.5]]
+
+        cachedir = tempfile.mkdtemp()
+        interpolation_cache.set_option('cachedir', cachedir)
+        interpolation_cache.set_option('memorysize', 100*1024*1024)
+        interpolation_cache.clear_memory_cache()
+
+        def no_build(*args, **kwargs):
+            raise Exception('Interpolation matrix should have been reused')
+
+        build = Interpolate._build_interpolation_matrix_A
+        try:
+            A, inside, outside, centroids = \
+                get_interpolation_matrix(points, vertices,
+                                         interpolation_points)
+            assert num.allclose(outside, [3])
+            assert len(os.listdir(cachedir)) == 1
+
+            f = linear_function(points)
+            z = A*f
+            assert num.allclose(z[:3], linear_function(interpolation_points[:3]))
+
+            # Same matrix from memory, then from disk, without building it
+            Interpolate._build_interpolation_matrix_A = no_build
+
+            X = get_interpolation_matrix(points, vertices,
+                                         interpolation_points)
+            assert X[0] is A
+
+            interpolation_cache.clear_memory_cache()
+            B, inside_B, outside_B, centroids_B = \
+                get_interpolation_matrix(points, vertices,
+                                         interpolation_points)
+            assert num.allclose(B*f, z)
+            assert num.allclose(inside_B, inside)
+            assert num.allclose(outside_B, outside)
+
+            # Interpolate and Interpolation_function use the cache too
+            interp = Interpolate(points, vertices)
+            z = interp.interpolate(f, interpolation_points)
+            assert num.allclose(z[:3], linear_function(interpolation_points[:3]))
+            assert z[3] == NAN
+
+            time = [0.0, 1.0]
+            F = Interpolation_function(time, {'f': num.array([f, 2*f])},
+                                       vertex_coordinates=points,
+                                       triangles=vertices,
+                                       interpolation_points=interpolation_points)
+            assert num.allclose(F(0.5, point_id=1),
+                                1.5*linear_function(interpolation_points[1:2]))
+
+            # Different points or centroid weights give a different matrix
+            try:
+                get_interpolation_matrix(points, vertices,
+                                         interpolation_points,
+                                         output_centroids=True)
+            except Exception:
+                pass
+            else:
+                msg = 'Interpolation matrix with centroids should be built'
+                raise Exception(msg)
+        finally:
+            Interpolate._build_interpolation_matrix_A = build
+            interpolation_cache.set_option('cachedir', None)
+            interpolation_cache.set_option('memorysize', None)
+            interpolation_cache.clear_memory_cache()
+            shutil.rmtree(cachedir)
+
+        # Nothing is kept in memory by default
+        get_interpolation_matrix(points, vertices, interpolation_points)
+        assert len(interpolation_cache.memory_cache) == 0
+
+        # The mesh is hashed once per Interpolate instance
+        hash_mesh = interpolation_cache.get_mesh_hash
+        calls = []
+        def get_mesh_hash(*args):
+            calls.append(args)
+            return hash_mesh(*args)
+
+        interpolation_cache.get_mesh_hash = get_mesh_hash
+        try:
+            interp = Interpolate(points, vertices)
+            z = interp.interpolate(f, interpolation_points,
+                                   start_blocking_len=2)
+            assert num.allclose(z[:3],
+                                linear_function(interpolation_points[:3]))
+            interp.interpolate(f, interpolation_points[:2])
+            assert len(calls) == 1
+        finally:
+            interpolation_cache.get_mesh_hash = hash_mesh
+
 ################################################################################
 
 if __name__ == "__main__":
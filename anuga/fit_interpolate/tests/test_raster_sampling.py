@@ -0,0 +1,209 @@
+"""Test sampling rasters in windows
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as num
+
+from anuga.fit_interpolate.raster_sampling import sample_raster
+from anuga.fit_interpolate.interpolate2d import interpolate2d
+from anuga.file_conversion.grd2array import grd2array
+from anuga.file_conversion.dem2array import dem2array
+from anuga.file_conversion.asc2dem import asc2dem
+from anuga.file_conversion.asc2flt import asc2flt
+
+
+def nanallclose(x, y):
+    """allclose for arrays with NaN at the same positions
+    """
+
+    if num.any(num.isnan(x) != num.isnan(y)):
+        return False
+
+    ok = num.logical_not(num.isnan(x))
+    return num.allclose(x[ok], y[ok])
+
+
+class Test_raster_sampling(unittest.TestCase):
+
+    def setUp(self):
+
+        self.dirname = tempfile.mkdtemp()
+        self.root = os.path.join(self.dirname, 'raster')
+
+        # Raster of 7 columns and 5 rows with one missing value
+        self.xllcorner = 300000.0
+        self.yllcorner = 6180000.0
+        self.cellsize = 10.0
+
+        Z = num.arange(35, dtype=num.float).reshape(5, 7)**1.5
+        Z[1, 4] = -9999
+
+        fid = open(self.root + '.asc', 'w')
+        fid.write('ncols 7\nnrows 5\n')
+        fid.write('xllcorner %f\nyllcorner %f\n'
+                  % (self.xllcorner, self.yllcorner))
+        fid.write('cellsize %f\nNODATA_value -9999\n' % self.cellsize)
+        for row in Z:
+            fid.write(' '.join([str(z) for z in row]) + '\n')
+        fid.close()
+
+        fid = open(self.root + '.prj', 'w')
+        fid.write('Projection UTM\nZone 56\nDatum WGS84\nZunits NO\n'
+                  'Units METERS\nSpheroid WGS84\nXshift 0.0000000000\n'
+                  'Yshift 10000000.0000000000\nParameters\n')
+        fid.close()
+
+        # Points inside and around the raster including grid points
+        num.random.seed(11)
+        points = num.random.uniform(-15.0, 75.0, (400, 2))
+        points[:, 1] *= 0.6
+        grid_points = num.array([[10.0, 20.0], [0.0, 0.0], [60.0, 40.0],
+                                 [30.0, 40.0], [45.0, 10.0]])
+        self.points = num.concatenate((points, grid_points)) + \
+                      [self.xllcorner, self.yllcorner]
+
+    def tearDown(self):
+
+        shutil.rmtree(self.dirname)
+
+    def test_sample_raster(self):
+        """Sampling in windows gives the values of interpolating the
+        whole raster
+        """
+
+        x, y, Z = grd2array(self.root + '.asc')
+
+        asc2dem(self.root + '.asc')
+
+        for mode in ['linear', 'constant']:
+            ref = interpolate2d(x, y, Z, self.points, mode=mode)
+            assert num.any(num.isnan(ref))
+            assert not num.all(num.isnan(ref))
+
+            for ext in ['.asc', '.dem']:
+                for max_block_size in [10, 20, 1000]:
+                    values = sample_raster(self.root + ext, self.points,
+                                           mode=mode,
+                                           max_block_size=max_block_size)
+                    assert nanallclose(values, ref)
+
+        # The .asc file was converted once
+        assert os.path.exists(self.root + '.flt')
+        x, y, Z = dem2array(self.root + '.dem')
+        ref = interpolate2d(x, y, Z, self.points)
+        assert nanallclose(sample_raster(self.root + '.flt', self.points), ref)
+
+    def test_asc2flt(self):
+
+        filename = asc2flt(self.root + '.asc', self.root + '_copy.flt')
+        assert filename == self.root + '_copy.flt'
+
+        x, y, Z = grd2array(self.root + '.asc')
+        values = num.fromfile(filename, '<f8').reshape(5, 7)
+        values = num.where(values == -9999, num.nan, values)
+        assert nanallclose(num.flipud(values).T, Z)
+
+        fid = open(self.root + '_copy.hdr')
+        lines = fid.readlines()
+        fid.close()
+        assert lines[0].split() == ['ncols', '7']
+        assert lines[-2].split() == ['nbits', '64']
+
+    def test_asc2flt_incomplete(self):
+        """No .flt file is left when the .asc file is incomplete
+        """
+
+        fid = open(self.root + '_short.asc', 'w')
+        fid.write('ncols 7\nnrows 5\ncellsize 10.0\n')
+        fid.write('1.0 2.0 3.0\n')
+        fid.close()
+
+        try:
+            asc2flt(self.root + '_short.asc')
+        except Exception:
+            pass
+        else:
+            raise Exception('Incomplete .asc file should raise')
+
+        assert not os.path.exists(self.root + '_short.flt')
+        assert [f for f in os.listdir(self.dirname)
+                if f.endswith('.tmp')] == []
+
+    def test_sample_raster_read_only_directory(self):
+        """A .asc file in a directory which is not writable is converted
+        into the cache directory
+        """
+
+        from anuga.caching.caching import options
+        from anuga.fit_interpolate.raster_sampling import \
+             get_cached_flt_filename
+
+        x, y, Z = grd2array(self.root + '.asc')
+        ref = interpolate2d(x, y, Z, self.points)
+
+        cachedir = options['cachedir']
+        options['cachedir'] = tempfile.mkdtemp()
+        access = os.access
+        def no_write_access(path, mode):
+            if path == self.dirname and mode & os.W_OK:
+                return False
+            return access(path, mode)
+
+        os.chmod(self.dirname, 0555)
+        os.access = no_write_access
+        try:
+            values = sample_raster(self.root + '.asc', self.points)
+            assert nanallclose(values, ref)
+
+            assert not os.path.exists(self.root + '.flt')
+            flt_filename = get_cached_flt_filename(self.root + '.asc')
+            assert os.path.dirname(flt_filename) == \
+                   os.path.abspath(options['cachedir'])
+            assert os.path.exists(flt_filename)
+            assert os.path.exists(flt_filename[:-4] + '.hdr')
+        finally:
+            os.access = access
+            os.chmod(self.dirname, 0755)
+            shutil.rmtree(options['cachedir'])
+            options['cachedir'] = cachedir
+
+    def test_sample_raster_pixel_is_area(self):
+        """With pixel_is_area values are at the centres of the cells
+        """
+
+        Z = num.arange(35, dtype=num.float).reshape(5, 7)**1.5
+
+        # Centre of cell in row 1 (from the north), column 2, and
+        # points in the outer half cells
+        points = num.array([[25.0, 35.0],
+                            [21.0, 38.0],
+                            [2.0, 47.0],
+                            [69.0, 1.0],
+                            [71.0, 1.0]]) + [self.xllcorner, self.yllcorner]
+
+        values = sample_raster(self.root + '.asc', points, mode='constant',
+                               pixel_is_area=True)
+        assert num.allclose(values[:4], [Z[1, 2], Z[1, 2], Z[0, 0], Z[4, 6]])
+        assert num.isnan(values[4])
+
+        values = sample_raster(self.root + '.asc', points, mode='linear',
+                               pixel_is_area=True)
+        assert num.allclose(values[0], Z[1, 2])
+        assert num.allclose(values[2], Z[0, 0])
+
+        # Half way between two cell centres on the edge
+        point = num.array([[30.0, 45.0]]) + [self.xllcorner, self.yllcorner]
+        value = sample_raster(self.root + '.asc', point, pixel_is_area=True)
+        assert num.allclose(value, (Z[0, 2] + Z[0, 3])/2)
+
+
+#-------------------------------------------------------------
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(Test_raster_sampling, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -550,6 +550,117 @@ def in_and_outside_polygon(points, polygon, closed=True, verbose=False):
         return  indices[:count], indices[count:][::-1]  #return reversed
 
 
+def inside_polygons(points, polygons, closed=True, verbose=False):
+    """Determine points inside each of a list of polygons
+
+       Returns a list with, for each polygon, the array of indices (in
+       increasing order) of points inside it, the same as calling
+       inside_polygon for each polygon in turn.
+
+       All polygons are done in one pass over the points, see
+       points_in_polygons.
+
+       points and polygons can be geospatial instances, lists or numeric
+       arrays. See separate_points_by_polygon for closed.
+    """
+
+    pairs = points_in_polygons(points, polygons, closed=closed, first=False,
+                               verbose=verbose)
+
+    # Pairs are ordered by point, so a stable sort by polygon keeps the
+    # points of each polygon in increasing order
+    order = num.argsort(pairs[:, 1], kind='mergesort')
+    point_ids = pairs[order, 0]
+    ptr = num.searchsorted(pairs[order, 1], num.arange(len(polygons) + 1))
+
+    return [point_ids[ptr[i]:ptr[i+1]] for i in range(len(polygons))]
+
+def points_in_polygons(points, polygons, closed=True, first=True,
+                       verbose=False):
+    """Determine which of a list of polygons contain each point
+
+    Input:
+       points - list or array of (x, y) coordinates or geospatial instance
+       polygons - list of polygons, each a list of vertices
+       closed - (optional) determine whether points on boundary should be
+       regarded as belonging to the polygons (closed = True)
+       or not (closed = False)
+       first - (optional) If True find only the first polygon in the list
+       containing each point, otherwise find all of them
+
+    Outputs:
+       If first is True, array with for each point the index of the first
+       polygon containing it, -1 for points outside all polygons.
+
+       Otherwise an array of pairs [point index, polygon index] for every
+       point inside every polygon, ordered by point then polygon.
+
+    Examples:
+       U = [[0,0], [1,0], [1,1], [0,1]] #Unit square
+       V = [[0.5,0], [2,0], [2,1], [0.5,1]]
+
+       points_in_polygons([[0.2, 0.5], [0.7, 0.5], [3, 0]], [U, V])
+       will return [0, 0, -1] and with first=False the pairs
+       [[0, 0], [1, 0], [1, 1]]
+
+    Remarks:
+       The bounding boxes of the polygons are registered in a grid over
+       them, so that each point is only tested against the polygons near
+       it. Many small polygons, e.g. land use parcels, cost little more
+       than one polygon.
+
+       See separate_points_by_polygon for the kind of polygons allowed.
+
+    Uses underlying C-implementation in polygon_ext.c
+    """
+
+    assert isinstance(closed, bool), \
+                'Keyword argument "closed" must be boolean'
+
+    points = ensure_absolute(points)
+    if len(points.shape) == 1:
+        # Only one point was passed in. Convert to array of points
+        points = num.reshape(points, (1, 2))
+    points = num.ascontiguousarray(points, num.float)
+
+    msg = 'Points array must have two columns'
+    assert len(points.shape) == 2 and points.shape[1] == 2, msg
+
+    vertices = []
+    polygon_ptr = num.zeros(len(polygons) + 1, num.int)
+    for i, polygon in enumerate(polygons):
+        polygon = ensure_absolute(polygon)
+
+        msg = 'Polygon array must be a 2d array of vertices'
+        assert len(polygon.shape) == 2 and len(polygon) > 0, msg
+
+        msg = 'Polygon array must have two columns'
+        assert polygon.shape[1] == 2, msg
+
+        vertices.append(polygon)
+        polygon_ptr[i+1] = polygon_ptr[i] + len(polygon)
+
+    if len(vertices) > 0:
+        vertices = num.ascontiguousarray(num.concatenate(vertices), num.float)
+    else:
+        vertices = num.zeros((0, 2), num.float)
+
+    result = _points_in_polygons(points, vertices, polygon_ptr,
+                                 int(closed), int(first), int(verbose))
+
+    if not first:
+        result = result.reshape(-1, 2)
+
+    if verbose:
+        if first:
+            count = num.sum(result >= 0)
+        else:
+            count = len(num.unique(result[:, 0]))
+        log.critical('Found %d points (out of %d) inside %d polygons'
+                     % (count, len(points), len(polygons)))
+
+    return result
+
 
 def separate_points_by_polygon(points, polygon,
                                closed=True, 
@@ -1125,6 +1236,7 @@ def polylist2points_verts(polylist):
 
 from polygon_ext import _point_on_line
 from polygon_ext import _separate_points_by_polygon
+from polygon_ext import _points_in_polygons
 from polygon_ext import _interpolate_polyline    
 from polygon_ext import _polygon_overlap
 from polygon_ext import _line_intersect
@@ -643,6 +643,47 @@ int __is_inside_triangle(double* point,
 }			  			       			       
 
 
+int __point_in_polygon(double x, double y,
+                       int N,           // Number of polygon vertices
+                       double* polygon,
+                       int closed,
+                       double rtol,
+                       double atol) {
+  // Return 1 if point x, y is inside polygon, 0 otherwise.
+  // Points on an edge are inside if closed is 1.
+  
+  double px_i, py_i, px_j, py_j;
+  int i, j, inside = 0;
+
+  for (i=0; i<N; i++) {
+    j = (i+1)%N;
+
+    px_i = polygon[2*i];
+    py_i = polygon[2*i+1];
+    px_j = polygon[2*j];
+    py_j = polygon[2*j+1];
+
+    // Check for case where point is contained in line segment
+    if (__point_on_line(x, y, px_i, py_i, px_j, py_j, rtol, atol)) {
+      if (closed == 1) {
+        return 1;
+      } else {
+        return 0;
+      }
+    } else {
+      //Check if truly inside polygon
+      if ( ((py_i < y) && (py_j >= y)) ||
+           ((py_j < y) && (py_i >= y)) ) {
+        if (px_i + (y-py_i)/(py_j-py_i)*(px_j-px_i) < x)
+          inside = 1-inside;
+      }
+    }
+  }
+
+  return inside;
+}
+
+
 int __separate_points_by_polygon(int M,     // Number of points
 				 int N,     // Number of polygon vertices
 				 double* points,
@@ -651,8 +692,8 @@ int __separate_points_by_polygon(int M,     // Number of points
 				 int closed,
 				 int verbose) {
 
-  double minpx, maxpx, minpy, maxpy, x, y, px_i, py_i, px_j, py_j, rtol=0.0, atol=0.0;
-  int i, j, k, outside_index, inside_index, inside;
+  double minpx, maxpx, minpy, maxpy, x, y, px_i, py_i, rtol=0.0, atol=0.0;
+  int i, k, outside_index, inside_index, inside;
 
   // Find min and max of poly used for optimisation when points
   // are far away from polygon
@@ -693,31 +734,7 @@ int __separate_points_by_polygon(int M,     // Number of points
       // Nothing
     } else {   
       // Check polygon
-      for (i=0; i<N; i++) {
-        j = (i+1)%N;
-
-        px_i = polygon[2*i];
-        py_i = polygon[2*i+1];
-        px_j = polygon[2*j];
-        py_j = polygon[2*j+1];
-
-        // Check for case where point is contained in line segment
-        if (__point_on_line(x, y, px_i, py_i, px_j, py_j, rtol, atol)) {
-	  if (closed == 1) {
-	    inside = 1;
-	  } else {
-	    inside = 0;
-	  }
-	  break;
-        } else {
-          //Check if truly inside polygon
-	  if ( ((py_i < y) && (py_j >= y)) ||
-	       ((py_j < y) && (py_i >= y)) ) {
-	    if (px_i + (y-py_i)/(py_j-py_i)*(px_j-px_i) < x)
-	      inside = 1-inside;
-	  }
-        }
-      }
+      inside = __point_in_polygon(x, y, N, polygon, closed, rtol, atol);
     } 
     if (inside == 1) {
       indices[inside_index] = k;
@@ -732,6 +749,220 @@ int __separate_points_by_polygon(int M,     // Number of points
 }
 
 
+int __grid_index(double v, double vmin, double cellsize, int n) {
+  // Index of the cell of the grid containing coordinate v
+  
+  int i;
+
+  if (cellsize <= 0.0) return 0;
+  
+  i = (int) ((v - vmin)/cellsize);
+  if (i < 0) i = 0;
+  if (i > n-1) i = n-1;
+  
+  return i;
+}
+
+
+int __points_in_polygons(int M,           // Number of points
+                         double* points,
+                         int P,           // Number of polygons
+                         double* vertices,
+                         long* polygon_ptr, // P+1 offsets into vertices
+                         int closed,
+                         int first,
+                         long* polygon_ids,  // M-Array, first polygon
+                         long** pairs,       // Point, polygon pairs
+                         long* number_of_pairs,
+                         int verbose) {
+  // Find the polygons containing each point.
+  //
+  // The vertices of polygon p are vertices[polygon_ptr[p]] to
+  // vertices[polygon_ptr[p+1]-1]. The bounding boxes of the polygons are
+  // registered in the cells of a regular grid over their extent, so each
+  // point is only tested against the polygons whose bounding box
+  // overlaps its cell, in the order of the polygons.
+  //
+  // If first is 1 polygon_ids[k] is set to the first polygon containing
+  // point k (-1 if none). Otherwise all pairs (point, polygon) with the
+  // point inside the polygon are stored in *pairs (allocated here, 2 longs
+  // per pair, ordered by point then polygon) and their number in
+  // *number_of_pairs.
+  //
+  // Returns 0 on success and 1 if memory could not be allocated.
+  
+  double *bbox = NULL;    // xmin, xmax, ymin, ymax of each polygon
+  long *cell_ptr = NULL;  // Offsets of cells into cell_polygons
+  long *cell_polygons = NULL;
+  long *buffer = NULL;
+  long capacity = 0, count = 0, total;
+  double xmin = 0.0, xmax = 0.0, ymin = 0.0, ymax = 0.0;
+  double dx, dy, w, h, x, y, px, py, rtol=0.0, atol=0.0;
+  int nx, ny, ncells, target, i, j, i0, i1, j0, j1, k, p, q, c, N;
+  double *b;
+
+  bbox = malloc(4*(P > 0 ? P : 1)*sizeof(double));
+  if (bbox == NULL) return 1;
+
+  // Bounding boxes of polygons and their extent
+  for (p=0; p<P; p++) {
+    b = bbox + 4*p;
+    b[0] = b[1] = vertices[2*polygon_ptr[p]];
+    b[2] = b[3] = vertices[2*polygon_ptr[p]+1];
+    for (i=polygon_ptr[p]+1; i<polygon_ptr[p+1]; i++) {
+      px = vertices[2*i];
+      py = vertices[2*i+1];
+      if (px < b[0]) b[0] = px;
+      if (px > b[1]) b[1] = px;
+      if (py < b[2]) b[2] = py;
+      if (py > b[3]) b[3] = py;
+    }
+
+    if (p == 0 || b[0] < xmin) xmin = b[0];
+    if (p == 0 || b[1] > xmax) xmax = b[1];
+    if (p == 0 || b[2] < ymin) ymin = b[2];
+    if (p == 0 || b[3] > ymax) ymax = b[3];
+  }
+
+  // Grid of about 4 cells per polygon with square cells, made coarser
+  // while polygons spanning many cells would give many more entries
+  // than cells and polygons
+  w = xmax - xmin;
+  h = ymax - ymin;
+  target = 4*P;
+  if (target > 4194304) target = 4194304;
+  if (target < 1) target = 1;
+  
+  if (w > 0.0 && h > 0.0) {
+    nx = (int) ceil(sqrt(target*w/h));
+    if (nx > target) nx = target;
+    ny = (int) ceil((double) target/nx);
+  } else if (w > 0.0) {
+    nx = target; ny = 1;
+  } else if (h > 0.0) {
+    nx = 1; ny = target;
+  } else {
+    nx = 1; ny = 1;
+  }
+
+  while (1) {
+    dx = w/nx;
+    dy = h/ny;
+    total = 0;
+    for (p=0; p<P; p++) {
+      b = bbox + 4*p;
+      total += (long) (__grid_index(b[1], xmin, dx, nx) - 
+                       __grid_index(b[0], xmin, dx, nx) + 1) *
+                      (__grid_index(b[3], ymin, dy, ny) - 
+                       __grid_index(b[2], ymin, dy, ny) + 1);
+    }
+
+    if (total <= 16*((long) P + (long) nx*ny) || (nx == 1 && ny == 1)) break;
+    
+    nx = (nx+1)/2;
+    ny = (ny+1)/2;
+  }
+  ncells = nx*ny;
+
+  if (verbose) printf("Registered %d polygons in %d x %d cells\n", P, nx, ny);
+
+  // Polygons of each cell in increasing order
+  cell_ptr = calloc(ncells+1, sizeof(long));
+  cell_polygons = malloc((total > 0 ? total : 1)*sizeof(long));
+  if (cell_ptr == NULL || cell_polygons == NULL) {
+    free(bbox); free(cell_ptr); free(cell_polygons);
+    return 1;
+  }
+
+  for (q=0; q<2; q++) {
+    // First count polygons per cell, then store them
+    for (p=0; p<P; p++) {
+      b = bbox + 4*p;
+      i0 = __grid_index(b[0], xmin, dx, nx);
+      i1 = __grid_index(b[1], xmin, dx, nx);
+      j0 = __grid_index(b[2], ymin, dy, ny);
+      j1 = __grid_index(b[3], ymin, dy, ny);
+      for (j=j0; j<=j1; j++) {
+        for (i=i0; i<=i1; i++) {
+          c = j*nx + i;
+          if (q == 0) {
+            cell_ptr[c+1] += 1;
+          } else {
+            cell_polygons[cell_ptr[c]] = p;
+            cell_ptr[c] += 1;
+          }
+        }
+      }
+    }
+
+    if (q == 0) {
+      for (c=0; c<ncells; c++) cell_ptr[c+1] += cell_ptr[c];
+    } else {
+      // Restore offsets shifted by storing
+      for (c=ncells; c>0; c--) cell_ptr[c] = cell_ptr[c-1];
+      cell_ptr[0] = 0;
+    }
+  }
+
+  // Begin main loop (for each point)
+  for (k=0; k<M; k++) {
+    if (verbose){
+      if (k %((M+10)/10)==0) printf("Doing %d of %d\n", k, M);
+    }
+
+    if (first) polygon_ids[k] = -1;
+    if (P == 0) continue;
+    
+    x = points[2*k];
+    y = points[2*k + 1];
+
+    // Also rejects NaN
+    if (!((x >= xmin) && (x <= xmax) && (y >= ymin) && (y <= ymax))) continue;
+
+    c = __grid_index(y, ymin, dy, ny)*nx + __grid_index(x, xmin, dx, nx);
+
+    for (i=cell_ptr[c]; i<cell_ptr[c+1]; i++) {
+      p = cell_polygons[i];
+      b = bbox + 4*p;
+      if ((x < b[0]) || (x > b[1]) || (y < b[2]) || (y > b[3])) continue;
+
+      N = polygon_ptr[p+1] - polygon_ptr[p];
+      if (!__point_in_polygon(x, y, N, vertices + 2*polygon_ptr[p],
+                              closed, rtol, atol)) continue;
+
+      if (first) {
+        polygon_ids[k] = p;
+        break;
+      }
+
+      if (count == capacity) {
+        capacity = 2*capacity + 1024;
+        *pairs = realloc(buffer, 2*capacity*sizeof(long));
+        if (*pairs == NULL) {
+          free(buffer); free(bbox); free(cell_ptr); free(cell_polygons);
+          return 1;
+        }
+        buffer = *pairs;
+      }
+      buffer[2*count] = k;
+      buffer[2*count+1] = p;
+      count += 1;
+    }
+  } // End k
+
+  if (!first) {
+    *pairs = buffer;
+    *number_of_pairs = count;
+  }
+
+  free(bbox);
+  free(cell_ptr);
+  free(cell_polygons);
+
+  return 0;
+}
+
+
 
 // Gateways to Python
 PyObject *_point_on_line(PyObject *self, PyObject *args) {
@@ -1095,6 +1326,103 @@ PyObject *_separate_points_by_polygon(PyObject *self, PyObject *args) {
 
 
 
+PyObject *_points_in_polygons(PyObject *self, PyObject *args) {
+  //def points_in_polygons(points, vertices, polygon_ptr, closed, first,
+  //                       verbose):
+  //  """Find the polygons containing each point
+  //
+  //  Input:
+  //     points - M x 2 array of point coordinates
+  //     vertices - vertices of all polygons one after the other
+  //     polygon_ptr - array of P+1 offsets into vertices, polygon p has
+  //     vertices polygon_ptr[p] to polygon_ptr[p+1]-1
+  //     closed - determine whether points on boundary should be
+  //     regarded as belonging to the polygon
+  //     first - 1 for the first polygon containing each point only,
+  //     0 for all of them
+  //
+  //  Output:
+  //     If first is 1, array of M indices of the first polygon containing
+  //     each point (-1 if none). Otherwise N x 2 array of all pairs
+  //     (point, polygon) with the point inside the polygon, ordered by
+  //     point then polygon.
+  //
+  //  See __points_in_polygons
+
+  PyArrayObject
+    *points,
+    *vertices,
+    *polygon_ptr,
+    *result;
+
+  int closed, first, verbose; //Flags
+  int M, P, err;
+  long number_of_pairs = 0;
+  long *pairs = NULL;
+  npy_intp dims[2];
+
+  // Convert Python arguments to C
+  if (!PyArg_ParseTuple(args, "OOOiii",
+			&points,
+			&vertices,
+			&polygon_ptr,
+			&closed,
+			&first,
+			&verbose)) {
+    PyErr_SetString(PyExc_RuntimeError, 
+		    "points_in_polygons could not parse input");
+    return NULL;
+  }
+
+  CHECK_C_CONTIG(points);
+  CHECK_C_CONTIG(vertices);
+  CHECK_C_CONTIG(polygon_ptr);
+
+  M = points -> dimensions[0];           //Number of points
+  P = polygon_ptr -> dimensions[0] - 1;  //Number of polygons
+
+  if (first) {
+    dims[0] = M;
+    result = (PyArrayObject*) PyArray_SimpleNew(1, dims, NPY_LONG);
+    if (result == NULL) return NULL;
+
+    err = __points_in_polygons(M, (double*) points -> data,
+                               P, (double*) vertices -> data,
+                               (long*) polygon_ptr -> data,
+                               closed, first,
+                               (long*) result -> data,
+                               NULL, NULL, verbose);
+  } else {
+    err = __points_in_polygons(M, (double*) points -> data,
+                               P, (double*) vertices -> data,
+                               (long*) polygon_ptr -> data,
+                               closed, first,
+                               NULL, &pairs, &number_of_pairs, verbose);
+    result = NULL;
+    if (err == 0) {
+      dims[0] = number_of_pairs;
+      dims[1] = 2;
+      result = (PyArrayObject*) PyArray_SimpleNew(2, dims, NPY_LONG);
+      if (result != NULL && number_of_pairs > 0) {
+        memcpy(result -> data, pairs, 2*number_of_pairs*sizeof(long));
+      }
+    }
+    free(pairs);
+    if (err == 0 && result == NULL) return NULL;
+  }
+
+  if (err != 0) {
+    Py_XDECREF(result);
+    PyErr_SetString(PyExc_MemoryError, 
+		    "points_in_polygons could not allocate memory");
+    return NULL;
+  }
+
+  return PyArray_Return(result);
+}
+
+
+
 // Method table for python module
 static struct PyMethodDef MethodTable[] = {
   /* The cast of the function is necessary since PyCFunction values
@@ -1106,6 +1434,8 @@ static struct PyMethodDef MethodTable[] = {
   //{"_intersection", _intersection, METH_VARARGS, "Print out"},  
   {"_separate_points_by_polygon", _separate_points_by_polygon, 
                                  METH_VARARGS, "Print out"},
+  {"_points_in_polygons", _points_in_polygons, 
+                                 METH_VARARGS, "Print out"},
   {"_interpolate_polyline", _interpolate_polyline, 
                                  METH_VARARGS, "Print out"},				 
   {"_polygon_overlap", _polygon_overlap, 
@@ -6,7 +6,7 @@
 
 import anuga.utilities.log as log
 import numpy as num
-from polygon import inside_polygon
+from polygon import inside_polygons
 
 class Polygon_function:
     """Create callable object f: x,y -> z, where a,y,z are vectors and
@@ -34,6 +34,11 @@ class Polygon_function:
 
     Note: If two polygons overlap, the one last in the list takes precedence
 
+    Which points fall in which polygons is remembered for the points of the
+    last call, so calling the function again with the same points (e.g.
+    for every time step) does not classify them again. Callable values are
+    evaluated once for all points in their polygon.
+
     Coordinates specified in the call are assumed to be relative to the
     origin (georeference) e.g. used by domain.
     By specifying the optional argument georeference,
@@ -88,6 +93,10 @@ class Polygon_function:
             georeffed_poly = geo_reference.change_points_geo_ref(polygon)
             self.regions.append((georeffed_poly, value))
 
+        # Points of last call and indices of them inside each polygon
+        self.points = None
+        self.inside_indices = None
+
     def __call__(self, pts_x, pts_y):
         """Implement the 'callable' property of Polygon_function.
 
@@ -111,18 +120,20 @@ class Polygon_function:
         else:
             result = num.ones(pts_len, num.float) * self.default
 
-        for polygon, value in self.regions:
-            indices = inside_polygon(points, polygon)
+        if self.points is None or not num.array_equal(points, self.points):
+            polygons = [polygon for polygon, value in self.regions]
+            self.inside_indices = inside_polygons(points, polygons)
+            self.points = points
+
+        for (polygon, value), indices in zip(self.regions,
+                                             self.inside_indices):
+            if len(indices) == 0:
+                continue
 
-            # FIXME: This needs to be vectorised
             if callable(value):
-                for i in indices:
-                    xx = num.array([pts_x[i]])
-                    yy = num.array([pts_y[i]])
-                    result[i] = value(xx, yy)[0]
+                result[indices] = value(pts_x[indices], pts_y[indices])
             else:
-                for i in indices:
-                    result[i] = value
+                result[indices] = value
 
         if len(result) == 0:
             msg = ('Warning: points provided to Polygon function did not fall '
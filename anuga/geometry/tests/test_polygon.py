@@ -15,7 +15,8 @@ from anuga.geometry.polygon import _poly_xy, separate_points_by_polygon, \
                     intersection, is_complex, polygon_overlap, not_polygon_overlap,\
                     line_intersect, not_line_intersect,\
                     is_inside_triangle, interpolate_polyline, inside_polygon, \
-                    in_and_outside_polygon
+                    in_and_outside_polygon, inside_polygons, \
+                    points_in_polygons
                     
 from anuga.geometry.polygon_function import Polygon_function
 from anuga.coordinate_transforms.geo_reference import Geo_reference
@@ -181,6 +182,129 @@ class Test_Polygon(unittest.TestCase):
         z = f([5, 5, 27, 35], [5, 9, 8, -5])
         assert num.allclose(z, [2, 14, 35, 2])
 
+    def test_polygon_function_callable_vectorised(self):
+        """Callable values are called once with all points inside their
+        polygon and the classification of points is reused.
+        """
+
+        p1 = [[0,0], [10,0], [10,10], [0,10]]
+        p2 = [[0,0], [10,10], [15,5], [20, 10], [25,0], [30,10], [40,-10]]
+
+        calls = []
+        def counting_function(x, y):
+            calls.append(len(x))
+            return x+y
+
+        f = Polygon_function([(p1, counting_function), (p2, 2.0)])
+        z = f([5, 5, 27, 35, 1], [5, 9, 8, -5, 2])
+        assert num.allclose(z, [2, 14, 0, 2, 3])
+        assert calls == [3]
+
+        inside_indices = f.inside_indices
+        z = f([5, 5, 27, 35, 1], [5, 9, 8, -5, 2])
+        assert num.allclose(z, [2, 14, 0, 2, 3])
+        assert f.inside_indices is inside_indices
+
+        # Other points are classified again
+        z = f([5, 27], [9, 8])
+        assert num.allclose(z, [14, 0])
+        assert f.inside_indices is not inside_indices
+
+    def test_inside_polygons(self):
+        """inside_polygons gives the same as inside_polygon for each polygon
+        """
+
+        # Squares of a grid, triangles and one non-convex polygon
+        polygons = []
+        for i in range(5):
+            for j in range(5):
+                polygons.append([[i, j], [i+1, j], [i+1, j+1], [i, j+1]])
+        polygons.append([[0.5, 0.5], [3.5, 1.0], [2.0, 4.5]])
+        polygons.append([[0,0], [10,10], [15,5], [20, 10], [25,0], [30,10],
+                         [40,-10]])
+
+        points = num.random.uniform(-1.0, 6.0, (500, 2))
+        points = num.concatenate((points, [[1.0, 1.0], [2.0, 0.5], [5, 5]]))
+
+        result = inside_polygons(points, polygons)
+        assert len(result) == len(polygons)
+        for polygon, indices in zip(polygons, result):
+            assert num.alltrue(indices == inside_polygon(points, polygon))
+
+        result = inside_polygons(points, polygons, closed=False)
+        for polygon, indices in zip(polygons, result):
+            assert num.alltrue(indices == inside_polygon(points, polygon,
+                                                         closed=False))
+
+        # Polygons outside all points
+        result = inside_polygons(points, [[[10, 10], [11, 10], [11, 11]]])
+        assert len(result[0]) == 0
+
+    def test_points_in_polygons(self):
+        """points_in_polygons agrees with inside_polygon for many polygons
+        """
+
+        num.random.seed(17)
+
+        # Random triangles and squares of various sizes, some overlapping
+        # and some covering everything
+        polygons = []
+        for i in range(200):
+            x, y = num.random.uniform(0.0, 100.0, 2)
+            r = num.random.uniform(0.1, 10.0)
+            if i % 2 == 0:
+                polygons.append([[x, y], [x+r, y], [x, y+r]])
+            else:
+                polygons.append([[x, y], [x+r, y], [x+r, y+r], [x, y+r]])
+        polygons.append([[-10, -10], [120, -10], [120, 120], [-10, 120]])
+        polygons.append([[0,0], [10,10], [15,5], [20, 10], [25,0], [30,10],
+                         [40,-10]])
+
+        points = num.random.uniform(-5.0, 105.0, (2000, 2))
+        # Vertices and points on edges
+        points = num.concatenate((points, polygons[0], polygons[1],
+                                  [[1.0, 1.0], [20.0, 10.0], [300.0, 0.0]]))
+
+        for closed in [True, False]:
+            inside = [inside_polygon(points, polygon, closed=closed)
+                      for polygon in polygons]
+
+            first = points_in_polygons(points, polygons, closed=closed)
+            assert len(first) == len(points)
+
+            ref = -num.ones(len(points), num.int)
+            for i in range(len(polygons)-1, -1, -1):
+                ref[inside[i]] = i
+            assert num.alltrue(first == ref)
+
+            pairs = points_in_polygons(points, polygons, closed=closed,
+                                       first=False)
+            ref = [[k, i] for i in range(len(polygons)) for k in inside[i]]
+            ref.sort()
+            assert num.alltrue(pairs == num.array(ref))
+
+            for indices, ref in zip(inside_polygons(points, polygons,
+                                                    closed=closed), inside):
+                assert num.alltrue(indices == ref)
+
+        # Example of doc string
+        U = [[0,0], [1,0], [1,1], [0,1]]
+        V = [[0.5,0], [2,0], [2,1], [0.5,1]]
+        points = [[0.2, 0.5], [0.7, 0.5], [3, 0]]
+        assert num.alltrue(points_in_polygons(points, [U, V]) == [0, 0, -1])
+        assert num.alltrue(points_in_polygons(points, [U, V], first=False) ==
+                           [[0, 0], [1, 0], [1, 1]])
+
+        # One point, no polygons, degenerate polygons and NaN
+        assert num.alltrue(points_in_polygons([0.2, 0.5], [V, U]) == [1])
+        assert num.alltrue(points_in_polygons(points, []) == [-1, -1, -1])
+        assert points_in_polygons(points, [], first=False).shape == (0, 2)
+        assert len(inside_polygons(points, [])) == 0
+        assert num.alltrue(points_in_polygons([[1, 0], [1, 1]],
+                                              [[[0, 0], [2, 0]]]) == [0, -1])
+        assert num.alltrue(points_in_polygons([[num.nan, 0.5], [0.5, 0.5]],
+                                              [U]) == [-1, 0])
+
     def test_point_on_line(self):
         # Endpoints first
         assert point_on_line([0,0], [[0,0], [1,0]])
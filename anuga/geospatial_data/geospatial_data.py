@@ -51,7 +51,7 @@ class Geospatial_data:
 
         data_points: x,y coordinates in meters. Type must be either a
         sequence of 2-tuples or an Mx2 numeric array of floats.  A file name
-        with extension .txt, .cvs or .pts can also be passed in here.
+        with extension .txt, .cvs, .pts or .npy can also be passed in here.
 
         attributes: Associated values for each data point. The type
         must be either a list or an array of length M or a dictionary
@@ -107,6 +107,11 @@ class Geospatial_data:
         The first two columns have to be x, y or lat, long
         coordinates.
 
+        A .npy file holds a numpy structured array of absolute points
+        with float fields x, y and one field per attribute, e.g. as
+        written by export_points_file. Blocks of it are read through a
+        memory map.
+
 
         The format for a Points dictionary is:
           ['pointlist'] a 2 column array describing points. 1st column x,
@@ -460,7 +465,7 @@ class Geospatial_data:
 ################################################################################
 
     def import_points_file(self, file_name, delimiter=None, verbose=False):
-        """ load an .txt, .csv or .pts file
+        """ load an .txt, .csv, .pts or .npy file
 
         Note: will throw an IOError/SyntaxError if it can't load the file.
         Catch these!
@@ -494,6 +499,10 @@ class Geospatial_data:
                 msg = ('Problem with format of file %s.\n%s'
                        % (file_name, Error_message['IOError']))
                 raise SyntaxError(msg)
+        elif file_name[-4:] == ".npy":
+            data_points, attributes = _read_npy_file_blocking(
+                num.load(file_name, mmap_mode='r'), 0, None)
+            geo_reference = None
         else:
             msg = 'Extension %s is unknown' % file_name[-4:]
             raise IOError(msg)
@@ -504,7 +513,7 @@ class Geospatial_data:
 
     def export_points_file(self, file_name, absolute=True,
                            as_lat_long=False, isSouthHemisphere=True):
-        """write a points file as a text (.csv) or binary (.pts) file
+        """write a points file as a text (.csv) or binary (.pts or .npy) file
 
         file_name is the file name, including the extension
         The point_dict is defined at the top of this file.
@@ -543,6 +552,12 @@ class Geospatial_data:
                                            isSouthHemisphere=isSouthHemisphere),
                             self.get_all_attributes(),
                             as_lat_long=as_lat_long)
+        elif file_name[-4:] == ".npy":
+            msg = "ERROR: Can not write a .npy file as a relative file."
+            assert absolute, msg
+            _write_npy_file(file_name,
+                            self.get_data_points(absolute=True),
+                            self.get_all_attributes())
         elif file_name[-4:] == ".urs" :
             msg = "ERROR: Can not write a .urs file as a relative file."
             assert absolute, msg
@@ -712,6 +727,10 @@ class Geospatial_data:
                                 self.file_name))
                 log.critical('Geospatial_data: Each block consists of %d data points'
                              % self.max_read_lines)
+        elif self.file_name[-4:] == ".npy":
+            self.blocks = read_points_file_range(self.file_name,
+                                                 max_read_lines=
+                                                     self.max_read_lines)
         else:
             # Assume the file is a csv file
             file_pointer = open(self.file_name)
@@ -761,6 +780,12 @@ class Geospatial_data:
             self.start_row = fin_row
 
             self.block_number += 1
+        elif self.file_name[-4:] == ".npy":
+            try:
+                geo = self.blocks.next()
+            except StopIteration:
+                del self.blocks
+                raise
         else:
             # Assume the file is a csv file
             try:
@@ -1072,6 +1097,163 @@ def _read_pts_file_blocking(fid, start_row, fin_row, keys):
     return pointlist, attributes
 
 
+def _read_npy_file_blocking(data, start_row, fin_row):
+    '''Read rows start_row to fin_row of the structured array of a .npy
+    file.'''
+
+    block = data[start_row:fin_row]
+
+    pointlist = num.empty((len(block), 2), num.float)
+    pointlist[:,0] = block['x']
+    pointlist[:,1] = block['y']
+
+    attributes = {}
+    for key in data.dtype.names:
+        if key not in ('x', 'y'):
+            attributes[key] = num.array(block[key], num.float)
+
+    return pointlist, attributes
+
+
+def get_points_file_ranges(file_name, number_of_ranges):
+    """Split the points of a .csv/.txt, .pts or .npy file into at most
+    number_of_ranges ranges of about equal size, e.g. to be read by
+    separate processes with read_points_file_range.
+
+    Return list of (start, end) pairs. Ranges of a .csv/.txt file are
+    byte offsets of the starts of lines after the header, those of .pts
+    and .npy files are rows.
+    """
+
+    if file_name[-4:] == ".pts":
+        fid = NetCDFFile(file_name, netcdf_mode_r)
+        try:
+            number_of_points = _read_pts_file_header(fid)[2]
+        finally:
+            fid.close()
+        bounds = [0, number_of_points]
+    elif file_name[-4:] == ".npy":
+        bounds = [0, len(num.load(file_name, mmap_mode='r'))]
+    else:
+        file_pointer = open(file_name)
+        try:
+            _read_csv_file_header(file_pointer)
+            bounds = [file_pointer.tell()]
+            file_pointer.seek(0, 2)
+            bounds.append(file_pointer.tell())
+        finally:
+            file_pointer.close()
+
+    starts = [bounds[0] + i*(bounds[1] - bounds[0])/number_of_ranges
+              for i in range(number_of_ranges)]
+
+    if file_name[-4:] not in (".pts", ".npy"):
+        # Move starts to the beginning of the next line
+        file_pointer = open(file_name)
+        try:
+            for i in range(1, number_of_ranges):
+                file_pointer.seek(starts[i] - 1)
+                file_pointer.readline()
+                starts[i] = file_pointer.tell()
+        finally:
+            file_pointer.close()
+
+    ranges = []
+    for start, end in zip(starts, starts[1:] + bounds[1:]):
+        if start < end:
+            ranges.append((start, end))
+
+    return ranges
+
+
+def read_points_file_range(file_name, start=0, end=None, max_read_lines=None):
+    """Generator of Geospatial_data objects holding blocks of at most
+    max_read_lines points of the given range (see get_points_file_ranges)
+    of a .csv/.txt, .pts or .npy file. By default the whole file is read.
+
+    Only one block is held in memory at a time.
+    """
+
+    if max_read_lines is None:
+        max_read_lines = int(MAX_READ_LINES)
+    max_read_lines = int(max_read_lines)
+
+    if file_name[-4:] == ".pts":
+        fid = NetCDFFile(file_name, netcdf_mode_r)
+        try:
+            georef, keys, number_of_points = _read_pts_file_header(fid)
+            if end is None or end > number_of_points:
+                end = number_of_points
+
+            for start_row in range(start, end, max_read_lines):
+                fin_row = min(start_row + max_read_lines, end)
+                pointlist, att_dict = _read_pts_file_blocking(fid, start_row,
+                                                              fin_row, keys)
+                yield Geospatial_data(pointlist, att_dict, georef)
+        finally:
+            fid.close()
+    elif file_name[-4:] == ".npy":
+        data = num.load(file_name, mmap_mode='r')
+        if end is None or end > len(data):
+            end = len(data)
+
+        for start_row in range(start, end, max_read_lines):
+            fin_row = min(start_row + max_read_lines, end)
+            pointlist, att_dict = _read_npy_file_blocking(data, start_row,
+                                                          fin_row)
+            yield Geospatial_data(pointlist, att_dict)
+    else:
+        # Assume the file is a csv file
+        from cStringIO import StringIO
+
+        file_pointer = open(file_name)
+        try:
+            header, file_pointer = _read_csv_file_header(file_pointer)
+            if start > file_pointer.tell():
+                file_pointer.seek(start)
+
+            blocking_georef = None
+            while end is None or file_pointer.tell() < end:
+                lines = []
+                while len(lines) < max_read_lines:
+                    if end is not None and file_pointer.tell() >= end:
+                        break
+                    line = file_pointer.readline()
+                    if line == '':
+                        break
+                    if line.strip() != '':
+                        lines.append(line)
+
+                if lines == []:
+                    break
+
+                try:
+                    pointlist, att_dict, geo_ref, _ = \
+                        _read_csv_file_blocking(StringIO(''.join(lines)),
+                                                header,
+                                                max_read_lines=len(lines))
+                except StopIteration:
+                    # Only comments
+                    continue
+                except SyntaxError:
+                    msg = ('Could not open file %s.\n%s'
+                           % (file_name, Error_message['IOError']))
+                    raise SyntaxError(msg)
+
+                # Check that the zones haven't changed.
+                if geo_ref is not None:
+                    geo_ref.reconcile_zones(blocking_georef)
+                    blocking_georef = geo_ref
+                elif blocking_georef is not None:
+                    msg = ('Geo reference given, then not given.'
+                           ' This should not happen.')
+                    raise ValueError(msg)
+
+                yield Geospatial_data(pointlist, att_dict, geo_ref)
+        finally:
+            file_pointer.close()
+
+
 def _write_pts_file(file_name,
                     write_data_points,
                     write_attributes=None,
@@ -1164,6 +1346,27 @@ def _write_csv_file(file_name,
     fd.close()
 
 
+def _write_npy_file(file_name,
+                    write_data_points,
+                    write_attributes=None):
+    """Write a .npy file of a structured array with fields x, y and
+    one per attribute."""
+
+    if write_attributes is None:
+        write_attributes = {}
+
+    names = ['x', 'y'] + sorted(write_attributes.keys())
+    data = num.empty(len(write_data_points),
+                     dtype=[(str(name), num.float) for name in names])
+
+    data['x'] = write_data_points[:,0]
+    data['y'] = write_data_points[:,1]
+    for key in write_attributes.keys():
+        data[str(key)] = write_attributes[key]
+
+    num.save(file_name, data)
+
+
 def _write_urs_file(file_name, points, delimiter=' '):
     """Write a URS format file.
     export a file, file_name, with the urs format
@@ -1324,12 +1527,18 @@ def find_optimal_smoothing_parameter(data_file,
                                      split_factor=0.1,
                                      seed_num=None,
                                      cache=False,
+                                     number_of_processes=1,
                                      verbose=False):
     """Removes a small random sample of points from 'data_file'.
     Then creates models with different alpha values from 'alpha_list' and
     cross validates the predicted value to the previously removed point data.
     Returns the alpha value which has the smallest covariance.
 
+    The fitting matrices of the remaining points and the interpolation
+    matrix of the sample are built once and shared by all alphas. Alphas
+    are solved in increasing order, each starting from the solution for
+    the previous one.
+
     data_file: must not contain points outside the boundaries defined
                and it must be either a pts, txt or csv file.
 
@@ -1347,6 +1556,9 @@ def find_optimal_smoothing_parameter(data_file,
 
     seed_num: the seed to the random number generator
 
+    number_of_processes: if larger than 1 the sorted alphas are split into
+                         this many runs solved by a pool of processes
+
     USAGE:
         value, alpha = find_optimal_smoothing_parameter(data_file=fileName,
                                              alpha_list=[0.0001, 0.01, 1],
@@ -1371,8 +1583,8 @@ def find_optimal_smoothing_parameter(data_file,
     from anuga.geospatial_data.geospatial_data import Geospatial_data
     from anuga.pmesh.mesh_interface import create_mesh_from_regions
     from anuga.utilities.numerical_tools import cov
-    from anuga.geometry.polygon import is_inside_polygon
-    from anuga.fit_interpolate.benchmark_least_squares import mem_usage
+    from anuga.fit_interpolate.fit import Fit
+    from anuga.fit_interpolate.interpolate import get_interpolation_matrix
 
     attribute_smoothed = 'elevation'
 
@@ -1444,32 +1656,54 @@ def find_optimal_smoothing_parameter(data_file,
 
     normal_cov = num.array(num.zeros([len(alphas), 2]), dtype=num.float)
 
-    if verbose: log.critical('Setup computational domains with '
-                             'different alphas')
-
-    for i, alpha in enumerate(alphas):
-        # add G_other data to domains with different alphas
-        if verbose:
-            log.critical('Calculating domain and mesh for Alpha=%s'
-                         % str(alpha))
-        domain = Domain(mesh_file, use_cache=cache, verbose=verbose)
-        if verbose: log.critical(domain.statistics())
-        domain.set_quantity(attribute_smoothed,
-                            geospatial_data=G_other,
-                            use_cache=cache,
-                            verbose=verbose,
-                            alpha=alpha)
+    if verbose: log.critical('Setup computational domain')
+    domain = Domain(mesh_file, use_cache=cache, verbose=verbose)
+    if verbose: log.critical(domain.statistics())
+
+    # Fitting matrices of the G_other data, shared by all alphas
+    fit = Fit(mesh=domain.mesh, verbose=verbose)
+    fit._build_matrix_AtA_Atz(G_other,
+                              G_other.get_attributes(attribute_smoothed))
+
+    # Matrix interpolating vertex values to the points that were "split" out
+    points_relative = domain.geo_reference.get_relative(
+        G_small.get_data_points(absolute=True))
+    interpolation_matrix = get_interpolation_matrix(domain.mesh.nodes,
+                                                    domain.mesh.triangles,
+                                                    points_relative,
+                                                    verbose=verbose)
+
+    # Runs of consecutive alphas, each solved with warm starts
+    number_of_runs = max(1, min(number_of_processes, len(alphas)))
+    runs = [[alphas[i] for i in indices]
+            for indices in num.array_split(num.argsort(alphas),
+                                           number_of_runs)]
+
+    _cross_validation['fit'] = fit
+    _cross_validation['interpolation_matrix'] = interpolation_matrix
+    _cross_validation['verbose'] = verbose
+    try:
+        if number_of_runs > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(number_of_runs)
+            try:
+                results = pool.map(_cross_validate_alphas, runs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = map(_cross_validate_alphas, runs)
+    finally:
+        _cross_validation.clear()
 
-        # Convert points to geospatial data for use with get_values below
-        points_geo = Geospatial_data(points, domain.geo_reference)
+    predictions = {}
+    for run, run_predictions in zip(runs, results):
+        predictions.update(zip(run, run_predictions))
 
-        # returns the predicted elevation of the points that were "split" out
+    for i, alpha in enumerate(alphas):
+        # the predicted elevation of the points that were "split" out
         # of the original data set for one particular alpha
-        if verbose: log.critical('Get predicted elevation for location '
-                                 'to be compared')
-        elevation_predicted = \
-                domain.quantities[attribute_smoothed].\
-                    get_values(interpolation_points=points_geo)
+        elevation_predicted = predictions[alpha]
 
         # add predicted elevation to array that starts with x, y, z...
         data[:,i+3] = elevation_predicted
@@ -1509,6 +1743,45 @@ def find_optimal_smoothing_parameter(data_file,
             normal_cov_new[(num.argmin(normal_cov_new,axis=0))[1],0])
 
 
+# Fit and interpolation matrix shared by the processes solving alphas
+# in find_optimal_smoothing_parameter. Pools are forked, so they are
+# inherited rather than pickled.
+_cross_validation = {}
+
+
+def _cross_validate_alphas(alphas):
+    """Return list of the values predicted at the sample points of
+    find_optimal_smoothing_parameter by fits with each of alphas.
+
+    Each fit starts from the solution for the previous alpha.
+    """
+
+    from anuga.utilities.numerical_tools import NAN
+
+    fit = _cross_validation['fit']
+    A, inside_poly_indices, outside_poly_indices, centroids = \
+        _cross_validation['interpolation_matrix']
+    verbose = _cross_validation['verbose']
+
+    predictions = []
+    vertex_values = None
+    for alpha in alphas:
+        if verbose:
+            log.critical('Fitting with alpha=%s' % str(alpha))
+
+        # B depends on alpha
+        fit.alpha = alpha
+        fit.B = None
+        fit.precon = None
+        vertex_values = fit.fit(x0=vertex_values)
+
+        elevation_predicted = A * vertex_values
+        elevation_predicted[outside_poly_indices] = NAN
+        predictions.append(elevation_predicted)
+
+    return predictions
+
+
 def old_find_optimal_smoothing_parameter(data_file,
                                          alpha_list=None,
                                          mesh_file=None,
@@ -1819,6 +1819,50 @@ class Test_Geospatial_data(unittest.TestCase):
             # 0.01 was expected with Numeric.RandomArray RNG
             assert alpha==1.0, msg
 
+    def test_find_optimal_smoothing_parameter_processes(self):
+        """Solving the alphas with a pool of processes gives the same
+        covariances as solving each alpha on its own
+        """
+
+        from cmath import cos
+
+        filename = tempfile.mktemp('.csv')
+        file = open(filename, 'w')
+        file.write('x,y,elevation \n')
+
+        for i in range(-5, 6):
+            for j in range(-5, 6):
+                z = abs(cos(((i*i) + (j*j))*.1)*2)
+                file.write("%s, %s, %s\n" % (i, j, z))
+
+        file.close()
+
+        kwargs = {'data_file': filename,
+                  'mesh_resolution': 3,
+                  'north_boundary': 5,
+                  'south_boundary': -5,
+                  'east_boundary': 5,
+                  'west_boundary': -5,
+                  'plot_name': None,
+                  'seed_num': 100000}
+
+        alphas = [1, 0.0001, 0.1, 0.01]
+        covariances = []
+        for alpha in alphas:
+            value, a = find_optimal_smoothing_parameter(alpha_list=[alpha],
+                                                        **kwargs)
+            assert a == alpha
+            covariances.append(value)
+
+        value, alpha = find_optimal_smoothing_parameter(alpha_list=alphas,
+                                                        number_of_processes=3,
+                                                        **kwargs)
+        os.remove(filename)
+
+        i = num.argmin(covariances)
+        assert alpha == alphas[i]
+        assert num.allclose(value, covariances[i])
+
     def test_find_optimal_smoothing_parameter2(self):
         '''Tests requirement that mesh file must exist or IOError is thrown
 
@@ -81,6 +81,22 @@ class Operator:
         return message
 
 
+    def get_state(self):
+        """Return dictionary of the values (numbers or arrays) the operator
+        accumulates while evolving. Used for checkpointing.
+
+        Operators without such state return an empty dictionary.
+        """
+
+        return {}
+
+    def set_state(self, state):
+        """Restore state as returned by get_state
+        """
+
+        for key, value in state.items():
+            setattr(self, key, value)
+
     def print_statistics(self):
 
         print self.statistics()
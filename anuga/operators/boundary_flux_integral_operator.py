@@ -61,6 +61,11 @@ class boundary_flux_integral_operator(Operator):
         # Zero the boundary_flux_sum 
         self.domain.boundary_flux_sum[:]=0.
 
+    def get_state(self):
+        """Boundary flux integral accumulated so far (for checkpointing)
+        """
+        return {'boundary_flux_integral': self.boundary_flux_integral}
+
     def parallel_safe(self):
         """Operator is applied independently on each parallel domain
 
@@ -2,6 +2,8 @@ from anuga import Domain
 from anuga import Quantity
 from anuga.utilities.sparse import Sparse, Sparse_CSR
 from anuga.utilities.cg_solve import conjugate_gradient
+from anuga.operators.elliptic_preconditioner import get_system_matrix, \
+     get_operator_preconditioner
 import anuga.abstract_2d_finite_volumes.neighbour_mesh as neighbour_mesh
 from anuga import Dirichlet_boundary
 import numpy as num
@@ -395,9 +397,27 @@ class Elliptic_operator(Operator):
         return new
 
     
+    def get_system_matrix(self):
+        """
+        Return the n x n Sparse_CSR matrix applied to centroid values by
+        this operator, i.e. div ( a grad ) or, during a parabolic solve,
+        I - dt div ( a grad ). Used to build preconditioners.
+        """
+
+        return get_system_matrix(self)
+
+    def _get_preconditioner(self, precon):
+        """
+        Return preconditioner precon ('None', 'Jacobi', 'ICC' or 'AMG')
+        built from the current system matrix, or precon itself if it has
+        been built already.
+        """
+
+        return get_operator_preconditioner(self, precon)
+
     def elliptic_solve(self, u_in, b, a = None, u_out = None, update_matrix=True, \
                        imax=10000, tol=1.0e-8, atol=1.0e-8,
-                       iprint=None, output_stats=False):
+                       iprint=None, output_stats=False, precon='None'):
         """ Solving div ( a grad u ) = b
         u | boundary = g
 
@@ -410,6 +430,9 @@ class Elliptic_operator(Operator):
 
         Centroid values of a and b provide diffusivity and rhs
 
+        precon selects the preconditioner of the conjugate gradient
+        solve ('None', 'Jacobi', 'ICC' or 'AMG')
+
         Solution u is retruned in u_out
         """
 
@@ -426,8 +449,10 @@ class Elliptic_operator(Operator):
         rhs = b.centroid_values - self.boundary_term
         x0 = u_in.centroid_values
 
+        precon = self._get_preconditioner(precon)
+
         x, stats = conjugate_gradient(A,rhs,x0,imax=imax, tol=tol, atol=atol,
-                               iprint=iprint, output_stats=True)
+                               iprint=iprint, output_stats=True, precon=precon)
 
         u_out.set_values(x, location='centroids')
         u_out.set_boundary_values(u_in.boundary_values)
@@ -441,7 +466,7 @@ class Elliptic_operator(Operator):
 
     def parabolic_solve(self, u_in, b, a = None, u_out = None, update_matrix=True, \
                        imax=10000, tol=1.0e-8, atol=1.0e-8,
-                       iprint=None, output_stats=False):
+                       iprint=None, output_stats=False, precon='None'):
         """
         Solve for u in the equation
 
@@ -459,6 +484,10 @@ class Elliptic_operator(Operator):
 
         Centroid values of a and b provide diffusivity and rhs
 
+        precon selects the preconditioner of the conjugate gradient
+        solve ('None', 'Jacobi', 'ICC' or 'AMG'), built from the matrix
+        of the parabolic problem
+
         Solution u is retruned in u_out
 
         """
@@ -479,8 +508,11 @@ class Elliptic_operator(Operator):
         rhs = b.centroid_values + (self.dt * self.boundary_term)
         x0 = u_in.centroid_values
 
+        precon = self._get_preconditioner(precon)
+
         x, stats = conjugate_gradient(IdtA,rhs,x0,imax=imax, tol=tol, atol=atol,
-                                      iprint=iprint, output_stats=True)
+                                      iprint=iprint, output_stats=True,
+                                      precon=precon)
 
         self.set_parabolic_solve(False)
 
@@ -0,0 +1,59 @@
+"""Preconditioners for the conjugate gradient solves of elliptic
+operators.
+
+Elliptic_operator and Kinematic_viscosity_operator apply
+div ( a grad ), or I - dt div ( a grad ) during a parabolic solve, to
+centroid values through an elliptic_matrix holding the centroid and the
+boundary columns. The functions here extract the square system matrix of
+the centroid values from it and build preconditioners of that matrix
+(see anuga.utilities.cg_solve.get_preconditioner).
+"""
+
+import numpy as num
+
+from anuga.utilities.sparse import Sparse_CSR
+from anuga.utilities.cg_solve import get_preconditioner, Preconditioner
+
+
+def get_system_matrix(operator):
+    """
+    Return the n x n Sparse_CSR matrix applied to centroid values by the
+    elliptic operator, i.e. div ( a grad ) or, during a parabolic solve,
+    I - dt div ( a grad ). Boundary columns are left out.
+    """
+
+    n = operator.n
+    A = operator.elliptic_matrix
+
+    rows = num.repeat(num.arange(n), A.row_ptr[1:] - A.row_ptr[:-1])
+    interior = A.colind < n
+
+    rows = rows[interior]
+    colind = A.colind[interior]
+    data = A.data[interior]
+
+    if operator.apply_triangle_areas:
+        data = data * operator.triangle_areas.data[colind]
+
+    if operator.parabolic:
+        data = -operator.dt * data
+        data[colind == rows] += 1.0
+
+    row_ptr = num.zeros(n+1, num.int)
+    row_ptr[1:] = num.cumsum(num.bincount(rows, minlength=n))
+
+    return Sparse_CSR(None, data, colind, row_ptr, n, n)
+
+
+def get_operator_preconditioner(operator, precon):
+    """
+    Return preconditioner precon ('None', 'Jacobi', 'ICC' or 'AMG') built
+    from the current system matrix of the elliptic operator, or precon
+    itself if it has been built already.
+    """
+
+    if precon is None or precon == 'None' \
+           or isinstance(precon, Preconditioner):
+        return precon
+
+    return get_preconditioner(get_system_matrix(operator), precon)
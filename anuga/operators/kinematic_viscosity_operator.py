@@ -2,6 +2,8 @@ from anuga import Domain
 from anuga import Quantity
 from anuga.utilities.sparse import Sparse, Sparse_CSR
 from anuga.utilities.cg_solve import conjugate_gradient
+from anuga.operators.elliptic_preconditioner import get_system_matrix, \
+     get_operator_preconditioner
 import anuga.abstract_2d_finite_volumes.neighbour_mesh as neighbour_mesh
 from anuga import Dirichlet_boundary
 import numpy as num
@@ -24,12 +26,17 @@ class Kinematic_viscosity_operator(Operator):
     du/dt = div( h grad u )
     dv/dt = div( h grad v )
 
+    precon selects the preconditioner ('None', 'Jacobi', 'ICC' or 'AMG')
+    of the conjugate gradient solves. It is built once per step and used
+    for both velocities.
+
     """
 
     def __init__(self,
                  domain, diffusivity='height',
                  use_triangle_areas=True,
                  add_safety = False,
+                 precon='None',
                  verbose=False):
 
         if verbose: log.critical('Kinematic Viscosity: Beginning Initialisation')
@@ -59,6 +66,7 @@ class Kinematic_viscosity_operator(Operator):
             
 
         self.add_safety = add_safety
+        self.precon = precon
         self.smooth = 0.1
         
         assert isinstance(self.diffusivity, Quantity)
@@ -159,9 +167,16 @@ class Kinematic_viscosity_operator(Operator):
         #Update operator using current height
         self.update_elliptic_matrix(d)
 
-        (u, self.u_stats) = self.parabolic_solve(u, u, d, u_out=u, update_matrix=False, output_stats=True)
+        # Preconditioner of the parabolic problem, shared by u and v
+        self.set_parabolic_solve(True)
+        precon = self._get_preconditioner(self.precon)
+        self.set_parabolic_solve(False)
+
+        (u, self.u_stats) = self.parabolic_solve(u, u, d, u_out=u, update_matrix=False, output_stats=True,
+                                                 precon=precon)
 
-        (v, self.v_stats) = self.parabolic_solve(v, v, d, u_out=v, update_matrix=False, output_stats=True)
+        (v, self.v_stats) = self.parabolic_solve(v, v, d, u_out=v, update_matrix=False, output_stats=True,
+                                                 precon=precon)
 
         # Update the conserved quantities
         domain.update_centroids_of_momentum_from_velocity()
@@ -453,9 +468,27 @@ class Kinematic_viscosity_operator(Operator):
         return new
 
     
+    def get_system_matrix(self):
+        """
+        Return the n x n Sparse_CSR matrix applied to centroid values by
+        this operator, i.e. div ( a grad ) or, during a parabolic solve,
+        I - dt div ( a grad ). Used to build preconditioners.
+        """
+
+        return get_system_matrix(self)
+
+    def _get_preconditioner(self, precon):
+        """
+        Return preconditioner precon ('None', 'Jacobi', 'ICC' or 'AMG')
+        built from the current system matrix, or precon itself if it has
+        been built already.
+        """
+
+        return get_operator_preconditioner(self, precon)
+
     def elliptic_solve(self, u_in, b, a = None, u_out = None, update_matrix=True, \
                        imax=10000, tol=1.0e-8, atol=1.0e-8,
-                       iprint=None, output_stats=False):
+                       iprint=None, output_stats=False, precon='None'):
         """ Solving div ( a grad u ) = b
         u | boundary = g
 
@@ -468,6 +501,9 @@ class Kinematic_viscosity_operator(Operator):
 
         Centroid values of a and b provide diffusivity and rhs
 
+        precon selects the preconditioner of the conjugate gradient
+        solve ('None', 'Jacobi', 'ICC' or 'AMG')
+
         Solution u is retruned in u_out
         """
 
@@ -484,8 +520,10 @@ class Kinematic_viscosity_operator(Operator):
         rhs = b.centroid_values - self.boundary_term
         x0 = u_in.centroid_values
 
+        precon = self._get_preconditioner(precon)
+
         x, stats = conjugate_gradient(A,rhs,x0,imax=imax, tol=tol, atol=atol,
-                               iprint=iprint, output_stats=True)
+                               iprint=iprint, output_stats=True, precon=precon)
 
         u_out.set_values(x, location='centroids')
         u_out.set_boundary_values(u_in.boundary_values)
@@ -498,7 +536,8 @@ class Kinematic_viscosity_operator(Operator):
     
 
     def parabolic_solve(self, u_in, b, a = None, u_out = None, update_matrix=True, \
-                       output_stats=False, use_dt_tol=True, iprint=None, imax=10000):
+                       output_stats=False, use_dt_tol=True, iprint=None, imax=10000,
+                       precon='None'):
         """
         Solve for u in the equation
 
@@ -516,6 +555,10 @@ class Kinematic_viscosity_operator(Operator):
 
         Centroid values of a and b provide diffusivity and rhs
 
+        precon selects the preconditioner of the conjugate gradient
+        solve ('None', 'Jacobi', 'ICC' or 'AMG'), built from the matrix
+        of the parabolic problem
+
         Solution u is retruned in u_out
 
         """
@@ -547,8 +590,11 @@ class Kinematic_viscosity_operator(Operator):
         rhs = b.centroid_values + (self.dt * self.boundary_term)
         x0 = u_in.centroid_values
 
+        precon = self._get_preconditioner(precon)
+
         x, stats = conjugate_gradient(IdtA,rhs,x0,imax=imax, tol=tol, atol=atol,
-                                      iprint=iprint, output_stats=True)
+                                      iprint=iprint, output_stats=True,
+                                      precon=precon)
 
         self.set_parabolic_solve(False)
 
@@ -580,6 +580,55 @@ class Test_kinematic_viscosity(unittest.TestCase):
         assert num.allclose(u_out.centroid_values, U_mod[:n])
 
 
+    def test_parabolic_solve_rectangular_cross_preconditioned(self):
+
+        from anuga import rectangular_cross_domain
+
+        domain = rectangular_cross_domain(10, 10)
+
+        # Diffusivity
+        a = Quantity(domain)
+        a.set_values(lambda x,y : 1.0 + x)
+        a.set_boundary_values(1.0)
+
+        operator = Kinematic_viscosity_operator(domain)
+        operator.dt = 0.01
+        operator.update_elliptic_matrix(a)
+
+        # System matrix agrees with the operator
+        x = num.sin(num.arange(operator.n))
+        A = operator.get_system_matrix()
+        assert num.allclose(A*x, operator*x)
+
+        operator.set_parabolic_solve(True)
+        A = operator.get_system_matrix()
+        assert num.allclose(A*x, operator*x)
+        operator.set_parabolic_solve(False)
+
+        # Quantity initial condition
+        u_in = Quantity(domain)
+        u_in.set_values(0.0)
+        u_in.set_boundary_values(0.0)
+
+        b = Quantity(domain)
+        b.set_values(lambda x,y : 16.0*x*(1-x)*y*(1-y))
+
+        u_ref, stats = operator.parabolic_solve(u_in, b, a, use_dt_tol=False,
+                                                output_stats=True)
+        assert stats.precon is None
+
+        for precon in ['Jacobi', 'ICC', 'AMG']:
+            u_out, stats = operator.parabolic_solve(u_in, b, a,
+                                                    use_dt_tol=False,
+                                                    output_stats=True,
+                                                    precon=precon)
+
+            assert stats.precon == precon
+            assert stats.setup_time >= 0.0
+            assert stats.solve_time >= 0.0
+            assert num.allclose(u_out.centroid_values,
+                                u_ref.centroid_values, atol=1.0e-5)
+
     def test_elliptic_solve_rectangular_cross_velocities(self):
 
         from anuga import rectangular_cross_domain
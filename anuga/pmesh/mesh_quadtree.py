@@ -28,6 +28,50 @@ from anuga.utilities.numerical_tools import ensure_numeric
 import anuga.fit_interpolate.fitsmooth as fitsmooth
 
 
+def _spread_bits(v):
+    """Spread the lower 16 bits of integer array v to the even bits.
+    """
+
+    v = (v | (v << 8)) & 0x00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F
+    v = (v | (v << 2)) & 0x33333333
+    v = (v | (v << 1)) & 0x55555555
+
+    return v
+
+
+def get_morton_order(points, extents=None):
+    """Return indices sorting points along a Morton (Z order) curve.
+
+    Points close to each other along the curve are close in space, so
+    locating them in this order lets each search start near the previous
+    result.
+
+    Inputs:
+        points:   N x 2 array of points
+        extents:  [xmin, xmax, ymin, ymax] of the region quantised along
+                  the curve (default the extent of the points)
+    """
+
+    points = ensure_numeric(points, num.float)
+
+    if len(points) == 0:
+        return num.zeros(0, num.int)
+
+    if extents is None:
+        extents = [num.min(points[:,0]), num.max(points[:,0]),
+                   num.min(points[:,1]), num.max(points[:,1])]
+
+    codes = num.zeros(len(points), num.int64)
+    for i in range(2):
+        xmin, xmax = extents[2*i], extents[2*i+1]
+        scale = 65535.0/max(xmax - xmin, 1.0e-300)
+        q = num.clip((points[:,i] - xmin)*scale, 0, 65535).astype(num.int64)
+        codes |= _spread_bits(q) << i
+
+    return num.argsort(codes, kind='mergesort')
+
+
 # PADARN NOTE: I don't think much from Cell is used anymore, if
 # anything, this dependency could be removed.
 class MeshQuadtree(Cell):
@@ -54,6 +98,8 @@ class MeshQuadtree(Cell):
         dic = self.__dict__
         if (dic.has_key('root')):
             dic.pop('root')
+        if (dic.has_key('walk_structures')):
+            dic.pop('walk_structures')
         return dic
 
     def set_extents(self):
@@ -125,6 +171,81 @@ class MeshQuadtree(Cell):
 
         return element_found, sigma[0], sigma[1], sigma[2], index
 
+    def locate_points(self, points, sort=True):
+        """
+        Find the triangles (elements) containing a set of points.
+
+        Points are located in order along a space filling curve (see
+        get_morton_order), each by walking through the mesh from the
+        triangle containing the previous point. The quad tree is only
+        searched when the walk fails, e.g. after a jump across a hole or
+        a boundary, or for meshes without neighbour structure.
+
+        Inputs:
+            points:   N x 2 array of points
+            sort:     False to locate the points in the given order
+
+        Return:
+            ids, sigmas
+
+            where
+            ids: Array of the indices of the triangles containing the
+                 points (-1 for points outside the mesh)
+            sigmas: N x 3 array of the barycentric coordinates of the
+                 points with respect to the vertices of their triangle
+                 (-1 for points outside the mesh)
+        """
+
+        if not hasattr(self, 'root'):
+            self.add_quad_tree()
+
+        vertex_coordinates, neighbours = self.get_walk_structures()
+
+        points = ensure_numeric(points, num.float).reshape(-1, 2)
+        n = len(points)
+
+        ids = num.zeros(n, num.int)
+        sigmas = num.zeros((n, 3), num.float)
+        if n == 0:
+            return ids, sigmas
+
+        if sort:
+            order = get_morton_order(points, self.extents)
+            points = num.ascontiguousarray(points[order])
+            sorted_ids = num.zeros(n, num.int)
+            sorted_sigmas = num.zeros((n, 3), num.float)
+        else:
+            points = num.ascontiguousarray(points)
+            sorted_ids = ids
+            sorted_sigmas = sigmas
+
+        fitsmooth.locate_points(self.root, points, vertex_coordinates,
+                                neighbours, sorted_ids, sorted_sigmas)
+
+        if sort:
+            ids[order] = sorted_ids
+            sigmas[order] = sorted_sigmas
+
+        return ids, sigmas
+
+    def get_walk_structures(self):
+        """Return vertex coordinates (as used by the quad tree) and
+        neighbours of the mesh for walking through it, neighbours is None
+        if the mesh has no neighbour structure.
+        """
+
+        if not hasattr(self, 'walk_structures'):
+            V = self.mesh.get_vertex_coordinates(absolute=True)
+            V = num.ascontiguousarray(V, dtype=num.float)
+
+            neighbours = getattr(self.mesh, 'neighbours', None)
+            if neighbours is not None:
+                neighbours = num.ascontiguousarray(neighbours, dtype=num.int)
+
+            self.walk_structures = (V, neighbours)
+
+        return self.walk_structures
+
     # PADARN NOTE: Only here to pass unit tests - does nothing.
     def set_last_triangle(self):
         pass
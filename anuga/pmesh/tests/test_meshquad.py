@@ -181,6 +181,62 @@ class Test_Quad(unittest.TestCase):
         Q.clear_visits()        
         results = Q.search_fast([5.5, 5.5])
         print 'visits: ', Q.count_visits()
+    def test_locate_points(self):
+        """Bulk location agrees with searching points one at a time
+        """
+
+        from anuga.abstract_2d_finite_volumes.mesh_factory \
+             import rectangular_cross
+        from anuga.abstract_2d_finite_volumes.neighbour_mesh \
+             import Mesh as Neighbour_mesh
+
+        points, vertices, boundary = rectangular_cross(10, 8, len1=3.0,
+                                                       len2=2.0)
+
+        num.random.seed(17)
+        P = num.random.rand(500, 2)*[4.0, 3.0] - 0.5
+        # Points on vertices, edges and the boundary
+        P = num.concatenate((P, points[:20], [[1.5, 1.0], [0.0, 0.5],
+                                              [3.0, 2.0]]))
+
+        for mesh in [Neighbour_mesh(points, vertices),
+                     Mesh(points, vertices)]:
+            Q = MeshQuadtree(mesh)
+
+            for sort in [True, False]:
+                ids, sigmas = Q.locate_points(P, sort=sort)
+
+                assert ids.shape == (len(P),)
+                assert sigmas.shape == (len(P), 3)
+
+                for i, x in enumerate(P):
+                    found, s0, s1, s2, k = Q.search_fast(x)
+                    if found:
+                        assert ids[i] == k
+                        assert num.allclose(sigmas[i], [s0, s1, s2])
+                    else:
+                        assert ids[i] == -1
+                        assert num.allclose(sigmas[i], -1)
+
+            # Barycentric coordinates reproduce the points
+            inside = ids >= 0
+            V = num.array(points)[num.array(vertices)[ids[inside]]]
+            assert num.allclose(num.sum(sigmas[inside][:,:,num.newaxis]*V,
+                                        axis=1), P[inside])
+
+        ids, sigmas = Q.locate_points(num.zeros((0, 2)))
+        assert len(ids) == 0
+
+    def test_morton_order(self):
+
+        from anuga.pmesh.mesh_quadtree import get_morton_order
+
+        # Z order on a 2 x 2 grid
+        P = [[1.0, 1.0], [0.0, 0.0], [0.0, 1.0], [1.0, 0.0]]
+        assert num.allclose(get_morton_order(P), [1, 3, 2, 0])
+
+        assert len(get_morton_order(num.zeros((0, 2)))) == 0
+
 ################################################################################
 
 if __name__ == "__main__":
@@ -14,8 +14,27 @@ read in the last stored domain. Do that via
 
 domain = load_last_checkpoint_file(domain_name, checkpoint_dir)
 
+Pickling the whole domain is slow and memory hungry for large models, and
+the pickles can not be read by a changed code base. With
+
+domain.set_checkpointing(checkpoint_format='npz', ...)
+
+only the evolving state of the domain (quantity values, time and the state
+of operators and boundaries) is saved, as raw arrays in one .npz file per
+processor. To restart, build the domain as in the original setup (mesh,
+distribute, boundaries, operators) and then load the state via
+
+load_checkpoint_state(domain, checkpoint_dir)
+
+The npz checkpoints can also be written asynchronously from a background
+thread, rotated (keeping only the most recent ones) and stored
+incrementally, see Checkpoint_writer and domain.set_checkpointing.
+
 """
 
+import os
+import numpy as num
+
 from anuga import send, receive, myid, numprocs, barrier
 from time import time as walltime
 
@@ -30,7 +49,7 @@ def load_checkpoint_file(domain_name = 'domain', checkpoint_dir = '.', time = No
             
     if time is None:
         # will pull out the last available time
-        times = _get_checkpoint_times(domain_name, checkpoint_dir)
+        times = _get_checkpoint_times(domain_name, checkpoint_dir, '.pickle')
 
         times = list(times)
         times.sort()
@@ -78,41 +97,633 @@ def load_checkpoint_file(domain_name = 'domain', checkpoint_dir = '.', time = No
     return domain
 
 
-def _get_checkpoint_times(domain_name, checkpoint_dir):
+def get_checkpoint_state(domain):
+    """Return dictionary of arrays holding the evolving state of domain
+
+    The state consists of the centroid values of the quantities, the
+    vertex values of the quantities which are not evolved (e.g. elevation,
+    which is not necessarily reconstructed from its centroid values), the
+    model time, the volume added by fractional steps and the state of the
+    fractional step operators and boundary objects which provide a
+    get_state method. For parallel domains the global ids of the triangles
+    (tri_l2g) and which of them are full triangles (tri_full_flag) are
+    included as well.
+    """
+
+    state = {}
+
+    state['time'] = domain.get_time()
+    state['starttime'] = domain.get_starttime()
+    state['yieldstep_id'] = domain.yieldstep_id
+    state['number_of_triangles'] = domain.number_of_triangles
+    state['fractional_step_volume_integral'] = \
+                          domain.fractional_step_volume_integral
+
+    # Numbering of the triangles of a parallel domain, needed to
+    # restart on a different number of processors
+    if domain.parallel:
+        state['tri_l2g'] = domain.tri_l2g
+        state['tri_full_flag'] = domain.tri_full_flag
+
+    for name, Q in domain.quantities.items():
+        # Coordinates of the mesh are not state
+        if name in ['x', 'y']:
+            continue
+
+        state['centroid_values.' + name] = Q.centroid_values
+        if name not in domain.evolved_quantities:
+            state['vertex_values.' + name] = Q.vertex_values
+
+    for i, operator in enumerate(domain.fractional_step_operators):
+        if hasattr(operator, 'get_state'):
+            for key, value in operator.get_state().items():
+                state['operator.%d.%s' % (i, key)] = value
+
+    for tag, boundary in (domain.boundary_map or {}).items():
+        if hasattr(boundary, 'get_state'):
+            for key, value in boundary.get_state().items():
+                state['boundary.%s.%s' % (tag, key)] = value
+
+    return state
+
+
+def set_checkpoint_state(domain, state):
+    """Set the evolving state of domain from a dictionary of arrays as
+    returned by get_checkpoint_state
+    """
+
+    msg = 'Checkpoint was saved for a domain with %d triangles, ' \
+          % int(state['number_of_triangles'])
+    msg += 'domain has %d triangles' % domain.number_of_triangles
+    assert int(state['number_of_triangles']) == domain.number_of_triangles, msg
+
+    domain.starttime = float(state['starttime'])
+    domain.yieldstep_id = int(state['yieldstep_id'])
+    domain.fractional_step_volume_integral = \
+                 float(state['fractional_step_volume_integral'])
+
+    operator_states = {}
+    boundary_states = {}
+
+    for key in state:
+        location, _, name = key.partition('.')
+        if location == 'centroid_values':
+            domain.quantities[name].centroid_values[:] = state[key]
+        elif location == 'vertex_values':
+            domain.quantities[name].vertex_values[:] = state[key]
+            domain.quantities[name].interpolate_from_vertices_to_edges()
+        elif location in ['operator', 'boundary']:
+            # Numbers are stored as 0-d arrays
+            value = state[key]
+            if value.shape == ():
+                value = value.item()
+
+            if location == 'operator':
+                i, _, name = name.partition('.')
+                operator_states.setdefault(int(i), {})[name] = value
+            else:
+                tag, _, name = name.rpartition('.')
+                boundary_states.setdefault(tag, {})[name] = value
+
+    for i, operator_state in operator_states.items():
+        domain.fractional_step_operators[i].set_state(operator_state)
+
+    for tag, boundary_state in boundary_states.items():
+        domain.boundary_map[tag].set_state(boundary_state)
+
+    # Continue evolving from the checkpoint time without yielding
+    # (and storing) the initial state again
+    domain.set_evolve_starttime(float(state['time']))
+    domain.evolved_called = True
+
+    domain.distribute_to_vertices_and_edges()
+    domain.update_boundary()
+
+
+def get_checkpoint_filename(domain, checkpoint_dir='.'):
+    """Return name of the npz checkpoint file of domain at its current time
+    """
+
+    return os.path.join(checkpoint_dir, domain.get_name()) \
+           + '_' + str(domain.get_time()) + '.npz'
+
+
+def save_checkpoint_state(domain, checkpoint_dir='.'):
+    """Save the evolving state of domain (see get_checkpoint_state) to
+    <checkpoint_dir>/<domain name>_<time>.npz
+
+    The file is written under a temporary name and renamed when complete,
+    so an interrupted save never leaves a partial checkpoint behind.
+    Return name of checkpoint file.
+    """
+
+    filename = get_checkpoint_filename(domain, checkpoint_dir)
+
+    _write_checkpoint_file(filename, get_checkpoint_state(domain))
+
+    return filename
+
+
+# Quantities stored as difference to the last full checkpoint by
+# incremental checkpointing
+INCREMENTAL_QUANTITIES = ['elevation', 'friction']
+
+# Incremental checkpoints store a quantity in full if more than this
+# fraction of its values changed since the last full checkpoint (e.g.
+# elevation vertex values which are reconstructed every step by the DE
+# algorithms)
+MAX_INCREMENTAL_FRACTION = 0.5
+
+
+class Checkpoint_writer:
+    """Save checkpoints of the evolving state of a domain (npz format)
+
+    checkpoint_dir  directory of the checkpoint files
+    keep            number of most recent checkpoints to keep, older
+                    ones are deleted (None: keep all)
+    asynchronous    True to write the files from a background thread.
+                    The state is copied into memory buffers, so the
+                    evolve loop only stalls for the copy (and for the
+                    previous write if it has not finished yet)
+    incremental     True to store the quantities that rarely change
+                    (INCREMENTAL_QUANTITIES, e.g. elevation under erosion
+                    operators) as the values changed since the last full
+                    checkpoint. A full checkpoint is kept as long as an
+                    incremental checkpoint which is kept refers to it.
+    """
+
+    def __init__(self, checkpoint_dir='.', keep=None,
+                 asynchronous=False, incremental=False):
+
+        msg = 'keep must be None or positive. I got %s' % keep
+        assert keep is None or keep > 0, msg
+
+        self.checkpoint_dir = checkpoint_dir
+        self.keep = keep
+        self.asynchronous = asynchronous
+        self.incremental = incremental
+
+        self.filenames = []     # Checkpoints saved so far, oldest first
+        self.bases = {}         # Full checkpoint of incremental ones
+        self.base_filename = None
+        self.base_state = {}
+
+        self.thread = None
+        self.error = None
+
+    def save(self, domain):
+        """Save checkpoint of domain at its current time.
+
+        Return name of checkpoint file.
+        """
+
+        # At most one checkpoint in flight
+        self.wait()
+
+        filename = get_checkpoint_filename(domain, self.checkpoint_dir)
+        state = get_checkpoint_state(domain)
+
+        if self.incremental:
+            state = self._get_incremental_state(filename, state)
+
+        if self.asynchronous:
+            # Snapshot, as the domain evolves while the file is written
+            for key in state:
+                state[key] = num.array(state[key])
+
+            import threading
+            self.thread = threading.Thread(target=self._write,
+                                           args=(filename, state))
+            self.thread.start()
+        else:
+            self._write(filename, state)
+            self._raise_error()
+
+        return filename
+
+    def wait(self):
+        """Wait until the checkpoint being written (if any) is complete
+        """
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        self._raise_error()
+
+    def _raise_error(self):
+
+        if self.error is not None:
+            error = self.error
+            self.error = None
+            raise error
+
+    def _write(self, filename, state):
+
+        try:
+            _write_checkpoint_file(filename, state)
+            self.filenames.append(filename)
+            if 'base_checkpoint' in state:
+                self.bases[filename] = \
+                    os.path.join(os.path.dirname(filename),
+                                 str(state['base_checkpoint']))
+            self._prune()
+        except Exception, e:
+            self.error = e
+
+    def _prune(self):
+        """Delete all but the most recent self.keep checkpoints, except
+        the full checkpoints the kept incremental ones (and the next
+        incremental one) refer to.
+        """
+
+        if self.keep is None:
+            return
+
+        while len(self.filenames) > self.keep:
+            referenced = set([self.base_filename])
+            for filename in self.filenames[-self.keep:]:
+                referenced.add(self.bases.get(filename))
+
+            candidates = [f for f in self.filenames[:-self.keep]
+                          if f not in referenced]
+            if len(candidates) == 0:
+                break
+
+            self.filenames.remove(candidates[0])
+            self.bases.pop(candidates[0], None)
+            if os.path.exists(candidates[0]):
+                os.remove(candidates[0])
+
+    def _get_incremental_state(self, filename, state):
+        """Replace the rarely changing quantities in state by their
+        changes since the last full checkpoint where there are few of them.
+        If there are none such, this checkpoint becomes the full one.
+        """
+
+        keys = [key for key in state
+                if key.partition('.')[0] in ['centroid_values', 'vertex_values']
+                and key.partition('.')[2] in INCREMENTAL_QUANTITIES]
+
+        if self.base_filename is not None:
+            incremental = False
+            for key in keys:
+                values = num.ravel(state[key])
+                index = num.flatnonzero(values != self.base_state[key])
+                if len(index) <= MAX_INCREMENTAL_FRACTION*len(values):
+                    del state[key]
+                    state['delta_index.' + key] = index
+                    state['delta_values.' + key] = values[index]
+                    incremental = True
+
+            if incremental:
+                state['base_checkpoint'] = \
+                            os.path.basename(self.base_filename)
+                return state
+
+        # Full checkpoint
+        self.base_filename = filename
+        self.base_state = {}
+        for key in keys:
+            self.base_state[key] = num.array(num.ravel(state[key]))
+
+        return state
+
+
+def _write_checkpoint_file(filename, state):
+    """Write dictionary of arrays to npz file filename via a temporary
+    file, so that filename only ever exists when complete.
+    """
+
+    fid = open(filename + '.tmp', 'wb')
+    num.savez(fid, **state)
+    fid.close()
+
+    os.rename(filename + '.tmp', filename)
+
+
+def _read_checkpoint_file(filename):
+    """Read dictionary of arrays from npz checkpoint file filename.
+
+    Quantities of incremental checkpoints are completed from the full
+    checkpoint they refer to.
+    """
+
+    data = num.load(filename)
+    state = {}
+    for key in data.files:
+        state[key] = data[key]
+    data.close()
+
+    if 'base_checkpoint' in state:
+        base_filename = os.path.join(os.path.dirname(filename),
+                                     str(state.pop('base_checkpoint')))
+        base_state = _read_checkpoint_file(base_filename)
+
+        for key in state.keys():
+            location, _, name = key.partition('.')
+            if location == 'delta_index':
+                values = num.array(base_state[name])
+                values.flat[state.pop(key)] = \
+                            state.pop('delta_values.' + name)
+                state[name] = values
+
+    return state
+
+
+def load_checkpoint_state(domain, checkpoint_dir='.', time=None,
+                          checkpoint_numprocs=None):
+    """Load the state of the latest (or the given time) checkpoint saved
+    with checkpoint_format='npz' into domain, which has to be set up as
+    in the original run (same mesh, quantities, boundaries and operators).
+
+    If checkpoint_numprocs is given and differs from the number of
+    processors domain is distributed over, the checkpoint of a run on
+    checkpoint_numprocs processors is repartitioned: every processor
+    gathers the values of its triangles from all the per processor
+    checkpoint files, matching triangles by their global id (tri_l2g),
+    i.e. their id in the original sequential domain, which does not depend
+    on the number of processors. Operator and boundary states can not be
+    repartitioned and are not restored in that case. A parallel domain
+    then starts new per processor sww files, and sww_merge_parallel puts
+    the results of the earlier run before its own, so the merged sww file
+    covers both runs.
+
+    If the domain stores its results, they are appended to the existing
+    sww file (or a new one is started).
+
+    Return domain
+    """
+
+    if checkpoint_numprocs is not None and checkpoint_numprocs != domain.numproc:
+        return _load_repartitioned_checkpoint_state(domain, checkpoint_dir,
+                                                    time, checkpoint_numprocs)
+
+    domain_name = domain.get_name()
+
+    if time is None:
+        # will pull out the last available time
+        times = _get_checkpoint_times(domain_name, checkpoint_dir, '.npz')
+
+        times = list(times)
+        times.sort()
+    else:
+        times = [float(time)]
+
+    if len(times) == 0: raise Exception, "Unable to open checkpoint file"
+
+    for time in reversed(times):
+
+        filename = os.path.join(checkpoint_dir, domain_name) \
+                   + '_' + str(time) + '.npz'
+
+        try:
+            state = _read_checkpoint_file(filename)
+            success = int(state['number_of_triangles']) == \
+                      domain.number_of_triangles
+        except:
+            success = False
+
+        overall = _all_processors(success)
+
+        if overall: break
+
+    if not overall: raise Exception, "Unable to open checkpoint file"
+
+    set_checkpoint_state(domain, state)
+
+    _resume_storage(domain)
+
+    return domain
+
+
+def _load_repartitioned_checkpoint_state(domain, checkpoint_dir, time,
+                                         checkpoint_numprocs):
+    """Load checkpoint of a run on checkpoint_numprocs processors into
+    domain distributed over a different number of processors.
+    See load_checkpoint_state.
+    """
+
+    if domain.parallel:
+        global_name = domain.get_global_name()
+        tri_l2g = num.asarray(domain.tri_l2g)
+    else:
+        global_name = domain.get_name()
+        tri_l2g = num.arange(domain.number_of_triangles)
+
+    if checkpoint_numprocs > 1:
+        names = [global_name + '_P%d_%d' % (checkpoint_numprocs, p)
+                 for p in range(checkpoint_numprocs)]
+    else:
+        names = [global_name]
+
+    if time is None:
+        # Latest time available for all checkpointed processors
+        times = None
+        for name in names:
+            name_times = _get_local_checkpoint_times(name, checkpoint_dir,
+                                                     '.npz')
+            if times is None:
+                times = name_times
+            else:
+                times = times & name_times
+
+        times = list(_all_processors_times(times))
+        times.sort()
+    else:
+        times = [float(time)]
+
+    if len(times) == 0: raise Exception, "Unable to open checkpoint file"
+
+    N = domain.number_of_triangles
+    number_of_global_triangles = domain.number_of_global_triangles
+
+    # Local id of each global triangle (-1 if not on this processor)
+    g2local = -num.ones(number_of_global_triangles, num.int)
+    g2local[tri_l2g] = num.arange(N)
+
+    for time in reversed(times):
+
+        try:
+            state = None
+            found = num.zeros(N, num.bool)
+
+            for name in names:
+                filename = os.path.join(checkpoint_dir, name) \
+                           + '_' + str(time) + '.npz'
+                rank_state = _read_checkpoint_file(filename)
+
+                if 'tri_full_flag' in rank_state:
+                    full = num.flatnonzero(rank_state['tri_full_flag'] == 1)
+                else:
+                    full = num.arange(int(rank_state['number_of_triangles']))
+
+                if checkpoint_numprocs > 1:
+                    msg = 'Checkpoint %s has no global triangle ids ' \
+                          'and can not be repartitioned' % filename
+                    assert 'tri_l2g' in rank_state, msg
+                    local = g2local[rank_state['tri_l2g'][full]]
+                else:
+                    local = g2local[full]
+                mask = local >= 0
+                src = full[mask]
+                dst = local[mask]
+
+                if state is None:
+                    state = {}
+                    for key in ['time', 'starttime', 'yieldstep_id']:
+                        state[key] = rank_state[key]
+                    state['number_of_triangles'] = N
+                    state['fractional_step_volume_integral'] = 0.0
+
+                state['fractional_step_volume_integral'] += \
+                          float(rank_state['fractional_step_volume_integral'])
+
+                for key in rank_state:
+                    location = key.partition('.')[0]
+                    if location not in ['centroid_values', 'vertex_values']:
+                        continue
+
+                    values = rank_state[key]
+                    if key not in state:
+                        state[key] = num.zeros((N,) + values.shape[1:],
+                                               values.dtype)
+                    state[key][dst] = values[src]
+
+                found[dst] = True
+
+            success = bool(num.all(found))
+        except:
+            success = False
+
+        overall = _all_processors(success)
+
+        if overall: break
+
+    if not overall: raise Exception, "Unable to open checkpoint file"
+
+    # Volume added by fractional steps is accounted for once
+    if myid != 0:
+        state['fractional_step_volume_integral'] = 0.0
+
+    set_checkpoint_state(domain, state)
+
+    _resume_repartitioned_storage(domain, global_name, checkpoint_numprocs)
+
+    return domain
+
+
+def _resume_repartitioned_storage(domain, global_name, checkpoint_numprocs):
+    """Start storing results of a domain restarted from a checkpoint of a
+    run on checkpoint_numprocs processors so that merging the sww files
+    gives the results of both runs.
+
+    A parallel domain starts new per processor sww files which record
+    checkpoint_numprocs, so that sww_merge_parallel puts the results of the
+    earlier run first. A sequential domain appends to the sww file the
+    per processor files of the earlier run are merged into.
+    """
+
+    if domain.store is not True:
+        return
+
+    datadir = domain.get_datadir()
+
+    if not domain.parallel:
+        if checkpoint_numprocs > 1 and myid == 0:
+            from anuga.utilities.sww_merge import sww_merge_parallel
+            sww_merge_parallel(os.path.join(datadir, global_name),
+                               checkpoint_numprocs)
+        barrier()
+
+        _resume_storage(domain)
+        return
+
+    from anuga.config import netcdf_mode_a
+    from anuga.file.netcdf import NetCDFFile
+
+    domain.initialise_storage()
+
+    fid = NetCDFFile(os.path.join(datadir, domain.get_name() + '.sww'),
+                     netcdf_mode_a)
+    try:
+        fid.restart_numprocs = checkpoint_numprocs
+    finally:
+        fid.close()
+
+
+def _resume_storage(domain):
+    """Append results of a restarted domain to its sww file
+    """
+
+    if domain.store is True:
+        from anuga.config import netcdf_mode_a
+        from anuga.file.sww import SWW_file
+
+        if os.path.exists(os.path.join(domain.get_datadir(),
+                                       domain.get_name() + '.sww')):
+            domain.writer = SWW_file(domain, mode=netcdf_mode_a)
+        else:
+            domain.initialise_storage()
+
+
+def _all_processors(success):
+    """Return True if success is True on all processors
+    """
+
+    overall = success
+    for cpu in range(numprocs):
+        if cpu != myid:
+            send(success,cpu)
+
+    for cpu in range(numprocs):
+        if cpu != myid:
+            overall = overall & receive(cpu)
+
+    barrier()
+
+    return overall
+
+
+def _all_processors_times(times):
+    """Return the times of the set times available on all processors
+    """
 
-    import os
-    times = set()
-    
-    for (path, directory, filenames) in os.walk(checkpoint_dir):
-        #print filenames
-        #print directory
-        
-        if len(filenames) == 0:
-            return None
-        else:          
-            for filename in filenames:
-                filebase = os.path.splitext(filename)[0].rpartition("_")
-                time = filebase[-1]
-                domain_name_base = filebase[0]
-                if domain_name_base == domain_name :
-                    #print domain_name_base, time
-                    times.add(float(time))
-
-
-    #times.sort()
-    #times = set(times)
-    
-    #print times
     combined = times
     for cpu in range(numprocs):
         if myid != cpu:
             send(times,cpu)
             rec = receive(cpu) 
-            #print rec
             combined = combined & rec 
-    
-    #combined = list(combined).sort()
-    #print combined
-    
+
     return combined
+
+
+def _get_local_checkpoint_times(domain_name, checkpoint_dir, extension=None):
+    """Return set of times of the checkpoint files of domain_name
+    """
+
+    times = set()
     
+    for (path, directory, filenames) in os.walk(checkpoint_dir):
+        for filename in filenames:
+            if extension is not None and \
+                   os.path.splitext(filename)[1] != extension:
+                continue
+            filebase = os.path.splitext(filename)[0].rpartition("_")
+            time = filebase[-1]
+            domain_name_base = filebase[0]
+            if domain_name_base == domain_name :
+                times.add(float(time))
+
+    return times
+
+
+def _get_checkpoint_times(domain_name, checkpoint_dir, extension=None):
+    """Return set of times of the checkpoint files of domain_name available
+    on all processors
+    """
+
+    times = _get_local_checkpoint_times(domain_name, checkpoint_dir, extension)
+
+    return _all_processors_times(times)
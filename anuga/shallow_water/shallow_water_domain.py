@@ -170,6 +170,7 @@ class Domain(Generic_Domain):
                  number_of_full_nodes=None,
                  number_of_full_triangles=None,
                  ghost_layer_width=2,
+                 mesh_cache_dir=None,
                  **kwargs):
 
         """
@@ -178,6 +179,8 @@ class Domain(Generic_Domain):
         @param coordinates: vertex locations for the mesh
         @param vertices: vertex indices for the mesh
         @param boundary: boundaries of the mesh
+        @param mesh_cache_dir: directory where structures derived from the
+                               mesh are stored for reuse by later runs
         """
 
         # Define quantities for the shallow_water domain
@@ -215,7 +218,8 @@ class Domain(Generic_Domain):
                             numproc,
                             number_of_full_nodes=number_of_full_nodes,
                             number_of_full_triangles=number_of_full_triangles,
-                            ghost_layer_width=ghost_layer_width)
+                            ghost_layer_width=ghost_layer_width,
+                            mesh_cache_dir=mesh_cache_dir)
 
         #-------------------------------
         # Operator Data Structures
@@ -259,6 +263,7 @@ class Domain(Generic_Domain):
         self.checkpoint = False
         self.yieldstep_id = 1 
         self.checkpoint_step = 10
+        self.checkpoint_format = 'pickle'
         
         #-------------------------------
         # Useful auxiliary quantity
@@ -1054,7 +1059,9 @@ class Domain(Generic_Domain):
         
         return self.store_centroids   
     
-    def set_checkpointing(self, checkpoint= True, checkpoint_dir = 'CHECKPOINTS', checkpoint_step=10, checkpoint_time = None):
+    def set_checkpointing(self, checkpoint= True, checkpoint_dir = 'CHECKPOINTS', checkpoint_step=10, checkpoint_time = None,
+                          checkpoint_format = 'pickle', checkpoint_keep = None,
+                          checkpoint_async = False, checkpoint_incremental = False):
         """
         Set up checkpointing.
         
@@ -1063,9 +1070,26 @@ class Domain(Generic_Domain):
         @param checkpoint_step: Save checkpoint files after this many yieldsteps
         @param checkpoint_time: If set, over-rides checkpoint_step. save checkpoint files
                         after this amount of walltime
-        """
-        
-        
+        @param checkpoint_format: 'pickle' to pickle the whole domain (restart with
+                        load_checkpoint_file) or 'npz' to save only the evolving
+                        state as arrays (restart with load_checkpoint_state)
+        @param checkpoint_keep: npz format only. Number of most recent checkpoint
+                        files to keep (default: keep all)
+        @param checkpoint_async: npz format only. Write checkpoint files from a
+                        background thread so that evolve does not wait for them
+        @param checkpoint_incremental: npz format only. Store quantities that
+                        rarely change (elevation, friction) as changes since
+                        the last full checkpoint
+        """
+        
+        msg = "checkpoint_format must be 'pickle' or 'npz', got %s" % checkpoint_format
+        assert checkpoint_format in ['pickle', 'npz'], msg
+
+        if checkpoint_format != 'npz':
+            msg = 'checkpoint_keep, checkpoint_async and checkpoint_incremental '
+            msg += "require checkpoint_format = 'npz'"
+            assert checkpoint_keep is None and not checkpoint_async \
+                   and not checkpoint_incremental, msg
         
         if checkpoint:
             # create checkpoint directory if necessary
@@ -1081,6 +1105,13 @@ class Domain(Generic_Domain):
                 self.checkpoint_step = 0
             else:
                 self.checkpoint_step = checkpoint_step
+            self.checkpoint_format = checkpoint_format
+            if checkpoint_format == 'npz':
+                from anuga.shallow_water.checkpoint import Checkpoint_writer
+                self.checkpoint_writer = Checkpoint_writer(checkpoint_dir,
+                                                           keep=checkpoint_keep,
+                                                           asynchronous=checkpoint_async,
+                                                           incremental=checkpoint_incremental)
             self.checkpoint = True
             #print self.checkpoint_dir, self.checkpoint_step
         else:
@@ -2452,7 +2483,16 @@ class Domain(Generic_Domain):
                 elif self.yieldstep_id%self.checkpoint_step == 0:
                         save_checkpoint = True
                         
-                if save_checkpoint:   
+                if save_checkpoint and getattr(self, 'checkpoint_format', 'pickle') == 'npz':
+                    self.checkpoint_writer.save(self)
+
+                    # No need to wait for the other processors when the
+                    # files are written in the background
+                    if not self.checkpoint_writer.asynchronous:
+                        barrier()
+                    self.walltime_prev = time.time()
+
+                elif save_checkpoint:   
                     pickle_name = os.path.join(self.checkpoint_dir,self.get_name())+'_'+str(self.get_time())+'.pickle'
                     cPickle.dump(self, open(pickle_name, 'wb'))
 
@@ -2463,6 +2503,10 @@ class Domain(Generic_Domain):
 
             # Pass control on to outer loop for more specific actions
             yield(t)
+
+        # Make sure the last checkpoint has been written
+        if self.checkpoint and getattr(self, 'checkpoint_format', 'pickle') == 'npz':
+            self.checkpoint_writer.wait()
      
 
     def initialise_storage(self):
@@ -11,6 +11,9 @@ from anuga.coordinate_transforms.geo_reference import Geo_reference
 from anuga.abstract_2d_finite_volumes.util import file_function
 from anuga.geometry.polygon import is_inside_polygon
 from anuga.file.sww import get_mesh_and_quantities_from_file
+from anuga.file.sww import get_mesh_from_file
+from anuga.file.swt import get_current_swt_filename, Read_swt
+from anuga.file.swt import get_timeseries_at_points_from_swt
 from anuga.abstract_2d_finite_volumes.neighbour_mesh import segment_midpoints
 
 
@@ -67,6 +70,61 @@ def get_interpolated_quantities_at_polyline_midpoints(filename,
     return segments, I
 
 
+def _get_quantities_at_multiple_polyline_midpoints(filename,
+                                                   quantity_names,
+                                                   polylines,
+                                                   verbose=False):
+    """Get time series of quantities at midpoints of polylines from SWW.
+
+    Returns (mult_segments, time, values)
+    where mult_segments is a list (one for each polyline) of lists of
+            Triangle_intersection instances,
+          time is the vector of stored (absolute) times
+      and values is a dictionary of arrays, one for each quantity name, with
+            dimensions number_of_timesteps x number_of_midpoints.
+
+    If the SWW file has an up to date time series sidecar (see sww2swt) only
+    the time series needed at the midpoints are read from it. Otherwise all
+    quantities are read from the SWW file and interpolated frame by frame.
+    """
+
+    if get_current_swt_filename(filename) is None:
+        X = get_interpolated_quantities_at_multiple_polyline_midpoints(filename,
+                                              quantity_names=quantity_names,
+                                              polylines=polylines,
+                                              verbose=verbose)
+        mult_segments, I = X
+
+        # Values at the stored timesteps have been precomputed
+        return mult_segments, I.time, I.precomputed_values
+
+    if verbose: log.critical('Using time series sidecar of %s' % filename)
+
+    mesh = get_mesh_from_file(filename, verbose=verbose)
+
+    # Find all intersections and associated triangles.
+    mult_segments = []
+    interpolation_points = []
+    for polyline in polylines:
+        segments = mesh.get_intersecting_segments(polyline, verbose=verbose)
+        mult_segments.append(segments)
+        interpolation_points = interpolation_points + \
+                               segment_midpoints(segments)
+
+    # Midpoints are relative to the georeference of the sww file
+    time, starttime, values, _ = \
+        get_timeseries_at_points_from_swt(filename,
+                                          quantity_names,
+                                          interpolation_points,
+                                          absolute=False,
+                                          verbose=verbose)
+
+    for name in quantity_names:
+        values[name] = num.transpose(values[name])
+
+    return mult_segments, time + starttime, values
+
+
 def get_flow_through_cross_section(filename, polyline, verbose=False):
     """Obtain flow (m^3/s) perpendicular to specified cross section.
 
@@ -96,39 +154,17 @@ def get_flow_through_cross_section(filename, polyline, verbose=False):
                      'ymomentum']
 
     # Get values for quantities at each midpoint of poly line from sww file
-    X = get_interpolated_quantities_at_polyline_midpoints(filename,
-                                                          quantity_names=\
-                                                              quantity_names,
-                                                          polyline=polyline,
-                                                          verbose=verbose)
-    segments, interpolation_function = X
-
-    # Get vectors for time and interpolation_points
-    time = interpolation_function.time
-    interpolation_points = interpolation_function.interpolation_points
+    X = _get_quantities_at_multiple_polyline_midpoints(filename,
+                                                       quantity_names,
+                                                       [polyline],
+                                                       verbose=verbose)
+    mult_segments, time, values = X
+    segments = mult_segments[0]
 
     if verbose: log.critical('Computing hydrograph')
 
     # Compute hydrograph
-    Q = []
-    for t in time:
-        total_flow = 0
-        for i in range(len(interpolation_points)):
-            elevation, stage, uh, vh = interpolation_function(t, point_id=i)
-            normal = segments[i].normal
-
-            # Inner product of momentum vector with segment normal [m^2/s]
-            normal_momentum = uh*normal[0] + vh*normal[1]
-
-            # Flow across this segment [m^3/s]
-            segment_flow = normal_momentum * segments[i].length
-
-            # Accumulate
-            total_flow += segment_flow
-
-        # Store flow at this timestep
-        Q.append(total_flow)
-
+    Q = _get_hydrograph(segments, values['xmomentum'], values['ymomentum'])
 
     return time, Q
 
@@ -162,54 +198,50 @@ def get_flow_through_multiple_cross_sections(filename, polylines, verbose=False)
                      'ymomentum']
 
     # Get values for quantities at each midpoint of poly line from sww file
-    X = get_interpolated_quantities_at_multiple_polyline_midpoints(filename,
-                                                          quantity_names=\
-                                                              quantity_names,
-                                                          polylines=polylines,
-                                                          verbose=verbose)
-    mult_segments, interpolation_function = X
-
-    # Get vectors for time and interpolation_points
-    time = interpolation_function.time
-    interpolation_points = interpolation_function.interpolation_points
+    X = _get_quantities_at_multiple_polyline_midpoints(filename,
+                                                       quantity_names,
+                                                       polylines,
+                                                       verbose=verbose)
+    mult_segments, time, values = X
 
     if verbose: log.critical('Computing hydrographs')
 
     # Compute hydrograph
     mult_Q = []
     base_id = 0
-    if verbose: print '',
     for segments in mult_segments:
-        if verbose: print '\b.',
-        Q = []
-        for t in time:
-            total_flow = 0.0
-            i= base_id
-            for segment in segments:
-                elevation, stage, uh, vh = interpolation_function(t, point_id=i)
-                normal = segment.normal
-
-                # Inner product of momentum vector with segment normal [m^2/s]
-                normal_momentum = uh*normal[0] + vh*normal[1]
-
-                # Flow across this segment [m^3/s]
-                segment_flow = normal_momentum * segment.length
-
-                # Accumulate
-                total_flow += segment_flow
-                
-                i=i+1
-
-            # Store flow at this timestep
-            Q.append(total_flow)
-            
+        ids = slice(base_id, base_id + len(segments))
+        Q = _get_hydrograph(segments,
+                            values['xmomentum'][:, ids],
+                            values['ymomentum'][:, ids])
+
         base_id = base_id + len(segments)
         mult_Q.append(Q)
 
-    if verbose: print
-    
     return time, mult_Q
 
+
+def _get_hydrograph(segments, uh, vh):
+    """Return total flow across segments for each timestep.
+
+    uh and vh are arrays of momentum at the segment midpoints with
+    dimensions number_of_timesteps x number_of_segments.
+    """
+
+    normals = num.array([segment.normal for segment in segments], num.float)
+    lengths = num.array([segment.length for segment in segments], num.float)
+
+    if len(segments) == 0:
+        return [0.0]*uh.shape[0]
+
+    # Inner product of momentum vector with segment normal [m^2/s]
+    normal_momentum = uh*normals[:,0] + vh*normals[:,1]
+
+    # Flow across each segment [m^3/s] accumulated over segments
+    Q = num.sum(normal_momentum*lengths, axis=1)
+
+    return Q.tolist()
+
 def get_interpolated_quantities_at_multiple_polyline_midpoints(filename,
                                                       quantity_names=None,
                                                       polylines=None,
@@ -315,62 +347,52 @@ def get_energy_through_cross_section(filename,
                      'xmomentum',
                      'ymomentum']
 
-    # Get values for quantities at each midpoint of poly line from sww file
-    X = get_interpolated_quantities_at_polyline_midpoints(filename,
-                                                          quantity_names=\
-                                                              quantity_names,
-                                                          polyline=polyline,
-                                                          verbose=verbose)
-    segments, interpolation_function = X
+    if kind not in ['specific', 'total']:
+        msg = 'Energy kind must be either "specific" or "total". '
+        msg += 'I got %s' % kind
+        raise Exception(msg)
 
-    # Get vectors for time and interpolation_points
-    time = interpolation_function.time
-    interpolation_points = interpolation_function.interpolation_points
+    # Get values for quantities at each midpoint of poly line from sww file
+    X = _get_quantities_at_multiple_polyline_midpoints(filename,
+                                                       quantity_names,
+                                                       [polyline],
+                                                       verbose=verbose)
+    mult_segments, time, values = X
+    segments = mult_segments[0]
 
     if verbose: log.critical('Computing %s energy' % kind)
 
     # Compute total length of polyline for use with weighted averages
-    total_line_length = 0.0
-    for segment in segments:
-        total_line_length += segment.length
-
-    # Compute energy
-    E = []
-    for t in time:
-        average_energy = 0.0
-        for i, p in enumerate(interpolation_points):
-            elevation, stage, uh, vh = interpolation_function(t, point_id=i)
-
-            # Depth
-            h = depth = stage-elevation
-
-            # Average velocity across this segment
-            if h > epsilon:
-                # Use protection against degenerate velocities
-                u = uh / (h + h0/h)
-                v = vh / (h + h0/h)
-            else:
-                u = v = 0.0
+    lengths = num.array([segment.length for segment in segments], num.float)
+    total_line_length = num.sum(lengths)
 
-            speed_squared = u*u + v*v
-            kinetic_energy = 0.5 * speed_squared / g
+    elevation = values['elevation']
+    stage = values['stage']
+    uh = values['xmomentum']
+    vh = values['ymomentum']
 
-            if kind == 'specific':
-                segment_energy = depth + kinetic_energy
-            elif kind == 'total':
-                segment_energy = stage + kinetic_energy
-            else:
-                msg = 'Energy kind must be either "specific" or "total". '
-                msg += 'I got %s' % kind
+    # Depth
+    h = depth = stage-elevation
+
+    # Average velocity across each segment
+    # Use protection against degenerate velocities
+    wet = h > epsilon
+    h_wet = num.where(wet, h, 1.0)
+    u = num.where(wet, uh / (h_wet + h0/h_wet), 0.0)
+    v = num.where(wet, vh / (h_wet + h0/h_wet), 0.0)
 
-            # Add to weighted average
-            weigth = segments[i].length / total_line_length
-            average_energy += segment_energy * weigth
+    speed_squared = u*u + v*v
+    kinetic_energy = 0.5 * speed_squared / g
+
+    if kind == 'specific':
+        segment_energy = depth + kinetic_energy
+    else:
+        segment_energy = stage + kinetic_energy
 
-        # Store energy at this timestep
-        E.append(average_energy)
+    # Weighted average over segments for each timestep
+    E = num.sum(segment_energy*lengths/total_line_length, axis=1)
 
-    return time, E
+    return time, E.tolist()
 
 
 def get_maximum_inundation_elevation(filename,
@@ -512,19 +534,43 @@ def get_maximum_inundation_data(filename, polygon=None, time_interval=None,
         x = fid.variables['x'][:] + xllcorner
         y = fid.variables['y'][:] + yllcorner
 
+        # If there is an up to date time series sidecar, stage is read
+        # from it cell by cell rather than frame by frame
+        swt_filename = get_current_swt_filename(filename)
+
         # Get the relevant quantities (Convert from single precison)
         try:
             elevation = num.array(fid.variables['elevation_c'][:], num.float)
-            stage     = num.array(fid.variables['stage_c'][:], num.float)
+            if swt_filename is None:
+                stage = num.array(fid.variables['stage_c'][:], num.float)
+            elif 'stage_c' not in fid.variables:
+                raise KeyError('stage_c')
             found_c_values = True
         except:
             elevation = num.array(fid.variables['elevation'][:], num.float)
-            stage     = num.array(fid.variables['stage'][:], num.float)
+            if swt_filename is None:
+                stage = num.array(fid.variables['stage'][:], num.float)
             found_c_values = False
 
+        if found_c_values:
+            stage_name = 'stage_c'
+        else:
+            stage_name = 'stage'
+
+        if swt_filename is not None:
+            swt = Read_swt(swt_filename)
+            use_swt = swt.has_quantity(stage_name) and len(elevation.shape) == 1
+            swt.close()
+
+            if not use_swt:
+                # Time dependent elevation is not handled with the sidecar
+                swt_filename = None
+                stage = num.array(fid.variables[stage_name][:], num.float)
+
         if verbose:
             print 'found c values ', found_c_values
-            print 'stage.shape ',stage.shape
+            if swt_filename is None:
+                print 'stage.shape ',stage.shape
             print 'elevation.shape ',elevation.shape
             
         # Here's where one could convert nodal information to centroid
@@ -543,7 +589,8 @@ def get_maximum_inundation_data(filename, polygon=None, time_interval=None,
                 pass
             else:
                 elevation=(elevation[vols0]+elevation[vols1]+elevation[vols2])/3.0
-                stage=(stage[:,vols0]+stage[:,vols1]+stage[:,vols2])/3.0
+                if swt_filename is None:
+                    stage=(stage[:,vols0]+stage[:,vols1]+stage[:,vols2])/3.0
 
         # Spatial restriction
         if polygon is not None:
@@ -558,7 +605,8 @@ def get_maximum_inundation_data(filename, polygon=None, time_interval=None,
 
             # Restrict quantities to polygon
             elevation = num.take(elevation, point_indices, axis=0)
-            stage = num.take(stage, point_indices, axis=1)
+            if swt_filename is None:
+                stage = num.take(stage, point_indices, axis=1)
 
             # Get info for location of maximal runup
             points_in_polygon = num.take(points, point_indices, axis=0)
@@ -605,6 +653,29 @@ def get_maximum_inundation_data(filename, polygon=None, time_interval=None,
 
         fid.close()
 
+        if swt_filename is not None:
+            if verbose: log.critical('Using time series sidecar %s'
+                                     % swt_filename)
+
+            if use_centroid_values is True and not found_c_values:
+                # Average stage at the vertices of each triangle
+                cells = num.take(volumes, point_indices, axis=0)
+            else:
+                cells = num.asarray(point_indices, num.int)[:, num.newaxis]
+
+            runup, runup_index, runup_time_index = \
+                _get_maximal_runup_from_swt(swt_filename, stage_name,
+                                            cells, elevation, timesteps)
+
+            if runup > maximal_runup:
+                maximal_runup = runup      # works even if maximal_runup is None
+                maximal_time = time[runup_time_index]
+
+                # Record location
+                maximal_runup_location = [x[runup_index], y[runup_index]]
+
+            continue
+
         # Compute maximal runup for each timestep
         #maximal_runup = None
         #maximal_runup_location = None
@@ -669,3 +740,65 @@ def get_maximum_inundation_data(filename, polygon=None, time_interval=None,
         return maximal_runup, maximal_runup_location
         
 
+
+
+def _get_maximal_runup_from_swt(swt_filename, stage_name, cells, elevation,
+                                timesteps):
+    """Find highest elevation where depth > 0 using a time series sidecar.
+
+    swt_filename  path to sidecar of an SWW file
+    stage_name    name of stage quantity in sidecar ('stage' or 'stage_c')
+    cells         N x k array of rows of stage_name in the sidecar. The
+                  stage of each of the N points is the average of its k rows
+                  (k = 3 for centroid values computed from vertex values).
+    elevation     elevation at each of the N points
+    timesteps     time indices to consider
+
+    Returns (runup, runup_index, runup_time_index)
+    where runup is the highest elevation of the points that are wet at any
+          of the given timesteps (None if they are all dry),
+          runup_index is the index of the point where runup occurs
+      and runup_time_index is the first time index at which it is wet.
+
+    Points are processed in chunks of the size the sidecar was written with,
+    so only the rows needed are held in memory.
+    """
+
+    swt = Read_swt(swt_filename)
+    try:
+        chunk = int(swt.fid.cells_per_chunk)
+    except AttributeError:
+        chunk = 10000
+
+    N = len(elevation)
+    ever_wet = num.zeros(N, num.bool)
+    first_wet = num.zeros(N, num.int)
+
+    for start in range(0, N, chunk):
+        end = min(start + chunk, N)
+
+        rows = cells[start:end]
+        stage = num.zeros((end-start, len(timesteps)), num.float)
+        for k in range(rows.shape[1]):
+            stage += swt.get_timeseries(stage_name, rows[:,k])[:, timesteps]
+        stage /= rows.shape[1]
+
+        wet = stage - elevation[start:end, num.newaxis] > 0.0
+
+        ever_wet[start:end] = num.any(wet, axis=1)
+        first_wet[start:end] = num.argmax(wet, axis=1)
+
+    swt.close()
+
+    if not num.any(ever_wet):
+        return None, None, None
+
+    runup = num.max(elevation[ever_wet])
+
+    # Of the wet points at the runup elevation take the one wet earliest
+    # (lowest index first)
+    candidates = num.where(ever_wet & (elevation == runup))[0]
+    earliest = num.min(first_wet[candidates])
+    runup_index = candidates[first_wet[candidates] == earliest][0]
+
+    return runup, runup_index, timesteps[earliest]
@@ -0,0 +1,518 @@
+"""  Test checkpointing of the evolving state of a domain
+"""
+
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as num
+
+from anuga.shallow_water.shallow_water_domain import Domain
+from anuga.shallow_water.boundaries import Reflective_boundary
+from anuga.abstract_2d_finite_volumes.generic_boundary_conditions \
+                            import Time_boundary
+from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular_cross
+from anuga.file.netcdf import NetCDFFile
+from anuga.operators.base_operator import Operator
+
+from anuga.shallow_water.checkpoint import load_checkpoint_state, \
+     save_checkpoint_state, get_checkpoint_state
+
+
+class Counting_operator(Operator):
+    """Operator adding a little water every step and counting the volume
+    """
+
+    def __init__(self, domain):
+        Operator.__init__(self, domain)
+        self.volume = 0.0
+
+    def __call__(self):
+        self.stage_c[:3] += 0.01*self.get_timestep()
+        self.volume += 0.03*self.get_timestep()
+
+    def get_state(self):
+        return {'volume': self.volume}
+
+
+class Test_checkpoint(unittest.TestCase):
+
+    def setUp(self):
+
+        self.checkpoint_dir = tempfile.mkdtemp()
+        self.name = 'checkpoint_test'
+
+    def tearDown(self):
+
+        shutil.rmtree(self.checkpoint_dir)
+        try:
+            os.remove(self.name + '.sww')
+        except:
+            pass
+
+    def _create_domain(self):
+
+        points, vertices, boundary = rectangular_cross(8, 4, len1=8.0,
+                                                       len2=4.0)
+        domain = Domain(points, vertices, boundary)
+        domain.set_name(self.name)
+        domain.set_datadir('.')
+        domain.set_quantity('elevation', lambda x, y: -x/4.0)
+        domain.set_quantity('friction', 0.01)
+        domain.set_quantity('stage', expression='elevation + 0.5')
+
+        Br = Reflective_boundary(domain)
+        Bt = Time_boundary(domain, function=lambda t: [0.2*t, 0.0, 0.0])
+        domain.set_boundary({'left': Bt, 'right': Br,
+                             'top': Br, 'bottom': Br})
+
+        operator = Counting_operator(domain)
+
+        return domain, operator
+
+    def test_checkpoint_state(self):
+
+        domain, operator = self._create_domain()
+        domain.set_checkpointing(checkpoint_dir=self.checkpoint_dir,
+                                 checkpoint_step=1,
+                                 checkpoint_format='npz')
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=2.0):
+            pass
+
+        stage = domain.quantities['stage'].centroid_values.copy()
+        xmom = domain.quantities['xmomentum'].centroid_values.copy()
+        volume = operator.volume
+
+        fid = NetCDFFile(self.name + '.sww')
+        times = fid.variables['time'][:]
+        stages = fid.variables['stage'][:]
+        fid.close()
+
+        filename = os.path.join(self.checkpoint_dir, self.name + '_1.0.npz')
+        assert os.path.exists(filename)
+
+        # Only arrays, no pickled objects
+        data = num.load(filename)
+        for key in data.files:
+            assert data[key].dtype != num.object
+        data.close()
+
+        # Lose the last two yieldsteps of the sww file and restart from
+        # the checkpoint at t = 1.0 with a freshly built domain
+        os.remove(self.name + '.sww')
+        domain, operator = self._create_domain()
+        for t in domain.evolve(yieldstep=0.5, finaltime=1.0):
+            pass
+
+        domain, operator = self._create_domain()
+        domain = load_checkpoint_state(domain, self.checkpoint_dir,
+                                       time=1.0)
+        assert domain.get_time() == 1.0
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=2.0):
+            pass
+
+        assert num.allclose(domain.quantities['stage'].centroid_values,
+                            stage)
+        assert num.allclose(domain.quantities['xmomentum'].centroid_values,
+                            xmom)
+        assert num.allclose(operator.volume, volume)
+
+        # Restarted run appended to the sww file
+        fid = NetCDFFile(self.name + '.sww')
+        assert num.allclose(fid.variables['time'][:], times)
+        assert num.allclose(fid.variables['stage'][:], stages)
+        fid.close()
+
+    def test_load_latest_checkpoint_state(self):
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=1.0):
+            if t > 0.0:
+                save_checkpoint_state(domain, self.checkpoint_dir)
+
+        state = get_checkpoint_state(domain)
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        load_checkpoint_state(domain, self.checkpoint_dir)
+
+        assert domain.get_time() == 1.0
+        i = domain.fractional_step_operators.index(operator)
+        assert num.allclose(operator.volume, state['operator.%d.volume' % i])
+        for name in ['stage', 'xmomentum', 'ymomentum', 'elevation']:
+            assert num.allclose(domain.quantities[name].centroid_values,
+                                state['centroid_values.' + name])
+
+        # Domain of a different size
+        points, vertices, boundary = rectangular_cross(4, 4)
+        other = Domain(points, vertices, boundary)
+        other.set_name(self.name)
+        other.set_store(False)
+        try:
+            load_checkpoint_state(other, self.checkpoint_dir)
+        except Exception:
+            pass
+        else:
+            msg = 'Should have raised exception for mismatched domain'
+            raise Exception(msg)
+
+    def test_async_checkpoint_rotation(self):
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        domain.set_checkpointing(checkpoint_dir=self.checkpoint_dir,
+                                 checkpoint_step=1,
+                                 checkpoint_format='npz',
+                                 checkpoint_keep=2,
+                                 checkpoint_async=True)
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=3.0):
+            pass
+
+        stage = domain.quantities['stage'].centroid_values.copy()
+
+        filenames = sorted(os.listdir(self.checkpoint_dir))
+        assert filenames == [self.name + '_2.5.npz', self.name + '_3.0.npz']
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        load_checkpoint_state(domain, self.checkpoint_dir)
+
+        assert domain.get_time() == 3.0
+        assert num.allclose(domain.quantities['stage'].centroid_values, stage)
+
+    def test_incremental_checkpoint(self):
+
+        class Erosion_operator(Operator):
+            def __call__(self):
+                self.elev_c[5] -= 0.01*self.get_timestep()
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        Erosion_operator(domain)
+        domain.set_checkpointing(checkpoint_dir=self.checkpoint_dir,
+                                 checkpoint_step=1,
+                                 checkpoint_format='npz',
+                                 checkpoint_keep=2,
+                                 checkpoint_incremental=True)
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=2.0):
+            pass
+
+        elevation = domain.quantities['elevation'].centroid_values.copy()
+        friction = domain.quantities['friction'].vertex_values.copy()
+
+        # The full checkpoint the two most recent ones refer to is kept
+        filenames = sorted(os.listdir(self.checkpoint_dir))
+        assert filenames == [self.name + '_0.0.npz', self.name + '_1.5.npz',
+                             self.name + '_2.0.npz']
+
+        data = num.load(os.path.join(self.checkpoint_dir,
+                                     self.name + '_2.0.npz'))
+        assert 'centroid_values.friction' not in data.files
+        assert len(data['delta_index.centroid_values.friction']) == 0
+        assert num.allclose(data['delta_index.centroid_values.elevation'],
+                            [5])
+        data.close()
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        Erosion_operator(domain)
+        load_checkpoint_state(domain, self.checkpoint_dir)
+
+        assert domain.get_time() == 2.0
+        assert num.allclose(domain.quantities['elevation'].centroid_values,
+                            elevation)
+        assert num.allclose(domain.quantities['friction'].vertex_values,
+                            friction)
+
+    def test_incremental_checkpoint_rotation(self):
+        """Full checkpoints are kept while a kept incremental checkpoint
+        refers to them
+        """
+
+        from anuga.shallow_water.checkpoint import Checkpoint_writer
+
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        elevation = domain.quantities['elevation'].centroid_values
+
+        writer = Checkpoint_writer(self.checkpoint_dir, keep=2,
+                                   incremental=True)
+
+        def save(time):
+            domain.set_time(time)
+            state = get_checkpoint_state(domain)
+            values = dict([(key, num.array(state[key])) for key in state])
+            return writer.save(domain), values
+
+        # Full F1, I1 against F1, full F2
+        F1, F1_state = save(1.0)
+        elevation[3] -= 0.1
+        I1, I1_state = save(2.0)
+        domain.set_quantity('elevation', lambda x, y: -x/4.0 - 0.2)
+        domain.set_quantity('friction', 0.02)
+        F2, F2_state = save(3.0)
+
+        data = num.load(I1)
+        assert str(data['base_checkpoint']) == os.path.basename(F1)
+        data.close()
+        data = num.load(F2)
+        assert 'base_checkpoint' not in data.files
+        data.close()
+
+        filenames = sorted(os.listdir(self.checkpoint_dir))
+        assert filenames == [os.path.basename(f) for f in [F1, I1, F2]]
+
+        # Every checkpoint kept can be loaded
+        for time, state in [(1.0, F1_state), (2.0, I1_state),
+                            (3.0, F2_state)]:
+            domain, operator = self._create_domain()
+            domain.set_store(False)
+            load_checkpoint_state(domain, self.checkpoint_dir, time=time)
+            assert domain.get_time() == time
+            assert num.allclose(
+                domain.quantities['elevation'].centroid_values,
+                state['centroid_values.elevation'])
+
+        # Once I1 is rotated out, F1 goes with it
+        domain, operator = self._create_domain()
+        domain.set_store(False)
+        domain.set_quantity('elevation', lambda x, y: -x/4.0 - 0.2)
+        domain.set_quantity('friction', 0.02)
+        domain.quantities['elevation'].centroid_values[3] -= 0.1
+        I2, I2_state = save(4.0)
+        domain.set_quantity('elevation', lambda x, y: -x/4.0 + 0.8)
+        domain.set_quantity('friction', 0.03)
+        F3, F3_state = save(5.0)
+
+        filenames = sorted(os.listdir(self.checkpoint_dir))
+        assert filenames == [os.path.basename(f) for f in [F2, I2, F3]]
+
+        for time, state in [(3.0, F2_state), (4.0, I2_state),
+                            (5.0, F3_state)]:
+            domain, operator = self._create_domain()
+            domain.set_store(False)
+            load_checkpoint_state(domain, self.checkpoint_dir, time=time)
+            assert num.allclose(
+                domain.quantities['elevation'].centroid_values,
+                state['centroid_values.elevation'])
+
+    def test_checkpoint_boundary_time_series(self):
+        """Restart across a boundary reading a time series which ends,
+        and the default boundary takes over, after the checkpoint
+        """
+
+        from anuga.fit_interpolate.interpolate import Interpolation_function
+
+        def create_domain():
+            domain, operator = self._create_domain()
+            domain.set_store(False)
+
+            time = num.array([0.0, 0.4, 0.8, 1.2])
+            F = Interpolation_function(time,
+                                       {'stage': 0.1*time,
+                                        'xmomentum': 0.0*time,
+                                        'ymomentum': 0.0*time},
+                                       quantity_names=['stage', 'xmomentum',
+                                                       'ymomentum'])
+            Bt = Time_boundary(domain, function=F,
+                               default_boundary=[0.05, 0.0, 0.0])
+            domain.set_boundary({'left': Bt})
+
+            return domain, Bt
+
+        domain, Bt = create_domain()
+        domain.set_checkpointing(checkpoint_dir=self.checkpoint_dir,
+                                 checkpoint_step=1,
+                                 checkpoint_format='npz')
+
+        for t in domain.evolve(yieldstep=0.5, finaltime=2.0):
+            if t == 1.0:
+                index = Bt.function.index
+
+        stage = domain.quantities['stage'].centroid_values.copy()
+        assert Bt.default_boundary_invoked is True
+
+        # The time cursor and default boundary flag are saved
+        data = num.load(os.path.join(self.checkpoint_dir,
+                                     self.name + '_1.0.npz'))
+        assert data['boundary.left.function_index'] == index
+        assert not data['boundary.left.default_boundary_invoked']
+        data.close()
+
+        data = num.load(os.path.join(self.checkpoint_dir,
+                                     self.name + '_1.5.npz'))
+        assert data['boundary.left.default_boundary_invoked']
+        data.close()
+
+        # Restart before and after the end of the time series
+        for time in [1.0, 1.5]:
+            domain, Bt = create_domain()
+            load_checkpoint_state(domain, self.checkpoint_dir, time=time)
+
+            assert Bt.default_boundary_invoked == (time == 1.5)
+
+            for t in domain.evolve(yieldstep=0.5, finaltime=2.0):
+                pass
+
+            assert num.allclose(domain.quantities['stage'].centroid_values,
+                                stage)
+
+        # The state of the boundary function is restored
+        domain, Bt = create_domain()
+        Bt.set_state({'function_index': 2,
+                      'default_boundary_invoked': True})
+        assert Bt.function.index == 2
+        assert Bt.default_boundary_invoked is True
+        assert Bt.get_state() == {'function_index': 2,
+                                  'default_boundary_invoked': True}
+
+    def _create_subdomains(self, numprocs):
+        """Distribute domain over numprocs processors without MPI
+        """
+
+        from anuga.parallel.sequential_distribute import Sequential_distribute
+        from anuga.parallel.parallel_shallow_water import Parallel_domain
+
+        points, vertices, boundary = rectangular_cross(8, 4, len1=8.0,
+                                                       len2=4.0)
+        domain = Domain(points, vertices, boundary)
+        domain.set_name(self.name)
+
+        partition = Sequential_distribute(domain)
+        partition.distribute(numprocs)
+
+        subdomains = []
+        for p in range(numprocs):
+            kwargs, points, vertices, boundary = partition.extract_submesh(p)[:4]
+            subdomain = Parallel_domain(points, vertices, boundary, **kwargs)
+            subdomain.set_name(self.name)
+            subdomain.set_store(False)
+
+            Br = Reflective_boundary(subdomain)
+            boundary_map = {'ghost': None}
+            for tag in ['left', 'right', 'top', 'bottom']:
+                boundary_map[tag] = Br
+            subdomain.set_boundary(boundary_map)
+
+            subdomains.append(subdomain)
+
+        return subdomains
+
+    def test_repartitioned_checkpoint(self):
+
+        # Checkpoint a run on 3 processors, ghost triangles are given
+        # values that must not be used
+        for subdomain in self._create_subdomains(3):
+            x, y = subdomain.centroid_coordinates.T
+            ghost = subdomain.tri_full_flag == 0
+            stage = x + 10*y
+            stage[ghost] = 1000.0
+            elevation = x - 10.0
+            elevation[ghost] = 1000.0
+            subdomain.quantities['stage'].centroid_values[:] = stage
+            subdomain.quantities['elevation'].centroid_values[:] = elevation
+            subdomain.set_evolve_starttime(0.5)
+            save_checkpoint_state(subdomain, self.checkpoint_dir)
+
+        assert len(os.listdir(self.checkpoint_dir)) == 3
+
+        # Restart on 2 processors
+        for subdomain in self._create_subdomains(2):
+            load_checkpoint_state(subdomain, self.checkpoint_dir,
+                                  checkpoint_numprocs=3)
+
+            assert subdomain.get_time() == 0.5
+            x, y = subdomain.centroid_coordinates.T
+            assert num.allclose(subdomain.quantities['stage'].centroid_values,
+                                x + 10*y)
+            assert num.allclose(subdomain.quantities['elevation'].centroid_values,
+                                x - 10.0)
+
+        # Restart on 1 processor
+        points, vertices, boundary = rectangular_cross(8, 4, len1=8.0,
+                                                       len2=4.0)
+        domain = Domain(points, vertices, boundary)
+        domain.set_name(self.name)
+        domain.set_store(False)
+        Br = Reflective_boundary(domain)
+        domain.set_boundary({'left': Br, 'right': Br, 'top': Br, 'bottom': Br})
+        load_checkpoint_state(domain, self.checkpoint_dir,
+                              checkpoint_numprocs=3)
+
+        x, y = domain.centroid_coordinates.T
+        assert num.allclose(domain.quantities['stage'].centroid_values,
+                            x + 10*y)
+
+    def test_repartitioned_checkpoint_sww_merge(self):
+        """The merged sww file of a run restarted on a different number of
+        processors holds the results of both runs
+        """
+
+        from anuga.utilities.sww_merge import sww_merge_parallel
+
+        def store(subdomains, time):
+            for subdomain in subdomains:
+                subdomain.set_time(time)
+                subdomain.set_quantity('stage', time)
+                subdomain.store_timestep()
+
+        # Run on 3 processors storing 0.0 and 0.5, which is checkpointed
+        subdomains = self._create_subdomains(3)
+        for subdomain in subdomains:
+            subdomain.set_datadir(self.checkpoint_dir)
+            subdomain.set_store(True)
+            subdomain.initialise_storage()
+        store(subdomains, 0.0)
+        store(subdomains, 0.5)
+        for subdomain in subdomains:
+            save_checkpoint_state(subdomain, self.checkpoint_dir)
+
+        # Restart on 2 processors storing 0.5 to 1.5
+        subdomains = self._create_subdomains(2)
+        for subdomain in subdomains:
+            subdomain.set_datadir(self.checkpoint_dir)
+            subdomain.set_store(True)
+            load_checkpoint_state(subdomain, self.checkpoint_dir,
+                                  checkpoint_numprocs=3)
+        for time in [0.5, 1.0, 1.5]:
+            store(subdomains, time)
+
+        global_name = os.path.join(self.checkpoint_dir, self.name)
+        sww_merge_parallel(global_name, 2)
+
+        fid = NetCDFFile(global_name + '.sww')
+        try:
+            times = fid.variables['time'][:]
+            assert num.allclose(times, [0.0, 0.5, 1.0, 1.5])
+
+            # Every node of the global mesh has the values of each time
+            x = fid.variables['x'][:]
+            assert len(x) == len(rectangular_cross(8, 4)[0])
+            stage = fid.variables['stage'][:]
+            assert stage.shape == (4, len(x))
+            for i, time in enumerate(times):
+                assert num.allclose(stage[i], time)
+        finally:
+            fid.close()
+
+        # Merging again gives the same file
+        sww_merge_parallel(global_name, 2)
+        fid = NetCDFFile(global_name + '.sww')
+        try:
+            assert num.allclose(fid.variables['time'][:], times)
+        finally:
+            fid.close()
+
+#-------------------------------------------------------------
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(Test_checkpoint, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
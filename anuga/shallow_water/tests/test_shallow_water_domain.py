@@ -8858,6 +8858,8 @@ friction  \n \
             os.remove(txt_file)
             os.remove(txt_file_prj)
             os.remove(txt_file_dem)
+            os.remove('test_asc.flt')
+            os.remove('test_asc.hdr')
         except:
             pass
 
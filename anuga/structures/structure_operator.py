@@ -480,6 +480,22 @@ class Structure_operator(anuga.Operator):
         raise
             
 
+    def get_state(self):
+        """Return the flow statistics and smoothed values accumulated by
+        the structure. Used for checkpointing.
+        """
+
+        state = {}
+        for name in ['accumulated_flow', 'discharge',
+                     'discharge_abs_timemean', 'velocity', 'outlet_depth',
+                     'delta_total_energy', 'driving_energy',
+                     'smooth_Q', 'smooth_delta_total_energy']:
+            if hasattr(self, name):
+                state[name] = getattr(self, name)
+
+        return state
+
+
     def statistics(self):
 
 
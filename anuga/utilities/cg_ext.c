@@ -223,7 +223,7 @@ int _jacobi_precon_c(double* data,
 //        imax: maximum number of iterations
 //        tol: error tollerance for stopping criteria
 //        M: length of vectors x and b
-// @return: 0 on success  
+// @return: number of iterations on success, -1 if imax was reached  
 int _cg_solve_c(double* data, 
                 long* colind,
                 long* row_ptr,
@@ -277,7 +277,7 @@ int _cg_solve_c(double* data,
     return -1;
   }
   else{
-    return 0;
+    return i;
   }
   
 
@@ -294,7 +294,7 @@ int _cg_solve_c(double* data,
 //        tol: error tollerance for stopping criteria
 //        M: length of vectors x and b
 //        precon: diagonal preconditioner given as vector
-// @return: 0 on success  
+// @return: number of iterations on success, -1 if imax was reached  
 int _cg_solve_c_precon(double* data, 
                 long* colind,
                 long* row_ptr,
@@ -323,7 +323,8 @@ int _cg_solve_c_precon(double* data,
   rTr=ddot(M,r,rhat);
   rTr0 = rTr;
   
-  while((i<imax) && (rTr>pow(tol,2)*rTr0) && (rTr > pow(a_tol,2))){
+  /* rTr is negative if A and the preconditioner are negative definite */
+  while((i<imax) && (fabs(rTr)>pow(tol,2)*fabs(rTr0)) && (fabs(rTr) > pow(a_tol,2))){
 
     zAx(q,data,colind,row_ptr,d,M);
     alpha = rTr/ddot(M,d,q);
@@ -354,12 +355,197 @@ int _cg_solve_c_precon(double* data,
     return -1;
   }
   else{
-    return 0;
+    return i;
   }
   
 
 }       
 
+
+// Incomplete Cholesky factorisation without fill in, IC(0), of a symmetric
+// positive definite matrix A.
+// @input ldata: double vector with the lower triangle of A in CSR format,
+//               overwritten by the factor L with L L^T ~ A
+//        lcolind: long vector of column indices, sorted within each row
+//                 with the diagonal entry last
+//        lrow_ptr: long vector giving index of rows of ldata
+//        M: number of rows
+// @return: 0 on success, otherwise 1 + the row where a non positive pivot
+//          (or a missing diagonal) was met
+int _ichol_c(double * ldata,
+             long * lcolind,
+             long * lrow_ptr,
+             int M){
+
+  long i, j, k, m, mm, diag, jdiag;
+  double s;
+
+  for (i=0; i<M; i++){
+    diag = lrow_ptr[i+1]-1;
+    if (diag < lrow_ptr[i] || lcolind[diag] != i) return i+1;
+
+    for (k=lrow_ptr[i]; k<diag; k++){
+      j = lcolind[k];
+      jdiag = lrow_ptr[j+1]-1;
+
+      // s = sum over m < j of L[i,m] L[j,m], merging the rows of i and j
+      s = 0.0;
+      m = lrow_ptr[i];
+      mm = lrow_ptr[j];
+      while (m<k && mm<jdiag){
+        if (lcolind[m] == lcolind[mm]){
+          s += ldata[m]*ldata[mm];
+          m++;
+          mm++;
+        }
+        else if (lcolind[m] < lcolind[mm]){
+          m++;
+        }
+        else{
+          mm++;
+        }
+      }
+
+      ldata[k] = (ldata[k]-s)/ldata[jdiag];
+    }
+
+    s = 0.0;
+    for (k=lrow_ptr[i]; k<diag; k++){
+      s += ldata[k]*ldata[k];
+    }
+    s = ldata[diag]-s;
+    if (s <= 0.0) return i+1;
+    ldata[diag] = sqrt(s);
+  }
+
+  return 0;
+}
+
+// Solve L L^T z = r for z, where L is a factor computed by _ichol_c
+// @input ldata, lcolind, lrow_ptr: the factor L in CSR format
+//        r: double vector right hand side
+//        z: double vector to store the result
+//        M: number of rows
+void _ichol_solve_c(double * ldata,
+                    long * lcolind,
+                    long * lrow_ptr,
+                    double * r,
+                    double * z,
+                    int M){
+
+  long i, k, diag;
+  double s;
+
+  // Forward substitution L y = r, y stored in z
+  for (i=0; i<M; i++){
+    diag = lrow_ptr[i+1]-1;
+    s = r[i];
+    for (k=lrow_ptr[i]; k<diag; k++){
+      s -= ldata[k]*z[lcolind[k]];
+    }
+    z[i] = s/ldata[diag];
+  }
+
+  // Backward substitution L^T z = y, by columns of L^T (rows of L)
+  for (i=M-1; i>=0; i--){
+    diag = lrow_ptr[i+1]-1;
+    z[i] = z[i]/ldata[diag];
+    for (k=lrow_ptr[i]; k<diag; k++){
+      z[lcolind[k]] -= ldata[k]*z[i];
+    }
+  }
+}
+
+// Group the unknowns of a matrix A into aggregates of strongly connected
+// neighbours for algebraic multigrid. i and j are strongly connected if
+// |a_ij| >= theta*sqrt(|a_ii a_jj|).
+// (1) Unknowns whose strong neighbours are all free form an aggregate with
+//     them
+// (2) Remaining unknowns join an aggregate of a strong neighbour from (1)
+// (3) Anything left forms new aggregates with its free strong neighbours
+// @input data, colind, row_ptr: A in CSR format
+//        theta: strength threshold
+//        aggregates: long vector to store the aggregate of each unknown
+//        M: number of rows
+// @return: number of aggregates
+long _aggregate_c(double* data,
+                  long* colind,
+                  long* row_ptr,
+                  double theta,
+                  long * aggregates,
+                  int M){
+
+  long i, j, k, n, free_neighbours, strong_neighbours;
+  double * diag = malloc(sizeof(double)*M);
+  long * first_pass = malloc(sizeof(long)*M);
+
+  for (i=0; i<M; i++){
+    diag[i] = 0.0;
+    for (k=row_ptr[i]; k<row_ptr[i+1]; k++){
+      if (colind[k] == i) diag[i] = fabs(data[k]);
+    }
+    aggregates[i] = -1;
+  }
+
+  #define STRONG(i,k) (colind[k] != i && \
+          fabs(data[k]) >= theta*sqrt(diag[i]*diag[colind[k]]) && data[k] != 0.0)
+
+  // (1)
+  n = 0;
+  for (i=0; i<M; i++){
+    if (aggregates[i] >= 0) continue;
+
+    strong_neighbours = 0;
+    free_neighbours = 1;
+    for (k=row_ptr[i]; k<row_ptr[i+1]; k++){
+      if (STRONG(i,k)){
+        strong_neighbours++;
+        if (aggregates[colind[k]] >= 0) free_neighbours = 0;
+      }
+    }
+
+    if (strong_neighbours > 0 && free_neighbours){
+      aggregates[i] = n;
+      for (k=row_ptr[i]; k<row_ptr[i+1]; k++){
+        if (STRONG(i,k)) aggregates[colind[k]] = n;
+      }
+      n++;
+    }
+  }
+
+  // (2)
+  for (i=0; i<M; i++){
+    first_pass[i] = aggregates[i];
+  }
+  for (i=0; i<M; i++){
+    if (aggregates[i] >= 0) continue;
+    for (k=row_ptr[i]; k<row_ptr[i+1]; k++){
+      j = colind[k];
+      if (STRONG(i,k) && first_pass[j] >= 0){
+        aggregates[i] = first_pass[j];
+        break;
+      }
+    }
+  }
+
+  // (3)
+  for (i=0; i<M; i++){
+    if (aggregates[i] >= 0) continue;
+    aggregates[i] = n;
+    for (k=row_ptr[i]; k<row_ptr[i+1]; k++){
+      if (STRONG(i,k) && aggregates[colind[k]] < 0) aggregates[colind[k]] = n;
+    }
+    n++;
+  }
+
+  #undef STRONG
+
+  free(diag);
+  free(first_pass);
+
+  return n;
+}
+
 		     
 /////////////////////////////////////////////////
 // Gateways to Python
@@ -564,11 +750,131 @@ PyObject *cg_solve_c_precon(PyObject *self, PyObject *args) {
 
 
 
+PyObject *ichol_c(PyObject *self, PyObject *args){
+
+  int M,err;
+
+  PyArrayObject
+    *ldata,           //Lower triangle of matrix, overwritten by factor
+    *lcolind,         //Column indices array
+    *lrow_ptr;        //Row pointers array
+
+  // Convert Python arguments to C
+  if (!PyArg_ParseTuple(args, "OOO", &ldata, &lcolind, &lrow_ptr)) {
+    PyErr_SetString(PyExc_RuntimeError, "ichol_c could not parse input");
+    return NULL;
+  }
+
+  M = (lrow_ptr -> dimensions[0])-1;
+
+  err = _ichol_c((double*) ldata->data,
+                 (long*) lcolind->data,
+                 (long*) lrow_ptr->data,
+                 M);
+
+  return Py_BuildValue("i",err);
+}
+
+PyObject *ichol_solve_c(PyObject *self, PyObject *args){
+
+  int M;
+
+  PyArrayObject
+    *ldata,           //Factor L
+    *lcolind,         //Column indices array
+    *lrow_ptr,        //Row pointers array
+    *r,               //Right hand side
+    *z;               //Result
+
+  // Convert Python arguments to C
+  if (!PyArg_ParseTuple(args, "OOOOO", &ldata, &lcolind, &lrow_ptr, &r, &z)) {
+    PyErr_SetString(PyExc_RuntimeError, "ichol_solve_c could not parse input");
+    return NULL;
+  }
+
+  M = (lrow_ptr -> dimensions[0])-1;
+
+  _ichol_solve_c((double*) ldata->data,
+                 (long*) lcolind->data,
+                 (long*) lrow_ptr->data,
+                 (double*) r->data,
+                 (double*) z->data,
+                 M);
+
+  return Py_BuildValue("");
+}
+
+PyObject *aggregate_c(PyObject *self, PyObject *args){
+
+  int M;
+  long n;
+  double theta;
+
+  PyObject *csr_sparse; // input sparse matrix (must be CSR format)
+
+  PyArrayObject
+    *data,            //Non Zeros Data array
+    *colind,          //Column indices array
+    *row_ptr,         //Row pointers array
+    *aggregates;      //Aggregate of each row
+
+  // Convert Python arguments to C
+  if (!PyArg_ParseTuple(args, "OdO", &csr_sparse, &theta, &aggregates)) {
+    PyErr_SetString(PyExc_RuntimeError, "aggregate_c could not parse input");
+    return NULL;
+  }
+
+  // Extract three subarrays making up the sparse matrix in CSR format.
+  data = (PyArrayObject*)
+    PyObject_GetAttrString(csr_sparse, "data");
+  if (!data) {
+    PyErr_SetString(PyExc_RuntimeError,
+        "Data array could not be allocated in aggregate_c");
+    return NULL;
+  }
+
+  colind = (PyArrayObject*)
+    PyObject_GetAttrString(csr_sparse, "colind");
+  if (!colind) {
+    PyErr_SetString(PyExc_RuntimeError,
+        "Column index array could not be allocated in aggregate_c");
+    return NULL;
+  }
+
+  row_ptr = (PyArrayObject*)
+    PyObject_GetAttrString(csr_sparse, "row_ptr");
+  if (!row_ptr) {
+    PyErr_SetString(PyExc_RuntimeError,
+        "Row pointer array could not be allocated in aggregate_c");
+    return NULL;
+  }
+
+  M = (row_ptr -> dimensions[0])-1;
+
+  n = _aggregate_c((double*) data->data,
+                   (long*) colind->data,
+                   (long*) row_ptr->data,
+                   theta,
+                   (long*) aggregates->data,
+                   M);
+
+  // Free extra references to sparse matrix parts
+  Py_DECREF(data);
+  Py_DECREF(colind);
+  Py_DECREF(row_ptr);
+
+  return Py_BuildValue("l",n);
+}
+
+
 // Method table for python module
 static struct PyMethodDef MethodTable[] = {
   {"cg_solve_c", cg_solve_c, METH_VARARGS, "Print out"},
   {"cg_solve_c_precon", cg_solve_c_precon, METH_VARARGS, "Print out"},
   {"jacobi_precon_c", jacobi_precon_c, METH_VARARGS, "Print out"},    
+  {"ichol_c", ichol_c, METH_VARARGS, "Print out"},
+  {"ichol_solve_c", ichol_solve_c, METH_VARARGS, "Print out"},
+  {"aggregate_c", aggregate_c, METH_VARARGS, "Print out"},
   {NULL, NULL, 0, NULL}   /* sentinel */
 };
 
@@ -3,6 +3,8 @@ class VectorShapeError(exceptions.Exception): pass
 class ConvergenceError(exceptions.Exception): pass
 class PreconditionerError(exceptions.Exception): pass
 
+import time
+
 import numpy as num
 
 import anuga.utilities.log as log
@@ -12,6 +14,7 @@ from anuga.utilities.sparse import Sparse, Sparse_CSR
 from cg_ext import cg_solve_c
 from cg_ext import cg_solve_c_precon
 from cg_ext import jacobi_precon_c
+from cg_ext import ichol_c, ichol_solve_c, aggregate_c
 
 
 class Stats:
@@ -24,10 +27,17 @@ class Stats:
         self.rTr0 = None
         self.x = None
         self.x0 = None
+        self.rTr_history = None
+        self.precon = None
+        self.setup_time = None
+        self.solve_time = None
 
     def __str__(self):
         msg = ' iter %.5g rTr %.5g x %.5g dx %.5g rTr0 %.5g x0 %.5g' \
               % (self.iter, self.rTr, self.x, self.dx, self.rTr0, self.x0)
+        if self.setup_time is not None and self.solve_time is not None:
+            msg += ' precon %s setup %.3g s solve %.3g s' \
+                   % (self.precon, self.setup_time, self.solve_time)
         return msg
 
 # Note Padarn 26/11/12: This function has been modified to include an
@@ -49,6 +59,21 @@ def conjugate_gradient(A, b, x0=None, imax=10000, tol=1.0e-8, atol=1.0e-14,
 
     If b is an array, solve it as if it was a set of vectors, solving each
     vector.
+
+    precon selects the preconditioner: 'None', 'Jacobi', 'ICC' (incomplete
+    Cholesky) or 'AMG' (algebraic multigrid), see get_preconditioner.
+    Preconditioners other than 'None' need A as a Sparse_CSR matrix, unless
+    precon is a preconditioner built earlier (e.g. from the matrix behind
+    an operator A), which also saves setting it up again when solving with
+    the same A repeatedly. The c implementation (use_c_cg) only supports
+    'None' and 'Jacobi', the python implementation is used for the others.
+
+    With precon='Jacobi' the initial guess defaults to b.
+
+    If output_stats is True the Stats of the solve are returned as well:
+    iterations, history of rTr (python implementation only) and the time
+    spent setting up the preconditioner and solving. If b has several
+    columns iter is the largest number of iterations over the columns.
     """
     
     if use_c_cg:
@@ -57,64 +82,71 @@ def conjugate_gradient(A, b, x0=None, imax=10000, tol=1.0e-8, atol=1.0e-14,
                 be of type %s') % (str(Sparse_CSR))
         assert isinstance(A, Sparse_CSR), msg
 
+    b = num.array(b, dtype=num.float)
+
     if x0 is None:
-        x0 = num.zeros(b.shape, dtype=num.float)
+        if precon == 'Jacobi':
+            x0 = b.copy()
+        else:
+            x0 = num.zeros(b.shape, dtype=num.float)
     else:
         x0 = num.array(x0, dtype=num.float)
 
-    b = num.array(b, dtype=num.float)
+    # preconditioner 
+    t0 = time.time()
+    preconditioner = get_preconditioner(A, precon)
+    setup_time = time.time() - t0
 
-    err = 0
+    if preconditioner is not None and \
+           not isinstance(preconditioner, Jacobi_preconditioner):
+        use_c_cg = False
 
-    # preconditioner 
-    # Padarn Note: currently a fairly lazy implementation, needs fixing
-    M = None
-    if precon == 'Jacobi':
-
-        M = num.zeros(b.shape[0])
-        jacobi_precon_c(A, M)
-        x0 = b.copy()     
-
-        if len(b.shape) != 1:   
-
-            for i in range(b.shape[1]): 
-
-                if not use_c_cg:
-                    x0[:, i], stats = _conjugate_gradient_preconditioned(A, b[:, i], x0[:, i], M,
-                                               imax, tol, atol, iprint, Type="Jacobi")
-                else:
-                    # need to copy into new array to ensure contiguous access
-                    xnew = x0[:, i].copy()
-                    err = cg_solve_c_precon(A, xnew, b[:, i].copy(), imax, tol, atol, b.shape[1], M)
-                    x0[:, i] = xnew
-        else:
+    t0 = time.time()
+    if len(b.shape) != 1:
 
-            if not use_c_cg:
-                x0, stats = _conjugate_gradient_preconditioned(A, b, x0, M, imax, tol, atol, iprint, Type="Jacobi")
-            else:
-                err = cg_solve_c_precon(A, x0, b, imax, tol, atol, 1, M)
+        iterations = 0
+        for i in range(b.shape[1]):
+            # need to copy into new array to ensure contiguous access
+            xnew, stats = _solve(A, b[:, i].copy(), x0[:, i].copy(),
+                                 preconditioner, use_c_cg,
+                                 imax, tol, atol, iprint)
+            x0[:, i] = xnew
+            iterations = max(iterations, stats.iter)
+        stats.iter = iterations
+    else:
+        x0, stats = _solve(A, b, x0, preconditioner, use_c_cg,
+                           imax, tol, atol, iprint)
+
+    stats.solve_time = time.time() - t0
+    stats.setup_time = setup_time
+    if preconditioner is not None:
+        stats.precon = preconditioner.name
 
+    if output_stats:
+        return x0, stats
     else:
+        return x0
 
-        if len(b.shape) != 1:
 
-            for i in range(b.shape[1]):
+def _solve(A, b, x0, preconditioner, use_c_cg, imax, tol, atol, iprint):
+    """Solve Ax = b for vector b with the given (or no) preconditioner
 
-                if not use_c_cg:
-                    x0[:, i], stats = _conjugate_gradient(A, b[:, i], x0[:, i],
-                                               imax, tol, atol, iprint)
-                else:
-                    # need to copy into new array to ensure contiguous access
-                    xnew = x0[:, i].copy()
-                    err = cg_solve_c(A, xnew, b[:, i].copy(), imax, tol, atol, b.shape[1])
-                    x0[:, i] = xnew
-        else:   
+    Return x, stats
+    """
 
-            if not use_c_cg:
-                x0, stats = _conjugate_gradient(A, b, x0, imax, tol, atol, iprint)
-            else:
-                x0 = b.copy()
-                err = cg_solve_c(A, x0, b, imax, tol, atol, 1)
+    if not use_c_cg:
+        if preconditioner is None:
+            return _conjugate_gradient(A, b, x0, imax, tol, atol, iprint)
+        else:
+            return _conjugate_gradient_preconditioned(A, b, x0,
+                                                      preconditioner,
+                                                      imax, tol, atol, iprint)
+
+    if preconditioner is None:
+        err = cg_solve_c(A, x0, b, imax, tol, atol, 1)
+    else:
+        err = cg_solve_c_precon(A, x0, b, imax, tol, atol, 1,
+                                preconditioner.diagonal)
 
     if err == -1:
         
@@ -122,10 +154,410 @@ def conjugate_gradient(A, b, x0=None, imax=10000, tol=1.0e-8, atol=1.0e-14,
         msg = 'Conjugate gradient solver did not converge'
         raise ConvergenceError, msg
 
+    # c functions return the number of iterations
+    stats = Stats()
+    stats.iter = err
+
+    return x0, stats
+
+
+def jacobi_preconditioner(A):
+    """Return Jacobi (diagonal) preconditioner of Sparse_CSR matrix A
+    as a vector of the diagonal entries of A (1 where they are zero).
+    """
+
+    M = num.zeros(A.M)
+    jacobi_precon_c(A, M)
+
+    return M
+
+
+def get_preconditioner(A, precon='None'):
+    """Return preconditioner for Sparse_CSR matrix A.
+
+    precon is one of
+    'None'   : no preconditioner (None is returned)
+    'Jacobi' : diagonal of A
+    'ICC'    : incomplete Cholesky factorisation of A without fill in
+    'AMG'    : one V-cycle of aggregation based algebraic multigrid
+
+    or a preconditioner, which is returned as it is.
+
+    Preconditioners are called on a residual r (vector or array of
+    columns) and return z approximately solving A z = r.
+    """
+
+    if precon is None or isinstance(precon, Preconditioner):
+        return precon
+
+    if precon == 'None':
+        return None
+
+    preconditioners = {'Jacobi': Jacobi_preconditioner,
+                       'ICC': ICC_preconditioner,
+                       'AMG': AMG_preconditioner}
+
+    if precon not in preconditioners:
+        msg = 'Unknown preconditioner %s, use one of %s' \
+              % (precon, ['None'] + sorted(preconditioners.keys()))
+        raise PreconditionerError, msg
+
+    if not isinstance(A, Sparse_CSR):
+        msg = 'Preconditioner %s requires matrix A to be of type %s' \
+              % (precon, str(Sparse_CSR))
+        raise PreconditionerError, msg
+
+    return preconditioners[precon](A)
+
+
+class Preconditioner:
+    """Base class of preconditioners for conjugate gradient.
+
+    Subclasses set up the preconditioner from a Sparse_CSR matrix in their
+    constructor and implement solve(r) for a vector r. setup_time is the
+    time taken to set up.
+    """
+
+    name = 'None'
+
+    def __init__(self):
+
+        self.setup_time = 0.0
+
+    def __call__(self, r):
+
+        r = num.asarray(r, dtype=num.float)
+
+        if len(r.shape) == 1:
+            return self.solve(r)
+
+        z = num.zeros(r.shape, num.float)
+        for i in range(r.shape[1]):
+            z[:, i] = self.solve(r[:, i].copy())
+
+        return z
+
+    def solve(self, r):
+
+        return r.copy()
+
+
+class Jacobi_preconditioner(Preconditioner):
+    """Diagonal of A (1 where it is zero).
+    """
+
+    name = 'Jacobi'
+
+    def __init__(self, A=None, diagonal=None):
+
+        t0 = time.time()
+        if diagonal is None:
+            diagonal = jacobi_preconditioner(A)
+        self.diagonal = num.array(diagonal, dtype=num.float)
+        self.setup_time = time.time() - t0
+
+    def __call__(self, r):
+
+        r = num.asarray(r, dtype=num.float)
+
+        if len(r.shape) == 1:
+            return r / self.diagonal
+        else:
+            return r / self.diagonal[:, num.newaxis]
+
+
+class ICC_preconditioner(Preconditioner):
+    """Incomplete Cholesky factorisation L L^T of A with the sparsity
+    pattern of A (IC(0)).
+
+    A must be symmetric and definite. If A is negative definite (e.g. a
+    discretised div grad) -A is factorised instead. If the factorisation
+    breaks down on a non positive pivot, it is repeated with the diagonal
+    of A increased by a factor 1 + shift, with shift growing from 1.0e-3
+    by factors of 10.
+    """
+
+    name = 'ICC'
+
+    def __init__(self, A, max_shift=1.0e3):
+
+        t0 = time.time()
+
+        diagonal = jacobi_preconditioner(A)
+        self.sign = 1.0
+        if num.sum(diagonal) < 0.0:
+            self.sign = -1.0
+            diagonal = -diagonal
+
+        # Strictly lower triangle of A followed by the diagonal in each row
+        n = A.M
+        rows = num.repeat(num.arange(n), A.row_ptr[1:] - A.row_ptr[:-1])
+        lower = A.colind < rows
+
+        rows = num.concatenate((rows[lower], num.arange(n)))
+        colind = num.concatenate((A.colind[lower], num.arange(n)))
+        data = num.concatenate((self.sign*A.data[lower], diagonal))
+
+        order = num.lexsort((colind, rows))
+        self.colind = num.ascontiguousarray(colind[order], dtype=num.int)
+        self.row_ptr = num.zeros(n+1, num.int)
+        self.row_ptr[1:] = num.cumsum(num.bincount(rows, minlength=n))
+        data = data[order]
+        is_diagonal = self.colind == rows[order]
+
+        self.shift = 0.0
+        while True:
+            self.data = data.copy()
+            self.data[is_diagonal] *= 1.0 + self.shift
+
+            if ichol_c(self.data, self.colind, self.row_ptr) == 0:
+                break
+
+            if self.shift == 0.0:
+                self.shift = 1.0e-3
+            else:
+                self.shift *= 10.0
+
+            if self.shift > max_shift:
+                msg = 'Incomplete Cholesky factorisation failed, '
+                msg += 'matrix is not definite'
+                raise PreconditionerError, msg
+
+        self.setup_time = time.time() - t0
+
+    def solve(self, r):
+
+        z = num.zeros(len(r), num.float)
+        ichol_solve_c(self.data, self.colind, self.row_ptr,
+                      num.ascontiguousarray(r, dtype=num.float), z)
+
+        if self.sign < 0.0:
+            z = -z
+
+        return z
+
+
+class AMG_preconditioner(Preconditioner):
+    """One symmetric V-cycle of algebraic multigrid with (unsmoothed)
+    aggregation.
+
+    Unknowns are grouped into aggregates of strongly connected neighbours,
+    where i and j are strongly connected if
+    |a_ij| >= theta*sqrt(|a_ii*a_jj|). Each aggregate is one unknown of the
+    next coarser level, whose matrix is the sum of the entries of A between
+    aggregates (Galerkin product with piecewise constant interpolation).
+    Levels are added until there are fewer than coarse_size unknowns,
+    which are solved for directly.
+
+    Each level does smoothing_steps damped Jacobi sweeps before and after
+    the coarse grid correction, with the damping chosen from a Gershgorin
+    bound of the eigenvalues of diag(A)^-1 A.
+    """
+
+    name = 'AMG'
+
+    def __init__(self, A, theta=0.08, coarse_size=100, max_levels=20,
+                 smoothing_steps=1):
+
+        t0 = time.time()
+
+        self.smoothing_steps = smoothing_steps
+        self.levels = []
+
+        while A.M > coarse_size and len(self.levels) < max_levels - 1:
+            aggregates = num.zeros(A.M, num.int)
+            number_of_aggregates = aggregate_c(A, theta, aggregates)
+            if number_of_aggregates >= A.M:
+                break
+
+            diagonal = jacobi_preconditioner(A)
+            rows = num.repeat(num.arange(A.M), A.row_ptr[1:] - A.row_ptr[:-1])
+            row_sums = num.bincount(rows, weights=num.abs(A.data),
+                                    minlength=A.M)
+            omega = (4.0/3.0) / max(num.max(row_sums/num.abs(diagonal)), 1.0)
+
+            self.levels.append((A, diagonal, omega, aggregates,
+                                number_of_aggregates))
+
+            A = _aggregate_matrix(A, rows, aggregates, number_of_aggregates)
+
+        # Direct solve on the coarsest level (pseudo inverse as the matrix
+        # may be singular, e.g. for vertices without triangles)
+        self.coarse_inverse = num.linalg.pinv(A.todense())
+
+        self.setup_time = time.time() - t0
+
+    def get_number_of_levels(self):
+
+        return len(self.levels) + 1
+
+    def solve(self, r):
+
+        return self._cycle(0, r)
+
+    def _cycle(self, level, b):
+
+        if level == len(self.levels):
+            return num.dot(self.coarse_inverse, b)
+
+        A, diagonal, omega, aggregates, number_of_aggregates = \
+            self.levels[level]
+
+        # Pre smoothing starting from 0
+        x = omega * b / diagonal
+        for i in range(self.smoothing_steps - 1):
+            x += omega * (b - A * x) / diagonal
+
+        # Coarse grid correction
+        r = b - A * x
+        r_coarse = num.bincount(aggregates, weights=r,
+                                minlength=number_of_aggregates)
+        x += self._cycle(level + 1, r_coarse)[aggregates]
+
+        # Post smoothing
+        for i in range(self.smoothing_steps):
+            x += omega * (b - A * x) / diagonal
+
+        return x
+
+
+def _aggregate_matrix(A, rows, aggregates, number_of_aggregates):
+    """Return Sparse_CSR matrix P^T A P where P interpolates piecewise
+    constant from aggregates (one column per aggregate).
+    """
+
+    n = number_of_aggregates
+    keys = aggregates[rows] * n + aggregates[A.colind]
+    keys, inverse = num.unique(keys, return_inverse=True)
+
+    data = num.bincount(inverse, weights=A.data)
+    colind = num.ascontiguousarray(keys % n, dtype=num.int)
+    row_ptr = num.zeros(n+1, num.int)
+    row_ptr[1:] = num.cumsum(num.bincount(keys // n, minlength=n))
+
+    return Sparse_CSR(None, data, colind, row_ptr, int(n), int(n))
+
+
+def block_conjugate_gradient(A, b, x0=None, imax=10000, tol=1.0e-8,
+                             atol=1.0e-14, iprint=None, output_stats=False,
+                             precon='None'):
+    """
+    Try to solve linear equation Ax = b for all columns of b together
+    using conjugate gradient method.
+
+    Every column follows its own conjugate gradient recursion, but the
+    products with A are done for all columns in one pass over A, which
+    is where most of the time goes. Columns are dropped from the
+    iteration as they converge.
+
+    As in conjugate_gradient a column has converged when its (pre-
+    conditioned) residual has been reduced by tol relative to the initial
+    residual, or is below atol, so each column gets the solution
+    conjugate_gradient would give it.
+
+    Input
+    A: Sparse_CSR matrix (or any matrix that can be multiplied onto an
+       n x k array), assumed symmetric
+    b: n x k array of right hand sides (or vector)
+    x0: initial guess of the same shape as b, e.g. the solution of a
+        related problem (default the 0 vector)
+    precon: preconditioner as for conjugate_gradient, i.e. 'None',
+       'Jacobi', 'ICC', 'AMG' (see get_preconditioner) or a
+       preconditioner built earlier
+    imax: max number of iterations
+    tol: tolerance used for residual
+
+    Output
+    x: approximate solution of the same shape as b
+    stats: (if output_stats) Stats with iter, rTr and rTr0 per column,
+           the history of the largest rTr and the solve time
+    """
+
+    t0 = time.time()
+    M = get_preconditioner(A, precon)
+    setup_time = time.time() - t0
+
+    t0 = time.time()
+
+    b = num.array(b, dtype=num.float)
+    vector = len(b.shape) == 1
+    if vector:
+        b = b.reshape(-1, 1)
+
+    if x0 is None:
+        x = num.zeros(b.shape, dtype=num.float)
+    else:
+        x = num.array(x0, dtype=num.float).reshape(b.shape)
+
+    if iprint == None or iprint == 0:
+        iprint = imax
+
+    stats = Stats()
+    stats.x0 = num.sqrt(num.sum(x**2, axis=0))
+    stats.rTr_history = []
+
+    r = b - A * x
+    if M is None:
+        z = r
+    else:
+        z = M(r)
+    d = z.copy()
+    rTr = num.sum(r*z, axis=0)
+    rTr0 = rTr.copy()
+
+    stats.rTr0 = rTr0
+    iterations = num.ones(b.shape[1], num.int)
+
+    i = 1
+    active = (num.abs(rTr) > tol**2 * num.abs(rTr0)) & (num.abs(rTr) > atol**2)
+    while active.any():
+        if i == imax:
+            log.warning('max number of iterations attained')
+            msg = 'Conjugate gradient solver did not converge: rTr==%20.15e' \
+                  % num.max(num.abs(rTr[active]))
+            raise ConvergenceError, msg
+
+        cols = num.nonzero(active)[0]
+        dc = num.ascontiguousarray(d[:, cols])
+        q = A * dc
+        alpha = rTr[cols] / num.sum(dc*q, axis=0)
+
+        x[:, cols] += alpha * dc
+        rc = r[:, cols] - alpha * q
+        r[:, cols] = rc
+        if M is None:
+            zc = rc
+        else:
+            zc = M(rc)
+        rTrNew = num.sum(rc*zc, axis=0)
+        stats.rTr_history.append(num.max(num.abs(rTrNew)))
+
+        d[:, cols] = zc + rTrNew / rTr[cols] * dc
+        rTr[cols] = rTrNew
+
+        i = i + 1
+        iterations[cols] = i
+        active[cols] = (num.abs(rTrNew) > tol**2 * num.abs(rTr0[cols])) & \
+                       (num.abs(rTrNew) > atol**2)
+
+        if i % iprint == 0:
+            log.info('i = %g max rTr = %15.8e' % (i, num.max(num.abs(rTrNew))))
+
+    stats.x = num.sqrt(num.sum(x**2, axis=0))
+    stats.iter = iterations
+    stats.rTr = rTr
+    stats.solve_time = time.time() - t0
+    stats.setup_time = setup_time
+    if M is not None:
+        stats.precon = M.name
+
+    if vector:
+        x = x.reshape(-1)
+
     if output_stats:
-        return x0, stats
+        return x, stats
     else:
-        return x0
+        return x
 
     
 def _conjugate_gradient(A, b, x0, 
@@ -173,6 +605,7 @@ def _conjugate_gradient(A, b, x0,
     rTr0 = rTr
 
     stats.rTr0 = rTr0
+    stats.rTr_history = [rTr]
 
     #FIXME Let the iterations stop if starting with a small residual
     while (i < imax and rTr > tol ** 2 * rTr0 and rTr > atol ** 2):
@@ -198,6 +631,7 @@ def _conjugate_gradient(A, b, x0,
             r = r - alpha * q
         rTrOld = rTr
         rTr = num.dot(r, r)
+        stats.rTr_history.append(rTr)
         bt = rTr / rTrOld
 
         d = r + bt * d
@@ -223,7 +657,7 @@ def _conjugate_gradient(A, b, x0,
 
     
 def _conjugate_gradient_preconditioned(A, b, x0, M, 
-                        imax=10000, tol=1.0e-8, atol=1.0e-10, iprint=None, Type='None'):
+                        imax=10000, tol=1.0e-8, atol=1.0e-10, iprint=None, Type='Jacobi'):
     """
    Try to solve linear equation Ax = b using
    preconditioned conjugate gradient method
@@ -234,6 +668,8 @@ def _conjugate_gradient_preconditioned(A, b, x0, M,
       (__mul__ just needs to be defined)
    b: right hand side
    x0: inital guess (default the 0 vector)
+   M: preconditioner (see get_preconditioner) or, for Type 'Jacobi',
+      the diagonal of A as returned by jacobi_preconditioner
    imax: max number of iterations
    tol: tolerance used for residual
 
@@ -241,18 +677,11 @@ def _conjugate_gradient_preconditioned(A, b, x0, M,
    x: approximate solution
    """
 
-    # Padarn note: This is temporary while the Jacboi preconditioner is the only
-    # one avaliable.
-    D=[]
-    if not Type=='Jacobi':
-        log.warning('Only the Jacobi Preconditioner is impletment cg_solve python')
-        msg = 'Only the Jacobi Preconditioner is impletment in cg_solve python'
-        raise PreconditionerError, msg
-    else:
-        D=Sparse(A.M, A.M)
-        for i in range(A.M):
-            D[i,i]=1/M[i]
-        D=Sparse_CSR(D)
+    if not isinstance(M, Preconditioner):
+        if not Type=='Jacobi':
+            msg = 'Preconditioner %s must be given as a preconditioner' % Type
+            raise PreconditionerError, msg
+        M = Jacobi_preconditioner(diagonal=M)
 
     stats = Stats()
 
@@ -275,15 +704,18 @@ def _conjugate_gradient_preconditioned(A, b, x0, M,
     i = 1
     x = x0
     r = b - A * x
-    z = D * r
-    d = r
+    z = M(r)
+    d = z
     rTr = num.dot(r, z)
     rTr0 = rTr
 
     stats.rTr0 = rTr0
+    stats.rTr_history = [rTr]
     
+    # rTr = r.M(r) is negative if A and M are negative definite
     #FIXME Let the iterations stop if starting with a small residual
-    while (i < imax and rTr > tol ** 2 * rTr0 and rTr > atol ** 2):
+    while (i < imax and abs(rTr) > tol ** 2 * abs(rTr0)
+           and abs(rTr) > atol ** 2):
         q = A * d
         alpha = rTr / num.dot(d, q)
         xold = x
@@ -305,8 +737,9 @@ def _conjugate_gradient_preconditioned(A, b, x0, M,
         else:
             r = r - alpha * q
         rTrOld = rTr
-        z = D * r
+        z = M(r)
         rTr = num.dot(r, z)
+        stats.rTr_history.append(rTr)
         bt = rTr / rTrOld
 
         d = z + bt * d
@@ -904,6 +904,33 @@ def make_grid(data, lats, lons, fileName, EPSG_CODE=None, proj4string=None,
     
 
 
+    ds = create_grid(lats, lons, fileName, EPSG_CODE=EPSG_CODE,
+                     proj4string=proj4string,
+                     creation_options=creation_options)
+
+    outband = ds.GetRasterBand(1)
+    outband.WriteArray(data)
+
+    ds = None
+    return
+
+def create_grid(lats, lons, fileName, EPSG_CODE=None, proj4string=None, 
+                creation_options=[]):
+    """
+        Create an empty georeferenced raster tif for the grid lats,lons, to
+        be filled with band.WriteArray(data, xoff, yoff) (e.g. tile by tile)
+        INPUT: as for make_grid
+        OUTPUT: the gdal dataset. Set it to None to close the file.
+    """
+
+    try:
+        import osgeo.gdal as gdal
+        import osgeo.osr as osr
+    except ImportError, e:
+        msg='Failed to import gdal/ogr modules --'\
+        + 'perhaps gdal python interface is not installed.'
+        raise ImportError, msg
+
     xres = lons[1] - lons[0]
     yres = lats[1] - lats[0]
 
@@ -934,16 +961,10 @@ def make_grid(data, lats, lons, fileName, EPSG_CODE=None, proj4string=None,
     #gt = [llx, xres, 0, lly, yres,0 ]
     ds.SetGeoTransform(gt)
 
-    #import pdb
-    #pdb.set_trace()
-    import scipy
-
     outband = ds.GetRasterBand(1)
     outband.SetNoDataValue(numpy.nan)
-    outband.WriteArray(data)
 
-    ds = None
-    return
+    return ds
 
 ##################################################################################
 
@@ -959,7 +980,8 @@ def Make_Geotif(swwFile=None,
              bounding_polygon=None,
              verbose=False,
              k_nearest_neighbours=3,
-             creation_options=[]):
+             creation_options=[],
+             tile_size=None):
     """
         Make a georeferenced tif by nearest-neighbour interpolation of sww file outputs (or a 3-column array with xyz Points)
 
@@ -985,6 +1007,8 @@ def Make_Geotif(swwFile=None,
                 bounding_polygon -- polygon (e.g. from read_polygon) If present, only set values of raster cells inside the bounding_polygon
                 k_nearest_neighbours -- how many neighbours to use in interpolation. If k>1, inverse-distance-weighted interpolation is used
                 creation_options -- list of tif creation options for gdal, e.g. ['COMPRESS=DEFLATE']
+                tile_size -- If not None, interpolate and write the rasters in tiles of 
+                             tile_size x tile_size cells, so that the full grid is never held in memory
     """
 
     import scipy.io
@@ -1068,102 +1092,163 @@ def Make_Geotif(swwFile=None,
     yres = (upper_right[1]-lower_left[1])*1.0/(1.0*(ny-1))
     desiredY = scipy.linspace(lower_left[1], upper_right[1], ny)
 
-    gridX, gridY = scipy.meshgrid(desiredX, desiredY)
-
     if(verbose):
         print 'Making interpolation functions...'
     swwXY = scipy.array([swwX[:],swwY[:]]).transpose()
 
-    # Get function to interpolate quantity onto gridXY_array
-    gridXY_array = scipy.array([scipy.concatenate(gridX),
-        scipy.concatenate(gridY)]).transpose()
-    gridXY_array = scipy.ascontiguousarray(gridXY_array)
+    def make_interp_fun(desiredX, desiredY):
+        """Return function interpolating a quantity from the sww points to
+           the grid desiredX,desiredY, and the indices of grid points
+           outside the bounding polygon
+        """
+        gridX, gridY = scipy.meshgrid(desiredX, desiredY)
+
+        # Get function to interpolate quantity onto gridXY_array
+        gridXY_array = scipy.array([scipy.concatenate(gridX),
+            scipy.concatenate(gridY)]).transpose()
+        gridXY_array = scipy.ascontiguousarray(gridXY_array)
+
+        # Create Interpolation function
+        #basic_nearest_neighbour=False
+        if(k_nearest_neighbours == 1):
+            gridqInd = index_qFun(gridXY_array)
+            # Function to do the interpolation
+            def myInterpFun(quantity):
+                return quantity[gridqInd]
+        else:
+            # Combined nearest neighbours and inverse-distance interpolation
+            NNInfo = index_qFun.query(gridXY_array, k=k_nearest_neighbours)
+            # Weights for interpolation
+            nn_wts = 1./(NNInfo[0]+1.0e-100)
+            nn_inds = NNInfo[1]
+            def myInterpFun(quantity):
+                denom = 0.
+                num = 0.
+                for i in range(k_nearest_neighbours):
+                    denom += nn_wts[:,i]
+                    num += quantity[nn_inds[:,i]]*nn_wts[:,i]
+                return (num/denom)
+
+        cut_points = []
+        if(bounding_polygon is not None):
+            # Find points to exclude (i.e. outside the bounding polygon)
+            from anuga.geometry.polygon import outside_polygon
+            cut_points = outside_polygon(gridXY_array, bounding_polygon)
+
+        return myInterpFun, cut_points
 
-    # Create Interpolation function
-    #basic_nearest_neighbour=False
     if(k_nearest_neighbours == 1):
         index_qFun = scipy.interpolate.NearestNDInterpolator(
             swwXY,
             scipy.arange(len(swwX),dtype='int64').transpose())
-        gridqInd = index_qFun(gridXY_array)
-        # Function to do the interpolation
-        def myInterpFun(quantity):
-            return quantity[gridqInd]
     else:
-        # Combined nearest neighbours and inverse-distance interpolation
         index_qFun = scipy.spatial.cKDTree(swwXY)
-        NNInfo = index_qFun.query(gridXY_array, k=k_nearest_neighbours)
-        # Weights for interpolation
-        nn_wts = 1./(NNInfo[0]+1.0e-100)
-        nn_inds = NNInfo[1]
-        def myInterpFun(quantity):
-            denom = 0.
-            num = 0.
-            for i in range(k_nearest_neighbours):
-                denom += nn_wts[:,i]
-                num += quantity[nn_inds[:,i]]*nn_wts[:,i]
-            return (num/denom)
-
-    if(bounding_polygon is not None):
-        # Find points to exclude (i.e. outside the bounding polygon)
-        from anuga.geometry.polygon import outside_polygon
-        cut_points = outside_polygon(gridXY_array, bounding_polygon)
-        
-    # Loop over all output quantities and produce the output
+
+    def get_output(myTSindex, myTSi, output_quantity):
+        """Return the values at the sww points to be rasterised, and the
+           name of the output file
+        """
+        if(myTSi is not 'max'):
+            myTS = myTSi
+        else:
+            # We have already extracted the max, and e.g.
+            # p2.stage is an array of dimension (1, number_of_pointS).
+            myTS = 0
+
+        if(type(myTS) == int):
+            if(output_quantity == 'stage'):
+                values = p2.stage[myTS,:]
+            elif(output_quantity == 'depth'):
+                values = p2.height[myTS,:]*(p2.height[myTS,:]>0.)# Force positive depth (tsunami alg)
+            elif(output_quantity == 'velocity'):
+                values = p2.vel[myTS,:]
+            elif(output_quantity == 'friction'):
+                values = p2.friction
+            elif(output_quantity == 'depthIntegratedVelocity'):
+                values = (p2.xmom[myTS,:]**2+p2.ymom[myTS,:]**2)**0.5
+            elif(output_quantity == 'elevation'):
+                values = p2.elev
+            else:
+                raise Exception, 'Unknown output_quantity ' + output_quantity
+
+            if(myTSi is 'max'):
+                timestepString = 'max'
+            else:
+                timestepString = str(myTimeStep[myTSindex])+'_Time_'+str(round(p2.time[myTS]))
+        elif(myTS == 'pointData'):
+            values = xyzPoints[:,2]
+
+        # Make name for output file
+        if(myTS != 'pointData'):
+            output_name = output_dir + '/' +\
+                os.path.splitext(os.path.basename(swwFile))[0] + '_' +\
+                output_quantity + '_' + timestepString + '.tif'
+                        #'_'+str(myTS)+'.tif'
+        else:
+            output_name = output_dir+'/'+'PointData_'+output_quantity+'.tif'
+
+        return values, output_name
+
+    outputs = []
     for myTSindex, myTSi in enumerate(myTimeStep):
-        if(verbose):
-            print 'Reduction = ', myTSi
         for output_quantity in output_quantities:
-            if (verbose): print output_quantity
+            outputs.append(get_output(myTSindex, myTSi, output_quantity))
 
-            if(myTSi is not 'max'):
-                myTS = myTSi
-            else:
-                # We have already extracted the max, and e.g.
-                # p2.stage is an array of dimension (1, number_of_pointS).
-                myTS = 0
-
-            if(type(myTS) == int):
-                if(output_quantity == 'stage'):
-                    gridq = myInterpFun(p2.stage[myTS,:])
-                if(output_quantity == 'depth'):
-                    gridq = p2.height[myTS,:]*(p2.height[myTS,:]>0.)# Force positive depth (tsunami alg)
-                    gridq = myInterpFun(gridq)
-                if(output_quantity == 'velocity'):
-                    gridq = myInterpFun(p2.vel[myTS,:])
-                if(output_quantity == 'friction'):
-                    gridq = myInterpFun(p2.friction)
-                if(output_quantity == 'depthIntegratedVelocity'):
-                    swwDIVel = (p2.xmom[myTS,:]**2+p2.ymom[myTS,:]**2)**0.5
-                    gridq = myInterpFun(swwDIVel)
-                if(output_quantity == 'elevation'):
-                    gridq = myInterpFun(p2.elev)
-    
-                if(myTSi is 'max'):
-                    timestepString = 'max'
-                else:
-                    timestepString = str(myTimeStep[myTSindex])+'_Time_'+str(round(p2.time[myTS]))
-            elif(myTS == 'pointData'):
-                gridq = myInterpFun(xyzPoints[:,2])
+    if(tile_size is None):
+        myInterpFun, cut_points = make_interp_fun(desiredX, desiredY)
+
+        # Loop over all output quantities and produce the output
+        for values, output_name in outputs:
+            if (verbose): print output_name
+
+            gridq = myInterpFun(values)
 
             if ( (bounding_polygon is not None) and (len(cut_points)>0)):
                 # Cut the points outside the bounding polygon
                 gridq[cut_points] = numpy.nan
 
-            # Make name for output file
-            if(myTS != 'pointData'):
-                output_name = output_dir + '/' +\
-                    os.path.splitext(os.path.basename(swwFile))[0] + '_' +\
-                    output_quantity + '_' + timestepString + '.tif'
-                            #'_'+str(myTS)+'.tif'
-            else:
-                output_name = output_dir+'/'+'PointData_'+output_quantity+'.tif'
-
             if(verbose):
                 print 'Making raster ...'
             gridq.shape = (len(desiredY),len(desiredX))
             make_grid(scipy.flipud(gridq), desiredY, desiredX, output_name, EPSG_CODE=EPSG_CODE, 
                       proj4string=proj4string, creation_options=creation_options)
+    else:
+        # Write all outputs tile by tile, so that only one tile of the
+        # grid is held in memory
+        datasets = []
+        for values, output_name in outputs:
+            datasets.append(create_grid(desiredY, desiredX, output_name,
+                                        EPSG_CODE=EPSG_CODE,
+                                        proj4string=proj4string,
+                                        creation_options=creation_options))
+
+        ny = len(desiredY)
+        nx = len(desiredX)
+        for i0 in range(0, ny, tile_size):
+            i1 = min(i0 + tile_size, ny)
+            if(verbose):
+                print 'Making raster rows ', i0, ' to ', i1, ' of ', ny
+            for j0 in range(0, nx, tile_size):
+                j1 = min(j0 + tile_size, nx)
+
+                myInterpFun, cut_points = make_interp_fun(desiredX[j0:j1],
+                                                          desiredY[i0:i1])
+
+                for (values, output_name), ds in zip(outputs, datasets):
+                    gridq = myInterpFun(values)
+                    if (len(cut_points)>0):
+                        gridq[cut_points] = numpy.nan
+
+                    gridq.shape = (i1-i0, j1-j0)
+                    # Rows of the raster go from north to south
+                    ds.GetRasterBand(1).WriteArray(scipy.flipud(gridq),
+                                                   j0, ny - i1)
+
+        # Close the files
+        for ds in datasets:
+            ds.FlushCache()
+        ds = None
+        datasets = None
 
     return
 
@@ -260,7 +260,7 @@ def composite_quantity_setting_function(poly_fun_pairs,
     """
     import os
     import numpy
-    from anuga.geometry.polygon import inside_polygon
+    from anuga.geometry.polygon import inside_polygon, inside_polygons
 
 
     # Check that clip_range has the right form
@@ -274,6 +274,70 @@ def composite_quantity_setting_function(poly_fun_pairs,
             if clip_range[i][0] > clip_range[i][1]:
                 raise Exception('clip_range minima must be less than maxima')
 
+    # Polygons of the poly_fun_pairs (read from files when first needed),
+    # and the points of the last call to F with the indices of them inside
+    # each polygon, so that calling F again for the same points does not
+    # classify them again
+    classification = {'polygons': None,
+                      'points': None,
+                      'inside_indices': None}
+
+    def get_polygon(pi, fi):
+        """Return polygon data of pi, which is not None or 'All'
+        """
+        if(pi == 'Extent'):
+            # Here fi MUST be a gdal-compatible raster
+            if(not (type(fi) == str)):
+                msg = ' pi = "Extent" can only be used when fi is a' +\
+                      ' raster file name'
+                raise Exception(msg)
+
+            if(not os.path.exists(fi)):
+                msg = 'fi ' + str(fi) + ' is supposed to be a ' +\
+                      ' raster filename, but it could not be found'
+                raise Exception(msg)
+
+            # Then we get the extent from the raster itself
+            pi_path = su.getRasterExtent(fi,asPolygon=True)
+
+            if verbose:
+                print 'Extracting extent from raster: ', fi
+                print 'Extent: ', pi_path
+
+        elif( (type(pi) == str) and os.path.isfile(pi) ): 
+            # pi is a file
+            pi_path = su.read_polygon(pi)
+
+        else:
+            # pi is the actual polygon data
+            pi_path = pi
+
+        return pi_path
+
+    def get_inside_indices(xy_array_trans):
+        """Return list of indices of points in xy_array_trans inside
+           each polygon pi (None for pi = None or 'All')
+        """
+        if classification['polygons'] is None:
+            classification['polygons'] = \
+                [get_polygon(pi, fi) if not (pi is None or pi == 'All')
+                 else None for pi, fi in poly_fun_pairs]
+
+        if (classification['points'] is None or 
+            not numpy.array_equal(xy_array_trans, classification['points'])):
+            polygons = classification['polygons']
+            ids = [i for i in range(len(polygons)) if polygons[i] is not None]
+            inside = inside_polygons(xy_array_trans,
+                                     [polygons[i] for i in ids])
+
+            inside_indices = [None]*len(polygons)
+            for i, indices in zip(ids, inside):
+                inside_indices[i] = indices
+
+            classification['points'] = xy_array_trans
+            classification['inside_indices'] = inside_indices
+
+        return classification['inside_indices']
 
     def F(x,y):
         """This is the function returned by composite_quantity_setting_function
@@ -305,6 +369,9 @@ def composite_quantity_setting_function(poly_fun_pairs,
                 if(not all(remaining_poly_fun_pairs_are_None)):
                     raise Exception('Can only have the last polygon = All')
 
+        # Indices of points inside each polygon pi
+        inside_indices = get_inside_indices(xy_array_trans)
+
         # Main Loop
         # Apply the fi inside the pi
         for i in range(lpf):
@@ -325,38 +392,9 @@ def composite_quantity_setting_function(poly_fun_pairs,
                 fInds = (fInside==1).nonzero()[0]
 
             else:
-
-                if(pi == 'Extent'):
-                    # Here fi MUST be a gdal-compatible raster
-                    if(not (type(fi) == str)):
-                        msg = ' pi = "Extent" can only be used when fi is a' +\
-                              ' raster file name'
-                        raise Exception(msg)
-
-                    if(not os.path.exists(fi)):
-                        msg = 'fi ' + str(fi) + ' is supposed to be a ' +\
-                              ' raster filename, but it could not be found'
-                        raise Exception(msg)
-
-                    # Then we get the extent from the raster itself
-                    pi_path = su.getRasterExtent(fi,asPolygon=True)
-
-                    if verbose:
-                        print 'Extracting extent from raster: ', fi
-                        print 'Extent: ', pi_path
-
-                elif( (type(pi) == str) and os.path.isfile(pi) ): 
-                    # pi is a file
-                    pi_path = su.read_polygon(pi)
-
-                else:
-                    # pi is the actual polygon data
-                    pi_path = pi
-
-                # Get the insides of unset points inside pi_path
-                notSet = (isSet==0.).nonzero()[0]
-                fInds = inside_polygon(xy_array_trans[notSet,:], pi_path)
-                fInds = notSet[fInds]
+                # Get the indices of unset points inside pi
+                fInds = inside_indices[i]
+                fInds = fInds[isSet[fInds]==0.]
 
             if len(fInds) == 0:
                 # No points found, move on
@@ -591,8 +629,31 @@ def quantityRasterFun(domain, rasterFile, interpolation='pixel'):
    
     OUTPUT: Function which takes x,y in ANUGA coordinates, and outputs their
             corresponding raster values 
+
+    Rasters in .asc, .dem or .flt files are sampled without GDAL, reading
+    only windows covering the points (see
+    anuga.fit_interpolate.raster_sampling). Points outside such rasters
+    get the value nan.
     """
     import scipy
+
+    if os.path.splitext(rasterFile)[1] in ['.asc', '.dem', '.flt']:
+        from anuga.fit_interpolate.raster_sampling import sample_raster
+
+        modes = {'pixel': 'constant', 'bilinear': 'linear'}
+        msg = 'Unknown interpolation %s' % interpolation
+        assert interpolation in modes, msg
+
+        def QFun(x,y):
+            xll=domain.geo_reference.xllcorner
+            yll=domain.geo_reference.yllcorner
+            inDat=scipy.vstack([x+xll,y+yll]).transpose()
+            return sample_raster(rasterFile, inDat,
+                                 mode=modes[interpolation],
+                                 pixel_is_area=True)
+
+        return QFun
+
     from anuga.utilities.spatialInputUtil import rasterValuesAtPoints
     def QFun(x,y):
         xll=domain.geo_reference.xllcorner
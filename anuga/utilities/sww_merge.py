@@ -19,9 +19,40 @@ def sww_merge(domain_global_name, np, verbose=False):
     _sww_merge(swwfiles, output, verbose)
 
 
-def sww_merge_parallel(domain_global_name, np, verbose=False, delete_old=False):
+def sww_merge_parallel(domain_global_name, np, verbose=False, delete_old=False,
+                       steps_per_block=None, number_of_processes=1):
+    """Merge the sww files <domain_global_name>_P<np>_<rank>.sww of a
+    parallel run into <domain_global_name>.sww
+
+    Dynamic quantities are merged steps_per_block timesteps at a time
+    (by default as many as fit in DEFAULT_VALUES_PER_BLOCK values), so
+    a quantity is never held in memory for all timesteps at once. With
+    number_of_processes > 1 the blocks are assembled by a pool of
+    processes.
+
+    If the run was restarted from a checkpoint of a run on a different
+    number of processors (see anuga.shallow_water.checkpoint), the sww
+    files record that number and the results of the earlier run are
+    merged too and put before those of the restarted run.
+    """
 
     output = domain_global_name+".sww"
+
+    _sww_merge_parallel_run(domain_global_name, np, output, verbose,
+                            delete_old, steps_per_block, number_of_processes)
+
+
+def _sww_merge_parallel_run(domain_global_name, np, output, verbose=False,
+                            delete_old=False, steps_per_block=None,
+                            number_of_processes=1):
+    """Merge the sww files of a parallel run on np processors, and of the
+    runs it was restarted from, into output. See sww_merge_parallel.
+    """
+
+    import os
+    import shutil
+    import tempfile
+
     swwfiles = [ domain_global_name+"_P"+str(np)+"_"+str(v)+".sww" for v in range(np)]
 
     fid = NetCDFFile(swwfiles[0], netcdf_mode_r)
@@ -33,13 +64,110 @@ def sww_merge_parallel(domain_global_name, np, verbose=False, delete_old=False):
         number_of_volumes = int(fid.dimensions['number_of_volumes'])
         number_of_points = int(fid.dimensions['number_of_points'])
 
+    restart_numprocs = int(getattr(fid, 'restart_numprocs', 0))
+
     fid.close()
 
-    if 3*number_of_volumes == number_of_points:
-        _sww_merge_parallel_non_smooth(swwfiles, output, verbose, delete_old)
+    if restart_numprocs == 0:
+        merged = output
     else:
-        _sww_merge_parallel_smooth(swwfiles, output, verbose, delete_old)
-        
+        # Merge this run into a temporary file first
+        fd, merged = tempfile.mkstemp(suffix='.sww',
+                                      dir=os.path.dirname(os.path.abspath(output)))
+        os.close(fd)
+
+    try:
+        if 3*number_of_volumes == number_of_points:
+            _sww_merge_parallel_non_smooth(swwfiles, merged, verbose, delete_old,
+                                           steps_per_block, number_of_processes)
+        else:
+            _sww_merge_parallel_smooth(swwfiles, merged, verbose, delete_old,
+                                       steps_per_block, number_of_processes)
+
+        if restart_numprocs == 0:
+            return
+
+        # Results of the run restarted from, which are in the sequential
+        # sww file if it ran on one processor
+        fd, previous = tempfile.mkstemp(suffix='.sww',
+                                        dir=os.path.dirname(os.path.abspath(output)))
+        os.close(fd)
+        try:
+            if restart_numprocs == 1:
+                shutil.copyfile(domain_global_name+".sww", previous)
+            else:
+                _sww_merge_parallel_run(domain_global_name, restart_numprocs,
+                                        previous, verbose, delete_old,
+                                        steps_per_block, number_of_processes)
+
+            _sww_concatenate(previous, merged, output, verbose)
+        finally:
+            os.remove(previous)
+    finally:
+        if merged != output and os.path.exists(merged):
+            os.remove(merged)
+
+
+def _sww_concatenate(first, second, output, verbose=False):
+    """Write the merged sww file first followed by the timesteps of the
+    merged sww file second of the same mesh to output.
+
+    Timesteps of first at or after the first time of second (e.g. stored
+    after the checkpoint a run was restarted from) are dropped.
+    """
+
+    if verbose:
+        print 'Concatenating files ', first, ' and ', second, ':'
+
+    fid1 = NetCDFFile(first, netcdf_mode_r)
+    fid2 = NetCDFFile(second, netcdf_mode_r)
+    fido = NetCDFFile(output, netcdf_mode_w)
+
+    try:
+        starttime = float(fid1.starttime)
+        times1 = num.array(fid1.variables['time'][:], num.float)
+        times2 = num.array(fid2.variables['time'][:], num.float) + \
+                 float(fid2.starttime) - starttime
+
+        if len(times2) > 0:
+            n1 = int(num.sum(times1 < times2[0]))
+        else:
+            n1 = len(times1)
+
+        for name in fid1.ncattrs():
+            fido.setncattr(name, fid1.getncattr(name))
+        if hasattr(fid1, 'description'):
+            fido.description = 'concatenated:' + fid1.description
+
+        for name, dimension in fid1.dimensions.items():
+            if name == 'number_of_timesteps':
+                fido.createDimension(name, None)
+            else:
+                fido.createDimension(name, len(dimension))
+
+        for name, variable in fid1.variables.items():
+            out = fido.createVariable(name, variable.dtype,
+                                      variable.dimensions)
+            for attribute in variable.ncattrs():
+                out.setncattr(attribute, variable.getncattr(attribute))
+
+            if name == 'time':
+                out[:] = num.concatenate((times1[:n1], times2))
+            elif variable.dimensions[:1] == ('number_of_timesteps',):
+                out[:n1] = variable[:n1]
+                for i in range(len(times2)):
+                    out[n1+i] = fid2.variables[name][i]
+            elif name.endswith('_range') and name in fid2.variables:
+                range1 = variable[:]
+                range2 = fid2.variables[name][:]
+                out[:] = [min(range1[0], range2[0]), max(range1[1], range2[1])]
+            else:
+                out[:] = variable[:]
+    finally:
+        fido.close()
+        fid2.close()
+        fid1.close()
+
 
 def _sww_merge(swwfiles, output, verbose=False):
     """
@@ -198,7 +326,165 @@ def _sww_merge(swwfiles, output, verbose=False):
     fido.close()
 
 
-def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=False):
+# Default maximal number of values (timesteps x points) of a dynamic
+# quantity assembled at a time by sww_merge_parallel
+DEFAULT_VALUES_PER_BLOCK = 10000000
+
+# Index arrays of the files being merged, cached by _merge_block
+_merge_indices = {}
+
+
+def _get_merge_indices(fid, smooth):
+    """Get the indices mapping the values of the full (non ghost)
+    triangles of an sww file from a parallel run to the merged file.
+
+    Return (l_vertex_ids, g_vertex_ids, l_tri_ids, g_tri_ids) such that
+    vertex values are merged as merged[g_vertex_ids] = local[l_vertex_ids]
+    and centroid values as merged[g_tri_ids] = local[l_tri_ids]
+    """
+
+    tri_l2g  = fid.variables['tri_l2g'][:]
+    tri_full_flag = fid.variables['tri_full_flag'][:]
+
+    l_tri_ids = num.argwhere(tri_full_flag==1).reshape(-1,)
+    g_tri_ids = tri_l2g[l_tri_ids]
+
+    if smooth:
+        # Nodes of the full triangles
+        node_l2g = fid.variables['node_l2g'][:]
+        volumes = num.array(fid.variables['volumes'][:],dtype=num.int)
+        l_vertex_ids = num.unique(volumes[l_tri_ids])
+        g_vertex_ids = node_l2g[l_vertex_ids]
+    else:
+        # Vertices are stored uniquely, three per triangle
+        l_vertex_ids = (3*l_tri_ids.reshape(-1,1) + num.array([0,1,2])).reshape(-1,)
+        g_vertex_ids = (3*g_tri_ids.reshape(-1,1) + num.array([0,1,2])).reshape(-1,)
+
+    return l_vertex_ids, g_vertex_ids, l_tri_ids, g_tri_ids
+
+
+def _merge_block(args):
+    """Assemble timesteps start:end of a dynamic quantity from all files
+
+    args is the tuple (swwfiles, quantity, centroid, smooth, start, end, size)
+    where centroid is True for centroid quantities and size is the number
+    of values per timestep in the merged file.
+
+    Return (end-start) x size array
+    """
+
+    swwfiles, quantity, centroid, smooth, start, end, size = args
+
+    q_values = num.zeros((end-start, size), num.float32)
+
+    for filename in swwfiles:
+        fid = NetCDFFile(filename, netcdf_mode_r)
+
+        if filename not in _merge_indices:
+            _merge_indices[filename] = _get_merge_indices(fid, smooth)
+        l_vertex_ids, g_vertex_ids, l_tri_ids, g_tri_ids = \
+                      _merge_indices[filename]
+
+        q = num.array(fid.variables[quantity][start:end], dtype=num.float32)
+        if centroid:
+            q_values[:, g_tri_ids] = q[:, l_tri_ids]
+        else:
+            q_values[:, g_vertex_ids] = q[:, l_vertex_ids]
+
+        fid.close()
+
+    return q_values
+
+
+def _write_dynamic_quantities(fido, swwfiles, smooth,
+                              dynamic_quantities, dynamic_c_quantities,
+                              n_steps, number_of_points, number_of_triangles,
+                              steps_per_block=None, number_of_processes=1,
+                              verbose=False):
+    """Merge the dynamic quantities of swwfiles into the open file fido
+    whose header, triangulation and times have already been written.
+
+    Quantities are assembled and written steps_per_block timesteps at a
+    time, so memory use is bounded by a few blocks whatever the number of
+    timesteps. If steps_per_block is None a block holds at most
+    DEFAULT_VALUES_PER_BLOCK values.
+
+    If number_of_processes > 1 the blocks of all quantities are assembled
+    by a pool of processes while this process writes them out in order
+    (netcdf files can not be written concurrently).
+    """
+
+    import itertools
+
+    if steps_per_block is None:
+        steps_per_block = max(1, DEFAULT_VALUES_PER_BLOCK/max(1, number_of_points))
+
+    msg = 'steps_per_block must be positive. I got %s' % steps_per_block
+    assert steps_per_block > 0, msg
+
+    _merge_indices.clear()
+
+    tasks = []
+    for q in dynamic_quantities + dynamic_c_quantities:
+        centroid = q in dynamic_c_quantities
+        if centroid:
+            size = number_of_triangles
+        else:
+            size = number_of_points
+
+        for start in range(0, n_steps, steps_per_block):
+            end = min(start + steps_per_block, n_steps)
+            tasks.append((swwfiles, q, centroid, smooth, start, end, size))
+
+    pool = None
+    q_ranges = {}
+    try:
+        if number_of_processes > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(number_of_processes)
+            blocks = pool.imap(_merge_block, tasks)
+        else:
+            blocks = itertools.imap(_merge_block, tasks)
+
+        for task, q_values in itertools.izip(tasks, blocks):
+            q, centroid, start, end = task[1], task[2], task[4], task[5]
+
+            if verbose and start == 0:
+                print '  Writing quantity: ',q
+
+            fido.variables[q][start:end] = q_values
+
+            if not centroid:
+                q_min = num.min(q_values)
+                q_max = num.max(q_values)
+                if q in q_ranges:
+                    q_min = min(q_min, q_ranges[q][0])
+                    q_max = max(q_max, q_ranges[q][1])
+                q_ranges[q] = (q_min, q_max)
+
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        _merge_indices.clear()
+
+    # This updates the _range values
+    for q in q_ranges:
+        q_values_min, q_values_max = q_ranges[q]
+        q_range = fido.variables[q + Write_sww.RANGE][:]
+        if q_values_min < q_range[0]:
+            fido.variables[q + Write_sww.RANGE][0] = q_values_min
+        if q_values_max > q_range[1]:
+            fido.variables[q + Write_sww.RANGE][1] = q_values_max
+
+
+def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=False,
+                               steps_per_block=None, number_of_processes=1):
     """
         Merge a list of sww files into a single file.
         
@@ -215,6 +501,7 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
         swwfiles is a list of .sww files to merge.
         output is the output filename, including .sww extension.
         verbose True to log output information
+        steps_per_block and number_of_processes: see _write_dynamic_quantities
     """
 
     if verbose:
@@ -238,10 +525,8 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
             starttime = int(fid.starttime)
             
             out_s_quantities = {}
-            out_d_quantities = {}
 
             out_s_c_quantities = {}
-            out_d_c_quantities = {}
 
 
             xllcorner = fid.xllcorner
@@ -287,11 +572,6 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
             for quantity in static_quantities:
                 out_s_quantities[quantity] = num.zeros((number_of_global_nodes,),num.float32)
 
-            # Quantities are stored as a 2D array of timesteps x data.
-            for quantity in dynamic_quantities:
-                out_d_quantities[quantity] = \
-                      num.zeros((n_steps,number_of_global_nodes),num.float32)
-
             #=======================================
             # Deal with the centroid based variables
             #=======================================
@@ -314,11 +594,6 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
             for quantity in static_c_quantities:
                 out_s_c_quantities[quantity] = num.zeros((number_of_global_triangles,),num.float32)
 
-            # Quantities are stored as a 2D array of timesteps x data.
-            for quantity in dynamic_c_quantities:
-                out_d_c_quantities[quantity] = \
-                      num.zeros((n_steps,number_of_global_triangles),num.float32)
-                 
             description = 'merged:' + getattr(fid, 'description')          
             first_file = False
 
@@ -413,17 +688,6 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
                          num.array(q[:],dtype=num.float32)[fl_nodes]
 
         
-        #Collate all dynamic quantities according to their timestep
-        for quantity in dynamic_quantities:
-            q = fid.variables[quantity]
-            #print q.shape
-            for i in range(n_steps):
-                #out_d_quantities[quantity][i][node_l2g] = \
-                #           num.array(q[i],dtype=num.float32)
-                out_d_quantities[quantity][i][f_node_l2g] = \
-                           num.array(q[i],dtype=num.float32)[fl_nodes]
-
-
         # Read in static c quantities
         for quantity in static_c_quantities:
             #out_s_quantities[quantity][node_l2g] = \
@@ -433,15 +697,6 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
                          num.array(q).astype(num.float32)[ftri_ids]
 
         
-        #Collate all dynamic c quantities according to their timestep
-        for quantity in dynamic_c_quantities:
-            q = fid.variables[quantity]
-            #print q.shape
-            for i in range(n_steps):
-                out_d_c_quantities[quantity][i][ftri_l2g] = \
-                           num.array(q[i]).astype(num.float32)[ftri_ids]
-
-
         fid.close()
 
 
@@ -490,30 +745,11 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
         fido.variables['time'][i] = times[i]
 
         
-    for q in dynamic_quantities:
-        q_values = out_d_quantities[q]
-        if verbose:
-            print '  Writing quantity: ',q
-            
-        for i in range(n_steps):
-            fido.variables[q][i] = q_values[i]
-        
-        # This updates the _range values
-        q_range = fido.variables[q + Write_sww.RANGE][:]
-        q_values_min = num.min(q_values)
-        if q_values_min < q_range[0]:
-            fido.variables[q + Write_sww.RANGE][0] = q_values_min
-        q_values_max = num.max(q_values)
-        if q_values_max > q_range[1]:
-            fido.variables[q + Write_sww.RANGE][1] = q_values_max        
-
-    for q in dynamic_c_quantities:
-        if verbose:
-            print '  Writing quantity: ',q
-            
-        q_values = out_d_c_quantities[q]
-        for i in range(n_steps):
-            fido.variables[q][i] = q_values[i]
+    _write_dynamic_quantities(fido, swwfiles, True,
+                              dynamic_quantities, dynamic_c_quantities,
+                              n_steps, number_of_global_nodes,
+                              number_of_global_triangles,
+                              steps_per_block, number_of_processes, verbose)
 
                                         
     #print out_s_quantities
@@ -535,7 +771,8 @@ def _sww_merge_parallel_smooth(swwfiles, output,  verbose=False, delete_old=Fals
             os.remove(filename)
 
 
-def _sww_merge_parallel_non_smooth(swwfiles, output,  verbose=False, delete_old=False):
+def _sww_merge_parallel_non_smooth(swwfiles, output,  verbose=False, delete_old=False,
+                                   steps_per_block=None, number_of_processes=1):
     """
         Merge a list of sww files into a single file.
 
@@ -552,6 +789,7 @@ def _sww_merge_parallel_non_smooth(swwfiles, output,  verbose=False, delete_old=
         swwfiles is a list of .sww files to merge.
         output is the output filename, including .sww extension.
         verbose True to log output information
+        steps_per_block and number_of_processes: see _write_dynamic_quantities
     """
 
     if verbose:
@@ -575,10 +813,8 @@ def _sww_merge_parallel_non_smooth(swwfiles, output,  verbose=False, delete_old=
             starttime = int(fid.starttime)
 
             out_s_quantities = {}
-            out_d_quantities = {}
 
             out_s_c_quantities = {}
-            out_d_c_quantities = {}
 
 
             xllcorner = fid.xllcorner
@@ -736,54 +972,11 @@ def _sww_merge_parallel_non_smooth(swwfiles, output,  verbose=False, delete_old=
     for i in range(n_steps):
         fido.variables['time'][i] = times[i]
 
-    for q in (dynamic_quantities + dynamic_c_quantities):
-
-        if verbose:
-            print '  Writing quantity: ',q
-                    
-        # Initialise q_values with zeros
-        if q in dynamic_quantities:
-            q_values = num.zeros((n_steps, 3*number_of_global_triangles), num.float32)
-        elif q in dynamic_c_quantities:
-            q_values = num.zeros((n_steps, number_of_global_triangles), num.float32)
-
-
-        # Read the quantities one at a time, to reduce memory usage
-        for filename in swwfiles:
-            fid = NetCDFFile(filename, netcdf_mode_r)
-
-            # Index information
-            tri_l2g  = fid.variables['tri_l2g'][:]
-            node_l2g = fid.variables['node_l2g'][:]
-            tri_full_flag = fid.variables['tri_full_flag'][:]
-            f_ids = num.argwhere(tri_full_flag==1).reshape(-1,)
-            f_gids = tri_l2g[f_ids]
-            g_vids = (3*f_gids.reshape(-1,1) + num.array([0,1,2])).reshape(-1,)
-            l_vids = (3*f_ids.reshape(-1,1) + num.array([0,1,2])).reshape(-1,)
-            for i in range(n_steps):
-                # Different indices for vertex and centroid quantities
-                if q in dynamic_quantities:
-                    q_values[i][g_vids] = \
-                    num.array(fid.variables[q][i], dtype=num.float32)[l_vids]
-                elif q in dynamic_c_quantities:
-                    q_values[i][f_gids] = \
-                    num.array(fid.variables[q][i], dtype=num.float32)[f_ids]
-
-            fid.close()
-
-        # Write to the file
-        for i in range(n_steps):
-            fido.variables[q][i] = q_values[i]
-
-        if q in dynamic_quantities:
-            # This updates the _range values
-            q_range = fido.variables[q + Write_sww.RANGE][:]
-            q_values_min = num.min(q_values)
-            if q_values_min < q_range[0]:
-                fido.variables[q + Write_sww.RANGE][0] = q_values_min
-            q_values_max = num.max(q_values)
-            if q_values_max > q_range[1]:
-                fido.variables[q + Write_sww.RANGE][1] = q_values_max
+    _write_dynamic_quantities(fido, swwfiles, False,
+                              dynamic_quantities, dynamic_c_quantities,
+                              n_steps, 3*number_of_global_triangles,
+                              number_of_global_triangles,
+                              steps_per_block, number_of_processes, verbose)
 
     fido.close()
 
@@ -815,6 +1008,10 @@ if __name__ == "__main__":
                    help='verbosity')
     parser.add_argument('-delete_old', nargs='?', type=bool, const=True, default=False,
                    help='Flag to delete the input files')
+    parser.add_argument('-steps_per_block', type=int, default=None,
+                   help='number of timesteps merged at a time')
+    parser.add_argument('-processes', type=int, default=1,
+                   help='number of processes used to merge')
     args = parser.parse_args()
 
     np = args.np
@@ -824,7 +1021,9 @@ if __name__ == "__main__":
 
 
     try:
-        sww_merge_parallel(domain_global_name, np, verbose, delete_old)
+        sww_merge_parallel(domain_global_name, np, verbose, delete_old,
+                           steps_per_block=args.steps_per_block,
+                           number_of_processes=args.processes)
     except:
         msg = 'ERROR: When merging sww files %s '% domain_global_name
         print msg
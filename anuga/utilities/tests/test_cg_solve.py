@@ -559,6 +559,186 @@ class Test_CG_Solve(unittest.TestCase):
 
         assert num.allclose(x,xe)
 
+    def test_block_solve_large_2d_csr_matrix(self):
+        """Standard 2d laplacian with several right hand sides solved
+        together, with and without Jacobi preconditioner
+        """
+
+        n = 30
+        m = 20
+
+        A = Sparse(m*n, m*n)
+
+        for i in num.arange(0,n):
+            for j in num.arange(0,m):
+                I = j+m*i
+                A[I,I] = 4.0 + j
+                if i > 0  :
+                    A[I,I-m] = -1.0
+                if i < n-1 :
+                    A[I,I+m] = -1.0
+                if j > 0  :
+                    A[I,I-1] = -1.0
+                if j < m-1 :
+                    A[I,I+1] = -1.0
+
+        A = Sparse_CSR(A)
+
+        xe = num.zeros((n*m, 3), num.float)
+        xe[:,0] = 1.0
+        xe[:,1] = num.arange(n*m)
+        xe[:,2] = num.sin(num.arange(n*m))
+        b = A*xe
+
+        x, stats = block_conjugate_gradient(A, b, tol=1.0e-12,
+                                            output_stats=True)
+        assert num.allclose(x, xe)
+        assert len(stats.iter) == 3
+
+        assert num.allclose(jacobi_preconditioner(A), A.todense().diagonal())
+        M = get_preconditioner(A, 'Jacobi')
+
+        x, stats_precon = block_conjugate_gradient(A, b, tol=1.0e-12,
+                                                   precon='Jacobi',
+                                                   output_stats=True)
+        assert num.allclose(x, xe)
+        assert num.all(stats_precon.iter <= stats.iter)
+
+        # Warm start from the solution needs no iterations
+        x, stats = block_conjugate_gradient(A, b, xe, precon=M,
+                                            output_stats=True)
+        assert num.allclose(x, xe)
+        assert num.all(stats.iter == 1)
+
+        # Vector right hand side
+        x = block_conjugate_gradient(A, b[:,1], precon=M, tol=1.0e-12)
+        assert x.shape == (n*m,)
+        assert num.allclose(x, xe[:,1])
+
+        # Zero right hand side
+        x = block_conjugate_gradient(A, 0*b)
+        assert num.allclose(x, 0.0)
+
+    def _laplacian(self, n, m, scale=None):
+        """Standard 2d laplacian in csr format, with rows and columns
+        scaled by the vector scale if given
+        """
+
+        A = Sparse(m*n, m*n)
+
+        if scale is None:
+            scale = num.ones(m*n)
+
+        for i in num.arange(0,n):
+            for j in num.arange(0,m):
+                I = j+m*i
+                A[I,I] = 4.0*scale[I]*scale[I]
+                if i > 0  :
+                    A[I,I-m] = -1.0*scale[I]*scale[I-m]
+                if i < n-1 :
+                    A[I,I+m] = -1.0*scale[I]*scale[I+m]
+                if j > 0  :
+                    A[I,I-1] = -1.0*scale[I]*scale[I-1]
+                if j < m-1 :
+                    A[I,I+1] = -1.0*scale[I]*scale[I+1]
+
+        return Sparse_CSR(A)
+
+    def test_solve_with_icc_and_amg(self):
+        """Badly scaled 2d laplacian solved with each preconditioner
+        """
+
+        n = 40
+        m = 30
+
+        scale = 1.0 + 10*num.arange(n*m)/float(n*m)
+        A = self._laplacian(n, m, scale)
+
+        xe = num.sin(num.arange(n*m))
+        b = A*xe
+
+        iterations = {}
+        for precon in ['None', 'Jacobi', 'ICC', 'AMG']:
+            x0 = num.zeros(n*m)
+            x, stats = conjugate_gradient(A, b, x0, tol=1.0e-10,
+                                          precon=precon, output_stats=True)
+
+            assert num.allclose(x, xe)
+            assert stats.iter == len(stats.rTr_history)
+            assert stats.rTr_history[-1] == stats.rTr
+            assert stats.setup_time >= 0.0
+            assert stats.solve_time > 0.0
+            iterations[precon] = stats.iter
+
+        assert iterations['ICC'] < iterations['Jacobi']
+        assert iterations['AMG'] < iterations['Jacobi']
+        assert iterations['Jacobi'] < iterations['None']
+
+        # Preconditioner built once and reused, also by the c solver
+        # (Jacobi) and for several right hand sides
+        for precon in ['Jacobi', 'ICC', 'AMG']:
+            M = get_preconditioner(A, precon)
+            assert M.name == precon
+            B = num.zeros((n*m, 2))
+            B[:,0] = b
+            B[:,1] = 2*b
+            x = conjugate_gradient(A, B, num.zeros((n*m, 2)), tol=1.0e-10,
+                                   precon=M, use_c_cg=True)
+            assert num.allclose(x[:,0], xe)
+            assert num.allclose(x[:,1], 2*xe)
+
+            x = block_conjugate_gradient(A, B, tol=1.0e-10, precon=M)
+            assert num.allclose(x[:,1], 2*xe)
+
+        M = get_preconditioner(A, 'AMG')
+        assert M.get_number_of_levels() > 1
+
+    def test_icc_negative_definite(self):
+        """Incomplete Cholesky of minus the laplacian
+        """
+
+        A = self._laplacian(10, 10)
+        A.data = -A.data
+
+        xe = num.arange(100.0)
+        b = A*xe
+
+        x = conjugate_gradient(A, b, tol=1.0e-10, precon='ICC')
+        assert num.allclose(x, xe)
+
+    def test_icc_exact_for_tridiagonal(self):
+        """IC(0) of a tridiagonal matrix has no fill in, so it is exact
+        """
+
+        A = [[2.0, -1.0, 0.0, 0.0 ],
+             [-1.0, 2.0, -1.0, 0.0],
+             [0.0, -1.0, 2.0, -1.0],
+             [0.0,0.0, -1.0, 2.0]]
+
+        A = Sparse_CSR(Sparse(A))
+
+        M = get_preconditioner(A, 'ICC')
+        assert M.shift == 0.0
+
+        xe = num.array([0.0, 1.0, 2.0, 3.0])
+        assert num.allclose(M(A*xe), xe)
+
+        x, stats = conjugate_gradient(A, A*xe, precon=M, output_stats=True)
+        assert num.allclose(x, xe)
+        assert stats.iter <= 2
+
+    def test_unknown_preconditioner(self):
+
+        A = self._laplacian(3, 3)
+
+        try:
+            conjugate_gradient(A, num.ones(9), precon='SSOR')
+        except PreconditionerError:
+            pass
+        else:
+            msg = 'Should have raised exception'
+            raise TestError, msg
+
 ################################################################################
 
 if __name__ == "__main__":
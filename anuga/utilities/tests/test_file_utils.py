@@ -4,11 +4,19 @@ import os
 import shutil
 import sys
 
+import numpy as num
+
 from anuga.utilities.file_utils import copy_code_files, get_all_swwfiles
 from anuga.utilities.file_utils import del_dir
 from anuga.utilities.sww_merge import sww_merge, _sww_merge
 
 
+def failing_merge_block(args):
+    """Replacement of sww_merge._merge_block failing for every block
+    """
+    raise ValueError('Block failed')
+
+
 class Test_FileUtils(unittest.TestCase):
                 
     def test_copy_code_files(self):
@@ -148,6 +156,119 @@ class Test_FileUtils(unittest.TestCase):
 			os.remove(outfile)      
         
         
+    def _create_parallel_swwfiles(self, name, numprocs, smooth=True):
+        """Create the sww files <name>_P<numprocs>_<p>.sww of a parallel
+        run without MPI by evolving each subdomain on its own.
+        """
+        from anuga.abstract_2d_finite_volumes.mesh_factory import rectangular_cross
+        from anuga.shallow_water.shallow_water_domain import Domain
+        from anuga.abstract_2d_finite_volumes.generic_boundary_conditions import \
+            Dirichlet_boundary
+        from anuga.parallel.sequential_distribute import Sequential_distribute
+
+        domain = Domain(*rectangular_cross(6, 4, len1=6.0, len2=4.0))
+        domain.set_name(name)
+        domain.set_quantity('elevation', lambda x, y: -x/3.0)
+        domain.set_quantity('stage', expression='elevation + 0.5')
+        domain.set_boundary({'left': None, 'right': None,
+                             'top': None, 'bottom': None})
+
+        partition = Sequential_distribute(domain)
+        partition.distribute(numprocs)
+
+        for p in range(numprocs):
+            kwargs, points, vertices, boundary, quantities, boundary_map = \
+                    partition.extract_submesh(p)[:6]
+
+            tri_l2g = kwargs.pop('tri_l2g')
+            node_l2g = kwargs.pop('node_l2g')
+            number_of_global_triangles = kwargs.pop('number_of_global_triangles')
+            number_of_global_nodes = kwargs.pop('number_of_global_nodes')
+            for key in ['s2p_map', 'p2s_map']:
+                kwargs.pop(key)
+
+            subdomain = Domain(points, vertices, boundary, **kwargs)
+            subdomain.parallel = True
+            subdomain.tri_l2g = tri_l2g
+            subdomain.node_l2g = node_l2g
+            subdomain.number_of_global_triangles = number_of_global_triangles
+            subdomain.number_of_global_nodes = number_of_global_nodes
+
+            subdomain.set_name('%s_P%d_%d' % (name, numprocs, p))
+            if not smooth:
+                subdomain.set_store_vertices_uniquely()
+            for q in quantities:
+                subdomain.set_quantity(q, quantities[q])
+
+            Bd = Dirichlet_boundary([0.2, 0., 0.])
+            subdomain.set_boundary({'left': Bd, 'right': Bd, 'top': Bd,
+                                    'bottom': Bd, 'ghost': None})
+            for t in subdomain.evolve(yieldstep=0.1, finaltime=0.5):
+                pass
+
+    def test_sww_merge_parallel_blocks(self):
+        from anuga.file.netcdf import NetCDFFile
+        from anuga.utilities.sww_merge import sww_merge_parallel
+
+        name = 'merge_blocks'
+        numprocs = 3
+
+        for smooth in [True, False]:
+            self._create_parallel_swwfiles(name, numprocs, smooth=smooth)
+
+            # All timesteps at once
+            sww_merge_parallel(name, numprocs)
+            fid = NetCDFFile(name + '.sww')
+            reference = {}
+            for q in fid.variables:
+                reference[q] = fid.variables[q][:]
+            fid.close()
+
+            # Per rank values of the full triangles end up in the merged file
+            for p in range(numprocs):
+                fid = NetCDFFile('%s_P%d_%d.sww' % (name, numprocs, p))
+                tri_full_flag = fid.variables['tri_full_flag'][:]
+                f_ids = num.argwhere(tri_full_flag==1).reshape(-1,)
+                f_gids = fid.variables['tri_l2g'][:][f_ids]
+                assert len(fid.variables['time'][:]) > 2
+                assert num.allclose(reference['stage_c'][:, f_gids],
+                                    fid.variables['stage_c'][:][:, f_ids])
+                fid.close()
+
+            # One timestep at a time and with a pool of processes
+            for steps_per_block, processes in [(1, 1), (2, 2)]:
+                sww_merge_parallel(name, numprocs,
+                                   steps_per_block=steps_per_block,
+                                   number_of_processes=processes)
+
+                fid = NetCDFFile(name + '.sww')
+                for q in reference:
+                    assert num.allclose(fid.variables[q][:], reference[q]), q
+                fid.close()
+
+            # A failing block stops the worker processes
+            import multiprocessing
+            sww_merge_module = sys.modules['anuga.utilities.sww_merge']
+            merge_block = sww_merge_module._merge_block
+            sww_merge_module._merge_block = failing_merge_block
+            try:
+                try:
+                    sww_merge_parallel(name, numprocs, steps_per_block=1,
+                                       number_of_processes=2)
+                except ValueError:
+                    pass
+                else:
+                    raise Exception('Failing block should have raised an error')
+            finally:
+                sww_merge_module._merge_block = merge_block
+
+            assert multiprocessing.active_children() == []
+            assert len(sww_merge_module._merge_indices) == 0
+
+            os.remove(name + '.sww')
+            for p in range(numprocs):
+                os.remove('%s_P%d_%d.sww' % (name, numprocs, p))
+
 
 #-------------------------------------------------------------
 
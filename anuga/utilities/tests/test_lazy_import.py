@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+"""Test that the public API of anuga is imported lazily
+"""
+
+import unittest
+import sys
+import subprocess
+
+import anuga
+
+
+def get_imported_modules(statement):
+    """Return names of the anuga modules imported by statement when run
+    in a fresh interpreter
+    """
+
+    script = '%s; import sys; ' \
+             'print " ".join([m for m in sys.modules ' \
+             'if m.startswith("anuga") and sys.modules[m] is not None])' \
+             % statement
+
+    output = subprocess.check_output([sys.executable, '-c', script])
+
+    return output.split()
+
+
+class Test_lazy_import(unittest.TestCase):
+
+    def test_import_is_lazy(self):
+
+        modules = get_imported_modules('import anuga')
+
+        for name in ['anuga.shallow_water', 'anuga.parallel', 'anuga.pmesh',
+                     'anuga.file_conversion', 'anuga.structures',
+                     'anuga.operators', 'anuga.utilities.plot_utils']:
+            assert name not in modules, '%s imported by import anuga' % name
+
+        # Only what is used is imported
+        modules = get_imported_modules('import anuga; anuga.sww2csv_gauges')
+        assert 'anuga.abstract_2d_finite_volumes.util' in modules
+        assert 'anuga.parallel.parallel_api' not in modules
+        assert 'anuga.file_conversion.sww2dem' not in modules
+
+    def test_public_api(self):
+
+        from anuga.shallow_water.shallow_water_domain import Domain
+        from anuga.utilities.sww_merge import sww_merge_parallel
+        from anuga.utilities.numerical_tools import safe_acos
+        import anuga.utilities.plot_utils as plot_utils
+
+        assert anuga.Domain is Domain
+        assert anuga.sww_merge is sww_merge_parallel
+        assert anuga.acos is safe_acos
+        assert anuga.plot_utils is plot_utils
+        assert 'Domain' in dir(anuga)
+
+        # Names depending on pypar are only there if it is available
+        for name in ['sequential_distribute_dump',
+                     'sequential_distribute_load']:
+            assert (name in dir(anuga)) == anuga.pypar_available
+            assert hasattr(anuga, name) == anuga.pypar_available
+
+        from numpy.testing import Tester
+        assert anuga.Tester is Tester
+
+        # Subpackages are imported on demand too
+        assert anuga.fit_interpolate.__name__ == 'anuga.fit_interpolate'
+
+        try:
+            anuga.No_such_name
+        except AttributeError:
+            pass
+        else:
+            msg = 'Should have raised AttributeError'
+            raise Exception(msg)
+
+        # from anuga import * imports the whole api
+        names = {}
+        exec 'from anuga import *' in names
+        for name in ['Domain', 'Reflective_boundary', 'sww2dem',
+                     'create_mesh_from_regions', 'distribute',
+                     'Inlet_operator', 'get_args', 'Tester', 'test']:
+            assert name in names, name
+        assert names['Domain'] is Domain
+
+#-------------------------------------------------------------
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(Test_lazy_import, 'test')
+    runner = unittest.TextTestRunner()
+    runner.run(suite)
@@ -356,6 +356,51 @@ class Test_quantity_setting_functions(unittest.TestCase):
 
         return
 
+    def test_composite_quantity_setting_function_polygons(self):
+        """Functions are called once for all their points and the points
+           in the polygons are reused for the same points
+        """
+
+        domain=self.create_domain(1.0, 0.0)
+
+        trenchPoly = [[minX+40., minY], [minX+40., minY+100.], 
+            [minX+60., minY+100.], [minX+60., minY]]
+        leftPoly = [[minX, minY], [minX, minY+100.], 
+            [minX+50., minY+100.], [minX+50., minY]]
+
+        calls = []
+        def f0(x,y):
+            calls.append(len(x))
+            return x/10.
+
+        F = qs.composite_quantity_setting_function(
+            [[trenchPoly, f0], [leftPoly, -1.], ['All', 3.]],
+            domain,
+            verbose=False) 
+
+        testPts_X=numpy.array([50., 3., 45., 80., 55.])
+        testPts_Y=numpy.array([1., 20., 30., 10., 90.])
+        fitted = F(testPts_X,testPts_Y)
+        assert(numpy.allclose(fitted, [5., -1., 4.5, 3., 5.5]))
+        assert(calls == [3])
+
+        fitted = F(testPts_X,testPts_Y)
+        assert(numpy.allclose(fitted, [5., -1., 4.5, 3., 5.5]))
+        assert(calls == [3, 3])
+
+        # Other points
+        fitted = F(testPts_X[1:3],testPts_Y[1:3])
+        assert(numpy.allclose(fitted, [-1., 4.5]))
+
+        # Setting a quantity with it
+        domain.set_quantity('elevation', F, location='centroids')
+        xc = domain.centroid_coordinates[:,0]
+        elev = domain.quantities['elevation'].centroid_values
+        trench = (xc > 40.) & (xc < 60.)
+        assert(numpy.allclose(elev[trench], xc[trench]/10.))
+        assert(numpy.allclose(elev[xc < 40.], -1.))
+        assert(numpy.allclose(elev[xc > 60.], 3.))
+
     def test_quantity_from_Pt_Pol_Data_and_Raster(self):
         # 
         # 
@@ -176,7 +176,7 @@ if myid == 0 and numprocs > 1:
     print 'Broadcast time %.2f seconds' \
         % domain.communication_broadcast_time
 
-    anuga.utilities.sww_merge.sww_merge_parallel(
+    anuga.sww_merge(
         project.scenario,
         np=numprocs, verbose=True, delete_old=True)
 
@@ -54,7 +54,7 @@ def setup_rainfall(domain, project):
             myrain = scipy.interpolate.interp1d(
                 rain_timeseries[:, 0], rain_timeseries[:, 1],
                 kind=interpolation_type)
-            anuga.operators.rate_operators.Rate_operator(
+            anuga.Rate_operator(
                 domain, rate=myrain, polygon=polygon, label=timeseries_file)
 
     return
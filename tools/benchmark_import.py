@@ -0,0 +1,62 @@
+"""Measure the time taken by "import anuga" in a fresh interpreter
+
+The public API in anuga/__init__.py is imported lazily, so importing anuga
+should only cost a fraction of importing the modules a script actually
+uses. Run this script to keep an eye on it, e.g.
+
+    python tools/benchmark_import.py
+    python tools/benchmark_import.py -statement "import anuga; anuga.Domain"
+    python tools/benchmark_import.py -max_time 0.5
+
+It reports the median (and best) wall clock time over a number of
+interpreters and the number of anuga modules that ended up imported.
+With -max_time it exits with status 1 if the median time is larger.
+"""
+
+import sys
+import subprocess
+import argparse
+
+
+def time_import(statement='import anuga', repeats=5):
+    """Time statement in repeats fresh interpreters
+
+    Return (list of times in seconds, number of anuga modules imported)
+    """
+
+    script = 'import time; t0 = time.time(); %s; t1 = time.time(); ' \
+             'import sys; ' \
+             'print t1 - t0, len([m for m in sys.modules ' \
+             'if m.startswith("anuga") and sys.modules[m] is not None])' \
+             % statement
+
+    times = []
+    for i in range(repeats):
+        output = subprocess.check_output([sys.executable, '-c', script])
+        t, n = output.split()[-2:]
+        times.append(float(t))
+
+    return times, int(n)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Time importing anuga')
+    parser.add_argument('-statement', type=str, default='import anuga',
+                        help='statement to time')
+    parser.add_argument('-repeats', type=int, default=5,
+                        help='number of interpreters to time')
+    parser.add_argument('-max_time', type=float, default=None,
+                        help='fail if the median time is larger (seconds)')
+    args = parser.parse_args()
+
+    times, number_of_modules = time_import(args.statement, args.repeats)
+    times.sort()
+    median = times[len(times)/2]
+
+    print '%s: median %.3f s, best %.3f s, %d anuga modules' \
+          % (args.statement, median, times[0], number_of_modules)
+
+    if args.max_time is not None and median > args.max_time:
+        print 'Median time larger than %.3f s' % args.max_time
+        sys.exit(1)
@@ -207,7 +207,7 @@ def outflow_stage_boundary(t):
     return -floodplain_length*floodplain_slope \
             + chan_initial_depth - chan_bankfull_depth
 
-Bout_tmss = anuga.shallow_water.boundaries.Transmissive_momentum_set_stage_boundary(domain, function = outflow_stage_boundary) 
+Bout_tmss = anuga.Transmissive_momentum_set_stage_boundary(domain, function = outflow_stage_boundary) 
 
 domain.set_boundary({'left': Br, 
                      'right': Br, 
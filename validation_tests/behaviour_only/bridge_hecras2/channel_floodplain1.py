@@ -214,7 +214,7 @@ def outflow_stage_boundary(t):
     return -floodplain_length*floodplain_slope \
             + chan_initial_depth - chan_bankfull_depth
 
-Bout_tmss = anuga.shallow_water.boundaries.Transmissive_momentum_set_stage_boundary(domain, function = outflow_stage_boundary) 
+Bout_tmss = anuga.Transmissive_momentum_set_stage_boundary(domain, function = outflow_stage_boundary) 
 
 domain.set_boundary({'left': Br, 
                      'right': Br, 
@@ -251,7 +251,7 @@ barrier()
 # Run sww merge
 if( (myid==0) & (numprocs>1)):
     print 'Merging sww files: ', numprocs, myid
-    anuga.utilities.sww_merge.sww_merge_parallel('channel_floodplain1',np=numprocs,verbose=True,delete_old=True)
+    anuga.sww_merge('channel_floodplain1',np=numprocs,verbose=True,delete_old=True)
 
 barrier()
 finalize()
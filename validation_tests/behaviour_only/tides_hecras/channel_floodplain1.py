@@ -184,7 +184,7 @@ barrier()
 # Run sww merge
 if( (myid==0) & (numprocs>1)):
     print 'Merging sww files: ', numprocs, myid
-    anuga.utilities.sww_merge.sww_merge_parallel(outname,np=numprocs,verbose=True,delete_old=True)
+    anuga.sww_merge(outname,np=numprocs,verbose=True,delete_old=True)
 
 barrier()
 domain=None